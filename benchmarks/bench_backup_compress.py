@@ -0,0 +1,180 @@
+"""Benchmark the compression stage of 'taca backup encrypt --compress'.
+
+Synthetic Illumina, Element and ONT run folders are created in a temporary
+directory, mixing already compressed data (random bytes in cbcl, FASTQ and pod5
+files) with compressible metadata (InterOp, logs, XML, filter and locs files).
+For each run the share of compressible data, and for each codec and number of
+threads the compression ratio and throughput of tar | codec are reported. The
+codec reads the tar stream from a pipe just like in the encryption pipeline,
+gpg is left out so its throughput does not mask the one of the codec.
+
+Usage:
+
+    python benchmarks/bench_backup_compress.py --size-mb 256 --codecs zstd pigz
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+from taca.backup.compression import CODECS, CompressionSettings
+
+RUNS = {
+    "illumina": "20240101_LH00217_0001_A22ABCDLT3",
+    "element": "20240101_AV242106_A2422446225",
+    "ont": "20240101_1200_1A_PAW12345_a1b2c3d4",
+}
+
+# Share of the run size taken by compressible metadata
+METADATA_FRACTION = {"illumina": 0.35, "element": 0.3, "ont": 0.05}
+
+
+def write_random(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+
+def write_metadata(path, size, rng):
+    """Write text or binary records with the redundancy of run metadata."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            if path.endswith((".xml", ".log", ".csv", ".json")):
+                record = (
+                    f"<Tile Lane='{rng.randint(1, 8)}' Number='{rng.randint(1101, 2678)}' "
+                    f"Density='{rng.gauss(2500, 80):.1f}' />\n"
+                ).encode()
+            else:
+                record = rng.randint(0, 3).to_bytes(1, "little") * rng.randint(1, 16)
+                record += rng.randint(0, 1 << 32).to_bytes(8, "little")
+            f.write(record)
+            written += len(record)
+
+
+def make_run(root, platform, size_mb, rng):
+    """Create a synthetic run folder of about 'size_mb' for a platform."""
+    run_path = os.path.join(root, RUNS[platform])
+    size = size_mb * 1024 * 1024
+    metadata = int(size * METADATA_FRACTION[platform])
+    data = size - metadata
+    if platform == "illumina":
+        data_files = [
+            f"Data/Intensities/BaseCalls/L00{lane}/C1.1/L00{lane}_1.cbcl"
+            for lane in range(1, 9)
+        ]
+        metadata_files = [
+            "InterOp/TileMetricsOut.bin",
+            "InterOp/ExtractionMetricsOut.bin",
+            "RunInfo.xml",
+            "Logs/CopyComplete.log",
+            "Data/Intensities/s.locs",
+            "Data/Intensities/BaseCalls/L001/s_1_1101.filter",
+        ]
+    elif platform == "element":
+        data_files = [f"BaseCalls/L{lane}R1.fastq.gz" for lane in (1, 2)]
+        metadata_files = [
+            "BaseCalls/RunStats.json",
+            "RunManifest.csv",
+            "RunParameters.json",
+            "BaseCalls/Metadata/L1_Positions.bin",
+        ]
+    else:
+        data_files = [f"pod5/PAW12345_{i}.pod5" for i in range(4)]
+        metadata_files = ["report_PAW12345.json", "sequencing_summary.log"]
+    for data_file in data_files:
+        write_random(os.path.join(run_path, data_file), data // len(data_files))
+    for metadata_file in metadata_files:
+        write_metadata(
+            os.path.join(run_path, metadata_file),
+            metadata // len(metadata_files),
+            rng,
+        )
+    return run_path
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def compress(run_path, settings):
+    """Pipe the tar stream of a run through the codec, return the number of
+    compressed bytes and the wall time."""
+    start = time.monotonic()
+    tar = subprocess.Popen(
+        [
+            "tar",
+            "-C",
+            os.path.dirname(run_path),
+            "-cf",
+            "-",
+            os.path.basename(run_path),
+        ],
+        stdout=subprocess.PIPE,
+    )
+    codec = subprocess.Popen(
+        settings.compress_cmd(), stdin=tar.stdout, stdout=subprocess.PIPE
+    )
+    tar.stdout.close()
+    compressed = 0
+    for chunk in iter(lambda: codec.stdout.read(4 * 1024 * 1024), b""):
+        compressed += len(chunk)
+    codec.wait()
+    tar.wait()
+    return compressed, time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--codecs", nargs="+", default=["zstd"], choices=CODECS)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        help="Thread counts to compare, defaults to 1, 2, 4 ... up to the number of cores",
+    )
+    args = parser.parse_args()
+    cores = os.cpu_count()
+    threads = args.threads or sorted(
+        {min(2**i, cores) for i in range(cores.bit_length() + 1)}
+    )
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"{cores} cores available")
+        print(
+            f"{'platform':<10}{'compressible':>13}{'codec':>7}{'threads':>9}"
+            f"{'ratio':>8}{'wall (s)':>10}{'MB/s':>9}"
+        )
+        for platform in RUNS:
+            run_path = make_run(root, platform, args.size_mb, rng)
+            run_size = dir_size(run_path)
+            for codec in args.codecs:
+                for n_threads in threads:
+                    settings = CompressionSettings(
+                        {"codec": codec, "threads": n_threads}
+                    )
+                    fraction = settings.compressible_fraction(
+                        (f, os.path.getsize(os.path.join(dirpath, f)))
+                        for dirpath, _, files in os.walk(run_path)
+                        for f in files
+                    )
+                    compressed, wall = compress(run_path, settings)
+                    print(
+                        f"{platform:<10}{fraction:>13.0%}{codec:>7}{n_threads:>9}"
+                        f"{run_size / compressed:>8.2f}{wall:>10.2f}"
+                        f"{run_size / 1e6 / wall:>9.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
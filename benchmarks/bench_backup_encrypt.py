@@ -0,0 +1,133 @@
+"""Benchmark the legacy and streaming encryption pipelines of 'taca backup encrypt'.
+
+A synthetic run folder is created in a temporary directory and encrypted with
+both pipelines. For each mode the wall time and the bytes read and written by
+the pipeline stages are reported. The byte counts are derived from the sizes of
+the files each stage consumes and produces, since the work is done by child
+processes whose I/O counters are not available once they have exited.
+
+Usage:
+
+    python benchmarks/bench_backup_encrypt.py --size-mb 512 --files 2000
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from taca.utils import filesystem
+from taca.utils.config import CONFIG
+
+RUN_NAME = "20240101_LH00217_0001_A22ABCDLT3"
+
+
+def make_run(root, size_mb, n_files):
+    """Create a run folder holding 'n_files' random files of 'size_mb' in total."""
+    run_path = os.path.join(root, RUN_NAME)
+    file_size = max(1, size_mb * 1024 * 1024 // n_files)
+    for i in range(n_files):
+        lane_dir = os.path.join(
+            run_path, "Data", "Intensities", "BaseCalls", f"L00{i % 8 + 1}"
+        )
+        os.makedirs(lane_dir, exist_ok=True)
+        with open(os.path.join(lane_dir, f"C{i}.1.cbcl"), "wb") as f:
+            f.write(os.urandom(file_size))
+    for indicator in ["RTAComplete.txt", "CopyComplete.txt"]:
+        open(os.path.join(run_path, indicator), "w").close()
+    return run_path
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def run_legacy(bk, run):
+    """tar to disk, md5sum, gpg, then gpg --decrypt | md5sum."""
+    exclude_files = " ".join([f"--exclude {x}" for x in bk.exclude_list])
+    bk._call_commands(cmd1=f"tar {exclude_files} -cf - {run.name}", out_file=run.tar)
+    _, md5_pre = bk._call_commands(cmd1=f"md5sum {run.tar}", return_out=True)
+    bk._call_commands(
+        cmd1=(
+            f"gpg --symmetric --cipher-algo aes256 --passphrase-file {run.key} --batch --compress-algo "
+            f"none -o {run.tar_encrypted} {run.tar}"
+        )
+    )
+    _, md5_post = bk._call_commands(
+        cmd1=f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch {run.tar_encrypted}",
+        cmd2="md5sum",
+        return_out=True,
+    )
+    assert md5_pre.split()[0] == md5_post.split()[0]
+    tar_size = os.path.getsize(run.tar)
+    enc_size = os.path.getsize(run.tar_encrypted)
+    # tar reads the run, md5sum and gpg read the tarball, the check reads the
+    # encrypted file
+    read = dir_size(run.name) + 2 * tar_size + enc_size
+    written = tar_size + enc_size
+    return read, written, tar_size + enc_size
+
+
+def run_stream(bk, run):
+    """tar | md5 | gpg in one pass, then a streamed decrypt check."""
+    md5_pre = bk._stream_encrypt(run)
+    md5_post = bk._stream_decrypted_digest(run)
+    assert md5_pre and md5_pre == md5_post
+    enc_size = os.path.getsize(run.tar_encrypted)
+    read = dir_size(run.name) + enc_size
+    return read, enc_size, enc_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--files", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        CONFIG.update(
+            {
+                "mail": {"recipients": None},
+                "backup": {
+                    "data_dirs": {},
+                    "archive_dirs": {"NovaSeqXPlus": root},
+                    "archived_dirs": {},
+                    "exclude_list": [],
+                    "keys_path": root,
+                    "gpg_receiver": None,
+                    "archive_log": os.path.join(root, "archived.tsv"),
+                },
+            }
+        )
+        from taca.backup.backup import backup_utils, run_vars
+
+        run_path = make_run(root, args.size_mb, args.files)
+        bk = backup_utils(run_path)
+        run = run_vars(run_path, root)
+        with filesystem.chdir(root):
+            subprocess.check_call(
+                ["gpg", "--gen-random", "1", "256"], stdout=open(run.key, "wb")
+            )
+            print(
+                f"Synthetic run: {args.files} files, {dir_size(RUN_NAME) / 1e6:.1f} MB"
+            )
+            print(
+                f"{'mode':<8}{'wall (s)':>10}{'read (MB)':>12}{'written (MB)':>14}{'scratch (MB)':>14}"
+            )
+            for mode, pipeline in [("legacy", run_legacy), ("stream", run_stream)]:
+                start = time.monotonic()
+                read, written, scratch = pipeline(bk, run)
+                wall = time.monotonic() - start
+                print(
+                    f"{mode:<8}{wall:>10.2f}{read / 1e6:>12.1f}{written / 1e6:>14.1f}{scratch / 1e6:>14.1f}"
+                )
+                bk._clean_tmp_files([run.tar, run.tar_encrypted, run.tar_digest])
+
+
+if __name__ == "__main__":
+    main()
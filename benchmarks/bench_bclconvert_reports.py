@@ -0,0 +1,246 @@
+"""Benchmark the aggregation of the reports of several sub-demultiplexings.
+
+A synthetic run has lanes demultiplexed several times with their own samples,
+each sub-demultiplexing writing the CSV reports of bclconvert. The reports
+are aggregated the way Runs._fix_html_reports_for_complex_lanes does, parsing
+the lane.html and laneBarcode.html of every sub-demultiplexing with an HTML
+parser, as LaneBarcodeParser does, and rewriting merged ones, and with
+DemuxReports, merging the CSV reports, writing them and rendering the HTML
+from them. The clusters per lane of both are checked to be the same before
+their timings and peak memory are reported. The HTML reports of the
+sub-demultiplexings are rendered beforehand, outside of the timings, and the
+peak memory is traced in a second run, as tracing slows the first down.
+
+Usage:
+
+    python benchmarks/bench_bclconvert_reports.py --lanes 8 --samples 384 --demuxes 3
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from html.parser import HTMLParser
+
+from taca.illumina.bclconvert_reports import DemuxReports, write_lane_html
+
+
+class TableParser(HTMLParser):
+    """Collect the cells of the rows of each table of an HTML report."""
+
+    def __init__(self):
+        super().__init__()
+        self.tables = []
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self.tables.append([])
+        elif tag == "tr":
+            self.tables[-1].append([])
+        elif tag in ("th", "td"):
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if tag in ("th", "td"):
+            self.tables[-1][-1].append("".join(self.cell).strip())
+            self.cell = None
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def index(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def write_demux(rng, demux_dir, n_lanes, n_samples, index_length):
+    reports_dir = os.path.join(demux_dir, "Reports")
+    os.makedirs(reports_dir)
+    stats = [
+        "Lane,SampleID,Sample_Project,Index,# Reads,# Perfect Index Reads,"
+        "# One Mismatch Index Reads,# Two Mismatch Index Reads,% Reads,"
+        "% Perfect Index Reads,% One Mismatch Index Reads,% Two Mismatch Index Reads"
+    ]
+    quality = [
+        "Lane,SampleID,index,index2,ReadNumber,Yield,YieldQ30,QualityScoreSum,"
+        "Mean Quality Score (PF),% Q30"
+    ]
+    unknown = ["Lane,index,index2,# Reads,% of Unknown Barcodes,% of All Reads"]
+    for lane in range(1, n_lanes + 1):
+        samples = [
+            (f"P{lane}_{index_length}{i:03}", index(rng, index_length))
+            for i in range(n_samples)
+        ]
+        samples.append(("Undetermined", ""))
+        for sample, idx in samples:
+            reads = rng.randint(100_000, 2_000_000)
+            perfect = reads * 9 // 10 if idx else 0
+            mismatch = reads - perfect if idx else 0
+            project = f"P{lane}" if idx else ""
+            stats.append(
+                f"{lane},{sample},{project},{idx}-{idx},{reads},{perfect},"
+                f"{mismatch},0,0.01,0.9,0.1,0"
+            )
+            for read in (1, 2):
+                quality.append(
+                    f"{lane},{sample},{idx},{idx},{read},{reads * 151},"
+                    f"{reads * 130},{reads * 151 * 36},36.00,0.86"
+                )
+        for _ in range(1000):
+            unknown.append(
+                f"{lane},{index(rng, 10)},{index(rng, 10)},"
+                f"{rng.randint(1, 100_000)},0.001,0.0001"
+            )
+    for name, lines in [
+        ("Demultiplex_Stats.csv", stats),
+        ("Quality_Metrics.csv", quality),
+        ("Top_Unknown_Barcodes.csv", unknown),
+    ]:
+        with open(os.path.join(reports_dir, name), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    # Stand-in of the legacy reports of bclconvert
+    DemuxReports.read(demux_dir).write_html(os.path.join(reports_dir, "html"))
+
+
+def parse_html(html_file):
+    """Read flowcell_data and sample_data the way LaneBarcodeParser does."""
+    parser = TableParser()
+    with open(html_file) as f:
+        parser.feed(f.read())
+    flowcell_data = dict(zip(*parser.tables[1]))
+    header, *rows = parser.tables[2]
+    sample_data = [dict(zip(header, row)) for row in rows]
+    return flowcell_data, sample_data
+
+
+def legacy_aggregation(html_dirs, complex_lanes, out_dir):
+    """The merge of the HTML reports of the sub-demultiplexings of
+    Runs._fix_html_reports_for_complex_lanes, returning the clusters of the
+    samples of each lane.
+    """
+    lane_flowcell_data, lane_data = None, []
+    for html_dir in html_dirs:
+        next_flowcell_data, next_lane_data = parse_html(
+            os.path.join(html_dir, "lane.html")
+        )
+        lane_flowcell_data = lane_flowcell_data or next_flowcell_data
+        lanes = [entry["Lane"] for entry in lane_data]
+        lane_data.extend(
+            entry for entry in next_lane_data if entry["Lane"] not in lanes
+        )
+    for entry in lane_data:
+        if entry["Lane"] in complex_lanes:
+            entry["% Perfectbarcode"] = None
+            entry["% One mismatchbarcode"] = None
+    write_lane_html(os.path.join(out_dir, "lane.html"), lane_flowcell_data, lane_data)
+
+    flowcell_data, sample_data = None, []
+    for html_dir in html_dirs:
+        html_file = os.path.join(html_dir, "laneBarcode.html")
+        next_flowcell_data, next_sample_data = parse_html(html_file)
+        flowcell_data = flowcell_data or next_flowcell_data
+        sample_data.extend(next_sample_data)
+    summary = dict()
+    modified_complex_lanes = []
+    for entry in sample_data[:]:
+        if entry["Lane"] in complex_lanes and entry["Project"] == "default":
+            if entry["Lane"] in modified_complex_lanes:
+                sample_data.remove(entry)
+                continue
+            modified_complex_lanes.append(entry["Lane"])
+        lane = summary.setdefault(entry["Lane"], {"total": 0, "samples": 0})
+        clusters = int(entry["PF Clusters"].replace(",", ""))
+        lane["total"] += clusters
+        if entry["Project"] != "default":
+            lane["samples"] += clusters
+    sample_data.sort(key=lambda k: (k["Lane"].lower(), k["Sample"]))
+    write_lane_html(
+        os.path.join(out_dir, "laneBarcode.html"), flowcell_data, sample_data
+    )
+    return {lane: value["samples"] for lane, value in summary.items()}
+
+
+def native_aggregation(demux_dirs, complex_lanes, out_dir):
+    """Merge the CSV reports with DemuxReports, returning the clusters of the
+    samples of each lane."""
+    merged = DemuxReports.merge(
+        {
+            str(demux_id): DemuxReports.read(demux_dir, str(demux_id))
+            for demux_id, demux_dir in enumerate(demux_dirs)
+        },
+        simple_lanes={},
+        complex_lanes=complex_lanes,
+    )
+    merged.write(out_dir)
+    merged.write_html(os.path.join(out_dir, "html"), complex_lanes=complex_lanes)
+    return {
+        lane: value["total_sample_cluster"]
+        for lane, value in merged.lane_summary().items()
+    }
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lanes", type=int, default=8)
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=384,
+        help="Samples per lane and sub-demultiplexing",
+    )
+    parser.add_argument("--demuxes", type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        demux_dirs = []
+        for demux_id in range(args.demuxes):
+            demux_dir = os.path.join(run_dir, f"Demultiplexing_{demux_id}")
+            write_demux(rng, demux_dir, args.lanes, args.samples, 6 + 2 * demux_id)
+            demux_dirs.append(demux_dir)
+        complex_lanes = {str(lane): {"0": [6, 6]} for lane in range(1, args.lanes + 1)}
+        html_dirs = [
+            os.path.join(demux_dir, "Reports", "html") for demux_dir in demux_dirs
+        ]
+        for name in ("legacy", "native"):
+            os.makedirs(os.path.join(run_dir, name))
+
+        legacy, legacy_time, legacy_peak = measure(
+            legacy_aggregation,
+            html_dirs,
+            complex_lanes,
+            os.path.join(run_dir, "legacy"),
+        )
+        native, native_time, native_peak = measure(
+            native_aggregation,
+            demux_dirs,
+            complex_lanes,
+            os.path.join(run_dir, "native"),
+        )
+        assert legacy == native, "results differ"
+
+    print(f"{'':>8}{'time (ms)':>12}{'peak (MiB)':>12}")
+    for name, elapsed, peak in [
+        ("legacy", legacy_time, legacy_peak),
+        ("native", native_time, native_peak),
+    ]:
+        print(f"{name:>8}{elapsed * 1000:>12.1f}{peak / 2**20:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Benchmark the grouping of samples into sub-demultiplexings.
+
+A synthetic sample table, as made from the sample sheet of a run, is grouped
+into sub-demultiplexings the way Standard_Run.demultiplex_run used to, by
+scanning the whole table once per sample type and again once per
+sub-demultiplexing, and with DemuxPlan, in a single pass. Both groupings are
+checked to be the same before their timings are reported.
+
+Usage:
+
+    python benchmarks/bench_demux_plan.py --samples 10000 --lanes 8
+"""
+
+import argparse
+import random
+import time
+
+from taca.illumina.demux_plan import DemuxPlan
+
+# Sample type -> index, UMI and read lengths seen on a flowcell
+MASKS = {
+    "ordinary": [([8, 8], [0, 0], [151, 151]), ([10, 10], [0, 0], [151, 151])],
+    "short_single_index": [([6, 0], [0, 0], [151, 151])],
+    "IDT_UMI": [([8, 8], [9, 0], [151, 151])],
+    "10X_DUAL": [([10, 10], [0, 0], [28, 90])],
+    "SMARTSEQ": [([8, 8], [0, 0], [151, 151])],
+}
+
+
+def make_sample_table(samples, lanes, rng):
+    sample_table = dict()
+    for i in range(samples):
+        lane = str(rng.randint(1, lanes))
+        sample_type = rng.choices(list(MASKS), weights=[70, 5, 10, 10, 5])[0]
+        index_length, umi_length, read_length = rng.choice(MASKS[sample_type])
+        sample_table.setdefault(lane, []).append(
+            (
+                f"P{1000 + i % 50}_{i}",
+                {
+                    "sample_type": sample_type,
+                    "index_length": list(index_length),
+                    "umi_length": list(umi_length),
+                    "read_length": list(read_length),
+                },
+            )
+        )
+    return sample_table
+
+
+def legacy_plan(software, sample_table):
+    """The grouping of demultiplex_run before DemuxPlan, without the logging."""
+    sub_demuxes = []
+    sample_type_list = []
+    for lane_contents in sample_table.values():
+        for _, detail in lane_contents:
+            if detail["sample_type"] not in sample_type_list:
+                sample_type_list.append(detail["sample_type"])
+    for sample_type in sorted(sample_type_list):
+        lane_table = dict()
+        for lane, lane_contents in sample_table.items():
+            for _, detail in lane_contents:
+                mask = (
+                    detail["index_length"],
+                    detail["umi_length"],
+                    detail["read_length"],
+                )
+                if detail["sample_type"] == sample_type:
+                    if mask not in lane_table.setdefault(lane, []):
+                        lane_table[lane].append(mask)
+        if software == "bcl2fastq":
+            n = len(max(lane_table.values(), key=len))
+        else:
+            unique_masks = []
+            for masks in lane_table.values():
+                for mask in masks:
+                    if mask not in unique_masks:
+                        unique_masks.append(mask)
+            n = len(unique_masks)
+        for i in range(n):
+            samples_to_include = dict()
+            mask_table = dict()
+            for lane, lane_contents in sample_table.items():
+                if software == "bcl2fastq":
+                    if i >= len(lane_table.get(lane, [])):
+                        continue
+                    mask = lane_table[lane][i]
+                else:
+                    mask = unique_masks[i]
+                    if mask not in lane_table.get(lane, []):
+                        continue
+                mask_table[lane] = mask
+                for sample_name, detail in lane_contents:
+                    if (
+                        detail["sample_type"] == sample_type
+                        and detail["index_length"] == mask[0]
+                        and detail["umi_length"] == mask[1]
+                        and detail["read_length"] == mask[2]
+                    ):
+                        samples_to_include.setdefault(lane, []).append(sample_name)
+            sub_demuxes.append((sample_type, mask_table, samples_to_include))
+    return sub_demuxes
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--lanes", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    sample_table = make_sample_table(args.samples, args.lanes, random.Random(42))
+
+    print(f"{'software':<12}{'sub-demuxes':>12}{'legacy (ms)':>13}{'plan (ms)':>11}")
+    for software in ["bcl2fastq", "bclconvert"]:
+        legacy, legacy_time = timed(
+            lambda: legacy_plan(software, sample_table), args.repeat
+        )
+        plan, plan_time = timed(
+            lambda: DemuxPlan.from_sample_table("run", software, sample_table),
+            args.repeat,
+        )
+        assert [
+            (
+                sub_demux["sample_type"],
+                {lane: tuple(mask) for lane, mask in sub_demux["mask_table"].items()},
+                sub_demux["samples"],
+            )
+            for sub_demux in plan.sub_demuxes
+        ] == legacy, f"{software} plans differ"
+        print(
+            f"{software:<12}{len(legacy):>12}{legacy_time * 1000:>13.1f}"
+            f"{plan_time * 1000:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
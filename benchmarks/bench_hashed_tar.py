@@ -0,0 +1,128 @@
+"""Benchmark checksumming tar archives while they are written.
+
+A synthetic run folder is tarred the way transfer_runfolder and
+NanoporeFlowcell.organise_data used to, writing the archive then running
+md5sum over it, and with hashed_tar.write_archive, which computes the md5
+of the tar stream on its way to the archive. Both are run with GNU tar and
+with the read-ahead writer. The checksum files are checked to be the same
+before the timings and the bytes read back from disk are reported.
+
+Reading the archive back costs a full pass over it only when it is no
+longer in the page cache, as for archives larger than the memory of the
+host, or when caches are dropped: they are before each pass if the
+benchmark runs as root.
+
+Usage:
+
+    python benchmarks/bench_hashed_tar.py --dir /mnt/nfs/tmp --files 2000 --file-kb 1024
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from taca.utils import hashed_tar, parallel_tar
+
+RUN_NAME = "20261018_PAW12345_1A_0c1f2e3d"
+
+
+def make_run(root, n_files, file_kb):
+    run_path = os.path.join(root, RUN_NAME)
+    for i in range(n_files):
+        pod5_dir = os.path.join(run_path, "pod5", f"barcode{i % 24:02}")
+        os.makedirs(pod5_dir, exist_ok=True)
+        with open(os.path.join(pod5_dir, f"reads_{i}.pod5"), "wb") as f:
+            f.write(os.urandom(file_kb * 1024))
+    return run_path
+
+
+def drop_caches():
+    """Drop the page cache, return whether it was possible."""
+    if os.geteuid() != 0:
+        return False
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+    return True
+
+
+def legacy(run_path, archive, workers):
+    """Tar then md5sum, as before."""
+    if workers:
+        parallel_tar.write_tar(archive, run_path, workers=workers)
+    else:
+        subprocess.run(
+            [
+                "tar",
+                "-cf",
+                archive,
+                "-C",
+                os.path.dirname(run_path),
+                os.path.basename(run_path),
+            ],
+            check=True,
+        )
+    drop_caches()
+    with open(f"{archive}.md5", "w") as f:
+        subprocess.run(
+            ["md5sum", os.path.basename(archive)],
+            cwd=os.path.dirname(archive),
+            stdout=f,
+            check=True,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="Directory to create the run in")
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--file-kb", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        run_path = make_run(root, args.files, args.file_kb)
+        archive = os.path.join(root, "run.tar")
+        passes = []
+        for tar_name, workers in [("GNU tar", None), ("read-ahead", args.workers)]:
+            passes.append(
+                (
+                    f"{tar_name} + md5sum",
+                    lambda workers=workers: legacy(run_path, archive, workers),
+                )
+            )
+            passes.append(
+                (
+                    f"{tar_name} hashed",
+                    lambda workers=workers: hashed_tar.write_archive(
+                        archive, run_path, workers=workers, stderr=subprocess.DEVNULL
+                    ),
+                )
+            )
+        print(f"Synthetic run: {args.files} files of {args.file_kb} kB")
+        print(f"{'writer':<24}{'wall (s)':>10}{'read back (MB)':>16}  cold cache")
+        checksums = dict()
+        for name, write in passes:
+            cold = drop_caches()
+            start = time.monotonic()
+            write()
+            wall = time.monotonic() - start
+            read_back = os.path.getsize(archive) / 1e6 if "md5sum" in name else 0
+            print(
+                f"{name:<24}{wall:>10.2f}{read_back:>16.1f}  {'yes' if cold else 'no'}"
+            )
+            with open(f"{archive}.md5") as f:
+                checksums[name] = f.read()
+            os.remove(archive)
+        assert checksums["GNU tar + md5sum"] == checksums["GNU tar hashed"], (
+            "md5 files of GNU tar differ"
+        )
+        assert checksums["read-ahead + md5sum"] == checksums["read-ahead hashed"], (
+            "md5 files of the read-ahead writer differ"
+        )
+
+
+if __name__ == "__main__":
+    main()
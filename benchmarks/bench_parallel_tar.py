@@ -0,0 +1,133 @@
+"""Benchmark the read-ahead tar writer against GNU tar on many small files.
+
+A synthetic run folder with many small files, like the cbcl, filter and locs
+files and thumbnails of a NovaSeq or Element run, is created and tarred with
+GNU tar, with tarfile adding one file at a time and with the read-ahead writer
+for a range of worker counts. For each the wall time, files per second and
+throughput are reported, and the archives of tarfile and the read-ahead
+writer are checked to be identical.
+
+The gain comes from hiding the latency of opening and reading each file, so
+the benchmark is only meaningful on the file system the runs live on, e.g.
+an NFS mount given with --dir, and with cold caches. The page cache is
+dropped before each pass if the benchmark runs as root, otherwise every
+pass after the first reads from the cache.
+
+Usage:
+
+    python benchmarks/bench_parallel_tar.py --dir /mnt/nfs/tmp --files 100000
+"""
+
+import argparse
+import hashlib
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from taca.utils import parallel_tar
+
+RUN_NAME = "20240101_LH00217_0001_A22ABCDLT3"
+
+
+def make_run(root, n_files, file_kb):
+    """Create a run folder holding 'n_files' files of about 'file_kb' each."""
+    run_path = os.path.join(root, RUN_NAME)
+    for i in range(n_files):
+        tile_dir = os.path.join(
+            run_path,
+            "Data",
+            "Intensities",
+            "BaseCalls",
+            f"L00{i % 8 + 1}",
+            f"C{i // 8 % 300 + 1}.1",
+        )
+        os.makedirs(tile_dir, exist_ok=True)
+        with open(os.path.join(tile_dir, f"s_{i % 8 + 1}_{i}.filter"), "wb") as f:
+            f.write(os.urandom(file_kb * 1024))
+    return run_path
+
+
+def drop_caches():
+    """Drop the page cache, return whether it was possible."""
+    if os.geteuid() != 0:
+        return False
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+    return True
+
+
+def gnu_tar(run_path, archive):
+    subprocess.run(
+        [
+            "tar",
+            "--sort=name",
+            "-C",
+            os.path.dirname(run_path),
+            "-cf",
+            archive,
+            os.path.basename(run_path),
+        ],
+        check=True,
+    )
+
+
+def sequential_tarfile(run_path, archive):
+    with tarfile.open(archive, "w", format=tarfile.GNU_FORMAT) as tar:
+        tar.add(run_path, arcname=os.path.basename(run_path))
+
+
+def md5(path):
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="Directory to create the run in")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--file-kb", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        run_path = make_run(root, args.files, args.file_kb)
+        archive = os.path.join(root, "run.tar")
+        size_mb = args.files * args.file_kb / 1024
+        passes = [("GNU tar", lambda: gnu_tar(run_path, archive))]
+        passes.append(("tarfile", lambda: sequential_tarfile(run_path, archive)))
+        for workers in args.workers:
+            passes.append(
+                (
+                    f"read-ahead {workers}",
+                    lambda workers=workers: parallel_tar.write_tar(
+                        archive, run_path, workers=workers
+                    ),
+                )
+            )
+        print(f"Synthetic run: {args.files} files, {size_mb:.1f} MB")
+        print(f"{'writer':<16}{'wall (s)':>10}{'files/s':>10}{'MB/s':>8}  cold cache")
+        reference = None
+        for name, write in passes:
+            cold = drop_caches()
+            start = time.monotonic()
+            write()
+            wall = time.monotonic() - start
+            print(
+                f"{name:<16}{wall:>10.2f}{args.files / wall:>10.0f}"
+                f"{size_mb / wall:>8.1f}  {'yes' if cold else 'no'}"
+            )
+            if name == "tarfile":
+                reference = md5(archive)
+            elif name != "GNU tar":
+                assert md5(archive) == reference, f"{name} archive differs from tarfile"
+            os.remove(archive)
+
+
+if __name__ == "__main__":
+    main()
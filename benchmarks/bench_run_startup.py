@@ -0,0 +1,184 @@
+"""Benchmark the startup of the Run objects of a data directory.
+
+A synthetic data directory has run folders with RunInfo.xml,
+runParameters.xml, a sample sheet and the Stats.json of their
+demultiplexing. Building the Run of each, as get_runObj does, used to parse
+all of them with RunParser, when starting up needs the read configuration
+and the sample sheet only. Startup is timed with a parser parsing everything
+when built, as RunParser, and with LazyRunParser, without a cache, with an
+empty one and with the one the previous startup left. The parsers are
+stand-ins of those of flowcell_parser, on ElementTree, csv and json. The
+read configuration and sample sheet of the runs are checked to be the same
+before the timings are reported.
+
+Usage:
+
+    python benchmarks/bench_run_startup.py --runs 200 --samples 384
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+import types
+from xml.etree import ElementTree
+
+from taca.illumina.run_parser import LazyRunParser
+
+
+class XmlParser:
+    def __init__(self, path):
+        self.data = ElementTree.parse(path).getroot()
+
+    def get_read_configuration(self):
+        return [dict(read.attrib) for read in self.data.iter("Read")]
+
+
+class SampleSheetParser:
+    def __init__(self, path):
+        with open(path) as f:
+            self.data = list(csv.DictReader(f))
+
+
+class RunParser:
+    """Parse every file of a run when built."""
+
+    def __init__(self, path):
+        self.path = path
+        self.runinfo = XmlParser(os.path.join(path, "RunInfo.xml"))
+        self.runparameters = XmlParser(os.path.join(path, "runParameters.xml"))
+        self.samplesheet = SampleSheetParser(os.path.join(path, "SampleSheet.csv"))
+        with open(os.path.join(path, "Demultiplexing", "Stats", "Stats.json")) as f:
+            self.json_stats = json.load(f)
+        self.obj = {
+            "name": os.path.basename(path),
+            "samplesheet_csv": self.samplesheet.data,
+            "Stats": self.json_stats,
+        }
+
+
+CLASSES = types.SimpleNamespace(
+    RunInfoParser=XmlParser,
+    RunParametersParser=XmlParser,
+    SampleSheetParser=SampleSheetParser,
+    RunParser=RunParser,
+)
+
+
+def index(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def write_run(rng, run_dir, n_samples):
+    os.makedirs(os.path.join(run_dir, "Demultiplexing", "Stats"))
+    with open(os.path.join(run_dir, "RunInfo.xml"), "w") as f:
+        f.write(
+            '<?xml version="1.0"?>\n<RunInfo><Run><Reads>'
+            '<Read Number="1" NumCycles="151" IsIndexedRead="N"/>'
+            '<Read Number="2" NumCycles="10" IsIndexedRead="Y"/>'
+            '<Read Number="3" NumCycles="10" IsIndexedRead="Y"/>'
+            '<Read Number="4" NumCycles="151" IsIndexedRead="N"/>'
+            "</Reads></Run></RunInfo>\n"
+        )
+    with open(os.path.join(run_dir, "runParameters.xml"), "w") as f:
+        f.write('<?xml version="1.0"?>\n<RunParameters>')
+        f.write("<InstrumentType>NovaSeqXPlus</InstrumentType>")
+        # Consumables, reagents and the like make up most of the file
+        for i in range(500):
+            f.write(
+                f"<Setting><Name>S{i}</Name><Value>{index(rng, 20)}</Value></Setting>"
+            )
+        f.write("</RunParameters>\n")
+    lanes = range(1, 9)
+    with open(os.path.join(run_dir, "SampleSheet.csv"), "w") as f:
+        f.write("Lane,Sample_ID,Sample_Name,index,index2,Sample_Project\n")
+        for lane in lanes:
+            for i in range(n_samples // 8):
+                f.write(
+                    f"{lane},P1_{lane}{i:03},P1_{lane}{i:03},"
+                    f"{index(rng, 10)},{index(rng, 10)},P1\n"
+                )
+    with open(os.path.join(run_dir, "Demultiplexing", "Stats", "Stats.json"), "w") as f:
+        json.dump(
+            {
+                "ConversionResults": [
+                    {
+                        "LaneNumber": lane,
+                        "DemuxResults": [
+                            {
+                                "SampleId": f"P1_{lane}{i:03}",
+                                "NumberReads": rng.randint(0, 10**7),
+                            }
+                            for i in range(n_samples)
+                        ],
+                    }
+                    for lane in lanes
+                ],
+                "UnknownBarcodes": [
+                    {
+                        "Lane": lane,
+                        "Barcodes": {
+                            f"{index(rng, 10)}+{index(rng, 10)}": rng.randint(1, 10**5)
+                            for _ in range(1000)
+                        },
+                    }
+                    for lane in lanes
+                ],
+            },
+            f,
+        )
+
+
+def startup(run_dirs, make_parser):
+    """Build the parser of each run and read what a Run reads when built."""
+    start = time.perf_counter()
+    runs = []
+    for run_dir in run_dirs:
+        parser = make_parser(run_dir)
+        runs.append((parser.runinfo.get_read_configuration(), parser.samplesheet.data))
+    return runs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=384, help="Samples per run")
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        run_dirs = []
+        for i in range(args.runs):
+            run_dir = os.path.join(data_dir, f"20261018_LH00001_{i:04}_A22FLOWCELL")
+            write_run(rng, run_dir, args.samples)
+            run_dirs.append(run_dir)
+        cache_dir = os.path.join(data_dir, "parser_cache")
+
+        results = dict()
+        for name, make_parser in [
+            ("eager", RunParser),
+            ("lazy", lambda run_dir: LazyRunParser(run_dir, classes=CLASSES)),
+            (
+                "lazy (cold cache)",
+                lambda run_dir: LazyRunParser(run_dir, cache_dir, classes=CLASSES),
+            ),
+            (
+                "lazy (warm cache)",
+                lambda run_dir: LazyRunParser(run_dir, cache_dir, classes=CLASSES),
+            ),
+        ]:
+            results[name] = startup(run_dirs, make_parser)
+        assert all(runs == results["eager"][0] for runs, _ in results.values()), (
+            "results differ"
+        )
+
+    print(f"{'':>18}{'time (s)':>10}")
+    for name, (_, elapsed) in results.items():
+        print(f"{name:>18}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Benchmark the merge of the Stats.json of sub-demultiplexings.
+
+A synthetic run has lanes demultiplexed several times, with the Stats.json of
+every sub-demultiplexing holding the metrics of its samples and a large map
+of unknown barcodes per lane. They are merged the way
+Runs._fix_demultiplexingstats_xml_dir used to, loading all of them with
+json.load and writing the result with one json.dump, and with merge_stats,
+one lane at a time, keeping all unknown barcodes and the top ones only. Each
+merge runs in a process of its own, to report its peak RSS. The merged files
+of the previous merge and of merge_stats keeping all unknown barcodes are
+checked to be the same before the timings are reported.
+
+Usage:
+
+    python benchmarks/bench_stats_json.py --lanes 8 --samples 1536 --barcodes 100000 --demuxes 3
+"""
+
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from taca.illumina.stats_json import TOP_UNKNOWN_BARCODES, merge_stats
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+from taca.utils.misc import peak_rss_mib
+
+
+def index(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def read_metrics(rng):
+    return [
+        {
+            "ReadNumber": read,
+            "Yield": rng.randint(0, 10**9),
+            "YieldQ30": rng.randint(0, 10**9),
+            "QualityScoreSum": rng.randint(0, 10**10),
+            "TrimmedBases": 0,
+        }
+        for read in (1, 2)
+    ]
+
+
+def write_stats(rng, stat_json, lanes, n_samples, n_barcodes, demux_id):
+    """Write the Stats.json of a sub-demultiplexing, one lane at a time."""
+    with open(stat_json, "w") as f:
+        f.write(
+            '{"Flowcell": "HFLOWCELL", "RunNumber": 42, '
+            '"RunId": "20261018_LH00001_0042_AHFLOWCELL", "ReadInfosForLanes": '
+        )
+        json.dump(
+            [{"LaneNumber": lane, "ReadInfos": [{"Number": 1}]} for lane in lanes], f
+        )
+        f.write(', "ConversionResults": [')
+        for i, lane in enumerate(lanes):
+            entry = {
+                "LaneNumber": lane,
+                "TotalClustersPF": rng.randint(0, 10**9),
+                "DemuxResults": [
+                    {
+                        "SampleId": f"P{lane}_{demux_id}{sample:04}",
+                        "IndexMetrics": [{"IndexSequence": index(rng, 10)}],
+                        "NumberReads": rng.randint(0, 10**7),
+                        "ReadMetrics": read_metrics(rng),
+                    }
+                    for sample in range(n_samples)
+                ],
+                "Undetermined": {
+                    "NumberReads": rng.randint(0, 10**7),
+                    "ReadMetrics": read_metrics(rng),
+                },
+            }
+            f.write((", " if i else "") + json.dumps(entry))
+        f.write('], "UnknownBarcodes": [')
+        for i, lane in enumerate(lanes):
+            barcodes = {
+                f"{index(rng, 10)}+{index(rng, 10)}": rng.randint(1, 10**6)
+                for _ in range(n_barcodes)
+            }
+            f.write(
+                (", " if i else "") + json.dumps({"Lane": lane, "Barcodes": barcodes})
+            )
+        f.write("]}")
+
+
+def legacy_merge(stats_json, stats_file, simple_lanes, complex_lanes, number_reads):
+    """The merge of _fix_demultiplexingstats_xml_dir before it streamed."""
+    stats_list = {}
+    lanes_to_update = dict()
+    compared_idx1 = None
+    for stat_json in stats_json:
+        demux_id = stat_json.split("Demultiplexing_")[1][0]
+        with open(stat_json) as f:
+            data = json.load(f)
+        if len(stats_list) == 0:
+            for key in ["RunNumber", "Flowcell", "RunId", "ConversionResults"]:
+                stats_list[key] = data[key]
+            stats_list["ReadInfosForLanes"] = data["ReadInfosForLanes"]
+            stats_list["UnknownBarcodes"] = []
+            for entry in stats_list["ConversionResults"]:
+                lanes_to_update.setdefault(entry["LaneNumber"], entry)
+        else:
+            lanes_present = [
+                entry["LaneNumber"] for entry in stats_list["ConversionResults"]
+            ]
+            for read_infos in data["ReadInfosForLanes"]:
+                if read_infos["LaneNumber"] not in lanes_present:
+                    stats_list["ReadInfosForLanes"].append(read_infos)
+            for entry in data["ConversionResults"]:
+                lane = entry["LaneNumber"]
+                if lane in lanes_present and str(lane) in complex_lanes:
+                    undetermined = entry["Undetermined"]
+                    undetermined["NumberReads"] = number_reads[str(lane)][
+                        "undet_cluster"
+                    ]
+                    undetermined["Yield"] = (
+                        number_reads[str(lane)]["undet_yield"] * 1000000
+                    )
+                    for read in [0, 1]:
+                        for key in [
+                            "QualityScoreSum",
+                            "TrimmedBases",
+                            "Yield",
+                            "YieldQ30",
+                        ]:
+                            undetermined["ReadMetrics"][read][key] = 0
+                    lanes_to_update[lane]["DemuxResults"].extend(entry["DemuxResults"])
+                    lanes_to_update[lane]["Undetermined"] = undetermined
+                else:
+                    stats_list["ConversionResults"].append(entry)
+                    lanes_to_update.setdefault(lane, entry)
+        for entry in data["UnknownBarcodes"]:
+            lane = str(entry["Lane"])
+            if lane in simple_lanes:
+                stats_list["UnknownBarcodes"].append(entry)
+            elif lane in complex_lanes and list(complex_lanes[lane])[0] == demux_id:
+                compared_idx1 = filter_unknown_barcodes(
+                    entry["Barcodes"], other_samples(lane, demux_id), compared_idx1
+                )
+                stats_list["UnknownBarcodes"].append(entry)
+    with open(stats_file, "w") as f:
+        json.dump(stats_list, f)
+
+
+def other_samples(lane, demux_id):
+    return [("ACGTACGT", "TTTTGGGG"), ("GGGGGG", "")]
+
+
+def run_merge(queue, name, stats_json, stats_file, lanes):
+    complex_lanes = {lane: {"0": [10, 10]} for lane in lanes}
+    number_reads = {lane: {"undet_cluster": 1000, "undet_yield": 100} for lane in lanes}
+    start = time.perf_counter()
+    if name == "legacy":
+        legacy_merge(stats_json, stats_file, {}, complex_lanes, number_reads)
+    else:
+        merge_stats(
+            stats_json,
+            stats_file,
+            {},
+            complex_lanes,
+            number_reads,
+            other_samples,
+            top=None if name == "streaming (all)" else TOP_UNKNOWN_BARCODES,
+        )
+    queue.put((time.perf_counter() - start, peak_rss_mib()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lanes", type=int, default=8)
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1536,
+        help="Samples per lane and sub-demultiplexing",
+    )
+    parser.add_argument(
+        "--barcodes", type=int, default=100000, help="Unknown barcodes per lane"
+    )
+    parser.add_argument("--demuxes", type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    lanes = list(range(1, args.lanes + 1))
+    # Processes of their own, not to inherit the memory of this one
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        stats_json = []
+        for demux_id in range(args.demuxes):
+            stats_dir = os.path.join(run_dir, f"Demultiplexing_{demux_id}")
+            os.makedirs(stats_dir)
+            stat_json = os.path.join(stats_dir, "Stats.json")
+            write_stats(rng, stat_json, lanes, args.samples, args.barcodes, demux_id)
+            stats_json.append(stat_json)
+        size = sum(os.path.getsize(stat_json) for stat_json in stats_json)
+        print(f"{args.demuxes} Stats.json, {size / 2**20:.0f} MiB")
+
+        results = dict()
+        for name in ["legacy", "streaming (all)", "streaming (top)"]:
+            queue = context.Queue()
+            process = context.Process(
+                target=run_merge,
+                args=(
+                    queue,
+                    name,
+                    stats_json,
+                    os.path.join(run_dir, f"{name}.json"),
+                    [str(lane) for lane in lanes],
+                ),
+            )
+            process.start()
+            results[name] = queue.get()
+            process.join()
+        assert filecmp.cmp(
+            os.path.join(run_dir, "legacy.json"),
+            os.path.join(run_dir, "streaming (all).json"),
+            shallow=False,
+        ), "results differ"
+
+    print(f"{'':>16}{'time (s)':>10}{'peak RSS (MiB)':>16}")
+    for name, (elapsed, peak) in results.items():
+        print(f"{name:>16}{elapsed:>10.1f}{peak:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
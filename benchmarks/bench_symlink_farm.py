@@ -0,0 +1,210 @@
+"""Benchmark the linking of the FASTQ files of aggregated demultiplexings.
+
+A synthetic Element run has its samples spread over lanes and
+sub-demultiplexings, with the read and index FASTQ files of each sample
+under Demultiplexing_N/Samples. The Demultiplexing folder is built, the
+first time and again on a run already aggregated, as aggregate_sample_fastq
+and aggregate_undet_fastq used to, clearing it and globbing the
+sub-demultiplexing of each sample before linking its files one at a time,
+and with a link plan from a single scan of each sub-demultiplexing, applied
+in bulk. The links are checked to be the same before the timings are
+reported.
+
+Usage:
+
+    python benchmarks/bench_symlink_farm.py --samples 5000 --lanes 4
+"""
+
+import argparse
+import glob
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from taca.element.Element_Runs import Run
+
+READS = ("R1", "R2", "I1", "I2")
+
+
+def write_run(run_dir, n_samples, n_lanes, n_sub_demux):
+    manifest = []
+    for i in range(n_samples):
+        lane = str(i % n_lanes + 1)
+        sub_demux = str(i // n_lanes % n_sub_demux)
+        project = f"P{i % 10:05}"
+        sample = f"{project}_{i:04}"
+        manifest.append(
+            {
+                "Lane": lane,
+                "SampleName": sample,
+                "Project": project,
+                "sub_demux_count": sub_demux,
+            }
+        )
+        sample_dir = os.path.join(
+            run_dir, f"Demultiplexing_{sub_demux}", "Samples", project, sample
+        )
+        os.makedirs(sample_dir)
+        for read in READS:
+            open(
+                os.path.join(sample_dir, f"{sample}_L00{lane}_{read}_001.fastq.gz"),
+                "w",
+            ).close()
+    for sub_demux in range(n_sub_demux):
+        undet_dir = os.path.join(
+            run_dir, f"Demultiplexing_{sub_demux}", "Samples", "Undetermined"
+        )
+        os.makedirs(undet_dir)
+        for lane in range(1, n_lanes + 1):
+            for read in READS:
+                open(
+                    os.path.join(
+                        undet_dir, f"Undetermined_L00{lane}_{read}_001.fastq.gz"
+                    ),
+                    "w",
+                ).close()
+    return sorted(
+        manifest, key=lambda x: (x["Lane"], x["SampleName"], x["sub_demux_count"])
+    )
+
+
+def legacy_aggregate(run_dir, demux_dir, demux_runmanifest):
+    """Link the FastQ files as aggregate_sample_fastq and
+    aggregate_undet_fastq did, into a cleared demux dir."""
+    for filename in os.listdir(demux_dir):
+        file_path = os.path.join(demux_dir, filename)
+        if os.path.isdir(file_path) and not os.path.islink(file_path):
+            shutil.rmtree(file_path)
+        else:
+            os.unlink(file_path)
+    lanes = sorted(set(sample["Lane"] for sample in demux_runmanifest))
+    for lane in lanes:
+        unique_sample_demux = set()
+        sample_count = 1
+        for sample in demux_runmanifest:
+            project = sample["Project"]
+            sample_name = sample["SampleName"]
+            sub_demux_count = sample["sub_demux_count"]
+            if sample["Lane"] == lane and sample_name != "PhiX":
+                sample_tuple = (sample_name, sub_demux_count)
+                if sample_tuple not in unique_sample_demux:
+                    project_dest = os.path.join(demux_dir, project)
+                    sample_dest = os.path.join(
+                        demux_dir, project, f"Sample_{sample_name}"
+                    )
+                    if not os.path.exists(project_dest):
+                        os.makedirs(project_dest)
+                    if not os.path.exists(sample_dest):
+                        os.makedirs(sample_dest)
+                    for fastqfile in glob.glob(
+                        os.path.join(
+                            run_dir,
+                            f"Demultiplexing_{sub_demux_count}",
+                            "Samples",
+                            project,
+                            sample_name,
+                            f"*L00{lane}*.fastq.gz",
+                        )
+                    ):
+                        old_name = os.path.basename(fastqfile)
+                        read_label = re.search(rf"L00{lane}_(.*?)_001", old_name).group(
+                            1
+                        )
+                        new_name = "_".join(
+                            [
+                                sample_name,
+                                f"S{sample_count}",
+                                f"L00{lane}",
+                                read_label,
+                                "001.fastq.gz",
+                            ]
+                        )
+                        os.symlink(fastqfile, os.path.join(sample_dest, new_name))
+                    unique_sample_demux.add(sample_tuple)
+                    sample_count += 1
+    for lane in lanes:
+        sub_demux = list(
+            set(
+                sample["sub_demux_count"]
+                for sample in demux_runmanifest
+                if sample["Lane"] == lane
+            )
+        )
+        if len(sub_demux) == 1:
+            project_dest = os.path.join(demux_dir, "Undetermined")
+            if not os.path.exists(project_dest):
+                os.makedirs(project_dest)
+            for fastqfile in glob.glob(
+                os.path.join(
+                    run_dir,
+                    f"Demultiplexing_{sub_demux[0]}",
+                    "Samples",
+                    "Undetermined",
+                    f"*L00{lane}*.fastq.gz",
+                )
+            ):
+                os.symlink(
+                    fastqfile, os.path.join(project_dest, os.path.basename(fastqfile))
+                )
+
+
+def links(demux_dir):
+    found = dict()
+    for root, dirs, names in os.walk(demux_dir):
+        for name in names:
+            found[os.path.join(root, name)] = os.readlink(os.path.join(root, name))
+    return found
+
+
+def timed(function, *args):
+    # Not to time the writeback of what was written before
+    os.sync()
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--lanes", type=int, default=4)
+    parser.add_argument("--sub-demux", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run_dir = os.path.join(tmp, "20261018_AV242106_A2349523513")
+        demux_runmanifest = write_run(run_dir, args.samples, args.lanes, args.sub_demux)
+        # The Run of the run, without its run parameters and statusdb
+        run = Run.__new__(Run)
+        run.run_dir = run_dir
+        run.demux_dir = os.path.join(run_dir, "Demultiplexing")
+        os.makedirs(run.demux_dir)
+
+        timings = dict()
+        _, timings["legacy"] = timed(
+            legacy_aggregate, run_dir, run.demux_dir, demux_runmanifest
+        )
+        _, timings["legacy again"] = timed(
+            legacy_aggregate, run_dir, run.demux_dir, demux_runmanifest
+        )
+        legacy_links = links(run.demux_dir)
+        shutil.rmtree(run.demux_dir)
+        os.makedirs(run.demux_dir)
+        plan, timings["plan"] = timed(run.plan_demux_links, demux_runmanifest)
+        _, timings["apply"] = timed(plan.apply, True)
+        assert links(run.demux_dir) == legacy_links, "links differ"
+        _, timings["plan + apply again"] = timed(
+            lambda: run.plan_demux_links(demux_runmanifest).apply(prune=True)
+        )
+        assert links(run.demux_dir) == legacy_links, "links differ"
+
+    print(f"{len(legacy_links)} links of {args.samples} samples")
+    print(f"{'':>20}{'time (s)':>10}")
+    for name, elapsed in timings.items():
+        print(f"{name:>20}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
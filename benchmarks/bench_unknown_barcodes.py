@@ -0,0 +1,108 @@
+"""Benchmark the filtering of unknown barcodes of lanes demultiplexed several times.
+
+Synthetic complex lanes are made of a number of sub-demultiplexings with
+their own samples, and of the unknown barcodes of the top priority one,
+which include the indexes of the samples of the others, truncated or
+extended, plus random barcodes. The barcodes are filtered the way
+Runs._fix_demultiplexingstats_xml_dir used to, comparing each sample with
+each barcode, and with filter_unknown_barcodes. Both are checked to keep
+the same barcodes before their timings are reported.
+
+Usage:
+
+    python benchmarks/bench_unknown_barcodes.py --samples 384 --barcodes 1000 --demuxes 3
+"""
+
+import argparse
+import random
+import time
+
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+
+
+def index(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def make_lane(rng, n_samples, n_barcodes, n_demuxes):
+    """Return the samples of the other sub-demultiplexings and the unknown
+    barcodes of the top priority one."""
+    samples = []
+    for demux in range(n_demuxes - 1):
+        length = 6 + 2 * demux
+        for _ in range(n_samples):
+            if demux % 2:
+                samples.append((index(rng, length), ""))
+            else:
+                samples.append((index(rng, length), index(rng, length)))
+    barcodes = dict()
+    while len(barcodes) < n_barcodes:
+        if rng.random() < 0.3:
+            idx1, idx2 = rng.choice(samples)
+            barcode = idx1[:8] + index(rng, 10 - len(idx1[:8]))
+            barcode += "+" + (idx2 or index(rng, 10))[:10].ljust(10, "A")
+        else:
+            barcode = f"{index(rng, 10)}+{index(rng, 10)}"
+        barcodes[barcode] = rng.randint(1, 100000)
+    return samples, barcodes
+
+
+def legacy_filter(barcodes, samples):
+    """The comparison of _fix_demultiplexingstats_xml_dir before the samples
+    were indexed, for samples with an index 1."""
+    for sample_idx1, sample_idx2 in samples:
+        for idx in tuple(barcodes.keys()):
+            unknownbarcode_idx1 = idx.split("+")[0] if "+" in idx else idx
+            unknownbarcode_idx2 = idx.split("+")[1] if "+" in idx else ""
+            comparepart_idx1 = (
+                sample_idx1
+                if len(sample_idx1) <= len(unknownbarcode_idx1)
+                else sample_idx1[: len(unknownbarcode_idx1)]
+            )
+            if sample_idx1 and sample_idx2:
+                comparepart_idx2 = (
+                    sample_idx2
+                    if len(sample_idx2) <= len(unknownbarcode_idx2)
+                    else sample_idx2[: len(unknownbarcode_idx2)]
+                )
+                if (
+                    comparepart_idx1 == unknownbarcode_idx1[: len(comparepart_idx1)]
+                    and comparepart_idx2 == unknownbarcode_idx2[: len(comparepart_idx2)]
+                ):
+                    del barcodes[idx]
+            elif sample_idx1:
+                if comparepart_idx1 == unknownbarcode_idx1[: len(comparepart_idx1)]:
+                    del barcodes[idx]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--samples", type=int, default=384, help="Samples per sub-demultiplexing"
+    )
+    parser.add_argument("--barcodes", type=int, default=1000)
+    parser.add_argument("--demuxes", type=int, nargs="+", default=[2, 3, 5])
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    print(
+        f"{'demuxes':>8}{'samples':>9}{'kept':>7}{'legacy (ms)':>13}{'indexed (ms)':>14}"
+    )
+    for n_demuxes in args.demuxes:
+        samples, barcodes = make_lane(rng, args.samples, args.barcodes, n_demuxes)
+        legacy = dict(barcodes)
+        start = time.perf_counter()
+        legacy_filter(legacy, samples)
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        filter_unknown_barcodes(barcodes, samples)
+        indexed_time = time.perf_counter() - start
+        assert list(barcodes.items()) == list(legacy.items()), "results differ"
+        print(
+            f"{n_demuxes:>8}{len(samples):>9}{len(barcodes):>7}"
+            f"{legacy_time * 1000:>13.1f}{indexed_time * 1000:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
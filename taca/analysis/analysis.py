@@ -2,18 +2,35 @@
 
 import glob
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
-from shutil import copyfile, copytree
-
-from flowcell_parser.classes import RunParametersParser
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from xml.etree import ElementTree
 
 from taca.illumina.MiSeq_Runs import MiSeq_Run
 from taca.illumina.NextSeq_Runs import NextSeq_Run
 from taca.illumina.NovaSeq_Runs import NovaSeq_Run
 from taca.illumina.NovaSeqXPlus_Runs import NovaSeqXPlus_Run
-from taca.utils import statusdb
+from taca.illumina.run_parser import (
+    LazyRunParser,
+    find_run_parameters,
+    parser_cache_dir,
+)
+from taca.utils import (
+    filesystem,
+    hashed_tar,
+    job_queue,
+    mirror,
+    run_state,
+    statusdb,
+    symlink_farm,
+    upload_cache,
+)
 from taca.utils.config import CONFIG
 from taca.utils.transfer import RsyncAgent
 
@@ -27,51 +44,24 @@ def get_runObj(
     and then return the respective Run object (MiSeq, HiSeq..)
     """
 
-    if os.path.exists(os.path.join(run, "runParameters.xml")):
-        run_parameters_file = "runParameters.xml"
-    elif os.path.exists(os.path.join(run, "RunParameters.xml")):
-        run_parameters_file = "RunParameters.xml"
-    else:
+    run_parameters_file = find_run_parameters(run)
+    if run_parameters_file is None:
         logger.error(
             f"Cannot find RunParameters.xml or runParameters.xml in the run folder for run {run}"
         )
         return None
 
     run_parameters_path = os.path.join(run, run_parameters_file)
+    run_parser = LazyRunParser(run, cache_dir=parser_cache_dir(CONFIG))
     try:
-        run_parameters = RunParametersParser(run_parameters_path)
-    except OSError:
+        # Sniffed, without parsing the whole file, and cached per run
+        runtype = run_parser.run_type
+    except (OSError, ElementTree.ParseError):
         logger.warn(
             f"Problems parsing the runParameters.xml file at {run_parameters_path}. "
             f"This is quite unexpected. please archive the run {run} manually"
         )
     else:
-        # Do a case by case test because there are so many version of RunParameters that there is no real other way
-        runtype = run_parameters.data["RunParameters"].get(
-            "InstrumentType",
-            run_parameters.data["RunParameters"].get(
-                "ApplicationName",
-                run_parameters.data["RunParameters"].get("Application", ""),
-            ),
-        )
-        if "Setup" in run_parameters.data["RunParameters"]:
-            # This is the HiSeq2500, MiSeq, and HiSeqX case
-            try:
-                # Works for recent control software
-                runtype = run_parameters.data["RunParameters"]["Setup"]["Flowcell"]
-            except KeyError:
-                # Use this as second resource but print a warning in the logs
-                logger.warn(
-                    "Parsing runParameters to fecth instrument type, "
-                    "not found Flowcell information in it. Using ApplicationName"
-                )
-                # Here makes sense to use get with default value '' ->
-                # so that it doesn't raise an exception in the next lines
-                # (in case ApplicationName is not found, get returns None)
-                runtype = run_parameters.data["RunParameters"]["Setup"].get(
-                    "ApplicationName", ""
-                )
-
         if "MiSeq" in runtype:
             return MiSeq_Run(run, software, CONFIG["analysis"]["MiSeq"])
         elif "NextSeq" in runtype:
@@ -103,14 +93,43 @@ def upload_to_statusdb(run_dir, software):
         _upload_to_statusdb(runObj)
 
 
+def demux_plan(run_dir, software):
+    """Plan the demultiplexing of a run without starting it.
+
+    :param str run_dir: the run to plan
+    :param str software: bcl2fastq or bclconvert
+    :returns: the plan as JSON, or None if the sequencer was not recognized
+    """
+    runObj = get_runObj(run_dir, software)
+    if runObj is None:
+        logger.error(f"Cannot plan the demultiplexing of run {run_dir}")
+        return None
+    return runObj.get_demux_plan().to_json()
+
+
+def demux_links(run_dir, software, kept=False):
+    """List the links the aggregation of the demultiplexings of a run would
+    make, or change, in its demux folder, without making them.
+
+    :param str run_dir: the run to aggregate
+    :param str software: bcl2fastq or bclconvert
+    :param bool kept: whether to list the links already in place as well
+    :returns: the listing, or None if the sequencer was not recognized
+    """
+    runObj = get_runObj(run_dir, software)
+    if runObj is None:
+        logger.error(f"Cannot plan the aggregation of run {run_dir}")
+        return None
+    plan = runObj.plan_demux_links()
+    return symlink_farm.format_actions(plan.apply(dry_run=True), plan.root, kept)
+
+
 def _upload_to_statusdb(run):
     """Triggers the upload to statusdb using the dependency flowcell_parser.
 
     :param Run run: the object run
     """
     couch_conf = CONFIG["statusdb"]
-    couch_connection = statusdb.StatusdbSession(couch_conf).connection
-    db = couch_connection[couch_conf["xten_db"]]
     parser = run.runParserObj
     # Check if I have NoIndex lanes
     for element in parser.obj["samplesheet_csv"]:
@@ -155,20 +174,33 @@ def _upload_to_statusdb(run):
         parser.obj["DemultiplexConfig"] = {
             "Setup": {"Software": run.CONFIG.get("bcl2fastq", {})}
         }
-    # Keep PDC archive date if there is one already
-    run_vals = parser.obj["name"].split("_")
-    if len(run_vals[0]) == 8:
-        run_date = run_vals[0][2:]
-    else:
-        run_date = run_vals[0]
-    run_fc = f"{run_date}_{run_vals[-1]}"
-    db_rows = db.view("names/name", reduce=False, include_docs=True)[run_fc].rows
-    if db_rows:
-        doc = db_rows[0].doc
-        if doc.get("pdc_archived") and not parser.obj.get("pdc_archived"):
-            parser.obj["pdc_archived"] = doc.get("pdc_archived")
 
-    statusdb.update_doc(db, parser.obj, over_write_db_entry=True)
+    def get_db():
+        couch_connection = statusdb.StatusdbSession(couch_conf).connection
+        return couch_connection[couch_conf["xten_db"]]
+
+    def full_upload(db):
+        # Keep PDC archive date if there is one already
+        run_vals = parser.obj["name"].split("_")
+        if len(run_vals[0]) == 8:
+            run_date = run_vals[0][2:]
+        else:
+            run_date = run_vals[0]
+        run_fc = f"{run_date}_{run_vals[-1]}"
+        db_rows = db.view("names/name", reduce=False, include_docs=True)[run_fc].rows
+        if db_rows:
+            doc = db_rows[0].doc
+            if doc.get("pdc_archived") and not parser.obj.get("pdc_archived"):
+                parser.obj["pdc_archived"] = doc.get("pdc_archived")
+        return statusdb.update_doc(db, parser.obj, over_write_db_entry=True)
+
+    # Runs unchanged since their last upload are not sent again
+    cache = upload_cache.load_upload_cache(CONFIG)
+    if cache is None:
+        full_upload(get_db())
+        return
+    with cache:
+        cache.upload(parser.obj, get_db, full_upload)
 
 
 def transfer_run(run_dir, software):
@@ -260,55 +292,57 @@ def transfer_runfolder(run_dir, pid, exclude_lane):
         if exclude_lane != "":
             exclude_options_for_tar += dir_for_excluding_lane
 
-        subprocess.call(
-            ["tar"]
-            + exclude_options_for_tar
-            + ["-cvf", archive, "-C", run_dir_path, dir_name]
+        deliver_config = CONFIG["analysis"]["deliver_runfolder"]
+        destination = deliver_config.get("destination")
+        connection_details = deliver_config.get("analysis_server")
+        stream_command = None
+        if deliver_config.get("stream"):
+            # Write the archive straight to the analysis cluster
+            stream_command = hashed_tar.ssh_command(
+                connection_details["host"],
+                hashed_tar.remote_archive_path(destination, archive),
+                remote_user=connection_details["user"],
+            )
+        # The md5sum of the archive is computed while it is written, in the
+        # format of md5sum run in the same folder as run_dir
+        hashed_tar.write_archive(
+            archive,
+            run_dir,
+            dir_name,
+            exclude=exclude_options_for_tar[1::2],
+            # Read the many small files ahead in parallel
+            workers=deliver_config.get("tar_workers"),
+            sha256=deliver_config.get("sha256", False),
+            stream_command=stream_command,
         )
-    except subprocess.CalledProcessError as e:
-        logger.error("Error creating tar archive")
+    except (OSError, tarfile.TarError) as e:
+        logger.error(f"Error creating tar archive: {e}")
         raise e
-
-    # Generate the md5sum under the same folder as run_dir
-    md5file = archive + ".md5"
-    try:
-        f = open(md5file, "w")
-        os.chdir(run_dir_path)
-        subprocess.call(["md5sum", os.path.basename(archive)], stdout=f)
-        f.close()
     except subprocess.CalledProcessError as e:
-        logger.error("Error creating md5 file")
+        logger.error("Error creating tar archive")
         raise e
 
     # Rsync the files to the analysis cluster
-    destination = CONFIG["analysis"]["deliver_runfolder"].get("destination")
     rsync_opts = {"-LtDrv": None, "--chmod": "g+rw"}
-    connection_details = CONFIG["analysis"]["deliver_runfolder"].get("analysis_server")
-    archive_transfer = RsyncAgent(
-        archive,
-        dest_path=destination,
-        remote_host=connection_details["host"],
-        remote_user=connection_details["user"],
-        validate=False,
-        opts=rsync_opts,
-    )
-    md5_transfer = RsyncAgent(
-        md5file,
-        dest_path=destination,
-        remote_host=connection_details["host"],
-        remote_user=connection_details["user"],
-        validate=False,
-        opts=rsync_opts,
-    )
-
-    archive_transfer.transfer()
-    md5_transfer.transfer()
+    checksum_files = [hashed_tar.checksum_file(archive)]
+    if deliver_config.get("sha256", False):
+        checksum_files.append(hashed_tar.checksum_file(archive, "sha256"))
+    transfers = [] if stream_command else [archive]
+    for path in transfers + checksum_files:
+        RsyncAgent(
+            path,
+            dest_path=destination,
+            remote_host=connection_details["host"],
+            remote_user=connection_details["user"],
+            validate=False,
+            opts=rsync_opts,
+        ).transfer()
 
     # clean up the generated files
     try:
         os.remove(new_sample_sheet)
-        os.remove(archive)
-        os.remove(md5file)
+        for path in transfers + checksum_files:
+            os.remove(path)
     except OSError as e:
         logger.error("Was not able to delete all temporary files")
         raise e
@@ -330,204 +364,377 @@ def extract_project_samplesheet(sample_sheet, pid_list):
     return new_samplesheet_content
 
 
-def run_preprocessing(run, software):
-    """Run demultiplexing in all data directories.
+def _process(run):
+    """Process a run/flowcell and transfer to analysis server.
 
-    :param str run: Process a particular run instead of looking for runs
+    :param taca.illumina.Run run: Run to be processed and transferred
     """
-
-    def _process(run):
-        """Process a run/flowcell and transfer to analysis server.
-
-        :param taca.illumina.Run run: Run to be processed and transferred
-        """
-        logger.info(f"Checking run {run.id}")
-        transfer_file = os.path.join(CONFIG["analysis"]["status_dir"], "transfer.tsv")
-        if run.is_transferred(
-            transfer_file
-        ):  # Transfer is ongoing or finished. Do nothing. Sometimes caused by runs that are copied back from NAS after a reboot
-            logger.info(
-                f"Run {run.id} already transferred to analysis server, skipping it"
+    logger.info(f"Checking run {run.id}")
+    transfer_file = os.path.join(CONFIG["analysis"]["status_dir"], "transfer.tsv")
+    if run.is_transferred(
+        transfer_file
+    ):  # Transfer is ongoing or finished. Do nothing. Sometimes caused by runs that are copied back from NAS after a reboot
+        logger.info(f"Run {run.id} already transferred to analysis server, skipping it")
+        return
+
+    if run.get_run_status() == "SEQUENCING":
+        logger.info(f"Run {run.id} is not finished yet")
+        if "statusdb" in CONFIG:
+            _upload_to_statusdb(run)
+    elif run.get_run_status() == "TO_START":
+        if run.get_run_type() == "NON-NGI-RUN":
+            # For now MiSeq specific case. Process only NGI-run, skip all the others (PhD student runs)
+            logger.warn(
+                f"Run {run.id} marked as {run.get_run_type()}, "
+                "TACA will skip this and move the run to "
+                "no-sync directory"
             )
+            if "storage" in CONFIG:
+                run.archive_run(CONFIG["storage"]["archive_dirs"][run.sequencer_type])
             return
-
-        if run.get_run_status() == "SEQUENCING":
-            logger.info(f"Run {run.id} is not finished yet")
-            if "statusdb" in CONFIG:
-                _upload_to_statusdb(run)
-        elif run.get_run_status() == "TO_START":
-            if run.get_run_type() == "NON-NGI-RUN":
-                # For now MiSeq specific case. Process only NGI-run, skip all the others (PhD student runs)
-                logger.warn(
-                    f"Run {run.id} marked as {run.get_run_type()}, "
-                    "TACA will skip this and move the run to "
-                    "no-sync directory"
-                )
-                if "storage" in CONFIG:
-                    run.archive_run(
-                        CONFIG["storage"]["archive_dirs"][run.sequencer_type]
-                    )
-                return
-            logger.info(
-                f"Starting BCL to FASTQ conversion and demultiplexing for run {run.id}"
-            )
-            if "statusdb" in CONFIG:
-                _upload_to_statusdb(run)
-            run.demultiplex_run()
-        elif run.get_run_status() == "IN_PROGRESS":
-            logger.info(
-                "BCL conversion and demultiplexing process in "
-                f"progress for run {run.id}, skipping it"
-            )
-            # Upload to statusDB if applies
-            if "statusdb" in CONFIG:
-                _upload_to_statusdb(run)
-            # This function checks if demux is done
-            run.check_run_status()
-
-        # Previous elif might change the status to COMPLETED, therefore to avoid skipping
-        # a cycle take the last if out of the elif
-        if run.get_run_status() == "COMPLETED":
-            run.check_run_status()
-            logger.info(f"Preprocessing of run {run.id} is finished, transferring it")
-            # Upload to statusDB if applies
-            if "statusdb" in CONFIG:
-                _upload_to_statusdb(run)
-                demux_summary_message = []
-                for demux_id, demux_log in run.demux_summary.items():
-                    if demux_log["errors"] or demux_log["warnings"]:
-                        demux_summary_message.append(
-                            "Sub-Demultiplexing in Demultiplexing_{} completed with {} errors and {} warnings:".format(
-                                demux_id, demux_log["errors"], demux_log["warnings"]
-                            )
+        logger.info(
+            f"Starting BCL to FASTQ conversion and demultiplexing for run {run.id}"
+        )
+        if "statusdb" in CONFIG:
+            _upload_to_statusdb(run)
+        run.demultiplex_run()
+    elif run.get_run_status() == "IN_PROGRESS":
+        logger.info(
+            "BCL conversion and demultiplexing process in "
+            f"progress for run {run.id}, skipping it"
+        )
+        # Upload to statusDB if applies
+        if "statusdb" in CONFIG:
+            _upload_to_statusdb(run)
+        # This function checks if demux is done
+        run.check_run_status()
+
+    # Previous elif might change the status to COMPLETED, therefore to avoid skipping
+    # a cycle take the last if out of the elif
+    if run.get_run_status() == "COMPLETED":
+        run.check_run_status()
+        logger.info(f"Preprocessing of run {run.id} is finished, transferring it")
+        # Upload to statusDB if applies
+        if "statusdb" in CONFIG:
+            _upload_to_statusdb(run)
+            demux_summary_message = []
+            for demux_id, demux_log in run.demux_summary.items():
+                if demux_log["errors"] or demux_log["warnings"]:
+                    demux_summary_message.append(
+                        "Sub-Demultiplexing in Demultiplexing_{} completed with {} errors and {} warnings:".format(
+                            demux_id, demux_log["errors"], demux_log["warnings"]
                         )
+                    )
+                    demux_summary_message.append(
+                        "\n".join(demux_log["error_and_warning_messages"][:5])
+                    )
+                    if len(demux_log["error_and_warning_messages"]) > 5:
                         demux_summary_message.append(
-                            "\n".join(demux_log["error_and_warning_messages"][:5])
+                            f"...... Only the first 5 errors or warnings are displayed for Demultiplexing_{demux_id}."
                         )
-                        if len(demux_log["error_and_warning_messages"]) > 5:
-                            demux_summary_message.append(
-                                f"...... Only the first 5 errors or warnings are displayed for Demultiplexing_{demux_id}."
-                            )
-                # Notify with a mail run completion and stats uploaded
-                if demux_summary_message:
-                    sbt = f"{run.id} Demultiplexing Completed with ERRORs or WARNINGS!"
-                    msg = """The run {run} has been demultiplexed with errors or warnings!
+            # Notify with a mail run completion and stats uploaded
+            if demux_summary_message:
+                sbt = f"{run.id} Demultiplexing Completed with ERRORs or WARNINGS!"
+                msg = """The run {run} has been demultiplexed with errors or warnings!
 
-                    {errors_warnings}
+                {errors_warnings}
 
-                    The Run will be transferred to the analysis cluster for further analysis.
+                The Run will be transferred to the analysis cluster for further analysis.
 
-                    The run is available at : https://genomics-status.scilifelab.se/flowcells/{run}
+                The run is available at : https://genomics-status.scilifelab.se/flowcells/{run}
 
-                    """.format(
-                        errors_warnings="\n".join(demux_summary_message), run=run.id
-                    )
-                else:
-                    sbt = f"{run.id} Demultiplexing Completed!"
-                    msg = f"""The run {run.id} has been demultiplexed without any error or warning.
+                """.format(errors_warnings="\n".join(demux_summary_message), run=run.id)
+            else:
+                sbt = f"{run.id} Demultiplexing Completed!"
+                msg = f"""The run {run.id} has been demultiplexed without any error or warning.
 
-                    The Run will be transferred to the analysis cluster for further analysis.
+                The Run will be transferred to the analysis cluster for further analysis.
 
-                    The run is available at : https://genomics-status.scilifelab.se/flowcells/{run.id}
+                The run is available at : https://genomics-status.scilifelab.se/flowcells/{run.id}
 
-                    """
-                run.send_mail(sbt, msg, rcp=CONFIG["mail"]["recipients"])
+                """
+            run.send_mail(sbt, msg, rcp=CONFIG["mail"]["recipients"])
 
-            # Copy demultiplex stats file, InterOp meta data and run xml files to shared file system for LIMS purpose
-            if "mfs_path" in CONFIG["analysis"]:
-                try:
-                    mfs_dest = os.path.join(
-                        CONFIG["analysis"]["mfs_path"][run.sequencer_type.lower()],
-                        run.id,
-                    )
-                    logger.info(
-                        f"Copying demultiplex stats, InterOp metadata and XML files for run {run.id} to {mfs_dest}"
-                    )
-                    if not os.path.exists(mfs_dest):
-                        os.mkdir(mfs_dest)
-                    demulti_stat_src = os.path.join(
-                        run.run_dir,
-                        run.demux_dir,
-                        "Reports",
-                        "html",
-                        run.flowcell_id,
-                        "all",
-                        "all",
-                        "all",
-                        "laneBarcode.html",
-                    )
-                    copyfile(
-                        demulti_stat_src, os.path.join(mfs_dest, "laneBarcode.html")
-                    )
-                    # Copy RunInfo.xml
-                    run_info_xml_src = os.path.join(run.run_dir, "RunInfo.xml")
-                    if os.path.isfile(run_info_xml_src):
-                        copyfile(
-                            run_info_xml_src, os.path.join(mfs_dest, "RunInfo.xml")
-                        )
-                    # Copy RunParameters.xml
-                    run_parameters_xml_src = os.path.join(
-                        run.run_dir, "RunParameters.xml"
-                    )
-                    if os.path.isfile(run_info_xml_src):
-                        copyfile(
-                            run_parameters_xml_src,
-                            os.path.join(mfs_dest, "RunParameters.xml"),
-                        )
-                    # Copy InterOp
-                    interop_src = os.path.join(run.run_dir, "InterOp")
-                    if os.path.exists(interop_src):
-                        copytree(
-                            interop_src,
-                            os.path.join(mfs_dest, "InterOp"),
-                            dirs_exist_ok=True,
+        # Copy demultiplex stats file, InterOp meta data and run xml files to shared file system for LIMS purpose
+        if "mfs_path" in CONFIG["analysis"]:
+            try:
+                mfs_dest = os.path.join(
+                    CONFIG["analysis"]["mfs_path"][run.sequencer_type.lower()],
+                    run.id,
+                )
+                logger.info(
+                    f"Copying demultiplex stats, InterOp metadata and XML files for run {run.id} to {mfs_dest}"
+                )
+                if not os.path.exists(mfs_dest):
+                    os.mkdir(mfs_dest)
+                demulti_stat_src = os.path.join(
+                    run.run_dir,
+                    run.demux_dir,
+                    "Reports",
+                    "html",
+                    run.flowcell_id,
+                    "all",
+                    "all",
+                    "all",
+                    "laneBarcode.html",
+                )
+                pairs = [(demulti_stat_src, os.path.join(mfs_dest, "laneBarcode.html"))]
+                # Copy RunInfo.xml and RunParameters.xml
+                for xml_file in ["RunInfo.xml", "RunParameters.xml"]:
+                    xml_src = os.path.join(run.run_dir, xml_file)
+                    if os.path.isfile(xml_src):
+                        pairs.append((xml_src, os.path.join(mfs_dest, xml_file)))
+                # Copy InterOp
+                interop_src = os.path.join(run.run_dir, "InterOp")
+                if os.path.exists(interop_src):
+                    pairs.extend(
+                        mirror.tree_files(
+                            interop_src, os.path.join(mfs_dest, "InterOp")
                         )
-                except:
-                    logger.warn(
-                        f"Could not copy demultiplex stats, InterOp metadata or XML files for run {run.id}"
                     )
+                cache_dir = parser_cache_dir(CONFIG)
+                mirror.mirror(
+                    pairs,
+                    f"the metadata of run {run.id} to {mfs_dest}",
+                    manifest=cache_dir
+                    and os.path.join(cache_dir, run.id, "mfs_manifest.json"),
+                )
+            except:
+                logger.warn(
+                    f"Could not copy demultiplex stats, InterOp metadata or XML files for run {run.id}"
+                )
 
-            # Transfer to analysis server if flag is True
-            if run.transfer_to_analysis_server:
-                mail_recipients = CONFIG.get("mail", {}).get("recipients")
-                logger.info(
-                    "Transferring run {} to {} into {}".format(
-                        run.id,
-                        run.CONFIG["analysis_server"]["host"],
-                        run.CONFIG["analysis_server"]["sync"]["data_archive"],
-                    )
+        # Transfer to analysis server if flag is True
+        if run.transfer_to_analysis_server:
+            mail_recipients = CONFIG.get("mail", {}).get("recipients")
+            logger.info(
+                "Transferring run {} to {} into {}".format(
+                    run.id,
+                    run.CONFIG["analysis_server"]["host"],
+                    run.CONFIG["analysis_server"]["sync"]["data_archive"],
                 )
-                run.transfer_run(transfer_file, mail_recipients)
+            )
+            run.transfer_run(transfer_file, mail_recipients)
 
-            # Archive the run if indicated in the config file
-            if "storage" in CONFIG:  # TODO: make sure archiving to PDC is not ongoing
-                run.archive_run(CONFIG["storage"]["archive_dirs"][run.sequencer_type])
+        # Archive the run if indicated in the config file
+        if "storage" in CONFIG:  # TODO: make sure archiving to PDC is not ongoing
+            run.archive_run(CONFIG["storage"]["archive_dirs"][run.sequencer_type])
 
-    if run:
+
+def _process_run_dir(run_dir, software, store=None, demux_queue=None):
+    """Process a run folder while holding its lock, so that overlapping
+    invocations never handle the same run.
+
+    :param str run_dir: the run folder
+    :param str software: Software used for demultiplexing
+    :param store: the run state store to record the state of the run in
+    :param demux_queue: the queue to submit demultiplexing jobs to
+    """
+    with filesystem.try_lock(_run_lock_file(run_dir)) as locked:
+        if not locked:
+            logger.info(
+                f"Run {os.path.basename(run_dir)} is being processed by "
+                "another invocation, skipping it"
+            )
+            return
         # Determine the run type
-        runObj = get_runObj(run, software)
+        runObj = get_runObj(run_dir, software)
         if not runObj:
             raise RuntimeError(
-                f"Unrecognized instrument type or incorrect run folder {run}"
+                f"Unrecognized instrument type or incorrect run folder {run_dir}"
             )
-        else:
+        runObj.demux_queue = demux_queue
+        transfer_file = os.path.join(CONFIG["analysis"]["status_dir"], "transfer.tsv")
+        try:
             _process(runObj)
+        finally:
+            if store:
+                store.refresh(
+                    run_dir, "illumina", runObj.get_lifecycle_state, transfer_file
+                )
+
+
+def run_preprocessing(run, software, workers=None):
+    """Run demultiplexing in all data directories.
+
+    :param str run: Process a particular run instead of looking for runs
+    :param str software: Software used for demultiplexing
+    :param int workers: Number of runs to process in parallel, each in a
+        process of its own
+    """
+    cycle_start = time.time()
+    # Records the state of the runs so settled ones need not be checked again
+    store = run_state.load_store(CONFIG)
+    # Launch the demultiplexings queued on earlier invocations first
+    demux_queue = job_queue.load_queue(CONFIG)
+    if demux_queue:
+        demux_queue.schedule()
+    if run:
+        _process_run_dir(run, software, store, demux_queue)
     else:
+        run_dirs = []
         data_dirs = CONFIG.get("analysis").get("data_dirs")
         for data_dir in data_dirs:
             # Run folder looks like DATE_*_*_*, the last section is the FC name.
             runs = glob.glob(os.path.join(data_dir, "[1-9]*_*_*_*"))
             for _run in runs:
-                runObj = get_runObj(_run, software)
-                if not runObj:
-                    logger.warning(
-                        f"Unrecognized instrument type or incorrect run folder {run}"
+                if store and store.is_settled(_run):
+                    logger.info(
+                        f"Run {os.path.basename(_run)} is {store.get(_run)['state']} "
+                        "and unchanged since, skipping it"
                     )
-                else:
-                    try:
-                        _process(runObj)
-                    except:
-                        # This function might throw and exception,
-                        # it is better to continue processing other runs
-                        logger.warning(f"There was an error processing the run {run}")
-                        pass
+                    continue
+                run_dirs.append(_run)
+        if workers and workers > 1 and len(run_dirs) > 1:
+            # The workers open the store and the queue themselves
+            if store:
+                store.close()
+                store = None
+            if demux_queue:
+                demux_queue.close()
+                demux_queue = None
+            _process_in_pool(run_dirs, software, workers)
+        else:
+            for _run in run_dirs:
+                try:
+                    _process_run_dir(_run, software, store, demux_queue)
+                except Exception as e:
+                    # This function might throw and exception,
+                    # it is better to continue processing other runs
+                    logger.warning(f"There was an error processing the run {_run}: {e}")
+    if store:
+        store.close()
+    if demux_queue:
+        demux_queue.close()
+    if "statusdb" in CONFIG:
+        _log_upload_counts(cycle_start)
+
+
+def _log_upload_counts(since):
+    """Log what the uploads to statusdb since a time did, if they are cached."""
+    cache = upload_cache.load_upload_cache(CONFIG)
+    if cache is None:
+        return
+    with cache:
+        counts = cache.counts(since)
+    logger.info(
+        "Uploads to statusdb: "
+        + ", ".join(f"{count} {action}" for action, count in counts.items())
+    )
+
+
+def _run_lock_file(run_dir):
+    """Return the path of the lock file of a run, in the status directory
+    rather than the run folder, which is synced to the analysis server.
+    """
+    lock_dir = os.path.join(CONFIG["analysis"]["status_dir"], "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, f"{os.path.basename(os.path.normpath(run_dir))}.lock")
+
+
+def _worker_log_file(run_dir):
+    """Return the log file of the worker processing a run, next to the main
+    log file, or None if no log file is configured.
+    """
+    log_file = CONFIG.get("log", {}).get("file")
+    if not log_file:
+        return None
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(log_file)), "runs")
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, f"{os.path.basename(os.path.normpath(run_dir))}.log")
+
+
+def _process_in_worker(run_dir, software):
+    """Process a single run in a worker process, logging to a file of its own.
+
+    Errors are reported back to the parent rather than raised.
+
+    :returns: the run folder, the worker log file and an error message or None
+    """
+    log_file = _worker_log_file(run_dir)
+    if log_file:
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                root_logger.removeHandler(handler)
+                handler.close()
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+        root_logger.addHandler(file_handler)
+    # The queued jobs were launched and the uploads are logged by the parent
+    store = run_state.load_store(CONFIG)
+    demux_queue = job_queue.load_queue(CONFIG)
+    try:
+        _process_run_dir(run_dir, software, store, demux_queue)
+    except Exception as e:
+        logger.exception(f"There was an error processing the run {run_dir}")
+        return run_dir, log_file, f"{type(e).__name__}: {e}"
+    finally:
+        if store:
+            store.close()
+        if demux_queue:
+            demux_queue.close()
+    return run_dir, log_file, None
+
+
+def _process_in_pool(run_dirs, software, workers):
+    """Process independent runs in a pool of worker processes.
+
+    The workers are forked from this process and report the outcome of each
+    run, so a failing run does not affect the others. A worker that dies
+    abruptly breaks the pool, the runs that were not processed are logged
+    and picked up again on the next invocation.
+    """
+    logger.info(f"Processing {len(run_dirs)} run(s) with {workers} workers")
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+    ) as pool:
+        futures = {
+            pool.submit(_process_in_worker, run_dir, software): run_dir
+            for run_dir in run_dirs
+        }
+        for future in as_completed(futures):
+            run_name = os.path.basename(futures[future])
+            try:
+                _, log_file, error = future.result()
+            except BrokenProcessPool as e:
+                failed.append(run_name)
+                logger.error(f"Run {run_name} was not processed, its worker died: {e}")
+                continue
+            log_note = f", see {log_file}" if log_file else ""
+            if error:
+                failed.append(run_name)
+                logger.warning(
+                    f"There was an error processing the run {run_name}: {error}{log_note}"
+                )
+            else:
+                logger.info(f"Run {run_name} processed{log_note}")
+    logger.info(f"Processed {len(run_dirs) - len(failed)} of {len(run_dirs)} run(s)")
+    return failed
+
+
+def reconcile_run_state():
+    """Rebuild the states of the Illumina runs in the data directories
+    from their marker files.
+    """
+    store = run_state.load_store(CONFIG)
+    if store is None:
+        logger.warning("No run state store configured with run_state_db")
+        return
+    transfer_file = os.path.join(CONFIG["analysis"]["status_dir"], "transfer.tsv")
+    with store:
+        store.clear("illumina")
+        for data_dir in CONFIG["analysis"]["data_dirs"]:
+            for _run in glob.glob(os.path.join(data_dir, "[1-9]*_*_*_*")):
+                runObj = get_runObj(_run, "bcl2fastq")
+                if runObj:
+                    store.refresh(
+                        _run, "illumina", runObj.get_lifecycle_state, transfer_file
+                    )
+        logger.info(
+            f"Recorded the state of {len(store.runs('illumina'))} Illumina run(s)"
+        )
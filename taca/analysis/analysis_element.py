@@ -3,8 +3,10 @@
 import glob
 import logging
 import os
+from pathlib import Path
 
 from taca.element.Aviti_Runs import Aviti_Run
+from taca.utils import job_queue, run_state, symlink_farm
 from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
 
@@ -49,6 +51,8 @@ def run_preprocessing(given_run):
             lims_zip_path = run.find_lims_zip()
             if lims_zip_path is not None:
                 os.mkdir(run.demux_dir)
+                # A failure of an earlier demultiplexing was reported already
+                Path(run.demux_failed_file).unlink(missing_ok=True)
                 run.copy_manifests(lims_zip_path)
                 demux_manifests = run.make_demux_manifests(
                     manifest_to_split=run.lims_manifest
@@ -81,6 +85,19 @@ def run_preprocessing(given_run):
                 run.update_statusdb()
             return
 
+        elif demultiplexing_status == "failed":
+            if os.path.exists(run.demux_failed_file):
+                logger.info(f"Demultiplexing of run {run} failed, already reported")
+                return
+            logger.warning(
+                f"Demultiplexing of run {run} failed, see the bases2fastq logs."
+            )
+            email_subject = f"Issues processing {run}"
+            email_message = f"Demultiplexing of run {run} failed, see the bases2fastq logs in {run.run_dir}."
+            send_mail(email_subject, email_message, CONFIG["mail"]["recipients"])
+            Path(run.demux_failed_file).touch()
+            return
+
         elif demultiplexing_status != "finished":
             logger.warning(
                 f"Unknown demultiplexing status {demultiplexing_status} of run {run}. Please investigate."
@@ -145,16 +162,34 @@ def run_preprocessing(given_run):
             send_mail(email_subject, email_message, CONFIG["mail"]["recipients"])
             return
 
+    # Records the state of the runs so settled ones need not be checked again
+    store = run_state.load_store(CONFIG)
+    # Launch the demultiplexings queued on earlier invocations first
+    demux_queue = job_queue.load_queue(CONFIG)
+    if demux_queue:
+        demux_queue.schedule()
     if given_run:
         run = Aviti_Run(given_run, CONFIG)
-        _process(run)
+        run.demux_queue = demux_queue
+        try:
+            _process(run)
+        finally:
+            if store:
+                store.refresh(given_run, "element", run.get_lifecycle_state)
     else:
         data_dirs = CONFIG.get("element_analysis").get("data_dirs")
         for data_dir in data_dirs:
             # Run folder looks like DATE_*_*, the last section is the FC side (A/B) and name
             runs = glob.glob(os.path.join(data_dir, "[1-9]*_*_*"))
             for run in runs:
+                if store and store.is_settled(run):
+                    logger.info(
+                        f"Run {os.path.basename(run)} is {store.get(run)['state']} "
+                        "and unchanged since, skipping it"
+                    )
+                    continue
                 runObj = Aviti_Run(run, CONFIG)
+                runObj.demux_queue = demux_queue
                 try:
                     _process(runObj)
                 except Exception as e:
@@ -171,3 +206,50 @@ def run_preprocessing(given_run):
                         f"There was an error processing the run {run}. Error: {e}"
                     )
                     pass
+                if store:
+                    store.refresh(run, "element", runObj.get_lifecycle_state)
+    if store:
+        store.close()
+    if demux_queue:
+        demux_queue.close()
+
+
+def demux_links(given_run, kept=False):
+    """List the links the aggregation of the demultiplexings of a run would
+    make, change or remove in its demux folder, without making them.
+
+    :param str given_run: the run to aggregate
+    :param bool kept: whether to list the links already in place as well
+    :returns: the listing
+    """
+    run = Aviti_Run(given_run, CONFIG)
+    demux_runmanifest = run.collect_demux_runmanifest(
+        glob.glob(os.path.join(run.run_dir, "Demultiplexing_*"))
+    )
+    plan = run.plan_demux_links(demux_runmanifest)
+    return symlink_farm.format_actions(
+        plan.apply(prune=True, dry_run=True), plan.root, kept
+    )
+
+
+def reconcile_run_state():
+    """Rebuild the states of the Element runs in the data directories
+    from their marker files.
+    """
+    store = run_state.load_store(CONFIG)
+    if store is None:
+        logger.warning("No run state store configured with run_state_db")
+        return
+    with store:
+        store.clear("element")
+        for data_dir in CONFIG.get("element_analysis").get("data_dirs"):
+            for run in glob.glob(os.path.join(data_dir, "[1-9]*_*_*")):
+                runObj = Aviti_Run(run, CONFIG)
+                try:
+                    runObj.parse_run_parameters()
+                except FileNotFoundError:
+                    continue
+                store.refresh(run, "element", runObj.get_lifecycle_state)
+        logger.info(
+            f"Recorded the state of {len(store.runs('element'))} Element run(s)"
+        )
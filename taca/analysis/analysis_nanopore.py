@@ -11,6 +11,7 @@ from taca.nanopore.ONT_run_classes import (
     ONT_run,
     ONT_user_run,
 )
+from taca.utils import run_state
 from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
 
@@ -279,6 +280,8 @@ def ont_transfer(run_abspath: str | None, qc: bool = False):
 
     # If no run is specified, locate all runs
     else:
+        # Records the state of the runs so settled ones need not be checked again
+        store = run_state.load_store(CONFIG)
         for run_type in ["user_run", "qc_run"]:
             logger.info(f"Looking for runs of type '{run_type}'...")
 
@@ -291,16 +294,31 @@ def ont_transfer(run_abspath: str | None, qc: bool = False):
                 run_dirs = find_run_dirs(data_dir, ignore_dirs)
 
                 for run_dir in run_dirs:
+                    if store and store.is_settled(run_dir):
+                        logger.info(
+                            f"Skipping run {os.path.basename(run_dir)}: "
+                            f"{store.get(run_dir)['state']} and unchanged since"
+                        )
+                        continue
+                    ont_run: ONT_run | None = None
                     # Send error mails at run-level
                     try:
                         if run_type == "user_run":
-                            process_user_run(ONT_user_run(run_dir))
+                            user_run = ONT_user_run(run_dir)
+                            ont_run = user_run
+                            process_user_run(user_run)
                         else:
-                            process_qc_run(ONT_qc_run(run_dir))
+                            qc_run = ONT_qc_run(run_dir)
+                            ont_run = qc_run
+                            process_qc_run(qc_run)
                     except WaitForRun as e:
                         logger.info(f"Skipping run {os.path.basename(run_dir)}: {e}")
                     except BaseException as e:
                         send_error_mail(os.path.basename(run_dir), e)
+                    if store and ont_run is not None:
+                        store.refresh(run_dir, "ont", ont_run.get_lifecycle_state)
+        if store:
+            store.close()
 
 
 class WaitForRun(Exception):
@@ -321,3 +339,26 @@ def ont_updatedb(run_abspath: str):
         f"{ont_run.run_name}: Manually updating StatusDB, ignoring run status..."
     )
     ont_run.update_db_entry(force_update=True)
+
+
+def reconcile_run_state():
+    """Rebuild the states of the ONT runs in the data directories from
+    their marker files.
+    """
+    store = run_state.load_store(CONFIG)
+    if store is None:
+        logger.warning("No run state store configured with run_state_db")
+        return
+    with store:
+        store.clear("ont")
+        for run_type, run_class in [("user_run", ONT_user_run), ("qc_run", ONT_qc_run)]:
+            run_type_config = CONFIG["nanopore_analysis"]["run_types"][run_type]
+            for data_dir in run_type_config["data_dirs"]:
+                for run_dir in find_run_dirs(data_dir, run_type_config["ignore_dirs"]):
+                    try:
+                        ont_run = run_class(run_dir)
+                    except (OSError, AssertionError) as e:
+                        logger.warning(f"Could not read run {run_dir}: {e}")
+                        continue
+                    store.refresh(run_dir, "ont", ont_run.get_lifecycle_state)
+        logger.info(f"Recorded the state of {len(store.runs('ont'))} ONT run(s)")
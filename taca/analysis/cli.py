@@ -4,6 +4,8 @@ import click
 
 from taca.analysis import analysis as an
 from taca.analysis import analysis_element, analysis_nanopore
+from taca.utils import transfer_ledger
+from taca.utils.config import CONFIG
 
 
 @click.group()
@@ -30,9 +32,16 @@ def analysis():
     default="bcl2fastq",
     help="Available software for demultiplexing: bcl2fastq (default), bclconvert",
 )
-def demultiplex(run, software):
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of runs to process in parallel (default: one at a time)",
+)
+def demultiplex(run, software, workers):
     """Demultiplex and transfer all runs present in the data directories."""
-    an.run_preprocessing(run, software)
+    an.run_preprocessing(run, software, workers)
 
 
 @analysis.command()
@@ -72,6 +81,80 @@ def updatedb(rundir, software):
     an.upload_to_statusdb(rundir, software)
 
 
+@analysis.command()
+@click.option(
+    "-s",
+    "--software",
+    type=click.Choice(["bcl2fastq", "bclconvert"]),
+    default="bcl2fastq",
+    help="Available software for demultiplexing: bcl2fastq (default), bclconvert",
+)
+@click.argument("rundir", type=click.Path(exists=True))
+def plan(rundir, software):
+    """Show how the samples of a run would be demultiplexed."""
+    demux_plan = an.demux_plan(rundir, software)
+    if demux_plan is not None:
+        click.echo(demux_plan)
+
+
+@analysis.command()
+@click.option(
+    "-s",
+    "--software",
+    type=click.Choice(["bcl2fastq", "bclconvert"]),
+    default="bcl2fastq",
+    help="Available software for demultiplexing: bcl2fastq (default), bclconvert",
+)
+@click.option(
+    "-k", "--kept", is_flag=True, help="List the links already in place as well"
+)
+@click.argument("rundir", type=click.Path(exists=True))
+def links(rundir, software, kept):
+    """Show the links aggregating the demultiplexings of a run would make."""
+    listing = an.demux_links(rundir, software, kept)
+    if listing is not None:
+        click.echo(listing)
+
+
+@analysis.command()
+@click.option(
+    "-p",
+    "--platform",
+    type=click.Choice(["illumina", "element", "ont"]),
+    multiple=True,
+    help="Platform to reconcile, can be given several times (default: all)",
+)
+def reconcile_state(platform):
+    """Rebuild the run state store from the marker files of all runs."""
+    reconcilers = {
+        "illumina": an.reconcile_run_state,
+        "element": analysis_element.reconcile_run_state,
+        "ont": analysis_nanopore.reconcile_run_state,
+    }
+    for name in platform or reconcilers:
+        reconcilers[name]()
+
+
+@analysis.command()
+@click.argument("transfer_logs", nargs=-1, type=click.Path())
+def import_transfer_logs(transfer_logs):
+    """(Re)build the index of transfer logs, by default all configured ones."""
+    for transfer_log in transfer_logs or transfer_ledger.configured_transfer_logs(
+        CONFIG
+    ):
+        ledger = transfer_ledger.get_ledger(transfer_log)
+        click.echo(f"Indexed {ledger.rebuild()} run(s) from {transfer_log}")
+
+
+@analysis.command()
+@click.argument("transfer_log", type=click.Path())
+@click.argument("output", type=click.Path())
+def export_transfer_log(transfer_log, output):
+    """Write the runs in the ledger of a transfer log to a TSV file."""
+    count = transfer_ledger.get_ledger(transfer_log).export_tsv(output)
+    click.echo(f"Exported {count} run(s) to {output}")
+
+
 # Element analysis subcommands
 
 
@@ -95,6 +178,16 @@ def element_updatedb(run):
     analysis_element.upload_to_statusdb(run)
 
 
+@analysis.command()
+@click.option(
+    "-k", "--kept", is_flag=True, help="List the links already in place as well"
+)
+@click.argument("run", type=click.Path(exists=True))
+def element_links(run, kept):
+    """Show the links aggregating the demultiplexings of a run would make."""
+    click.echo(analysis_element.demux_links(run, kept))
+
+
 # Nanopore analysis subcommands
 
 
@@ -1,19 +1,36 @@
 """Backup methods and utilities."""
 
 import csv
+import hashlib
+import json
 import logging
 import os
 import re
 import shutil
 import subprocess as sp
+import tarfile
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
-from taca.utils import filesystem, misc, statusdb
+from taca.backup import compression, indexed_archive
+from taca.backup.pdc import PdcCatalogue, query_archive
+from taca.backup.reservations import DiskReservationLedger
+from taca.utils import filesystem, misc, parallel_tar, statusdb
 from taca.utils.config import CONFIG
 
 logger = logging.getLogger(__name__)
 
+# Size of the chunks passed between tar, the hasher and gpg when streaming
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+# Seconds between progress reports when restoring a run
+RESTORE_PROGRESS_INTERVAL = 60
+# Writes the random passphrase of a run. gpg reads a passphrase file up to its
+# first newline, so the random bytes are armored into a single line of text
+KEY_COMMAND = "gpg --armor --gen-random 1 256"
+
 
 class run_vars:
     """A simple variable storage class."""
@@ -26,6 +43,23 @@ class run_vars:
         self.key = f"{self.name}.key"
         self.key_encrypted = f"{self.name}.key.gpg"
         self.tar_encrypted = os.path.join(archive_path, f"{self.name}.tar.gpg")
+        # Indexed archives are not single gpg messages, see indexed_archive
+        self.tar_segmented = os.path.join(
+            archive_path, f"{self.name}{indexed_archive.SEGMENTED_EXTENSION}"
+        )
+        self.tar_digest = os.path.join(archive_path, f"{self.name}.tar.md5")
+        self.tar_index = os.path.join(archive_path, f"{self.name}.tar.index.json")
+        self.tar_compression = os.path.join(
+            archive_path, f"{self.name}.tar.compression.json"
+        )
+        # Size in bytes of the run folder, measured once when first needed
+        self.size = None
+
+    def encrypted_file(self):
+        """The encrypted run on disk, the segmented archive if it was indexed."""
+        if os.path.exists(self.tar_segmented):
+            return self.tar_segmented
+        return self.tar_encrypted
 
 
 class backup_utils:
@@ -35,6 +69,10 @@ class backup_utils:
         self.run = run
         self.fetch_config_info()
         self.host_name = os.getenv("HOSTNAME", os.uname()[1]).split(".", 1)[0]
+        self.pdc_catalogue = PdcCatalogue(
+            self.pdc_catalogue_file, ttl=self.pdc_catalogue_ttl * 3600
+        )
+        self.reservation_ledger = DiskReservationLedger(self.reservation_ledger_file)
 
     def fetch_config_info(self):
         """Try to fecth required info from the config file. Log and exit if any neccesary info is missing."""
@@ -55,11 +93,40 @@ class backup_utils:
                 "copy_complete_indicator", "CopyComplete.txt"
             )
             self.archive_log_location = CONFIG["backup"]["archive_log"]
+            self.pdc_catalogue_file = CONFIG["backup"].get(
+                "pdc_catalogue",
+                os.path.join(
+                    os.path.dirname(self.archive_log_location), "pdc_catalogue.json"
+                ),
+            )
+            self.pdc_catalogue_ttl = CONFIG["backup"].get("pdc_catalogue_ttl", 12)
+            self.reservation_ledger_file = CONFIG["backup"].get(
+                "reservation_ledger",
+                os.path.join(
+                    os.path.dirname(self.archive_log_location),
+                    "encryption_reservations.json",
+                ),
+            )
+            self.encrypt_workers = CONFIG["backup"].get("encrypt_workers", 1)
+            self.segment_size = CONFIG["backup"].get(
+                "segment_size", indexed_archive.DEFAULT_SEGMENT_SIZE
+            )
+            self.pdc_sessions = CONFIG["backup"].get("pdc_sessions", 1)
+            self.pdc_retries = CONFIG["backup"].get("pdc_retries", 3)
+            self.pdc_retry_delay = CONFIG["backup"].get("pdc_retry_delay", 30)
+            self.pdc_confirm_timeout = CONFIG["backup"].get("pdc_confirm_timeout", 300)
+            self.tar_workers = CONFIG["backup"].get("tar_workers", 0)
+            self.compression = compression.CompressionSettings(
+                CONFIG["backup"].get("compression")
+            )
         except KeyError as e:
             logger.error(
                 f"Config file is missing the key {str(e)}, make sure it have all required information"
             )
             raise SystemExit
+        except ValueError as e:
+            logger.error(f"Invalid backup config: {e}")
+            raise SystemExit
 
     def collect_runs(self, ext=None, filter_by_ext=False):
         """Collect runs from archive directories."""
@@ -78,6 +145,12 @@ class backup_utils:
             if self._is_ready_to_archive(run, ext):
                 self.runs.append(run)
         else:
+            # Runs encrypted into indexed archives are sent to PDC as well
+            exts = (
+                (ext, indexed_archive.SEGMENTED_EXTENSION)
+                if ext == ".tar.gpg"
+                else (ext,)
+            )
             for archive_dir in self.archive_dirs.values():
                 if not os.path.isdir(archive_dir):
                     logger.warning(
@@ -85,26 +158,28 @@ class backup_utils:
                     )
                     continue
                 for item in os.listdir(archive_dir):
-                    if filter_by_ext and not item.endswith(ext):
+                    item_ext = next((e for e in exts if item.endswith(e)), None)
+                    if filter_by_ext and item_ext is None:
                         continue
-                    elif item.endswith(ext):
-                        item = item.replace(ext, "")
+                    elif item_ext is not None:
+                        item = item[: -len(item_ext)]
                     elif not os.path.isdir(os.path.join(archive_dir, item)):
                         continue
                     if (
                         re.match(filesystem.RUN_RE_ILLUMINA, item)
                         or re.match(filesystem.RUN_RE_ONT, item)
                         or re.match(filesystem.RUN_RE_ELEMENT, item)
-                    ) and item not in self.runs:
+                    ) and item not in [run.name for run in self.runs]:
                         run_type = self._get_run_type(item)
                         archive_path = self.archive_dirs[run_type]
                         run = run_vars(os.path.join(archive_dir, item), archive_path)
                         if self._is_ready_to_archive(run, ext):
                             self.runs.append(run)
 
-    def avail_disk_space(self, path, run):
-        """Check the space on file system based on parent directory of the run."""
-        # not able to fetch runtype use the max size as precaution, size units in GB
+    def _ongoing_runs_headroom(self):
+        """Space in bytes to keep free for the runs that are still being
+        sequenced into the data directories and will keep growing."""
+        # expected size of a finished run, size units in GB
         run_sizes = {
             "novaseq": 1800,
             "miseq": 20,
@@ -114,8 +189,7 @@ class backup_utils:
             "minion": 1000,
             "aviti": 350,
         }
-        required_size = run_sizes.get(self._get_run_type(run), 900) * 2
-        # check for any ongoing runs and add up the required size accordingly
+        headroom = 0
         for data_dir in self.data_dirs.values():
             if not os.path.isdir(data_dir):
                 continue
@@ -137,40 +211,72 @@ class backup_utils:
                         os.path.join(data_dir, run_dir, "RunUploaded.json")  # Element
                     )
                 ):
-                    required_size += run_sizes.get(self._get_run_type(run), 900)
-        # get available free space from the file system
+                    headroom += run_sizes.get(self._get_run_type(run_dir), 900)
+        return headroom * 1024**3
+
+    def _required_space(self, run, stream=False, indexed=False):
+        """Measure the scratch space in bytes needed to encrypt a run and
+        return it together with the files it will be written to.
+
+        The encrypted file is about as large as the run. Unless encrypting in
+        streaming mode or from an existing tarball, the tarball is written too.
+        """
+        encrypted = run.tar_segmented if indexed else run.tar_encrypted
+        if os.path.exists(run.tar):
+            return os.path.getsize(run.tar), [encrypted]
+        if run.size is None:
+            run.size = filesystem.dir_size(run.abs_path)
+        if stream:
+            return run.size, [encrypted]
+        return 2 * run.size, [run.tar, encrypted]
+
+    def reserve_disk_space(self, run, stream=False, indexed=False):
+        """Reserve the space needed to encrypt a run in the reservation ledger.
+
+        The reservation is only made if the free space of the file system,
+        minus what other ongoing encryptions have reserved and what runs
+        still being sequenced need, is enough. Returns True if it was made.
+        """
+        required_size, out_files = self._required_space(run, stream, indexed)
         try:
-            df_proc = sp.Popen(["df", path], stdout=sp.PIPE, stderr=sp.PIPE)
-            df_out, df_err = df_proc.communicate()
-            available_size = (
-                int(df_out.strip().decode("utf-8").split("\n")[-1].strip().split()[3])
-                / 1024
-                / 1024
+            reserved, available = self.reservation_ledger.reserve(
+                run.name,
+                run.path,
+                required_size,
+                out_files,
+                headroom=self._ongoing_runs_headroom(),
             )
-        except Exception as e:
+        except OSError as e:
             logger.error(f"Evaluation of disk space failed with error {e}")
             raise SystemExit
-        if available_size < required_size:
-            e_msg = f"Required space for encryption is {required_size}GB, but only {available_size}GB available"
-            subjt = f"Low space for encryption - {self.host_name}"
-            logger.error(e_msg)
-            misc.send_mail(subjt, e_msg, self.mail_recipients)
-            raise SystemExit
+        if not reserved:
+            logger.info(
+                f"Required space for encryption of run {run.name} is {required_size / 1024**3:.1f}GB, "
+                f"but only {max(available, 0) / 1024**3:.1f}GB available"
+            )
+        return reserved
+
+    def notify_low_disk_space(self, run):
+        """Log and mail that a run can not be encrypted for lack of space."""
+        e_msg = f"Not enough space for encryption of run {run.name} in {run.path}"
+        subjt = f"Low space for encryption - {self.host_name}"
+        logger.error(e_msg)
+        misc.send_mail(subjt, e_msg, self.mail_recipients)
 
-    def file_in_pdc(self, src_file, silent=True):
-        """Check if the given files exist in PDC."""
-        # dsmc will return zero/True only when file exists, it returns
-        # non-zero/False though cmd is execudted but file not found
+    def file_in_pdc(self, src_file, silent=True, refresh=False):
+        """Check if the given files exist in PDC.
+
+        The lookup is done in the local PDC catalogue, which lists each archive
+        directory with a single dsmc query. With 'refresh' PDC is queried for
+        the file directly, e.g. to confirm that an archiving succeeded.
+        """
         src_file_abs = os.path.abspath(src_file)
-        try:
-            sp.check_call(
-                ["dsmc", "query", "archive", src_file_abs],
-                stdout=sp.PIPE,
-                stderr=sp.PIPE,
-            )
-            value = True
-        except sp.CalledProcessError:
-            value = False
+        if refresh:
+            value = query_archive(src_file_abs)
+            if value:
+                self.pdc_catalogue.add(src_file_abs)
+        else:
+            value = self.pdc_catalogue.contains(src_file_abs)
         if not silent:
             msg = "File {} {} in PDC".format(
                 src_file_abs, "exist" if value else "does not exist"
@@ -178,6 +284,15 @@ class backup_utils:
             logger.info(msg)
         return value
 
+    def _archive_to_pdc(self, src_file, tmp_files=[]):
+        """Archive a file to PDC and record it in the PDC catalogue."""
+        if not self._call_commands(
+            cmd1=f"dsmc archive {src_file}", tmp_files=tmp_files
+        ):
+            return False
+        self.pdc_catalogue.add(src_file)
+        return True
+
     def _get_run_type(self, run):
         """Returns run type based on the flowcell name."""
         run_type = ""
@@ -274,8 +389,277 @@ class backup_utils:
             if os.path.exists(fl):
                 os.remove(fl)
 
-    def _log_pdc_statusdb(self, run):
-        """Log the time stamp in statusDB if a file is succussfully sent to PDC."""
+    def _open_tar_stream(self, run):
+        """Open the plain tar stream of a run, either from an already existing
+        tarball or from tar. Returns the stream, and the tar process and the
+        file capturing its stderr when tar was started."""
+        if os.path.exists(run.tar):
+            return open(run.tar, "rb"), None, None
+        src_err = tempfile.TemporaryFile()
+        if self.tar_workers:
+            src_proc = parallel_tar.TarPipe(
+                run.abs_path,
+                run.name,
+                exclude=self.exclude_list,
+                workers=self.tar_workers,
+                stderr=src_err,
+            )
+            return src_proc.stdout, src_proc, src_err
+        exclude_files = " ".join([f"--exclude {x}" for x in self.exclude_list])
+        src_cmd = f"tar {exclude_files} -C {run.path} -cf - {run.name}".split()
+        src_proc = sp.Popen(src_cmd, stdout=sp.PIPE, stderr=src_err)
+        return src_proc.stdout, src_proc, src_err
+
+    def _tar_run(self, run, tmp_files=[]):
+        """Write the tarball of a run, with GNU tar or, if 'tar_workers' is
+        configured, with the read-ahead tar writer."""
+        if not self.tar_workers:
+            exclude_files = " ".join([f"--exclude {x}" for x in self.exclude_list])
+            return self._call_commands(
+                cmd1=f"tar {exclude_files} -C {run.path} -cf - {run.name}",
+                out_file=run.tar,
+                mail_failed=True,
+                tmp_files=tmp_files,
+            )
+        try:
+            parallel_tar.write_tar(
+                run.tar,
+                run.abs_path,
+                run.name,
+                exclude=self.exclude_list,
+                workers=self.tar_workers,
+            )
+        except (OSError, tarfile.TarError) as e:
+            return self._check_status(
+                ["tar", "-cf", run.tar, run.abs_path], 2, str(e), True, tmp_files
+            )
+        return True
+
+    def _stop_tar_stream(self, src, src_proc):
+        """Stop a tar started by '_open_tar_stream' whose stream is not read."""
+        src.close()
+        if src_proc is None:
+            return
+        if isinstance(src_proc, sp.Popen):
+            src_proc.terminate()
+        src_proc.wait()
+
+    def _check_tar_stream(self, src_proc, src_err, tmp_files=[]):
+        """Wait for a tar started by '_open_tar_stream' and check its status."""
+        if src_proc is None:
+            return True
+        src_stat = src_proc.wait()
+        src_err.seek(0)
+        return self._check_status(
+            src_proc.args, src_stat, src_err.read(), True, tmp_files
+        )
+
+    def _start_compression(self, src):
+        """Start the compression codec and a thread feeding it the tar stream.
+
+        Returns the codec process, the file capturing its stderr, the feeder
+        thread and a dict in which the feeder counts the bytes it passed on.
+        """
+        codec_cmd = self.compression.compress_cmd()
+        codec_err = tempfile.TemporaryFile()
+        try:
+            codec_proc = sp.Popen(
+                codec_cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=codec_err
+            )
+        except OSError:
+            codec_err.close()
+            raise
+        fed = {"bytes": 0}
+
+        def feed():
+            try:
+                for chunk in iter(lambda: src.read(STREAM_CHUNK_SIZE), b""):
+                    codec_proc.stdin.write(chunk)
+                    fed["bytes"] += len(chunk)
+            except BrokenPipeError:
+                # the codec died, its exit status is checked by the caller
+                pass
+            finally:
+                try:
+                    codec_proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        return codec_proc, codec_err, feeder, fed
+
+    def _stream_encrypt(self, run, tmp_files=[], compress=False):
+        """Encrypt a run in a single pass by piping the tar stream through an
+        in-process md5 hasher straight into gpg, so no plain tarball is ever
+        written to disk. An already existing tarball is streamed as is.
+
+        With 'compress', runs worth compressing are passed through the
+        configured compression codec ahead of the hasher, and the codec and
+        compression ratio are recorded in 'run.tar_compression'.
+
+        The digest of the stream given to gpg is written to 'run.tar_digest'
+        in md5sum format. Returns the digest or None if anything failed.
+        """
+        src, src_proc, src_err = self._open_tar_stream(run)
+        codec_proc = None
+        if compress and self.compression.worth_compressing(
+            run.tar if os.path.exists(run.tar) else run.abs_path
+        ):
+            logger.info(f"Compressing run {run.name} with {self.compression.codec}")
+            try:
+                codec_proc, codec_err, feeder, fed = self._start_compression(src)
+            except OSError as e:
+                # E.g. the codec is not installed
+                logger.error(
+                    f"Could not start {self.compression.codec} for run {run.name}: {e}"
+                )
+                self._stop_tar_stream(src, src_proc)
+                self._clean_tmp_files(tmp_files)
+                return None
+            payload = codec_proc.stdout
+        else:
+            payload = src
+        gpg_cmd = (
+            f"gpg --symmetric --cipher-algo aes256 --passphrase-file {run.key} --batch "
+            f"--compress-algo none -o {run.tar_encrypted}"
+        ).split()
+        gpg_err = tempfile.TemporaryFile()
+        gpg_proc = sp.Popen(gpg_cmd, stdin=sp.PIPE, stderr=gpg_err)
+        hasher = hashlib.md5()
+        payload_bytes = 0
+        try:
+            for chunk in iter(lambda: payload.read(STREAM_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                payload_bytes += len(chunk)
+                gpg_proc.stdin.write(chunk)
+        except BrokenPipeError:
+            # gpg died, its exit status is checked below
+            pass
+        finally:
+            payload.close()
+            if codec_proc is not None:
+                feeder.join()
+                src.close()
+            try:
+                gpg_proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        gpg_stat = gpg_proc.wait()
+        if not self._check_tar_stream(src_proc, src_err, tmp_files):
+            return None
+        if codec_proc is not None:
+            codec_stat = codec_proc.wait()
+            codec_err.seek(0)
+            if not self._check_status(
+                codec_proc.args, codec_stat, codec_err.read(), False, tmp_files
+            ):
+                return None
+        gpg_err.seek(0)
+        if not self._check_status(gpg_cmd, gpg_stat, gpg_err.read(), False, tmp_files):
+            return None
+        digest = hasher.hexdigest()
+        if codec_proc is None:
+            self._write_digest(run, digest)
+            return digest
+        ratio = fed["bytes"] / payload_bytes if payload_bytes else 1.0
+        with open(run.tar_compression, "w") as compression_file:
+            json.dump(
+                {
+                    "codec": self.compression.codec,
+                    "level": self.compression.level,
+                    "raw_bytes": fed["bytes"],
+                    "compressed_bytes": payload_bytes,
+                    "ratio": round(ratio, 3),
+                },
+                compression_file,
+            )
+        logger.info(f"Compressed run {run.name} with ratio {ratio:.2f}")
+        self._write_digest(run, digest, extension=self.compression.extension)
+        return digest
+
+    def _indexed_encrypt(self, run, tmp_files=[]):
+        """Encrypt a run in a single pass into an indexed archive,
+        'run.tar_segmented', whose segments can be decrypted independently,
+        together with the index of its members, see
+        'taca.backup.indexed_archive'.
+
+        The digest of the plain tar stream is written to 'run.tar_digest' in
+        md5sum format. Returns the digest or None if anything failed.
+        """
+        src, src_proc, src_err = self._open_tar_stream(run)
+        try:
+            digest = indexed_archive.write_indexed_archive(
+                src,
+                run.tar_segmented,
+                run.tar_index,
+                run.key,
+                segment_size=self.segment_size,
+            )
+        except indexed_archive.IndexedArchiveError as e:
+            logger.error(f"Encryption of run {run.name} failed: {e}")
+            digest = None
+        finally:
+            src.close()
+        if not self._check_tar_stream(src_proc, src_err, tmp_files):
+            return None
+        if not digest:
+            self._clean_tmp_files(tmp_files)
+            return None
+        self._write_digest(run, digest)
+        return digest
+
+    def _indexed_decrypted_digest(self, run, tmp_files=[]):
+        """Decrypt all segments of an indexed archive on the fly and return the
+        md5 digest of the decrypted stream, or None if decryption failed."""
+        try:
+            return indexed_archive.decrypted_digest(
+                run.tar_segmented, run.tar_index, run.key
+            )
+        except indexed_archive.IndexedArchiveError as e:
+            logger.error(f"Decryption of run {run.name} failed: {e}")
+            self._clean_tmp_files(tmp_files)
+            return None
+
+    def _write_digest(self, run, digest, extension=None):
+        """Record the md5 digest of the run tarball in md5sum format, with
+        the extension of the codec if it was compressed."""
+        tar_name = os.path.basename(run.tar)
+        if extension:
+            tar_name = f"{tar_name}.{extension}"
+        with open(run.tar_digest, "w") as digest_file:
+            digest_file.write(f"{digest}  {tar_name}\n")
+
+    def _compression_ratio(self, run):
+        """Return the compression ratio recorded for a run, or None if it
+        was not compressed."""
+        if not os.path.exists(run.tar_compression):
+            return None
+        with open(run.tar_compression) as compression_file:
+            return json.load(compression_file)["ratio"]
+
+    def _stream_decrypted_digest(self, run, tmp_files=[]):
+        """Decrypt the encrypted run on the fly and return the md5 digest of
+        the decrypted stream, or None if decryption failed."""
+        gpg_cmd = (
+            f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch "
+            f"{run.tar_encrypted}"
+        ).split()
+        gpg_err = tempfile.TemporaryFile()
+        gpg_proc = sp.Popen(gpg_cmd, stdout=sp.PIPE, stderr=gpg_err)
+        hasher = hashlib.md5()
+        for chunk in iter(lambda: gpg_proc.stdout.read(STREAM_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+        gpg_proc.stdout.close()
+        gpg_stat = gpg_proc.wait()
+        gpg_err.seek(0)
+        if not self._check_status(gpg_cmd, gpg_stat, gpg_err.read(), False, tmp_files):
+            return None
+        return hasher.hexdigest()
+
+    def _log_pdc_statusdb(self, run, compression_ratio=None):
+        """Log the time stamp in statusDB if a file is succussfully sent to PDC,
+        together with the compression ratio if the run was compressed."""
         if re.match(filesystem.RUN_RE_ELEMENT, run):
             try:
                 element_db_connection = statusdb.ElementRunsConnection(
@@ -285,6 +669,8 @@ class backup_utils:
                 run_doc = element_db_connection.db[run_doc_id]
                 run_doc["pdc_archived"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 run_doc["run_status"] = "archived"
+                if compression_ratio is not None:
+                    run_doc["pdc_compression_ratio"] = compression_ratio
                 element_db_connection.upload_to_statusdb(run_doc)
             except:
                 logger.warning(
@@ -304,6 +690,8 @@ class backup_utils:
                 d_id = fc_names[run_fc]
                 doc = db.get(d_id)
                 doc["pdc_archived"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                if compression_ratio is not None:
+                    doc["pdc_compression_ratio"] = compression_ratio
                 db.save(doc)
                 logger.info(
                     f'Logged "pdc_archived" timestamp for fc {run} in statusdb doc "{d_id}"'
@@ -324,6 +712,7 @@ class backup_utils:
                 os.path.exists(rta_file)
                 and os.path.exists(cp_file)
                 and (not self.file_in_pdc(run.tar_encrypted))
+                and (not self.file_in_pdc(run.tar_segmented))
             )
             or (
                 self._get_run_type(run.name) in ["promethion", "minion"]
@@ -336,14 +725,16 @@ class backup_utils:
         ):
             # Case for encrypting
             # Run has NOT been encrypted (run.tar.gpg not exists)
-            if ext == ".tar" and (not os.path.exists(run.tar_encrypted)):
+            if ext == ".tar" and not (
+                os.path.exists(run.tar_encrypted) or os.path.exists(run.tar_segmented)
+            ):
                 logger.info(
                     f"Sequencing has finished and copying completed for run {os.path.basename(run_path)} and is ready for archiving"
                 )
                 archive_ready = True
             # Case for putting data to PDC
             # Run has already been encrypted (run.tar.gpg exists)
-            elif ext == ".tar.gpg" and os.path.exists(run.tar_encrypted):
+            elif ext == ".tar.gpg" and os.path.exists(run.encrypted_file()):
                 logger.info(
                     f"Sequencing has finished and copying completed for run {os.path.basename(run_path)} and is ready for sending to PDC"
                 )
@@ -351,11 +742,15 @@ class backup_utils:
 
         return archive_ready
 
-    def log_archived_run(self, file_name):
-        """Write files archived to PDC to log file"""
+    def log_archived_run(self, file_name, compression_ratio=None):
+        """Write files archived to PDC to log file, with the compression ratio
+        if the run was compressed"""
+        row = [file_name, str(datetime.now())]
+        if compression_ratio is not None:
+            row.append(f"{compression_ratio:.2f}")
         with open(self.archive_log_location, "a") as archive_file:
             tsv_writer = csv.writer(archive_file, delimiter="\t")
-            tsv_writer.writerow([file_name, str(datetime.now())])
+            tsv_writer.writerow(row)
 
     def _move_run_to_archived(self, run):
         """Move a run folder from nosync to archived"""
@@ -363,23 +758,214 @@ class backup_utils:
         archived_path = self.archived_dirs[run_type]
         if os.path.isdir(archived_path):
             logger.info(f"Moving run {run.name} to the archived folder")
-            shutil.move(run.name, archived_path)
+            shutil.move(run.abs_path, archived_path)
         else:
             logger.warning("Cannot move run to archived, destination does not exist")
 
+    def _encrypt_run(self, run, force, stream=False, indexed=False, compress=False):
+        """Encrypt a single run whose disk space has already been reserved.
+
+        Only absolute paths are used, since runs are encrypted by concurrent
+        workers which can not change the working directory.
+        """
+        if indexed and compress:
+            logger.warning(
+                f"Indexed archives are not compressed, so run {run.name} will be encrypted as is"
+            )
+            compress = False
+        # Indexed and compressed archives are always written in a single pass
+        stream = stream or indexed or compress
+        run.flag = os.path.join(run.path, f"{run.name}.encrypting")
+        run.key = os.path.join(run.path, f"{run.name}.key")
+        run.key_encrypted = os.path.join(run.path, f"{run.name}.key.gpg")
+        run.dst_key_encrypted = os.path.join(
+            self.keys_path, os.path.basename(run.key_encrypted)
+        )
+        tmp_files = [
+            run.tar_encrypted,
+            run.tar_segmented,
+            run.tar_digest,
+            run.tar_index,
+            run.tar_compression,
+            run.key_encrypted,
+            run.key,
+            run.flag,
+        ]
+        logger.info(f"Encryption of run {run.name} is now started")
+        # skip run if already ongoing
+        if not self._claim_flag(run.flag):
+            logger.warning(
+                f"Run {run.name} is already being encrypted, so skipping now"
+            )
+            return
+        # Make run directory tarball
+        if os.path.exists(run.tar):
+            if os.path.isdir(run.abs_path):
+                logger.warning(
+                    f"Both run source and archive tarball exist for run {run.name}, skipping run as precaution"
+                )
+                self._clean_tmp_files([run.flag])
+                return
+            logger.info(
+                f"Archive tarball already exist for run {run.name}, so using it for encryption"
+            )
+        elif not stream:
+            logger.info(f"Creating archive tarball for run {run.name}")
+            if self._tar_run(run, tmp_files=[run.tar, run.flag]):
+                logger.info(
+                    f"Run {run.name} was successfully tarballed and transferred to {run.tar}"
+                )
+            else:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return
+        # Remove encrypted file if already exists
+        if os.path.exists(run.tar_encrypted) or os.path.exists(run.tar_segmented):
+            logger.warning(
+                f"Removing already existing encrypted file for run {run.name}, this is a precaution "
+                "to make sure the file was encrypted with correct key file"
+            )
+            self._clean_tmp_files(
+                [
+                    run.tar_encrypted,
+                    run.tar_segmented,
+                    run.tar_digest,
+                    run.tar_index,
+                    run.tar_compression,
+                    run.key,
+                    run.key_encrypted,
+                    run.dst_key_encrypted,
+                ]
+            )
+        # Generate random key to use as pasphrase
+        if not self._call_commands(
+            cmd1=KEY_COMMAND, out_file=run.key, tmp_files=tmp_files
+        ):
+            logger.warning(f"Skipping run {run.name} and moving on")
+            return
+        logger.info(f"Generated random phrase key for run {run.name}")
+        if indexed:
+            # Tar, hash, index and encrypt in one pass
+            logger.info(f"Streaming run {run.name} into an indexed archive")
+            md5_pre_encrypt = self._indexed_encrypt(run, tmp_files=tmp_files)
+            if not md5_pre_encrypt:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return
+        elif stream:
+            # Tar, hash and encrypt in one pass
+            logger.info(f"Streaming run {run.name} through tar and gpg")
+            md5_pre_encrypt = self._stream_encrypt(
+                run, tmp_files=tmp_files, compress=compress
+            )
+            if not md5_pre_encrypt:
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return
+        else:
+            # Calculate md5 sum pre encryption
+            if not force:
+                logger.info("Calculating md5sum before encryption")
+                md5_call, md5_out = self._call_commands(
+                    cmd1=f"md5sum {run.tar}",
+                    return_out=True,
+                    tmp_files=tmp_files,
+                )
+                if not md5_call:
+                    logger.warning(f"Skipping run {run.name} and moving on")
+                    return
+                md5_pre_encrypt = md5_out.split()[0]
+                self._write_digest(run, md5_pre_encrypt.decode("utf-8"))
+            # Encrypt the tar run file
+            logger.info("Encrypting the tar run file")
+            if not self._call_commands(
+                cmd1=(
+                    f"gpg --symmetric --cipher-algo aes256 --passphrase-file {run.key} --batch --compress-algo "
+                    f"none -o {run.tar_encrypted} {run.tar}"
+                ),
+                tmp_files=tmp_files,
+            ):
+                logger.warning(f"Skipping run {run.name} and moving on")
+                return
+        # Decrypt and check for md5
+        if not force:
+            logger.info("Calculating md5sum after encryption")
+            if indexed:
+                md5_post_encrypt = self._indexed_decrypted_digest(
+                    run, tmp_files=tmp_files
+                )
+                if not md5_post_encrypt:
+                    logger.warning(f"Skipping run {run.name} and moving on")
+                    return
+            elif stream:
+                md5_post_encrypt = self._stream_decrypted_digest(
+                    run, tmp_files=tmp_files
+                )
+                if not md5_post_encrypt:
+                    logger.warning(f"Skipping run {run.name} and moving on")
+                    return
+            else:
+                md5_call, md5_out = self._call_commands(
+                    cmd1=f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch {run.tar_encrypted}",
+                    cmd2="md5sum",
+                    return_out=True,
+                    tmp_files=tmp_files,
+                )
+                if not md5_call:
+                    logger.warning(f"Skipping run {run.name} and moving on")
+                    return
+                md5_post_encrypt = md5_out.split()[0]
+            if md5_pre_encrypt != md5_post_encrypt:
+                logger.error(
+                    f"md5sum did not match before {md5_pre_encrypt} and after {md5_post_encrypt} encryption. Will remove temp files and move on"
+                )
+                self._clean_tmp_files(tmp_files)
+                return
+            logger.info("Md5sum matches before and after encryption")
+        # Encrypt and move the key file
+        if self._call_commands(
+            cmd1=f"gpg -e -r {self.gpg_receiver} -o {run.key_encrypted} {run.key}",
+            tmp_files=tmp_files,
+        ):
+            shutil.move(run.key_encrypted, run.dst_key_encrypted)
+        else:
+            logger.error("Encryption of key file failed, skipping run")
+            return
+        self._clean_tmp_files([run.tar, run.key, run.flag])
+        logger.info(
+            f"Encryption of run {run.name} is successfully done, removing run folder tarball"
+        )
+
+    def _encrypt_run_and_release(
+        self, run, force, stream=False, indexed=False, compress=False
+    ):
+        """Encrypt a run and release its disk space reservation afterwards."""
+        try:
+            self._encrypt_run(run, force, stream, indexed, compress)
+        finally:
+            self.reservation_ledger.release(run.name)
+
     @classmethod
-    def encrypt_runs(cls, run, force):
-        """Encrypt the runs that have been collected."""
+    def encrypt_runs(
+        cls, run, force, stream=False, workers=None, indexed=False, compress=False
+    ):
+        """Encrypt the runs that have been collected.
+
+        With 'stream' the run is tarred, hashed and encrypted in a single pass
+        without writing an intermediate tarball, see '_stream_encrypt'. With
+        'indexed' the run is also written as an indexed archive from which
+        single files can be restored, see '_indexed_encrypt'. With 'compress'
+        runs worth compressing are streamed through the configured codec
+        before they are encrypted.
+
+        Up to 'workers' runs are encrypted at the same time, defaults to the
+        'encrypt_workers' config option. A run is only started once its disk
+        space could be reserved in the reservation ledger, otherwise it waits
+        for ongoing encryptions of this invocation to finish.
+        """
         bk = cls(run)
         bk.collect_runs(ext=".tar")
         logger.info(f"In total, found {len(bk.runs)} run(s) to be encrypted")
+        workers = workers or bk.encrypt_workers
+        pending = []
         for run in bk.runs:
-            run.flag = f"{run.name}.encrypting"
-            run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
-            tmp_files = [run.tar_encrypted, run.key_encrypted, run.key, run.flag]
-            logger.info(f"Encryption of run {run.name} is now started")
-            # Check if there is enough space and exit if not
-            bk.avail_disk_space(run.path, run.name)
             # Check if the run in demultiplexed
             if not force and bk.check_demux:
                 if not misc.run_is_demuxed(
@@ -392,185 +978,476 @@ class backup_utils:
                 logger.info(
                     f"Run {run.name} is demultiplexed and proceeding with encryption"
                 )
-            with filesystem.chdir(run.path):
-                # skip run if already ongoing
-                if os.path.exists(run.flag):
-                    logger.warning(
-                        f"Run {run.name} is already being encrypted, so skipping now"
-                    )
-                    continue
-                open(run.flag, "w").close()
-                # Make run directory tarball
-                if os.path.exists(run.tar):
-                    if os.path.isdir(run.name):
-                        logger.warning(
-                            f"Both run source and archive tarball exist for run {run.name}, skipping run as precaution"
-                        )
-                        bk._clean_tmp_files([run.flag])
-                        continue
-                    logger.info(
-                        f"Archive tarball already exist for run {run.name}, so using it for encryption"
-                    )
-                else:
-                    exclude_files = " ".join(
-                        [f"--exclude {x}" for x in bk.exclude_list]
+            if not os.path.exists(run.tar):
+                # Walking a run folder is slow, it is measured once here
+                # rather than on every attempt to reserve its space below
+                run.size = filesystem.dir_size(run.abs_path)
+            pending.append(run)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                if (
+                    pending
+                    and len(running) < workers
+                    and bk.reserve_disk_space(
+                        pending[0],
+                        stream=stream or indexed or compress,
+                        indexed=indexed,
                     )
-                    logger.info(f"Creating archive tarball for run {run.name}")
-                    if bk._call_commands(
-                        cmd1=f"tar {exclude_files} -cf - {run.name}",
-                        out_file=run.tar,
-                        mail_failed=True,
-                        tmp_files=[run.tar, run.flag],
-                    ):
-                        logger.info(
-                            f"Run {run.name} was successfully tarballed and transferred to {run.tar}"
-                        )
-                    else:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                # Remove encrypted file if already exists
-                if os.path.exists(run.tar_encrypted):
-                    logger.warning(
-                        f"Removing already existing encrypted file for run {run.name}, this is a precaution "
-                        "to make sure the file was encrypted with correct key file"
-                    )
-                    bk._clean_tmp_files(
-                        [
-                            run.tar_encrypted,
-                            run.key,
-                            run.key_encrypted,
-                            run.dst_key_encrypted,
-                        ]
-                    )
-                # Generate random key to use as pasphrase
-                if not bk._call_commands(
-                    cmd1="gpg --gen-random 1 256", out_file=run.key, tmp_files=tmp_files
                 ):
-                    logger.warning(f"Skipping run {run.name} and moving on")
-                    continue
-                logger.info(f"Generated random phrase key for run {run.name}")
-                # Calculate md5 sum pre encryption
-                if not force:
-                    logger.info("Calculating md5sum before encryption")
-                    md5_call, md5_out = bk._call_commands(
-                        cmd1=f"md5sum {run.tar}", return_out=True, tmp_files=tmp_files
+                    run = pending.pop(0)
+                    future = executor.submit(
+                        bk._encrypt_run_and_release,
+                        run,
+                        force,
+                        stream,
+                        indexed,
+                        compress,
                     )
-                    if not md5_call:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                    md5_pre_encrypt = md5_out.split()[0]
-                # Encrypt the tar run file
-                logger.info("Encrypting the tar run file")
-                if not bk._call_commands(
-                    cmd1=(
-                        f"gpg --symmetric --cipher-algo aes256 --passphrase-file {run.key} --batch --compress-algo "
-                        f"none -o {run.tar_encrypted} {run.tar}"
-                    ),
-                    tmp_files=tmp_files,
-                ):
-                    logger.warning(f"Skipping run {run.name} and moving on")
+                    running[future] = run
                     continue
-                # Decrypt and check for md5
-                if not force:
-                    logger.info("Calculating md5sum after encryption")
-                    md5_call, md5_out = bk._call_commands(
-                        cmd1=f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch {run.tar_encrypted}",
-                        cmd2="md5sum",
-                        return_out=True,
-                        tmp_files=tmp_files,
-                    )
-                    if not md5_call:
-                        logger.warning(f"Skipping run {run.name} and moving on")
-                        continue
-                    md5_post_encrypt = md5_out.split()[0]
-                    if md5_pre_encrypt != md5_post_encrypt:
-                        logger.error(
-                            f"md5sum did not match before {md5_pre_encrypt} and after {md5_post_encrypt} encryption. Will remove temp files and move on"
-                        )
-                        bk._clean_tmp_files(tmp_files)
-                        continue
-                    logger.info("Md5sum matches before and after encryption")
-                # Encrypt and move the key file
-                if bk._call_commands(
-                    cmd1=f"gpg -e -r {bk.gpg_receiver} -o {run.key_encrypted} {run.key}",
-                    tmp_files=tmp_files,
-                ):
-                    shutil.move(run.key_encrypted, run.dst_key_encrypted)
-                else:
-                    logger.error("Encryption of key file failed, skipping run")
-                    continue
-                bk._clean_tmp_files([run.tar, run.key, run.flag])
-                logger.info(
-                    f"Encryption of run {run.name} is successfully done, removing run folder tarball"
+                if pending and not running:
+                    # Not enough space even with nothing else ongoing
+                    bk.notify_low_disk_space(pending[0])
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    run = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Encryption of run {run.name} failed: {e}")
+
+    def _claim_flag(self, flag):
+        """Atomically create a flag file, return False if it already exists.
+
+        Creating the file exclusively guarantees that two workers, or a worker
+        and another TACA invocation, never pick up the same run.
+        """
+        try:
+            os.close(os.open(flag, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def _pdc_call_with_retry(self, description, pdc_call, tmp_files=[]):
+        """Run a dsmc call, retrying it with an exponentially increasing delay
+        if it failed. 'pdc_call' is given the files to remove on failure, the
+        'tmp_files' are only passed on the last attempt."""
+        for attempt in range(self.pdc_retries + 1):
+            last_attempt = attempt == self.pdc_retries
+            if pdc_call(tmp_files if last_attempt else []):
+                return True
+            if not last_attempt:
+                delay = self.pdc_retry_delay * 2**attempt
+                logger.warning(f"{description} failed, retrying in {delay} seconds")
+                time.sleep(delay)
+        return False
+
+    def _archive_to_pdc_with_retry(self, src_file, tmp_files=[]):
+        """Archive a file to PDC, retrying failed dsmc calls."""
+        return self._pdc_call_with_retry(
+            f"Archiving {src_file} to PDC",
+            lambda to_remove: self._archive_to_pdc(src_file, tmp_files=to_remove),
+            tmp_files,
+        )
+
+    def _retrieve_from_pdc_with_retry(self, src_file, dst_file, tmp_files=[]):
+        """Retrieve a file archived in PDC to 'dst_file', retrying failed dsmc calls."""
+        return self._pdc_call_with_retry(
+            f"Retrieving {src_file} from PDC",
+            lambda to_remove: self._call_commands(
+                cmd1=f"dsmc retrieve -replace=yes {src_file} {dst_file}",
+                tmp_files=to_remove,
+            ),
+            tmp_files,
+        )
+
+    def _wait_for_pdc(self, src_file):
+        """Poll PDC until the given file is confirmed to be archived or
+        'pdc_confirm_timeout' seconds have passed."""
+        deadline = time.monotonic() + self.pdc_confirm_timeout
+        interval = 1
+        while True:
+            if self.file_in_pdc(src_file, refresh=True):
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 60)
+
+    def _pdc_put_run(self, run):
+        """Archive the encrypted run, its key and digest to PDC.
+
+        Returns a dict with the outcome, the number of bytes sent and the
+        time it took, to be used in the summary of 'pdc_put'.
+        """
+        result = {"run": run.name, "status": "skipped", "bytes": 0, "seconds": 0}
+        run.flag = os.path.join(run.path, f"{run.name}.archiving")
+        encrypted = run.encrypted_file()
+        run.dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        if run.path not in self.archive_dirs.values():
+            logger.error(
+                "Given run is not in one of the archive directories {}. Kindly move the run {} to appropriate "
+                "archive dir before sending it to PDC".format(
+                    ",".join(list(self.archive_dirs.values())), run.name
                 )
+            )
+            return result
+        if not os.path.exists(run.dst_key_encrypted):
+            logger.error(
+                f"Encrypted key file {run.dst_key_encrypted} is not found for file {encrypted}, skipping it"
+            )
+            return result
+        # skip run if being encrypted
+        if os.path.exists(os.path.join(run.path, f"{run.name}.encrypting")):
+            logger.warning(
+                f"Run {run.name} is currently being encrypted, so skipping now"
+            )
+            return result
+        # skip run if already ongoing
+        if os.path.exists(run.flag):
+            logger.warning(f"Run {run.name} is already being archived, so skipping now")
+            return result
+        if self.file_in_pdc(encrypted, silent=False) or self.file_in_pdc(
+            run.dst_key_encrypted, silent=False
+        ):
+            logger.warning(
+                f"Seems like files related to run {run.name} already exist in PDC, check and cleanup"
+            )
+            return result
+        if not self._claim_flag(run.flag):
+            logger.warning(f"Run {run.name} is already being archived, so skipping now")
+            return result
+        result["status"] = "failed"
+        result["bytes"] = os.path.getsize(encrypted)
+        logger.info(f"Sending file {encrypted} to PDC")
+        start = time.monotonic()
+        if not self._archive_to_pdc_with_retry(encrypted, tmp_files=[run.flag]):
+            logger.warning(f"Sending file {encrypted} to PDC failed")
+            return result
+        result["seconds"] = time.monotonic() - start
+        for src_file in [
+            run.dst_key_encrypted,
+            run.tar_digest,
+            run.tar_index,
+            run.tar_compression,
+        ]:
+            if src_file != run.dst_key_encrypted and not os.path.exists(src_file):
+                continue
+            if not self._archive_to_pdc_with_retry(src_file, tmp_files=[run.flag]):
+                logger.warning(f"Sending file {src_file} to PDC failed")
+                return result
+        if not (
+            self._wait_for_pdc(encrypted) and self._wait_for_pdc(run.dst_key_encrypted)
+        ):
+            logger.warning(
+                f"Could not confirm that file {encrypted} was sent to PDC, check and cleanup"
+            )
+            return result
+        logger.info(
+            f"Successfully sent file {encrypted} to PDC, moving file locally from {run.path} to archived folder"
+        )
+        compression_ratio = self._compression_ratio(run)
+        self.log_archived_run(encrypted, compression_ratio)
+        if self.couch_info:
+            self._log_pdc_statusdb(run.name, compression_ratio)
+        self._clean_tmp_files(
+            [
+                encrypted,
+                run.tar_digest,
+                run.tar_index,
+                run.tar_compression,
+                run.dst_key_encrypted,
+                run.flag,
+            ]
+        )
+        self._move_run_to_archived(run)
+        result["status"] = "archived"
+        return result
+
+    def _log_pdc_summary(self, results, done_status="archived"):
+        """Log the outcome of a 'pdc_put' or 'restore_runs' with the throughput
+        of each run."""
+        logger.info("Summary of runs transferred with PDC:")
+        for result in results:
+            if result["status"] == "skipped":
+                continue
+            mb = result["bytes"] / 1024 / 1024
+            throughput = mb / result["seconds"] if result["seconds"] else 0
+            logger.info(
+                f"{result['run']}\t{result['status']}\t{mb:.1f} MB\t"
+                f"{result['seconds']:.0f} s\t{throughput:.1f} MB/s"
+            )
+        done = [r for r in results if r["status"] == done_status]
+        total_mb = sum(r["bytes"] for r in done) / 1024 / 1024
+        logger.info(
+            f"{done_status.capitalize()} {len(done)} of {len(results)} run(s), {total_mb:.1f} MB in total"
+        )
 
     @classmethod
-    def pdc_put(cls, run):
-        """Archive the collected runs to PDC."""
+    def pdc_put(cls, run, workers=None):
+        """Archive the collected runs to PDC.
+
+        Up to 'workers' runs are archived at the same time, each with its own
+        dsmc session. Defaults to the 'pdc_sessions' config option.
+        """
         bk = cls(run)
         bk.collect_runs(ext=".tar.gpg", filter_by_ext=True)
         logger.info(f"In total, found {len(bk.runs)} run(s) to send PDC")
-        for run in bk.runs:
-            run.flag = f"{run.name}.archiving"
-            run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
-            if run.path not in bk.archive_dirs.values():
-                logger.error(
-                    "Given run is not in one of the archive directories {}. Kindly move the run {} to appropriate "
-                    "archive dir before sending it to PDC".format(
-                        ",".join(list(bk.archive_dirs.values())), run.name
+        workers = workers or bk.pdc_sessions
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(bk._pdc_put_run, bk.runs))
+        else:
+            results = [bk._pdc_put_run(run) for run in bk.runs]
+        bk._log_pdc_summary(results)
+
+    def _stream_restore(self, run, outdir):
+        """Decrypt a retrieved run straight into tar extraction in 'outdir', so
+        neither the decrypted tarball nor a second copy of the run is written.
+
+        Indexed archives are decrypted segment by segment and compressed
+        ones are decompressed with the codec they were compressed with.
+        Progress and throughput are logged every RESTORE_PROGRESS_INTERVAL
+        seconds. Returns the md5 digest of the decrypted stream or None if
+        anything failed.
+        """
+        encrypted = run.encrypted_file()
+        index = None
+        if encrypted == run.tar_segmented:
+            # Not a single gpg message, it is decrypted segment by segment
+            try:
+                index = indexed_archive.load_index(run.tar_index)
+            except (OSError, ValueError, indexed_archive.IndexedArchiveError) as e:
+                logger.error(f"Can not restore run {run.name} without its index: {e}")
+                return None
+        tar_cmd = ["tar", "-xf", "-", "-C", outdir]
+        tar_err = tempfile.TemporaryFile()
+        codec_proc = None
+        if os.path.exists(run.tar_compression):
+            with open(run.tar_compression) as compression_file:
+                codec = json.load(compression_file)["codec"]
+            codec_err = tempfile.TemporaryFile()
+            codec_proc = sp.Popen(
+                compression.decompress_cmd(codec),
+                stdin=sp.PIPE,
+                stdout=sp.PIPE,
+                stderr=codec_err,
+            )
+            tar_proc = sp.Popen(tar_cmd, stdin=codec_proc.stdout, stderr=tar_err)
+            # Only tar should hold the read end of the pipe
+            codec_proc.stdout.close()
+            sink = codec_proc.stdin
+        else:
+            tar_proc = sp.Popen(tar_cmd, stdin=sp.PIPE, stderr=tar_err)
+            sink = tar_proc.stdin
+        gpg_proc = None
+        if index is not None:
+            chunks = indexed_archive.decrypt_archive(encrypted, index, run.key)
+        else:
+            gpg_cmd = (
+                f"gpg --decrypt --cipher-algo aes256 --passphrase-file {run.key} --batch "
+                f"{encrypted}"
+            ).split()
+            gpg_err = tempfile.TemporaryFile()
+            gpg_proc = sp.Popen(gpg_cmd, stdout=sp.PIPE, stderr=gpg_err)
+            chunks = iter(lambda: gpg_proc.stdout.read(STREAM_CHUNK_SIZE), b"")
+        total_mb = os.path.getsize(encrypted) / 1024 / 1024
+        hasher = hashlib.md5()
+        restored = 0
+        decrypted = True
+        start = last_report = time.monotonic()
+        try:
+            for chunk in chunks:
+                hasher.update(chunk)
+                sink.write(chunk)
+                restored += len(chunk)
+                now = time.monotonic()
+                if now - last_report >= RESTORE_PROGRESS_INTERVAL:
+                    restored_mb = restored / 1024 / 1024
+                    logger.info(
+                        f"Restored {restored_mb:.0f} of {total_mb:.0f} MB of run {run.name}, "
+                        f"{restored_mb / (now - start):.1f} MB/s"
                     )
+                    last_report = now
+        except indexed_archive.IndexedArchiveError as e:
+            logger.error(f"Decryption of run {run.name} failed: {e}")
+            decrypted = False
+        except BrokenPipeError:
+            # tar or the codec died, their exit status is checked below
+            pass
+        finally:
+            try:
+                sink.close()
+            except BrokenPipeError:
+                pass
+            if gpg_proc is not None:
+                gpg_proc.stdout.close()
+        tar_stat = tar_proc.wait()
+        if codec_proc is not None:
+            codec_stat = codec_proc.wait()
+            codec_err.seek(0)
+            decompressed = self._check_status(
+                codec_proc.args, codec_stat, codec_err.read(), False
+            )
+        else:
+            decompressed = True
+        if gpg_proc is not None:
+            gpg_stat = gpg_proc.wait()
+            gpg_err.seek(0)
+            decrypted = self._check_status(gpg_cmd, gpg_stat, gpg_err.read(), False)
+        tar_err.seek(0)
+        if not (
+            self._check_status(tar_cmd, tar_stat, tar_err.read(), False)
+            and decrypted
+            and decompressed
+        ):
+            return None
+        return hasher.hexdigest()
+
+    def _restore_run(self, run_name, outdir):
+        """Retrieve an archived run from PDC and restore its run folder in 'outdir'.
+
+        Only the encrypted run is retrieved to disk, next to where it is
+        restored, and it is removed as soon as the run folder is extracted.
+        The restored data is verified against the digest recorded at
+        encryption time, if there is one. Returns a dict with the outcome,
+        the number of bytes retrieved and the time it took.
+        """
+        run_name = os.path.basename(run_name).split(".", 1)[0]
+        result = {"run": run_name, "status": "skipped", "bytes": 0, "seconds": 0}
+        run_type = self._get_run_type(run_name)
+        if run_type not in self.archive_dirs:
+            logger.error(
+                f"Could not tell which archive directory run {run_name} was sent to PDC from, skipping it"
+            )
+            return result
+        archive_path = self.archive_dirs[run_type]
+        run = run_vars(os.path.join(archive_path, run_name), archive_path)
+        run.dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        run_dest = os.path.join(outdir, run.name)
+        flag = os.path.join(outdir, f"{run.name}.restoring")
+        if os.path.exists(run_dest):
+            logger.warning(f"Run folder {run_dest} already exists, skipping it")
+            return result
+        if not self._claim_flag(flag):
+            logger.warning(f"Run {run.name} is already being restored, so skipping now")
+            return result
+        result["status"] = "failed"
+        logger.info(f"Restoring run {run.name} from PDC to {outdir}")
+        start = time.monotonic()
+        scratch_dir = tempfile.mkdtemp(prefix=f".{run.name}.", dir=outdir)
+        try:
+            # The retrieved files, with the same names as when they were archived
+            local = run_vars(os.path.join(scratch_dir, run.name), scratch_dir)
+            local.key = os.path.join(scratch_dir, run.key)
+            local.key_encrypted = os.path.join(scratch_dir, run.key_encrypted)
+            if self.file_in_pdc(run.tar_segmented):
+                encrypted, local_encrypted = run.tar_segmented, local.tar_segmented
+            else:
+                encrypted, local_encrypted = run.tar_encrypted, local.tar_encrypted
+            retrievals = [
+                (run.dst_key_encrypted, local.key_encrypted),
+                (encrypted, local_encrypted),
+            ]
+            for src_file, dst_file in [
+                (run.tar_digest, local.tar_digest),
+                (run.tar_index, local.tar_index),
+                (run.tar_compression, local.tar_compression),
+            ]:
+                if self.file_in_pdc(src_file):
+                    retrievals.append((src_file, dst_file))
+            for src_file, dst_file in retrievals:
+                if not self._retrieve_from_pdc_with_retry(src_file, dst_file):
+                    logger.warning(f"Retrieving {src_file} from PDC failed")
+                    return result
+            result["bytes"] = os.path.getsize(local_encrypted)
+            if not self._call_commands(
+                cmd1=f"gpg --decrypt --batch -o {local.key} {local.key_encrypted}"
+            ):
+                logger.error(f"Decryption of key file of run {run.name} failed")
+                return result
+            digest = self._stream_restore(local, outdir)
+            if digest is None:
+                logger.error(f"Restoring run {run.name} failed, removing {run_dest}")
+                shutil.rmtree(run_dest, ignore_errors=True)
+                return result
+            if os.path.exists(local.tar_digest):
+                with open(local.tar_digest) as digest_file:
+                    recorded_digest = digest_file.read().split()[0]
+                if digest != recorded_digest:
+                    logger.error(
+                        f"md5sum {digest} of restored run {run.name} did not match the one recorded "
+                        f"at encryption {recorded_digest}, removing {run_dest}"
+                    )
+                    shutil.rmtree(run_dest, ignore_errors=True)
+                    return result
+                logger.info(
+                    f"Md5sum of restored run {run.name} matches the recorded one"
                 )
-                continue
-            if not os.path.exists(run.dst_key_encrypted):
+            else:
+                logger.warning(
+                    f"No digest was recorded at encryption of run {run.name}, so the restored run could not be verified"
+                )
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            self._clean_tmp_files([flag])
+        result["seconds"] = time.monotonic() - start
+        result["status"] = "restored"
+        logger.info(f"Successfully restored run {run.name} to {run_dest}")
+        return result
+
+    @classmethod
+    def restore_runs(cls, runs, outdir=None, workers=None):
+        """Restore archived runs from PDC.
+
+        Up to 'workers' runs are restored at the same time, each with its own
+        dsmc session. Defaults to the 'pdc_sessions' config option.
+
+        :param list runs: names of the runs to restore
+        :param str outdir: directory to restore into, defaults to the current directory
+        """
+        bk = cls()
+        outdir = os.path.abspath(outdir or os.getcwd())
+        workers = workers or bk.pdc_sessions
+        logger.info(f"Restoring {len(runs)} run(s) from PDC to {outdir}")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda run: bk._restore_run(run, outdir), runs))
+        bk._log_pdc_summary(results, done_status="restored")
+
+    @classmethod
+    def extract_member(cls, run, member, key=None, outdir=None):
+        """Restore a single file from the indexed archive of an encrypted run,
+        decrypting only the segments that hold it.
+
+        :param str run: path to the encrypted run, with its index next to it
+        :param str member: path of the file in the run folder
+        :param str key: encrypted key file of the run, defaults to the one in 'keys_path'
+        :param str outdir: directory to restore into, defaults to the current directory
+        """
+        bk = cls()
+        run = run_vars(run, os.path.dirname(os.path.abspath(run)))
+        key = key or os.path.join(bk.keys_path, run.key_encrypted)
+        for required_file in [run.tar_segmented, run.tar_index, key]:
+            if not os.path.exists(required_file):
                 logger.error(
-                    f"Encrypted key file {run.dst_key_encrypted} is not found for file {run.tar_encrypted}, skipping it"
+                    f"File {required_file} is not found, can not extract from run {run.name}"
                 )
-                continue
-            with filesystem.chdir(run.path):
-                # skip run if being encrypted
-                if os.path.exists(f"{run.name}.encrypting"):
-                    logger.warning(
-                        f"Run {run.name} is currently being encrypted, so skipping now"
-                    )
-                    continue
-                # skip run if already ongoing
-                if os.path.exists(run.flag):
-                    logger.warning(
-                        f"Run {run.name} is already being archived, so skipping now"
-                    )
-                    continue
-                if bk.file_in_pdc(run.tar_encrypted, silent=False) or bk.file_in_pdc(
-                    run.dst_key_encrypted, silent=False
-                ):
-                    logger.warning(
-                        f"Seems like files related to run {run.name} already exist in PDC, check and cleanup"
-                    )
-                    continue
-                open(run.flag, "w").close()
-                logger.info(f"Sending file {run.tar_encrypted} to PDC")
-                if bk._call_commands(
-                    cmd1=f"dsmc archive {run.tar_encrypted}", tmp_files=[run.flag]
-                ):
-                    time.sleep(15)  # give some time just in case 'dsmc' needs to settle
-                    if bk._call_commands(
-                        cmd1=f"dsmc archive {run.dst_key_encrypted}",
-                        tmp_files=[run.flag],
-                    ):
-                        time.sleep(
-                            5
-                        )  # give some time just in case 'dsmc' needs to settle
-                        if bk.file_in_pdc(run.tar_encrypted) and bk.file_in_pdc(
-                            run.dst_key_encrypted
-                        ):
-                            logger.info(
-                                f"Successfully sent file {run.tar_encrypted} to PDC, moving file locally from {run.path} to archived folder"
-                            )
-                            bk.log_archived_run(run.tar_encrypted)
-                            if bk.couch_info:
-                                bk._log_pdc_statusdb(run.name)
-                            bk._clean_tmp_files(
-                                [run.tar_encrypted, run.dst_key_encrypted, run.flag]
-                            )
-                            bk._move_run_to_archived(run)
-                        continue
-                logger.warning(f"Sending file {run.tar_encrypted} to PDC failed")
+                raise SystemExit
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            key_file = os.path.join(tmp_dir, run.key)
+            if not bk._call_commands(cmd1=f"gpg --decrypt --batch -o {key_file} {key}"):
+                logger.error(f"Decryption of key file {key} failed")
+                raise SystemExit
+            try:
+                indexed_archive.extract_member(
+                    run.tar_segmented,
+                    run.tar_index,
+                    key_file,
+                    member,
+                    outdir or os.getcwd(),
+                )
+            except indexed_archive.IndexedArchiveError as e:
+                logger.error(e)
+                raise SystemExit
@@ -25,9 +25,65 @@ def backup(ctx):
     is_flag=True,
     help="Ignore the checks and just try encryption. USE IT WITH CAUTION.",
 )
+@click.option(
+    "-s",
+    "--stream",
+    is_flag=True,
+    help="Tar, checksum and encrypt in a single pass without writing the tarball to disk",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of runs to encrypt in parallel, as long as there is disk space for them",
+)
+@click.option(
+    "-i",
+    "--indexed",
+    is_flag=True,
+    help="Write an indexed archive of separately encrypted segments, run.tar.gpgseg, from which single files can be extracted",
+)
+@click.option(
+    "-c",
+    "--compress",
+    is_flag=True,
+    help="Compress runs worth compressing with the codec in the backup config before encrypting them",
+)
+@click.pass_context
+def encrypt(ctx, run, force, stream, workers, indexed, compress):
+    bkut.encrypt_runs(run, force, stream, workers, indexed, compress)
+
+
+@backup.command()
+@click.option(
+    "-r",
+    "--run",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="An encrypted run (run.tar.gpgseg) written with --indexed, with its index next to it",
+)
+@click.option(
+    "-m",
+    "--member",
+    required=True,
+    help="Path of the file to restore, relative to the run folder",
+)
+@click.option(
+    "-k",
+    "--key",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Encrypted key file of the run, defaults to the one in the keys path",
+)
+@click.option(
+    "-o",
+    "--outdir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    help="Directory to restore the file into, defaults to the current directory",
+)
 @click.pass_context
-def encrypt(ctx, run, force):
-    bkut.encrypt_runs(run, force)
+def extract(ctx, run, member, key, outdir):
+    """Restore a single file from an indexed run archive"""
+    bkut.extract_member(run, member, key, outdir)
 
 
 @backup.command(name="put_data")
@@ -37,9 +93,42 @@ def encrypt(ctx, run, force):
     type=click.Path(exists=True),
     help="A run name (without extension) to be sent to PDC",
 )
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of runs to send to PDC in parallel, each with its own dsmc session",
+)
+@click.pass_context
+def put_data(ctx, run, workers):
+    bkut.pdc_put(run, workers)
+
+
+@backup.command()
+@click.option(
+    "-r",
+    "--run",
+    "runs",
+    required=True,
+    multiple=True,
+    help="Name of an archived run to restore, can be given several times",
+)
+@click.option(
+    "-o",
+    "--outdir",
+    type=click.Path(exists=True, file_okay=False, writable=True),
+    help="Directory to restore the runs into, defaults to the current directory",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of runs to restore in parallel, each with its own dsmc session",
+)
 @click.pass_context
-def put_data(ctx, run):
-    bkut.pdc_put(run)
+def restore(ctx, runs, outdir, workers):
+    """Retrieve runs from PDC, decrypt and unpack them in a single pass"""
+    bkut.restore_runs(runs, outdir, workers)
 
 
 @backup.command(name="get_data")
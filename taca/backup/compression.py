@@ -0,0 +1,140 @@
+"""Optional compression of run archives ahead of encryption.
+
+Runs are compressed with a multi-threaded codec started as a subprocess
+between tar and gpg. Whether a run is worth compressing is decided from the
+types of its files: base calls, FASTQ and raw signal files are already
+compressed, while InterOp, logs, XML, filter and locs files compress well.
+"""
+
+import logging
+import os
+import tarfile
+
+logger = logging.getLogger(__name__)
+
+# Command lines of the supported codecs, with the file extension they add
+CODECS = {
+    "zstd": {
+        "compress": "zstd -q -T{threads} -{level} -c",
+        "decompress": "zstd -q -d -c",
+        "extension": "zst",
+        "level": 3,
+    },
+    "pigz": {
+        "compress": "pigz -p {threads} -{level} -c",
+        "decompress": "pigz -d -c",
+        "extension": "gz",
+        "level": 6,
+    },
+    "xz": {
+        "compress": "xz -T{threads} -{level} -c",
+        "decompress": "xz -d -c",
+        "extension": "xz",
+        "level": 1,
+    },
+}
+
+# Files with these suffixes are already compressed and not worth compressing again
+INCOMPRESSIBLE_SUFFIXES = [
+    ".gz",
+    ".bgzf",
+    ".zst",
+    ".bz2",
+    ".xz",
+    ".zip",
+    ".cbcl",
+    ".bam",
+    ".cram",
+    ".fast5",
+    ".pod5",
+    ".jpg",
+    ".jpeg",
+    ".png",
+]
+
+
+class CompressionSettings:
+    """Compression settings of the 'compression' section of the backup config.
+
+    The section is optional, all keys default to compressing with zstd on all
+    cores when at least a quarter of the bytes of a run is compressible.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.codec = config.get("codec", "zstd")
+        if self.codec not in CODECS:
+            raise ValueError(
+                f"Unknown compression codec {self.codec}, use one of {', '.join(CODECS)}"
+            )
+        self.level = config.get("level", CODECS[self.codec]["level"])
+        # zstd and xz use all cores with 0 threads, pigz needs a number
+        self.threads = config.get("threads", 0) or (
+            os.cpu_count() if self.codec == "pigz" else 0
+        )
+        self.min_compressible_fraction = config.get("min_compressible_fraction", 0.25)
+        self.incompressible_suffixes = tuple(
+            config.get("incompressible_suffixes", INCOMPRESSIBLE_SUFFIXES)
+        )
+
+    @property
+    def extension(self):
+        return CODECS[self.codec]["extension"]
+
+    def compress_cmd(self):
+        return (
+            CODECS[self.codec]["compress"]
+            .format(threads=self.threads, level=self.level)
+            .split()
+        )
+
+    def is_compressible(self, file_name):
+        return not file_name.lower().endswith(self.incompressible_suffixes)
+
+    def compressible_fraction(self, files):
+        """Fraction of the bytes in compressible files.
+
+        :param files: iterable of (file name, size in bytes) tuples
+        """
+        total = compressible = 0
+        for file_name, size in files:
+            total += size
+            if self.is_compressible(file_name):
+                compressible += size
+        return compressible / total if total else 0
+
+    def worth_compressing(self, path):
+        """Decide from its file types whether a run folder, or a run tarball,
+        is worth compressing."""
+        fraction = self.compressible_fraction(
+            _tar_members(path) if os.path.isfile(path) else _dir_files(path)
+        )
+        logger.info(
+            f"{fraction:.0%} of the data in {os.path.basename(path)} is compressible"
+        )
+        return fraction >= self.min_compressible_fraction
+
+
+def decompress_cmd(codec):
+    return CODECS[codec]["decompress"].split()
+
+
+def _dir_files(path):
+    """Yield the name and size of all regular files under 'path'."""
+    dirs = [path]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.name, entry.stat(follow_symlinks=False).st_size
+
+
+def _tar_members(path):
+    """Yield the name and size of all regular files in a tarball, reading
+    only the member headers."""
+    with tarfile.open(path) as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, member.size
@@ -0,0 +1,367 @@
+"""Encrypted run archives with a member index, allowing single files to be restored.
+
+An indexed archive is a tar stream split into fixed-size segments which are
+encrypted one by one with gpg and concatenated into 'run.tar.gpgseg'. Since
+every segment is a complete OpenPGP message, any of them can be decrypted on
+its own. The whole file is not a single OpenPGP message though, which a plain
+'gpg --decrypt' refuses with "multiple plaintexts seen", hence its own
+extension rather than the '.tar.gpg' of runs encrypted in one piece. It is
+decrypted segment by segment with the offsets recorded in the index.
+The companion index records, for every segment, its offsets in the plain tar
+stream and in the encrypted file, and, for every tar member, the offset of its
+data in the plain tar stream, its size and md5 checksum. Restoring a member then
+only needs the segments that hold its data.
+
+The index is plain JSON:
+
+    {
+        "version": 2,
+        "format": "gpg-segments",
+        "segment_size": 1073741824,
+        "md5": "<md5 of the whole plain tar stream>",
+        "segments": [
+            {"offset": 0, "size": ..., "md5": ..., "enc_offset": 0, "enc_size": ...},
+            ...
+        ],
+        "members": [
+            {"name": "run/RunInfo.xml", "type": "file", "header_offset": 512,
+             "offset": 1024, "size": 1234, "md5": ...},
+            ...
+        ]
+    }
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess as sp
+import tarfile
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+# How the encrypted file of an indexed archive is laid out, and its extension
+SEGMENT_FORMAT = "gpg-segments"
+SEGMENTED_EXTENSION = ".tar.gpgseg"
+DEFAULT_SEGMENT_SIZE = 1024**3
+CHUNK_SIZE = 4 * 1024 * 1024
+
+MEMBER_TYPES = {
+    tarfile.REGTYPE: "file",
+    tarfile.AREGTYPE: "file",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+}
+
+
+class IndexedArchiveError(Exception):
+    pass
+
+
+def _gpg_symmetric_cmd(key_file):
+    return [
+        "gpg",
+        "--symmetric",
+        "--cipher-algo",
+        "aes256",
+        "--passphrase-file",
+        key_file,
+        "--batch",
+        "--compress-algo",
+        "none",
+    ]
+
+
+def _gpg_decrypt_cmd(key_file):
+    return [
+        "gpg",
+        "--decrypt",
+        "--cipher-algo",
+        "aes256",
+        "--passphrase-file",
+        key_file,
+        "--batch",
+    ]
+
+
+class _SegmentedEncryptor:
+    """Write-only stream that encrypts every 'segment_size' bytes written to it
+    as a separate gpg message appended to 'out_file'."""
+
+    def __init__(self, out_file, key_file, segment_size):
+        self.key_file = key_file
+        self.segment_size = segment_size
+        self.out_fh = open(out_file, "wb")
+        self.md5 = hashlib.md5()
+        self.segments = []
+        self.position = 0
+        self._proc = None
+
+    def _start_segment(self):
+        self._err = tempfile.TemporaryFile()
+        self._proc = sp.Popen(
+            _gpg_symmetric_cmd(self.key_file),
+            stdin=sp.PIPE,
+            stdout=self.out_fh,
+            stderr=self._err,
+        )
+        self._segment = {
+            "offset": self.position,
+            "size": 0,
+            "enc_offset": os.fstat(self.out_fh.fileno()).st_size,
+        }
+        self._segment_md5 = hashlib.md5()
+
+    def _finish_segment(self):
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            self._err.seek(0)
+            raise IndexedArchiveError(
+                f"Encryption of segment {len(self.segments)} failed: {self._err.read()}"
+            )
+        enc_end = os.fstat(self.out_fh.fileno()).st_size
+        self._segment["enc_size"] = enc_end - self._segment["enc_offset"]
+        self._segment["md5"] = self._segment_md5.hexdigest()
+        self.segments.append(self._segment)
+        self._proc = None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._proc is None:
+                self._start_segment()
+            room = self.segment_size - self._segment["size"]
+            chunk = view[:room]
+            self._proc.stdin.write(chunk)
+            self._segment_md5.update(chunk)
+            self.md5.update(chunk)
+            self._segment["size"] += len(chunk)
+            self.position += len(chunk)
+            view = view[len(chunk) :]
+            if self._segment["size"] == self.segment_size:
+                self._finish_segment()
+        return len(data)
+
+    def close(self):
+        if self._proc is not None:
+            self._finish_segment()
+        self.out_fh.close()
+
+    def abort(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+        self.out_fh.close()
+
+
+class _TeeReader:
+    """Readable stream passing everything read from 'src' on to 'sink'."""
+
+    def __init__(self, src, sink):
+        self.src = src
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+
+def write_indexed_archive(
+    src, encrypted_file, index_file, key_file, segment_size=DEFAULT_SEGMENT_SIZE
+):
+    """Encrypt a tar stream into an indexed archive.
+
+    The tar stream is parsed while it is encrypted, so the archive is written
+    in a single pass over 'src'.
+
+    :param src: readable binary stream of a tar archive, e.g. the stdout of tar
+    :param str encrypted_file: path of the encrypted archive to write
+    :param str index_file: path of the index to write
+    :param str key_file: file with the passphrase to encrypt with
+    :param int segment_size: size in bytes of the plain segments
+    :returns: the md5 digest of the whole tar stream
+    :raises IndexedArchiveError: if encryption failed
+    """
+    encryptor = _SegmentedEncryptor(encrypted_file, key_file, segment_size)
+    tee = _TeeReader(src, encryptor)
+    members = []
+    try:
+        with tarfile.open(fileobj=tee, mode="r|") as tar:
+            for member in tar:
+                entry = {
+                    "name": member.name,
+                    "type": MEMBER_TYPES.get(member.type, "other"),
+                    "header_offset": member.offset,
+                    "offset": member.offset_data,
+                    "size": member.size if member.isfile() else 0,
+                }
+                if member.isfile():
+                    md5 = hashlib.md5()
+                    member_fh = tar.extractfile(member)
+                    for chunk in iter(lambda: member_fh.read(CHUNK_SIZE), b""):
+                        md5.update(chunk)
+                    entry["md5"] = md5.hexdigest()
+                elif member.issym() or member.islnk():
+                    entry["linkname"] = member.linkname
+                members.append(entry)
+        # Pass on the end of archive blocks and padding tarfile did not read
+        for _ in iter(lambda: tee.read(CHUNK_SIZE), b""):
+            pass
+        encryptor.close()
+    except (tarfile.TarError, OSError, IndexedArchiveError) as e:
+        encryptor.abort()
+        raise IndexedArchiveError(f"Writing indexed archive failed: {e}")
+    index = {
+        "version": INDEX_VERSION,
+        "format": SEGMENT_FORMAT,
+        "segment_size": segment_size,
+        "md5": encryptor.md5.hexdigest(),
+        "segments": encryptor.segments,
+        "members": members,
+    }
+    with open(index_file, "w") as fh:
+        json.dump(index, fh)
+    return index["md5"]
+
+
+def load_index(index_file):
+    with open(index_file) as fh:
+        index = json.load(fh)
+    if index.get("version") != INDEX_VERSION:
+        raise IndexedArchiveError(
+            f"Unsupported version {index.get('version')} of archive index {index_file}"
+        )
+    if index.get("format") != SEGMENT_FORMAT:
+        raise IndexedArchiveError(
+            f"Archive index {index_file} is of a {index.get('format')} archive, "
+            f"not {SEGMENT_FORMAT}"
+        )
+    return index
+
+
+def decrypt_segment(encrypted_file, segment, key_file):
+    """Decrypt a single segment of an indexed archive.
+
+    :yields: chunks of the decrypted segment
+    :raises IndexedArchiveError: if decryption failed
+    """
+    err = tempfile.TemporaryFile()
+    proc = sp.Popen(
+        _gpg_decrypt_cmd(key_file), stdin=sp.PIPE, stdout=sp.PIPE, stderr=err
+    )
+
+    def feed():
+        try:
+            with open(encrypted_file, "rb") as fh:
+                fh.seek(segment["enc_offset"])
+                remaining = segment["enc_size"]
+                while remaining:
+                    chunk = fh.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    proc.stdin.write(chunk)
+                    remaining -= len(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        yield from iter(lambda: proc.stdout.read(CHUNK_SIZE), b"")
+    finally:
+        proc.stdout.close()
+        feeder.join()
+        status = proc.wait()
+    if status != 0:
+        err.seek(0)
+        raise IndexedArchiveError(
+            f"Decryption of segment at offset {segment['enc_offset']} failed: {err.read()}"
+        )
+
+
+def decrypt_archive(encrypted_file, index, key_file):
+    """Decrypt a whole indexed archive segment by segment.
+
+    :yields: chunks of the plain tar stream
+    """
+    for segment in index["segments"]:
+        yield from decrypt_segment(encrypted_file, segment, key_file)
+
+
+def decrypted_digest(encrypted_file, index_file, key_file):
+    """Return the md5 digest of the decrypted archive."""
+    md5 = hashlib.md5()
+    for chunk in decrypt_archive(encrypted_file, load_index(index_file), key_file):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+def find_member(index, member_name):
+    """Return the index entry of a member, given with or without the run folder."""
+    member_name = member_name.strip("/")
+    for entry in index["members"]:
+        name = entry["name"].strip("/")
+        if name == member_name or name.split("/", 1)[-1] == member_name:
+            return entry
+    return None
+
+
+def extract_member(encrypted_file, index_file, key_file, member_name, dest_dir):
+    """Restore a single regular file from an indexed archive, decrypting only
+    the segments holding its data.
+
+    :param str member_name: path of the file in the archive, with or without
+        the leading run folder
+    :param str dest_dir: directory to restore into, the path of the member
+        in the archive is kept
+    :returns: path of the restored file
+    :raises IndexedArchiveError: if the member is missing or its checksum
+        did not match
+    """
+    index = load_index(index_file)
+    entry = find_member(index, member_name)
+    if entry is None:
+        raise IndexedArchiveError(f"No member {member_name} in {index_file}")
+    if entry["type"] != "file":
+        raise IndexedArchiveError(
+            f"Member {member_name} is a {entry['type']}, only files can be extracted"
+        )
+    start = entry["offset"]
+    end = start + entry["size"]
+    dest_file = os.path.join(dest_dir, entry["name"])
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    md5 = hashlib.md5()
+    with open(dest_file, "wb") as out_fh:
+        for segment in index["segments"] if entry["size"] else []:
+            seg_start = segment["offset"]
+            seg_end = seg_start + segment["size"]
+            if seg_end <= start:
+                continue
+            if seg_start >= end:
+                break
+            position = seg_start
+            for chunk in decrypt_segment(encrypted_file, segment, key_file):
+                lo = max(start - position, 0)
+                hi = min(end - position, len(chunk))
+                if lo < hi:
+                    out_fh.write(chunk[lo:hi])
+                    md5.update(chunk[lo:hi])
+                position += len(chunk)
+    if md5.hexdigest() != entry["md5"]:
+        os.remove(dest_file)
+        raise IndexedArchiveError(
+            f"Checksum of extracted {entry['name']} did not match the index"
+        )
+    logger.info(f"Extracted {entry['name']} from {encrypted_file} to {dest_file}")
+    return dest_file
@@ -0,0 +1,179 @@
+"""Local catalogue of the files archived in PDC."""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import subprocess as sp
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# A file line in the output of 'dsmc query archive', e.g.
+#   3,608,211 B  08/20/2024 10:12:31    /path/to/run.tar.gpg 08/20/2034 Archive Date: ...
+DSMC_FILE_LINE_RE = re.compile(
+    r"^\s*[\d,.]+\s+[KMGT]?B\s+\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}:\d{2}\s+(/\S+)"
+)
+# Returned by dsmc when nothing in PDC matches the query
+DSMC_NO_MATCH = "ANS1092W"
+
+
+def query_archive(src_file):
+    """Ask PDC whether a single file is archived.
+
+    dsmc returns zero only when the file exists, it returns non-zero when the
+    command was executed but the file was not found.
+    """
+    try:
+        sp.check_call(
+            ["dsmc", "query", "archive", os.path.abspath(src_file)],
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+        )
+        return True
+    except sp.CalledProcessError:
+        return False
+
+
+def list_archive(directory):
+    """List all files archived in PDC under the given directory with a single
+    wildcard query.
+
+    :param str directory: absolute path of the directory to list
+    :returns: a set of absolute file paths, or None if the query failed
+    """
+    cmd = ["dsmc", "query", "archive", os.path.join(directory, "*")]
+    try:
+        proc = sp.run(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
+    except OSError as e:
+        logger.warning(f"Listing PDC archive for {directory} failed: {e}")
+        return None
+    out = proc.stdout.decode("utf-8", errors="replace")
+    files = set()
+    for line in out.splitlines():
+        match = DSMC_FILE_LINE_RE.match(line)
+        if match:
+            files.add(match.group(1))
+    if proc.returncode != 0 and not files and DSMC_NO_MATCH not in out:
+        logger.warning(
+            f'Listing PDC archive with "{" ".join(cmd)}" failed with exit status '
+            f"{proc.returncode}"
+        )
+        return None
+    return files
+
+
+class PdcCatalogue:
+    """Cached listing of the files archived in PDC, one entry per directory.
+
+    Each directory is listed with one 'dsmc query archive' call the first time
+    a file in it is looked up, after which lookups are set membership tests.
+    The listings are persisted to a JSON file so that subsequent invocations
+    can reuse them until they are older than 'ttl' seconds.
+    """
+
+    def __init__(self, catalogue_file, ttl=43200):
+        """
+        :param str catalogue_file: path to the JSON file to persist the catalogue
+        :param int ttl: number of seconds a directory listing is trusted
+        """
+        self.catalogue_file = catalogue_file
+        self.ttl = ttl
+        self.dirs = self._read()
+        # Guards 'dirs' when the catalogue is shared by several upload workers
+        self._lock = threading.RLock()
+
+    def _read(self):
+        """Read the persisted directory listings, if any."""
+        if not os.path.exists(self.catalogue_file):
+            return {}
+        try:
+            with open(self.catalogue_file) as fh:
+                content = json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Could not read PDC catalogue {self.catalogue_file}, ignoring it: {e}"
+            )
+            return {}
+        return {
+            directory: {"fetched": entry["fetched"], "files": set(entry["files"])}
+            for directory, entry in content.items()
+        }
+
+    def save(self, refreshed=()):
+        """Write the catalogue to disk.
+
+        The file is locked while it is updated and the listings already on
+        disk are merged in, so concurrent invocations never drop each
+        others' entries. The listings of the 'refreshed' directories were
+        just fetched from PDC in full though, and replace those on disk that
+        are older, so that files deleted or expired from PDC are dropped.
+        """
+        with self._lock, open(f"{self.catalogue_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for directory, entry in self._read().items():
+                if directory not in self.dirs:
+                    self.dirs[directory] = entry
+                elif directory in refreshed:
+                    if entry["fetched"] > self.dirs[directory]["fetched"]:
+                        # Listed again meanwhile by another invocation
+                        self.dirs[directory] = entry
+                else:
+                    self.dirs[directory]["files"] |= entry["files"]
+                    self.dirs[directory]["fetched"] = max(
+                        self.dirs[directory]["fetched"], entry["fetched"]
+                    )
+            tmp_file = f"{self.catalogue_file}.tmp{os.getpid()}"
+            with open(tmp_file, "w") as fh:
+                json.dump(
+                    {
+                        directory: {
+                            "fetched": entry["fetched"],
+                            "files": sorted(entry["files"]),
+                        }
+                        for directory, entry in self.dirs.items()
+                    },
+                    fh,
+                )
+            os.replace(tmp_file, self.catalogue_file)
+
+    def _is_fresh(self, directory):
+        entry = self.dirs.get(directory)
+        return entry is not None and time.time() - entry["fetched"] < self.ttl
+
+    def refresh(self, directory):
+        """(Re)fetch the listing of the given directory from PDC.
+
+        :returns: True if the listing could be fetched
+        """
+        directory = os.path.abspath(directory)
+        files = list_archive(directory)
+        if files is None:
+            return False
+        with self._lock:
+            self.dirs[directory] = {"fetched": time.time(), "files": files}
+            self.save(refreshed=[directory])
+        return True
+
+    def contains(self, src_file):
+        """Check if the given file is archived in PDC.
+
+        Falls back to querying the single file if the directory listing
+        could not be fetched.
+        """
+        src_file_abs = os.path.abspath(src_file)
+        directory = os.path.dirname(src_file_abs)
+        if not self._is_fresh(directory) and not self.refresh(directory):
+            return query_archive(src_file_abs)
+        return src_file_abs in self.dirs[directory]["files"]
+
+    def add(self, src_file):
+        """Record a file that was successfully archived to PDC."""
+        src_file_abs = os.path.abspath(src_file)
+        directory = os.path.dirname(src_file_abs)
+        with self._lock:
+            if directory in self.dirs:
+                self.dirs[directory]["files"].add(src_file_abs)
+                self.save()
@@ -0,0 +1,125 @@
+"""Ledger of the disk space claimed by ongoing encryptions."""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DiskReservationLedger:
+    """Shared on-disk record of the scratch space each in-flight job needs.
+
+    Every job reserves the number of bytes it will write and the files it
+    will write them to before it starts. The space still outstanding for a
+    job is its reservation minus what those files already hold, so a new job
+    is only started when the measured free space covers both the outstanding
+    reservations on the same file system and its own needs.
+
+    The ledger is a JSON file locked with flock while it is read and
+    updated, so it can be shared between workers and TACA invocations.
+    Entries of processes on this host that are no longer alive are dropped.
+    """
+
+    def __init__(self, ledger_file):
+        """
+        :param str ledger_file: path to the JSON file holding the reservations
+        """
+        self.ledger_file = ledger_file
+        self.host_name = os.uname()[1]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _entries(self):
+        """Yield the reservations for update and write them back afterwards."""
+        with self._lock, open(f"{self.ledger_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = {}
+            if os.path.exists(self.ledger_file):
+                try:
+                    with open(self.ledger_file) as fh:
+                        entries = json.load(fh)
+                except ValueError as e:
+                    logger.warning(
+                        f"Could not parse reservation ledger {self.ledger_file}, resetting it: {e}"
+                    )
+            for job in [job for job, entry in entries.items() if self._is_stale(entry)]:
+                logger.warning(f"Dropping stale disk space reservation for {job}")
+                entries.pop(job)
+            yield entries
+            tmp_file = f"{self.ledger_file}.tmp{os.getpid()}"
+            with open(tmp_file, "w") as fh:
+                json.dump(entries, fh, indent=2)
+            os.replace(tmp_file, self.ledger_file)
+
+    def _is_stale(self, entry):
+        if entry["host"] != self.host_name:
+            return False
+        try:
+            os.kill(entry["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    @staticmethod
+    def _written(entry):
+        """Number of bytes already written by a job to its output files."""
+        return sum(
+            os.path.getsize(out_file)
+            for out_file in entry["files"]
+            if os.path.exists(out_file)
+        )
+
+    @staticmethod
+    def free_space(path):
+        """Free space in bytes available to unprivileged users at 'path'."""
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    def outstanding(self, path, entries):
+        """Bytes reserved on the file system of 'path' but not yet written."""
+        dev = os.stat(path).st_dev
+        return sum(
+            max(0, entry["bytes"] - self._written(entry))
+            for entry in entries.values()
+            if entry["dev"] == dev
+        )
+
+    def reserve(self, job, path, size, files, headroom=0):
+        """Reserve 'size' bytes on the file system of 'path' for 'job'.
+
+        :param str job: unique name of the job, e.g. the run name
+        :param str path: a path on the file system the job writes to
+        :param int size: number of bytes the job will write
+        :param list files: the files the job will write to
+        :param int headroom: bytes that must be left free on top of all reservations
+        :returns: a tuple of whether the reservation was made and the number
+            of bytes available for it
+        """
+        with self._entries() as entries:
+            available = (
+                self.free_space(path) - self.outstanding(path, entries) - headroom
+            )
+            if available < size:
+                return False, available
+            entries[job] = {
+                "path": os.path.abspath(path),
+                "dev": os.stat(path).st_dev,
+                "bytes": size,
+                "files": [os.path.abspath(f) for f in files],
+                "host": self.host_name,
+                "pid": os.getpid(),
+                "started": time.time(),
+            }
+            return True, available
+
+    def release(self, job):
+        """Release the reservation of a finished job."""
+        with self._entries() as entries:
+            entries.pop(job, None)
@@ -12,6 +12,7 @@ from pathlib import Path
 
 import pandas as pd
 
+from taca.utils import mirror, symlink_farm, transfer_ledger
 from taca.utils.filesystem import chdir
 from taca.utils.statusdb import ElementRunsConnection
 
@@ -145,6 +146,8 @@ class Run:
             .get("transfer_log")
         )
         self.rsync_exit_file = os.path.join(self.run_dir, ".rsync_exit_status")
+        # Marks a failed demultiplexing as reported, so it is reported once
+        self.demux_failed_file = os.path.join(self.run_dir, ".demux_failed")
 
         # Instrument generated files
         self.run_parameters_file = os.path.join(self.run_dir, "RunParameters.json")
@@ -164,6 +167,8 @@ class Run:
         self.lims_full_manifest = None
         self.lims_start_manifest = None
         self.lims_demux_manifests = None
+        # Queue the sub-demultiplexings are submitted to, if one is configured
+        self.demux_queue = None
 
         # Fields that will be set when parsing run parameters
         self.run_name = None
@@ -321,6 +326,11 @@ class Run:
     def get_demultiplexing_status(self):
         if not os.path.exists(self.demux_dir):
             return "not started"
+        if self.demux_queue is not None:
+            # Queued jobs record their state and exit status
+            queue_state = self.demux_queue.run_state(os.path.basename(self.run_dir))
+            if queue_state is not None:
+                return queue_state
         sub_demux_dirs = glob.glob(os.path.join(self.run_dir, "Demultiplexing_*"))
         finished_count = 0
         for demux_dir in sub_demux_dirs:
@@ -437,9 +447,9 @@ class Run:
 
         # Get '[SAMPLES]' section
         split_contents = manifest_contents.split("[SAMPLES]")
-        assert (
-            len(split_contents) == 2
-        ), f"Could not split sample rows out of manifest {manifest_contents}"
+        assert len(split_contents) == 2, (
+            f"Could not split sample rows out of manifest {manifest_contents}"
+        )
         sample_section = split_contents[1].strip().split("\n")
 
         # Split into header and rows
@@ -560,7 +570,7 @@ class Run:
                     "[RUNVALUES]",
                     "KeyName, Value",
                     f"manifest_file, {file_name}",
-                    f"manifest_group, {n+1}/{len(grouped_df)}",
+                    f"manifest_group, {n + 1}/{len(grouped_df)}",
                     f"built_from, {manifest_to_split}",
                 ]
             )
@@ -641,7 +651,7 @@ class Run:
             f"{self.CONFIG.get('element_analysis').get('bases2fastq')}"
             + f" {self.run_dir}"
             + f" {demux_dir}"
-            + " -p 8"
+            + f" -p {self._bases2fastq_threads()}"
             + " --num-unassigned 500"
             + f" -r {run_manifest}"
             + " --legacy-fastq"
@@ -653,9 +663,38 @@ class Run:
             command_file.write(command)
         return command
 
+    def _bases2fastq_threads(self):
+        return self.CONFIG.get("element_analysis").get("bases2fastq_threads", 8)
+
+    def _manifest_projects(self, run_manifest):
+        """Return the projects of the samples in a demultiplexing manifest."""
+        with open(run_manifest) as f:
+            sample_section = f.read().split("[SAMPLES]")[-1].strip()
+        return {
+            row.get("Project") for row in csv.DictReader(sample_section.splitlines())
+        }
+
     def start_demux(self, run_manifest, demux_dir):
         with chdir(self.run_dir):
             cmd = self.generate_demux_command(run_manifest, demux_dir)
+            if self.demux_queue is not None:
+                # Each sub-demultiplexing logs to files of its own
+                job_name = os.path.basename(demux_dir)
+                self.demux_queue.submit(
+                    os.path.basename(self.run_dir),
+                    job_name,
+                    cmd,
+                    self.run_dir,
+                    cpus=self._bases2fastq_threads(),
+                    memory_gb=self.CONFIG.get("element_analysis").get(
+                        "bases2fastq_memory_gb", 0
+                    ),
+                    priority=self.demux_queue.priority(
+                        self._manifest_projects(run_manifest)
+                    ),
+                )
+                self.demux_queue.schedule()
+                return
             stderr_abspath = f"{self.run_dir}/bases2fastq_stderr.txt"  # TODO: individual files for each sub-demux
             try:
                 with open(stderr_abspath, "w") as stderr:
@@ -697,11 +736,7 @@ class Run:
             return "unknown"
 
     def in_transfer_log(self):
-        with open(self.transfer_file) as transfer_file:
-            for row in transfer_file.readlines():
-                if self.NGI_run_id in row:
-                    return True
-        return False
+        return self.NGI_run_id in transfer_ledger.get_ledger(self.transfer_file)
 
     def transfer_ongoing(self):
         return os.path.isfile(os.path.join(self.run_dir, ".rsync_ongoing"))
@@ -717,17 +752,31 @@ class Run:
         else:
             return False
 
-    # Clear all content under a dir
-    def clear_dir(self, dir):
-        for filename in os.listdir(dir):
-            file_path = os.path.join(dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                print(f"Failed to delete {file_path} Reason {e}")
+    def get_lifecycle_state(self):
+        """Return the state of the run as derived from its marker files, and
+        whether it is settled, i.e. can only change when the run directory does.
+        """
+        if not os.path.isdir(self.run_dir):
+            # Processed runs are moved to nosync
+            return "processed", True
+        if not self.check_sequencing_status():
+            return "sequencing", False
+        demultiplexing_status = self.get_demultiplexing_status()
+        if demultiplexing_status == "not started":
+            return "sequenced", False
+        elif demultiplexing_status == "failed":
+            # Settled once reported, until the run is demultiplexed anew
+            return "demultiplexing failed", os.path.exists(self.demux_failed_file)
+        elif demultiplexing_status != "finished":
+            return "demultiplexing", False
+        transfer_status = self.get_transfer_status()
+        if transfer_status == "not started":
+            return "demultiplexed", False
+        elif transfer_status == "ongoing":
+            return "transferring", False
+        elif transfer_status == "rsync failed":
+            return "transfer failed", False
+        return transfer_status, False
 
     # Write to csv
     def write_to_csv(self, data, filename):
@@ -782,8 +831,18 @@ class Run:
         )
         return sorted_demux_runmanifest
 
-    # Aggregate the output FastQ files of samples from multiple demux
-    def aggregate_sample_fastq(self, demux_runmanifest):
+    # Index of the FastQ files of a sub-demux, scanned once per aggregation
+    def _fastq_index(self, indexes, sub_demux_count):
+        if sub_demux_count not in indexes:
+            indexes[sub_demux_count] = symlink_farm.FastqIndex(
+                os.path.join(
+                    self.run_dir, f"Demultiplexing_{sub_demux_count}", "Samples"
+                )
+            )
+        return indexes[sub_demux_count]
+
+    # Plan the links of the output FastQ files of samples from multiple demux
+    def aggregate_sample_fastq(self, demux_runmanifest, plan, indexes):
         lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
         for lane in lanes:
             unique_sample_demux = set()
@@ -797,49 +856,29 @@ class Run:
                 if lanenr == lane and sample_name != "PhiX":
                     sample_tuple = (sample_name, sub_demux_count)
                     if sample_tuple not in unique_sample_demux:
-                        project_dest = os.path.join(
-                            self.run_dir, self.demux_dir, project
-                        )
                         sample_dest = os.path.join(
-                            self.run_dir,
-                            self.demux_dir,
-                            project,
-                            f"Sample_{sample_name}",
-                        )
-                        if not os.path.exists(project_dest):
-                            os.makedirs(project_dest)
-                        if not os.path.exists(sample_dest):
-                            os.makedirs(sample_dest)
-                        fastqfiles = glob.glob(
-                            os.path.join(
-                                self.run_dir,
-                                f"Demultiplexing_{sub_demux_count}",
-                                "Samples",
-                                project,
-                                sample_name,
-                                f"*L00{lane}*.fastq.gz",
-                            )
+                            self.demux_dir, project, f"Sample_{sample_name}"
                         )
-                        for fastqfile in fastqfiles:
-                            old_name = os.path.basename(fastqfile)
-                            read_label = re.search(
-                                rf"L00{lane}_(.*?)_001", old_name
-                            ).group(1)
+                        plan.add_dir(sample_dest)
+                        fastq_index = self._fastq_index(indexes, sub_demux_count)
+                        for fastq in fastq_index.files(project, sample_name, lane):
+                            if not fastq.name.endswith(".fastq.gz"):
+                                continue
                             new_name = "_".join(
                                 [
                                     sample_name,
                                     f"S{sample_count}",
                                     f"L00{lane}",
-                                    read_label,
+                                    fastq.read,
                                     "001.fastq.gz",
                                 ]
                             )
-                            os.symlink(fastqfile, os.path.join(sample_dest, new_name))
+                            plan.add(fastq.path, os.path.join(sample_dest, new_name))
                         unique_sample_demux.add(sample_tuple)
                         sample_count += 1
 
-    # Symlink the output FastQ files of undet only if a lane does not have multiple demux
-    def aggregate_undet_fastq(self, demux_runmanifest):
+    # Plan the links of the output FastQ files of undet only if a lane does not have multiple demux
+    def aggregate_undet_fastq(self, demux_runmanifest, plan, indexes):
         lanes = sorted(list(set(sample["Lane"] for sample in demux_runmanifest)))
         for lane in lanes:
             sub_demux = list(
@@ -850,25 +889,21 @@ class Run:
                 )
             )
             if len(sub_demux) == 1:
-                project_dest = os.path.join(
-                    self.run_dir, self.demux_dir, "Undetermined"
-                )
-                if not os.path.exists(project_dest):
-                    os.makedirs(project_dest)
-                fastqfiles = glob.glob(
-                    os.path.join(
-                        self.run_dir,
-                        f"Demultiplexing_{sub_demux[0]}",
-                        "Samples",
-                        "Undetermined",
-                        f"*L00{lane}*.fastq.gz",
-                    )
-                )
-                for fastqfile in fastqfiles:
-                    base_name = os.path.basename(
-                        fastqfile
-                    )  # TODO: Make symlinks relative instead of absolute to maintain them after archiving
-                    os.symlink(fastqfile, os.path.join(project_dest, base_name))
+                project_dest = os.path.join(self.demux_dir, "Undetermined")
+                plan.add_dir(project_dest)
+                fastq_index = self._fastq_index(indexes, sub_demux[0])
+                for fastq in fastq_index.files("Undetermined", lane=lane):
+                    if fastq.name.endswith(".fastq.gz"):
+                        # TODO: Make symlinks relative instead of absolute to maintain them after archiving
+                        plan.add(fastq.path, os.path.join(project_dest, fastq.name))
+
+    # Plan the links of the demux dir, scanning each sub-demux once
+    def plan_demux_links(self, demux_runmanifest):
+        plan = symlink_farm.LinkPlan(self.demux_dir)
+        indexes = dict()
+        self.aggregate_sample_fastq(demux_runmanifest, plan, indexes)
+        self.aggregate_undet_fastq(demux_runmanifest, plan, indexes)
+        return plan
 
     # Read in each Project_RunStats.json to fetch PercentMismatch, PercentQ30, PercentQ40 and QualityScoreMean
     # Note that Element promised that they would include these stats into IndexAssignment.csv
@@ -1214,13 +1249,10 @@ class Run:
         # Ensure the destination directory exists
         if not os.path.exists(os.path.join(self.run_dir, self.demux_dir)):
             os.makedirs(os.path.join(self.run_dir, self.demux_dir))
-        # Clear all content under dest_dir
-        self.clear_dir(os.path.join(self.run_dir, self.demux_dir))
         demux_runmanifest = self.collect_demux_runmanifest(demux_results_dirs)
-        # Aggregate the output FastQ files of samples from multiple demux
-        self.aggregate_sample_fastq(demux_runmanifest)
-        # Symlink the output FastQ files of undet only if a lane does not have multiple demux
-        self.aggregate_undet_fastq(demux_runmanifest)
+        # Link the output FastQ files of samples, and of undet for lanes
+        # without multiple demux, removing what is left from earlier runs
+        self.plan_demux_links(demux_runmanifest).apply(prune=True)
         # Aggregate stats in IndexAssignment.csv
         aggregated_assigned_indexes_filtered_sorted = self.aggregate_stats_assigned(
             demux_runmanifest
@@ -1241,11 +1273,13 @@ class Run:
         dest = os.path.join(metadata_archive, self.NGI_run_id)
         if not os.path.exists(dest):
             os.makedirs(dest)
+        pairs = []
         for f in files_to_copy:  # UnassignedSequences.csv missing in NoIndex case
             if os.path.exists(f):
-                shutil.copy(f, dest)
+                pairs.append((f, os.path.join(dest, os.path.basename(f))))
             else:
                 logger.warning(f"File {f} missing for run {self.run}")
+        mirror.mirror(pairs, f"the metadata of run {self.NGI_run_id} to {dest}")
 
     def make_transfer_indicator(self):
         transfer_indicator = os.path.join(self.run_dir, ".rsync_ongoing")
@@ -1285,9 +1319,7 @@ class Run:
     def update_transfer_log(self):
         """Update transfer log with run id and date."""
         try:
-            with open(self.transfer_file, "a") as f:
-                tsv_writer = csv.writer(f, delimiter="\t")
-                tsv_writer.writerow([self.NGI_run_id, str(datetime.now())])
+            transfer_ledger.get_ledger(self.transfer_file).add(self.NGI_run_id)
         except OSError:
             msg = f"{self}: Could not update the transfer logfile {self.transfer_file}"
             logger.error(msg)
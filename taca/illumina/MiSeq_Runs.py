@@ -101,10 +101,7 @@ class MiSeq_Run(Standard_Run):
         self.runParserObj.samplesheet = SampleSheetParser(
             os.path.join(self.run_dir, "SampleSheet_copy.csv")
         )
-        if not self.runParserObj.obj.get("samplesheet_csv"):
-            self.runParserObj.obj["samplesheet_csv"] = (
-                self.runParserObj.samplesheet.data
-            )
+        # The parser falls back to it for the samplesheet_csv of its obj
 
     def _generate_clean_samplesheet(
         self,
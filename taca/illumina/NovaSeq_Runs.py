@@ -88,12 +88,16 @@ class NovaSeq_Run(Standard_Run):
             datafields.append(field)
         output += ",".join(datafields)
         output += os.linesep
+        # Sets, as every line of the sample sheet is looked up
+        samples_to_include = {
+            lane: set(samples) for lane, samples in samples_to_include.items()
+        }
         for line in ssparser.data:
             sample_name = line.get("Sample_Name") or line.get("SampleName")
             lane = line["Lane"]
             noindex_flag = False
-            if lane in samples_to_include.keys():
-                if sample_name in samples_to_include.get(lane):
+            if lane in samples_to_include:
+                if sample_name in samples_to_include[lane]:
                     line_ar = []
                     for field in datafields:
                         # Case with NoIndex
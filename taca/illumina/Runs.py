@@ -1,6 +1,5 @@
 import csv
 import glob
-import json
 import logging
 import os
 import re
@@ -8,9 +7,18 @@ import shutil
 import subprocess
 from datetime import datetime
 
-from flowcell_parser.classes import LaneBarcodeParser, RunParser, SampleSheetParser
-
-from taca.utils import misc
+from flowcell_parser.classes import LaneBarcodeParser, SampleSheetParser
+
+from taca.illumina import bclconvert_reports, demux_plan, lane_merge
+from taca.illumina import demux_log as demux_log_scanner
+from taca.illumina.run_parser import LazyRunParser, parser_cache_dir
+from taca.illumina.stats_json import (
+    TOP_UNKNOWN_BARCODES,
+    merge_stats,
+    rewrite_noindex_stats,
+)
+from taca.utils import misc, parallel_rsync, symlink_farm, transfer_ledger
+from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
 
 logger = logging.getLogger(__name__)
@@ -57,9 +65,12 @@ class Run:
         self.demux_dir = "Demultiplexing"
         self.legacy_dir = "legacy"
         self.demux_summary = dict()
-        self.runParserObj = RunParser(self.run_dir)
+        self._demux_log_scanner = None
+        self.runParserObj = self._get_run_parser()
         # This flag tells TACA to move demultiplexed files to the analysis server
         self.transfer_to_analysis_server = True
+        # Queue the sub-demultiplexings are submitted to, if one is configured
+        self.demux_queue = None
         # Probably worth to add the samplesheet name as a variable too
 
     def demultiplex_run(self):
@@ -84,16 +95,36 @@ class Run:
         for samplesheet in samplesheets:
             demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
             demux_folder = os.path.join(self.run_dir, f"Demultiplexing_{demux_id}")
-            # Check if this job is done
-            if os.path.exists(
-                os.path.join(
-                    self.run_dir,
-                    demux_folder,
-                    legacy_path,
-                    "Stats",
-                    "DemultiplexingStats.xml",
+            # Queued jobs record their state, no need to guess it from their output
+            jobs = self._get_demux_jobs(demux_id)
+            if any(job["state"] in ("queued", "running") for job in jobs):
+                all_demux_done = False
+                logger.info(
+                    f"Sub-Demultiplexing in {demux_folder} is queued or running."
+                )
+                self._log_demux_progress(demux_folder, jobs)
+                continue
+            failed_jobs = [job for job in jobs if job["state"] == "failed"]
+            if failed_jobs:
+                all_demux_done = False
+                self._report_failed_demux_jobs(demux_folder, failed_jobs)
+                continue
+            demux_stats_xml = os.path.join(
+                demux_folder, legacy_path, "Stats", "DemultiplexingStats.xml"
+            )
+            # Sub-demultiplexings split per lane are merged once all lanes are done
+            lane_dirs = self._get_lane_dirs(demux_id)
+            if (
+                lane_dirs
+                and not os.path.exists(demux_stats_xml)
+                and all(
+                    lane_merge.lane_done(lane_dir, legacy_path)
+                    for lane_dir in lane_dirs
                 )
             ):
+                self._aggregate_lane_results(demux_id, lane_dirs)
+            # Check if this job is done
+            if os.path.exists(demux_stats_xml):
                 all_demux_done = all_demux_done and True
                 if self.software == "bcl2fastq":
                     demux_log = os.path.join(
@@ -137,7 +168,7 @@ class Run:
         if all_demux_done and dex_status != "COMPLETED":
             dex_status = "COMPLETED"
             self._aggregate_demux_results()
-            self.runParserObj = RunParser(self.run_dir)
+            self.runParserObj = self._get_run_parser()
             # Rename undetermined if needed
             lanes = misc.return_unique(
                 [lanes["Lane"] for lanes in self.runParserObj.samplesheet.data]
@@ -148,43 +179,207 @@ class Run:
                     self._rename_undet(lane, samples_per_lane)
             return None
 
+    def _get_run_parser(self):
+        """Return a parser of the files of the run, parsing them on first
+        access and caching them under the status dir of the analysis.
+        """
+        return LazyRunParser(self.run_dir, cache_dir=parser_cache_dir(CONFIG))
+
+    def _is_split_per_lane(self):
+        """Check if sub-demultiplexings are run as one bclconvert job per lane,
+        set with 'lane_split' in the bclconvert config of the sequencer.
+        """
+        return self.software == "bclconvert" and bool(
+            self.CONFIG[self.software].get("lane_split")
+        )
+
+    def _use_native_reports(self, samplesheets):
+        """Check if the reports of the sub-demultiplexings are aggregated from
+        the CSV reports of bclconvert, set with 'native_reports' in the
+        bclconvert config of the sequencer, and if all of them wrote theirs.
+        """
+        if self.software != "bclconvert" or not self.CONFIG[self.software].get(
+            "native_reports"
+        ):
+            return False
+        for samplesheet in samplesheets:
+            demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
+            demux_dir = os.path.join(self.run_dir, f"Demultiplexing_{demux_id}")
+            if not bclconvert_reports.has_native_reports(demux_dir):
+                logger.warning(
+                    f"No native reports in {demux_dir}, aggregating the legacy ones"
+                )
+                return False
+        return True
+
+    def _use_legacy_html(self):
+        """Check if the HTML reports are rendered next to the native ones,
+        unset 'legacy_reports' in the bclconvert config to skip them.
+        """
+        return self.CONFIG[self.software].get("legacy_reports", True)
+
+    def _get_lane_dir(self, demux_id, lane):
+        """Return the output folder of a lane of a sub-demultiplexing split
+        per lane, kept under Reports so it is not mistaken for a project.
+        """
+        return lane_merge.lane_dir(self.run_dir, demux_id, lane)
+
+    def _get_lane_dirs(self, demux_id):
+        """Return the output folders of the lanes of a sub-demultiplexing
+        split per lane, all that were started whether they exist yet or not.
+
+        The lanes are those with samples in the sub-demultiplexing, as in the
+        demultiplexing plan. Without a plan, the lane folders found are used.
+        """
+        plan = demux_plan.DemuxPlan.load(self.run_dir)
+        if plan is None or not self._is_split_per_lane():
+            return sorted(glob.glob(self._get_lane_dir(demux_id, "*")))
+        for sub_demux in plan.sub_demuxes:
+            if str(sub_demux["id"]) == str(demux_id):
+                return [
+                    self._get_lane_dir(demux_id, lane)
+                    for lane in sorted(sub_demux["samples"], key=int)
+                ]
+        return []
+
+    def _get_demux_jobs(self, demux_id):
+        """Return the queued jobs of a sub-demultiplexing, one per lane if
+        it is split per lane.
+        """
+        if self.demux_queue is None:
+            return []
+        return [
+            job
+            for job in self.demux_queue.jobs(self.id)
+            if job["name"] == f"demux_{demux_id}"
+            or job["name"].startswith(f"demux_{demux_id}_L")
+        ]
+
+    def _report_failed_demux_jobs(self, demux_folder, failed_jobs):
+        """Log and mail the failed jobs of a sub-demultiplexing, each once."""
+        messages = []
+        for job in failed_jobs:
+            message = (
+                f"Sub-Demultiplexing {job['name']} in {demux_folder} failed "
+                f"with exit status {job['exit_code']}, "
+                f"see {job['log_prefix']}_*.err"
+            )
+            if job["reported"]:
+                logger.info(f"{message}, already reported")
+            else:
+                logger.error(message)
+                messages.append(message)
+        if not messages:
+            return
+        mail_recipients = CONFIG.get("mail", {}).get("recipients")
+        if mail_recipients:
+            self.send_mail(
+                f"Demultiplexing of run {self.id} failed",
+                "\n".join(messages),
+                mail_recipients,
+            )
+        for job in failed_jobs:
+            if not job["reported"]:
+                self.demux_queue.mark_reported(job["id"])
+
+    def _aggregate_lane_results(self, demux_id, lane_dirs):
+        """Merge the outputs of a sub-demultiplexing split per lane into its
+        folder, as if a single bclconvert process had made them, see
+        taca.illumina.lane_merge.
+        """
+        lane_merge.merge_lane_outputs(
+            self.run_dir, demux_id, lane_dirs, html_parser=LaneBarcodeParser
+        )
+
+    def _start_demux_job(self, cmd, demux_id):
+        """Start a sub-demultiplexing, or submit it to the demultiplexing
+        queue if one is configured.
+
+        Queued jobs use the CPUs and memory given by 'cpus' and 'memory_gb'
+        in the config of the software, and go first if the run has samples
+        of a priority project.
+        """
+        if self.demux_queue is None:
+            misc.call_external_command_detached(
+                cmd, with_log_files=True, prefix=f"demux_{demux_id}"
+            )
+            return
+        software_config = self.CONFIG[self.software]
+        projects = {
+            entry.get("Sample_Project") for entry in self.runParserObj.samplesheet.data
+        }
+        self.demux_queue.submit(
+            self.id,
+            f"demux_{demux_id}",
+            cmd,
+            self.run_dir,
+            cpus=software_config.get("cpus"),
+            memory_gb=software_config.get("memory_gb", 0),
+            priority=self.demux_queue.priority(projects),
+        )
+        self.demux_queue.schedule()
+
     def _check_demux_log(self, demux_id, demux_log):
         """
         This function checks the log files of bcl2fastq/bclconvert
         Errors or warnings will be captured and email notifications will be sent
         """
-        with open(demux_log) as demux_log_file:
-            demux_log_content = demux_log_file.readlines()
-            if self.software == "bcl2fastq":
-                pattern = r"Processing completed with (\d+) errors and (\d+) warnings"
-                match = re.search(pattern, demux_log_content[-1])
-                if match:
-                    errors = int(match.group(1))
-                    warnings = int(match.group(2))
-                    error_and_warning_messages = []
-                    if errors or warnings:
-                        for line in demux_log_content:
-                            if "ERROR" in line or "WARN" in line:
-                                error_and_warning_messages.append(line)
-                    return errors, warnings, error_and_warning_messages
-                else:
-                    raise RuntimeError(
-                        f"Bad format with log file demux_{demux_id}_bcl2fastq.err"
-                    )
-            elif self.software == "bclconvert":
-                errors = 0
-                warnings = 0
+        if self.software not in ("bcl2fastq", "bclconvert"):
+            raise RuntimeError("Unrecognized software!")
+        # Only what was appended since the last check is read
+        scanner = self._get_demux_log_scanner()
+        summary = scanner.scan(demux_log, self.software)
+        scanner.save()
+        if self.software == "bcl2fastq":
+            match = demux_log_scanner.BCL2FASTQ_SUMMARY.search(
+                summary["last_line"] or ""
+            )
+            if match:
+                errors = int(match.group(1))
+                warnings = int(match.group(2))
                 error_and_warning_messages = []
-                for line in demux_log_content:
-                    if "ERROR" in line:
-                        errors += 1
-                        error_and_warning_messages.append(line)
-                    elif "WARNING" in line:
-                        warnings += 1
-                        error_and_warning_messages.append(line)
+                if errors or warnings:
+                    error_and_warning_messages = summary["error_and_warning_messages"]
                 return errors, warnings, error_and_warning_messages
             else:
-                raise RuntimeError("Unrecognized software!")
+                raise RuntimeError(
+                    f"Bad format with log file demux_{demux_id}_bcl2fastq.err"
+                )
+        return (
+            summary["errors"],
+            summary["warnings"],
+            summary["error_and_warning_messages"],
+        )
+
+    def _get_demux_log_scanner(self):
+        """Return the scanner of the demultiplexing logs of the run, its state
+        kept with the parser cache of the run."""
+        if self._demux_log_scanner is None:
+            cache_dir = parser_cache_dir(CONFIG)
+            self._demux_log_scanner = demux_log_scanner.DemuxLogScanner(
+                os.path.join(cache_dir, self.id, "demux_logs.json")
+                if cache_dir
+                else None
+            )
+        return self._demux_log_scanner
+
+    def _log_demux_progress(self, demux_folder, jobs):
+        """Log the tiles, errors and warnings in the logs of running
+        sub-demultiplexing jobs so far."""
+        scanner = self._get_demux_log_scanner()
+        for job in jobs:
+            if job["state"] != "running":
+                continue
+            for demux_log in sorted(
+                glob.glob(os.path.join(self.run_dir, f"{job['log_prefix']}_*.err"))
+            ):
+                summary = scanner.scan(demux_log, self.software)
+                logger.info(
+                    f"Sub-Demultiplexing {job['name']} in {demux_folder} is running, "
+                    f"{summary['tiles']} tiles, {summary['errors']} errors and "
+                    f"{summary['warnings']} warnings in {os.path.basename(demux_log)} so far"
+                )
+        scanner.save()
 
     def _set_run_type(self):
         raise NotImplementedError("Please Implement this method")
@@ -294,20 +489,21 @@ class Run:
         :param str t_file: File where to put the transfer information
         """
         # The option -a implies -o and -g which is not the desired behaviour
-        command_line = ["rsync", "-LtDrv"]
         # Add R/W permissions to the group
-        command_line.append("--chmod=g+rw")
+        options = ["-LtDv", "--chmod=g+rw"]
         # This horrible thing here avoids data dup when we use multiple indexes in a lane/FC
-        command_line.append("--exclude=Demultiplexing_*/*_*")
-        command_line.append("--include=*/")
+        filters = ["--exclude=Demultiplexing_*/*_*", "--include=*/"]
         for to_include in self.CONFIG["analysis_server"]["sync"]["include"]:
-            command_line.append(f"--include={to_include}")
-        command_line.extend(["--exclude=*", "--prune-empty-dirs"])
+            filters.append(f"--include={to_include}")
+        filters.extend(["--exclude=*", "--prune-empty-dirs"])
         r_user = self.CONFIG["analysis_server"]["user"]
         r_host = self.CONFIG["analysis_server"]["host"]
         r_dir = self.CONFIG["analysis_server"]["sync"]["data_archive"]
         remote = f"{r_user}@{r_host}:{r_dir}"
+        command_line = ["rsync", "-LtDrv", "--chmod=g+rw"] + filters
         command_line.extend([self.run_dir, remote])
+        # Several rsync at the same time, each with a shard of the files
+        streams = self.CONFIG["analysis_server"]["sync"].get("streams", 1)
 
         # Create temp file indicating that the run is being transferred
         try:
@@ -323,11 +519,16 @@ class Run:
         # In this particular case we want to capture the exception because we want
         # to delete the transfer file
         try:
-            msge_text = f"I am about to transfer with this command \n{command_line}"
-            logger.info(msge_text)
-            misc.call_external_command(
-                command_line, with_log_files=True, prefix="", log_dir=self.run_dir
-            )
+            if streams > 1:
+                parallel_rsync.transfer(
+                    self.run_dir, remote, options, filters, streams, self.run_dir
+                )
+            else:
+                msge_text = f"I am about to transfer with this command \n{command_line}"
+                logger.info(msge_text)
+                misc.call_external_command(
+                    command_line, with_log_files=True, prefix="", log_dir=self.run_dir
+                )
         except subprocess.CalledProcessError as exception:
             os.remove(os.path.join(self.run_dir, "transferring"))
             # Send an email notifying that the transfer failed
@@ -342,9 +543,7 @@ class Run:
             raise exception
 
         logger.info(f"Adding run {self.id} to {t_file}")
-        with open(t_file, "a") as tranfer_file:
-            tsv_writer = csv.writer(tranfer_file, delimiter="\t")
-            tsv_writer.writerow([self.id, str(datetime.now())])
+        transfer_ledger.get_ledger(t_file).add(self.id)
         os.remove(os.path.join(self.run_dir, "transferring"))
 
         # Send an email notifying that the transfer was successful
@@ -380,18 +579,27 @@ class Run:
         :param str transfer_file: Path to file with information about transferred runs
         """
         try:
-            with open(transfer_file) as file_handle:
-                transfer_file_contents = csv.reader(file_handle, delimiter="\t")
-                for row in transfer_file_contents:
-                    # Rows have two columns: run and transfer date
-                    if row[0] == os.path.basename(self.id):
-                        return True
+            if os.path.basename(self.id) in transfer_ledger.get_ledger(transfer_file):
+                return True
             if os.path.exists(os.path.join(self.run_dir, "transferring")):
                 return True
             return False
         except OSError:
             return False
 
+    def get_lifecycle_state(self, transfer_file):
+        """Return the state of the run as derived from its marker files, and
+        whether it is settled, i.e. can only change when the run folder does.
+        :param str transfer_file: Path to file with information about transferred runs
+        """
+        if not os.path.isdir(self.run_dir):
+            return "archived", True
+        if os.path.exists(os.path.join(self.run_dir, "transferring")):
+            return "transferring", False
+        if self.is_transferred(transfer_file):
+            return "transferred", True
+        return self.get_run_status().lower(), False
+
     def is_unpooled_lane(self, lane):
         """
         :param lane: lane identifier
@@ -449,6 +657,25 @@ class Run:
             )
             os.rename(file, os.path.join(os.path.dirname(file), new_name))
 
+    def _planned_index_lengths(self, samplesheets):
+        """Return the index lengths of each lane in each sub-demultiplexing
+        from the demultiplexing plan, or None if there is no plan or the
+        sub-samplesheets were written after it.
+        """
+        plan_file = os.path.join(self.run_dir, demux_plan.PLAN_FILE)
+        try:
+            plan_mtime = os.path.getmtime(plan_file)
+            if any(os.path.getmtime(ss) > plan_mtime for ss in samplesheets):
+                return None
+            plan = demux_plan.DemuxPlan.load(self.run_dir)
+            return plan.lane_index_lengths(
+                os.path.splitext(os.path.split(ss)[1])[0].split("_")[1]
+                for ss in samplesheets
+            )
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug(f"Demultiplexing plan of {self.id} not used: {e}")
+            return None
+
     def _classify_lanes(self, samplesheets):
         # Prepare a list for lanes with NoIndex samples
         noindex_lanes = []
@@ -463,25 +690,30 @@ class Run:
                 noindex_lanes.append(entry["Lane"])
         # Prepare a dict with the lane, demux_id and index_length info based on the sub-samplesheets
         # This is for the purpose of deciding simple_lanes and complex_lanes, plus we should start with the Stats.json file from which demux_id for each lane
-        lane_demuxid_indexlength = dict()
-        for samplesheet in samplesheets:
-            demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
-            ssparser = SampleSheetParser(samplesheet)
-            for row in ssparser.data:
-                if row["Lane"] not in lane_demuxid_indexlength.keys():
-                    lane_demuxid_indexlength[row["Lane"]] = {
-                        demux_id: [
+        # The demultiplexing plan has it, otherwise the sub-samplesheets are parsed
+        lane_demuxid_indexlength = self._planned_index_lengths(samplesheets)
+        if lane_demuxid_indexlength is None:
+            lane_demuxid_indexlength = dict()
+            for samplesheet in samplesheets:
+                demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split(
+                    "_"
+                )[1]
+                ssparser = SampleSheetParser(samplesheet)
+                for row in ssparser.data:
+                    if row["Lane"] not in lane_demuxid_indexlength.keys():
+                        lane_demuxid_indexlength[row["Lane"]] = {
+                            demux_id: [
+                                len(row.get("index", "")),
+                                len(row.get("index2", "")),
+                            ]
+                        }
+                    elif demux_id not in lane_demuxid_indexlength[row["Lane"]].keys():
+                        lane_demuxid_indexlength[row["Lane"]][demux_id] = [
                             len(row.get("index", "")),
                             len(row.get("index2", "")),
                         ]
-                    }
-                elif demux_id not in lane_demuxid_indexlength[row["Lane"]].keys():
-                    lane_demuxid_indexlength[row["Lane"]][demux_id] = [
-                        len(row.get("index", "")),
-                        len(row.get("index2", "")),
-                    ]
-                else:
-                    pass
+                    else:
+                        pass
 
         simple_lanes = dict()
         complex_lanes = dict()
@@ -509,44 +741,44 @@ class Run:
 
         return noindex_lanes, simple_lanes, complex_lanes
 
-    def _process_noindex_sample_with_fake_index_with_single_demux(
-        self, demux_id, legacy_path
-    ):
-        demux_folder = os.path.join(self.run_dir, self.demux_dir)
+    def _plan_noindex_sample_links(self, plan, fastq_index, samplesheet_data):
+        """Plan links of the undetermined FastQ files of each NoIndex sample,
+        renamed after the sample, in the demux folder of the plan."""
         sample_counter = 1
-        for entry in sorted(
-            self.runParserObj.samplesheet.data, key=lambda k: k["Lane"]
-        ):
+        for entry in sorted(samplesheet_data, key=lambda k: k["Lane"]):
             lane = entry["Lane"]
             project = entry["Sample_Project"]
             sample = entry["Sample_ID"]
-            project_dest = os.path.join(demux_folder, project)
-            if not os.path.exists(project_dest):
-                os.makedirs(project_dest)
-            sample_dest = os.path.join(project_dest, sample)
-            if not os.path.exists(sample_dest):
-                os.makedirs(sample_dest)
-            for file in glob.glob(
-                os.path.join(
-                    self.run_dir,
-                    f"Demultiplexing_{demux_id}",
-                    f"Undetermined*L0?{lane}*",
-                )
-            ):
-                old_name = os.path.basename(file)
-                old_name_comps = old_name.split("_")
+            sample_dest = os.path.join(plan.root, project, sample)
+            plan.add_dir(sample_dest)
+            for fastq in fastq_index.files(lane=lane):
+                if not fastq.name.startswith("Undetermined"):
+                    continue
+                old_name_comps = fastq.name.split("_")
                 new_name_comps = [
                     sample.replace("Sample_", ""),
                     f"S{str(sample_counter)}",
                 ] + old_name_comps[2:]
                 new_name = "_".join(new_name_comps)
-                os.symlink(file, os.path.join(sample_dest, new_name))
+                plan.add(fastq.path, os.path.join(sample_dest, new_name))
                 logger.info(
                     "For undet sample {}, renaming {} to {}".format(
-                        sample.replace("Sample_", ""), old_name, new_name
+                        sample.replace("Sample_", ""), fastq.name, new_name
                     )
                 )
             sample_counter += 1
+
+    def _plan_noindex_sample_with_fake_index_with_single_demux(
+        self, demux_id, legacy_path
+    ):
+        demux_folder = os.path.join(self.run_dir, self.demux_dir)
+        plan = symlink_farm.LinkPlan(demux_folder)
+        fastq_index = symlink_farm.FastqIndex(
+            os.path.join(self.run_dir, f"Demultiplexing_{demux_id}"), depth=0
+        )
+        self._plan_noindex_sample_links(
+            plan, fastq_index, self.runParserObj.samplesheet.data
+        )
         # Make a softlink of lane.html
         html_report_lane_source = os.path.join(
             self.run_dir,
@@ -570,10 +802,16 @@ class Run:
             "all",
             "lane.html",
         )
-        if not os.path.isdir(os.path.dirname(html_report_lane_dest)):
-            os.makedirs(os.path.dirname(html_report_lane_dest))
-        os.symlink(html_report_lane_source, html_report_lane_dest)
+        plan.add(html_report_lane_source, html_report_lane_dest)
+        return plan
 
+    def _process_noindex_sample_with_fake_index_with_single_demux(
+        self, demux_id, legacy_path
+    ):
+        demux_folder = os.path.join(self.run_dir, self.demux_dir)
+        self._plan_noindex_sample_with_fake_index_with_single_demux(
+            demux_id, legacy_path
+        ).apply()
         # Modify the laneBarcode.html file
         html_report_laneBarcode = os.path.join(
             self.run_dir,
@@ -587,24 +825,6 @@ class Run:
             "all",
             "laneBarcode.html",
         )
-        html_report_laneBarcode_parser = LaneBarcodeParser(html_report_laneBarcode)
-        lane_project_sample = dict()
-        for entry in html_report_laneBarcode_parser.sample_data:
-            if entry["Sample"] != "Undetermined":
-                lane_project_sample[entry["Lane"]] = {
-                    "Project": entry["Project"],
-                    "Sample": entry["Sample"],
-                }
-        for entry in html_report_laneBarcode_parser.sample_data[:]:
-            if entry["Sample"] == "Undetermined":
-                entry["Project"] = lane_project_sample[entry["Lane"]]["Project"]
-                entry["Sample"] = lane_project_sample[entry["Lane"]]["Sample"]
-            else:
-                html_report_laneBarcode_parser.sample_data.remove(entry)
-        html_report_laneBarcode_parser.sample_data = sorted(
-            html_report_laneBarcode_parser.sample_data,
-            key=lambda k: (k["Lane"].lower(), k["Sample"]),
-        )
         new_html_report_laneBarcode = os.path.join(
             demux_folder,
             "Reports",
@@ -615,11 +835,44 @@ class Run:
             "all",
             "laneBarcode.html",
         )
-        _generate_lane_html(new_html_report_laneBarcode, html_report_laneBarcode_parser)
+        samplesheets = glob.glob(os.path.join(self.run_dir, "*_[0-9].csv"))
+        if self._use_native_reports(samplesheets):
+            reports = bclconvert_reports.DemuxReports.read(
+                os.path.join(self.run_dir, f"Demultiplexing_{demux_id}"), demux_id
+            )
+            bclconvert_reports.write_lane_html(
+                new_html_report_laneBarcode,
+                reports.flowcell_summary(),
+                reports.lane_barcode_rows(
+                    noindex_lanes=reports.demux_stats["Lane"].unique()
+                ),
+            )
+        else:
+            html_report_laneBarcode_parser = LaneBarcodeParser(html_report_laneBarcode)
+            lane_project_sample = dict()
+            for entry in html_report_laneBarcode_parser.sample_data:
+                if entry["Sample"] != "Undetermined":
+                    lane_project_sample[entry["Lane"]] = {
+                        "Project": entry["Project"],
+                        "Sample": entry["Sample"],
+                    }
+            for entry in html_report_laneBarcode_parser.sample_data[:]:
+                if entry["Sample"] == "Undetermined":
+                    entry["Project"] = lane_project_sample[entry["Lane"]]["Project"]
+                    entry["Sample"] = lane_project_sample[entry["Lane"]]["Sample"]
+                else:
+                    html_report_laneBarcode_parser.sample_data.remove(entry)
+            html_report_laneBarcode_parser.sample_data = sorted(
+                html_report_laneBarcode_parser.sample_data,
+                key=lambda k: (k["Lane"].lower(), k["Sample"]),
+            )
+            _generate_lane_html(
+                new_html_report_laneBarcode, html_report_laneBarcode_parser
+            )
 
         if not os.path.exists(os.path.join(demux_folder, "Stats")):
             os.makedirs(os.path.join(demux_folder, "Stats"))
-        # Modify the Stats.json file
+        # Modify the Stats.json file, one lane at a time
         stat_json_source = os.path.join(
             self.run_dir,
             f"Demultiplexing_{demux_id}",
@@ -628,23 +881,14 @@ class Run:
             "Stats.json",
         )
         stat_json_new = os.path.join(demux_folder, "Stats", "Stats.json")
-        with open(stat_json_source) as json_data:
-            data = json.load(json_data)
-        # Fix the sample stats per lane
-        for entry in data["ConversionResults"][:]:
-            del entry["DemuxResults"][0]["IndexMetrics"]
-            entry["DemuxResults"][0].update(entry["Undetermined"])
-            del entry["Undetermined"]
-        # Reset unknown barcodes list
-        for entry in data["UnknownBarcodes"][:]:
-            entry["Barcodes"] = {"unknown": 1}
-        # Write to a new Stats.json file
-        with open(stat_json_new, "w") as stat_json_new_file:
-            json.dump(data, stat_json_new_file)
+        rewrite_noindex_stats(stat_json_source, stat_json_new)
+        logger.info(
+            f"Rewrote the Stats.json of sub-demultiplexing {demux_id}, "
+            f"peak RSS {misc.peak_rss_mib():.0f} MiB"
+        )
 
-    def _process_simple_lane_with_single_demux(
-        self, demux_id, legacy_path, noindex_lanes
-    ):
+    def _plan_simple_lane_with_single_demux(self, demux_id, legacy_path, noindex_lanes):
+        plan = symlink_farm.LinkPlan(os.path.join(self.run_dir, self.demux_dir))
         elements = [
             element
             for element in os.listdir(
@@ -659,8 +903,8 @@ class Run:
                     self.run_dir, f"Demultiplexing_{demux_id}", element
                 )
                 dest = os.path.join(self.run_dir, self.demux_dir, element)
-                os.symlink(source, dest)
-        os.makedirs(os.path.join(self.run_dir, self.demux_dir, "Stats"))
+                plan.add(source, dest)
+        plan.add_dir(os.path.join(self.run_dir, self.demux_dir, "Stats"))
         # Fetch the lanes that have NoIndex
         statsFiles = glob.glob(
             os.path.join(
@@ -680,7 +924,7 @@ class Run:
                     dest = os.path.join(
                         self.run_dir, self.demux_dir, "Stats", source_name
                     )
-                    os.symlink(source, dest)
+                    plan.add(source, dest)
         for file in [
             "DemultiplexingStats.xml",
             "AdapterTrimming.txt",
@@ -691,23 +935,40 @@ class Run:
                 self.run_dir, f"Demultiplexing_{demux_id}", legacy_path, "Stats", file
             )
             dest = os.path.join(self.run_dir, self.demux_dir, "Stats", file)
-            os.symlink(source, dest)
+            plan.add(source, dest)
+        source = os.path.join(
+            self.run_dir, f"Demultiplexing_{demux_id}", legacy_path, "Reports"
+        )
+        dest = os.path.join(self.run_dir, self.demux_dir, "Reports")
+        plan.add(source, dest)
+        return plan
+
+    def _process_simple_lane_with_single_demux(
+        self, demux_id, legacy_path, noindex_lanes
+    ):
+        plan = self._plan_simple_lane_with_single_demux(
+            demux_id, legacy_path, noindex_lanes
+        )
         source = os.path.join(
             self.run_dir, f"Demultiplexing_{demux_id}", legacy_path, "Reports"
         )
         dest = os.path.join(self.run_dir, self.demux_dir, "Reports")
-        if os.path.exists(dest):
-            try:
-                os.rmdir(dest)
-            except NotADirectoryError:
-                os.unlink(dest)
-        os.symlink(source, dest)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            os.rmdir(dest)
+        plan.apply()
 
         # Replace the file laneBarcode.html
         html_report_laneBarcode = os.path.join(
             source, "html", self.flowcell_id, "all", "all", "all", "laneBarcode.html"
         )
-        if os.path.exists(html_report_laneBarcode):
+        samplesheets = glob.glob(os.path.join(self.run_dir, "*_[0-9].csv"))
+        if os.path.exists(html_report_laneBarcode) and self._use_native_reports(
+            samplesheets
+        ):
+            bclconvert_reports.DemuxReports.read(
+                os.path.join(self.run_dir, f"Demultiplexing_{demux_id}"), demux_id
+            ).write_html(os.path.dirname(html_report_laneBarcode), lane_html=False)
+        elif os.path.exists(html_report_laneBarcode):
             html_report_laneBarcode_parser = LaneBarcodeParser(html_report_laneBarcode)
             # Remove the trailing "_SX" postfix from samples names for BCL Convert when it handles SmartSeq3 libraries
             for entry in html_report_laneBarcode_parser.sample_data:
@@ -896,6 +1157,41 @@ class Run:
         )
         _generate_lane_html(new_html_report_laneBarcode, html_report_laneBarcode_parser)
 
+    def _aggregate_native_reports(
+        self,
+        demux_folder,
+        samplesheets,
+        index_cycles,
+        simple_lanes,
+        complex_lanes,
+        noindex_lanes,
+    ):
+        """Merge the CSV reports of bclconvert of all sub-demultiplexings into
+        the Reports of the Demultiplexing folder, the HTML reports are rendered
+        from them rather than parsed and rewritten.
+        """
+        reports = dict()
+        for samplesheet in samplesheets:
+            demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
+            reports[demux_id] = bclconvert_reports.DemuxReports.read(
+                os.path.join(self.run_dir, f"Demultiplexing_{demux_id}"), demux_id
+            )
+        merged = bclconvert_reports.DemuxReports.merge(
+            reports, simple_lanes, complex_lanes
+        )
+        merged.write(os.path.join(demux_folder, "Reports"))
+        # NumberReads for total lane cluster/yields and total sample cluster/yields
+        self.NumberReads_Summary = merged.lane_summary()
+        if self._use_legacy_html():
+            html_dir = _create_folder_structure(
+                demux_folder, ["Reports", "html", self.flowcell_id, "all", "all", "all"]
+            )
+            merged.write_html(
+                html_dir,
+                complex_lanes=complex_lanes,
+                noindex_lanes=noindex_lanes if index_cycles != [0, 0] else (),
+            )
+
     def _fix_demultiplexingstats_xml_dir(
         self,
         demux_folder,
@@ -908,247 +1204,49 @@ class Run:
     ):
         # Create the DemultiplexingStats.xml (empty it is here only to say thay demux is done)
         DemultiplexingStats_xml_dir = _create_folder_structure(demux_folder, ["Stats"])
-        # For creating DemuxSummary.txt files for complex lanes
-        DemuxSummaryFiles_complex_lanes = dict()
-        # Generate the Stats.json
-        with open(
-            os.path.join(DemultiplexingStats_xml_dir, "Stats.json"), "w"
-        ) as json_data_cumulative:
-            stats_list = {}
-            for stat_json in stats_json:
-                demux_id = re.findall("Demultiplexing_([0-9])", stat_json)[0]
-                with open(stat_json) as json_data_partial:
-                    data = json.load(json_data_partial)
-                    if len(stats_list) == 0:
-                        # First time I do this
-                        stats_list["RunNumber"] = data["RunNumber"]
-                        stats_list["Flowcell"] = data["Flowcell"]
-                        stats_list["RunId"] = data["RunId"]
-                        stats_list["ConversionResults"] = data["ConversionResults"]
-                        stats_list["ReadInfosForLanes"] = data["ReadInfosForLanes"]
-                        stats_list["UnknownBarcodes"] = []
-                    else:
-                        # Update only the importat fields
-                        lanes_present_in_stats_json = [
-                            entry["LaneNumber"]
-                            for entry in stats_list["ConversionResults"]
-                        ]
-                        for ReadInfosForLanes_lane in data["ReadInfosForLanes"]:
-                            if (
-                                ReadInfosForLanes_lane["LaneNumber"]
-                                not in lanes_present_in_stats_json
-                            ):
-                                stats_list["ReadInfosForLanes"].extend(
-                                    [ReadInfosForLanes_lane]
-                                )
-                        for ConversionResults_lane in data["ConversionResults"]:
-                            if (
-                                ConversionResults_lane["LaneNumber"]
-                                in lanes_present_in_stats_json
-                                and str(ConversionResults_lane["LaneNumber"])
-                                in complex_lanes.keys()
-                            ):
-                                # For complex lanes, we set all stats to 0, except for read number and yield which will use values from NumberReads_Summary
-                                ConversionResults_lane["Undetermined"][
-                                    "NumberReads"
-                                ] = self.NumberReads_Summary[
-                                    str(ConversionResults_lane["LaneNumber"])
-                                ]["undet_cluster"]
-                                ConversionResults_lane["Undetermined"]["Yield"] = (
-                                    self.NumberReads_Summary[
-                                        str(ConversionResults_lane["LaneNumber"])
-                                    ]["undet_yield"]
-                                    * 1000000
-                                )
-                                ConversionResults_lane["Undetermined"]["ReadMetrics"][
-                                    0
-                                ]["QualityScoreSum"] = 0
-                                ConversionResults_lane["Undetermined"]["ReadMetrics"][
-                                    0
-                                ]["TrimmedBases"] = 0
-                                ConversionResults_lane["Undetermined"]["ReadMetrics"][
-                                    0
-                                ]["Yield"] = 0
-                                ConversionResults_lane["Undetermined"]["ReadMetrics"][
-                                    0
-                                ]["YieldQ30"] = 0
-                                if (
-                                    len(
-                                        [
-                                            r
-                                            for r in self.runParserObj.runinfo.data[
-                                                "Reads"
-                                            ]
-                                            if r["IsIndexedRead"] == "N"
-                                        ]
-                                    )
-                                    == 2
-                                ):
-                                    ConversionResults_lane["Undetermined"][
-                                        "ReadMetrics"
-                                    ][1]["QualityScoreSum"] = 0
-                                    ConversionResults_lane["Undetermined"][
-                                        "ReadMetrics"
-                                    ][1]["TrimmedBases"] = 0
-                                    ConversionResults_lane["Undetermined"][
-                                        "ReadMetrics"
-                                    ][1]["Yield"] = 0
-                                    ConversionResults_lane["Undetermined"][
-                                        "ReadMetrics"
-                                    ][1]["YieldQ30"] = 0
-                                # Find the list containing info for this lane #TODO: can lane_to_update be removed?
-                                lane_to_update = [
-                                    entry
-                                    for entry in stats_list["ConversionResults"]
-                                    if entry["LaneNumber"]
-                                    == ConversionResults_lane["LaneNumber"]
-                                ][0]
-                                lane_to_update["DemuxResults"].extend(
-                                    ConversionResults_lane["DemuxResults"]
-                                )
-                                lane_to_update["Undetermined"] = ConversionResults_lane[
-                                    "Undetermined"
-                                ]
-                            else:
-                                stats_list["ConversionResults"].extend(
-                                    [ConversionResults_lane]
-                                )
-
-                    for unknown_barcode_lane in data["UnknownBarcodes"]:
-                        if str(unknown_barcode_lane["Lane"]) in simple_lanes.keys():
-                            stats_list["UnknownBarcodes"].extend([unknown_barcode_lane])
-                        elif str(unknown_barcode_lane["Lane"]) in complex_lanes.keys():
-                            if (
-                                list(
-                                    complex_lanes[
-                                        str(unknown_barcode_lane["Lane"])
-                                    ].keys()
-                                )[0]
-                                == demux_id
-                            ):
-                                # First have the list of unknown indexes from the top priority demux run
-                                full_list_unknownbarcodes = unknown_barcode_lane
-                                # Remove the samples involved in the other samplesheets
-                                for samplesheet in samplesheets:
-                                    demux_id_ss = os.path.splitext(
-                                        os.path.split(samplesheet)[1]
-                                    )[0].split("_")[1]
-                                    if demux_id_ss != demux_id:
-                                        ssparser = SampleSheetParser(samplesheet)
-                                        ssparser_data_lane = [
-                                            row
-                                            for row in ssparser.data
-                                            if row["Lane"]
-                                            == str(unknown_barcode_lane["Lane"])
-                                        ]
-                                        for row in ssparser_data_lane:
-                                            sample_idx1 = row.get("index", "")
-                                            sample_idx2 = row.get("index2", "")
-                                            idx_copy = tuple(
-                                                full_list_unknownbarcodes[
-                                                    "Barcodes"
-                                                ].keys()
-                                            )
-                                            for idx in idx_copy:
-                                                unknownbarcode_idx1 = (
-                                                    idx.split("+")[0]
-                                                    if "+" in idx
-                                                    else idx
-                                                )
-                                                unknownbarcode_idx2 = (
-                                                    idx.split("+")[1]
-                                                    if "+" in idx
-                                                    else ""
-                                                )
-                                                if sample_idx1 and sample_idx2:
-                                                    comparepart_idx1 = (
-                                                        sample_idx1
-                                                        if len(sample_idx1)
-                                                        <= len(unknownbarcode_idx1)
-                                                        else sample_idx1[
-                                                            : len(unknownbarcode_idx1)
-                                                        ]
-                                                    )
-                                                    comparepart_idx2 = (
-                                                        sample_idx2
-                                                        if len(sample_idx2)
-                                                        <= len(unknownbarcode_idx2)
-                                                        else sample_idx2[
-                                                            : len(unknownbarcode_idx2)
-                                                        ]
-                                                    )
-                                                    if (
-                                                        comparepart_idx1
-                                                        == unknownbarcode_idx1[
-                                                            : len(comparepart_idx1)
-                                                        ]
-                                                        and comparepart_idx2
-                                                        == unknownbarcode_idx2[
-                                                            : len(comparepart_idx2)
-                                                        ]
-                                                    ):
-                                                        del full_list_unknownbarcodes[
-                                                            "Barcodes"
-                                                        ][idx]
-                                                elif sample_idx1 and not sample_idx2:
-                                                    comparepart_idx1 = (
-                                                        sample_idx1
-                                                        if len(sample_idx1)
-                                                        <= len(unknownbarcode_idx1)
-                                                        else sample_idx1[
-                                                            : len(unknownbarcode_idx1)
-                                                        ]
-                                                    )
-                                                    if (
-                                                        comparepart_idx1
-                                                        == unknownbarcode_idx1[
-                                                            : len(comparepart_idx1)
-                                                        ]
-                                                    ):
-                                                        del full_list_unknownbarcodes[
-                                                            "Barcodes"
-                                                        ][idx]
-                                                elif not sample_idx1 and sample_idx2:
-                                                    comparepart_idx2 = (
-                                                        sample_idx2
-                                                        if len(sample_idx2)
-                                                        <= len(unknownbarcode_idx1)
-                                                        else sample_idx2[
-                                                            : len(unknownbarcode_idx1)
-                                                        ]
-                                                    )
-                                                    if (
-                                                        comparepart_idx1
-                                                        == unknownbarcode_idx1[
-                                                            : len(comparepart_idx2)
-                                                        ]
-                                                    ):
-                                                        del full_list_unknownbarcodes[
-                                                            "Barcodes"
-                                                        ][idx]
-                                stats_list["UnknownBarcodes"].extend(
-                                    [full_list_unknownbarcodes]
-                                )
-                                DemuxSummaryFiles_complex_lanes[
-                                    str(unknown_barcode_lane["Lane"])
-                                ] = full_list_unknownbarcodes
-                            else:
-                                pass
+        # Indexes of the samples in each lane of each sub-samplesheet
+        samplesheet_indexes = dict()
+
+        def other_samples(lane, demux_id):
+            """Indexes of the samples of a lane in the other sub-samplesheets."""
+            samples = []
+            for samplesheet in samplesheets:
+                demux_id_ss = os.path.splitext(os.path.split(samplesheet)[1])[0].split(
+                    "_"
+                )[1]
+                if demux_id_ss != demux_id:
+                    if samplesheet not in samplesheet_indexes:
+                        samplesheet_indexes[samplesheet] = _get_indexes_per_lane(
+                            samplesheet
+                        )
+                    samples.extend(samplesheet_indexes[samplesheet].get(lane, []))
+            return samples
 
+        # Generate the Stats.json, one lane at a time
+        DemuxSummaryFiles_complex_lanes = merge_stats(
+            stats_json,
+            os.path.join(DemultiplexingStats_xml_dir, "Stats.json"),
+            simple_lanes,
+            complex_lanes,
+            self.NumberReads_Summary,
+            other_samples,
+            read_count=len(
+                [
+                    r
+                    for r in self.runParserObj.runinfo.data["Reads"]
+                    if r["IsIndexedRead"] == "N"
+                ]
+            ),
             # Fix special case that when we assign fake indexes for NoIndex samples
-            if noindex_lanes and index_cycles != [0, 0]:
-                for entry in stats_list["ConversionResults"][:]:
-                    if str(entry["LaneNumber"]) in noindex_lanes:
-                        del entry["DemuxResults"][0]["IndexMetrics"]
-                        entry["DemuxResults"][0].update(entry["Undetermined"])
-                        del entry["Undetermined"]
-                # Reset unknown barcodes list
-                for entry in stats_list["UnknownBarcodes"][:]:
-                    if str(entry["Lane"]) in noindex_lanes:
-                        entry["Barcodes"] = {"unknown": 1}
-
-            # Write the final version of Stats.json file
-            json.dump(stats_list, json_data_cumulative)
+            noindex_lanes=noindex_lanes if index_cycles != [0, 0] else (),
+            top=self.CONFIG[self.software].get(
+                "unknown_barcodes_top", TOP_UNKNOWN_BARCODES
+            ),
+        )
+        logger.info(
+            f"Merged the Stats.json of {len(stats_json)} sub-demultiplexings, "
+            f"peak RSS {misc.peak_rss_mib():.0f} MiB"
+        )
 
         # Create DemuxSummary.txt files for complex lanes
         if len(DemuxSummaryFiles_complex_lanes) > 0:
@@ -1161,7 +1259,7 @@ class Run:
                 ) as DemuxSummaryFile:
                     DemuxSummaryFile.write("### Most Popular Unknown Index Sequences\n")
                     DemuxSummaryFile.write("### Columns: Index_Sequence Hit_Count\n")
-                    for idx, count in value["Barcodes"].items():
+                    for idx, count in value.items():
                         DemuxSummaryFile.write(f"{idx}\t{count}\n")
 
         open(
@@ -1177,10 +1275,12 @@ class Run:
         simple_lanes,
         complex_lanes,
         noindex_lanes,
+        html_reports=True,
     ):
         html_reports_lane = []
         html_reports_laneBarcode = []
         stats_json = []
+        plan = symlink_farm.LinkPlan(demux_folder)
         for samplesheet in samplesheets:
             ssparser = SampleSheetParser(samplesheet)
             demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
@@ -1196,7 +1296,9 @@ class Run:
                 "all",
                 "lane.html",
             )
-            if os.path.exists(html_report_lane):
+            if not html_reports:
+                pass
+            elif os.path.exists(html_report_lane):
                 html_reports_lane.append(html_report_lane)
             else:
                 raise RuntimeError(
@@ -1215,7 +1317,9 @@ class Run:
                 "all",
                 "laneBarcode.html",
             )
-            if os.path.exists(html_report_laneBarcode):
+            if not html_reports:
+                pass
+            elif os.path.exists(html_report_laneBarcode):
                 html_reports_laneBarcode.append(html_report_laneBarcode)
             else:
                 raise RuntimeError(
@@ -1236,163 +1340,124 @@ class Run:
                     f"Not able to find Stats.json report {stat_json}: possible cause is problem in demultiplexing"
                 )
 
-            # Aggregate fastq
-            lanes_samples = dict()
-            for row in ssparser.data:
-                if row["Lane"] not in lanes_samples.keys():
-                    lanes_samples[row["Lane"]] = [row["Sample_Name"]]
-                else:
-                    lanes_samples[row["Lane"]].append(row["Sample_Name"])
+            self._plan_sub_demux_links(
+                plan,
+                demux_id,
+                samplesheet,
+                ssparser,
+                legacy_path,
+                index_cycles,
+                simple_lanes,
+                noindex_lanes,
+            )
+        plan.apply()
 
-            # Special case that when we assign fake indexes for NoIndex samples
-            if (
-                set(list(lanes_samples.keys())) & set(noindex_lanes)
-            ) and index_cycles != [0, 0]:
-                sample_counter = 1
-                for entry in sorted(ssparser.data, key=lambda k: k["Lane"]):
-                    lane = entry["Lane"]
-                    project = entry["Sample_Project"]
-                    sample = entry["Sample_ID"]
-                    project_dest = os.path.join(demux_folder, project)
-                    if not os.path.exists(project_dest):
-                        os.makedirs(project_dest)
-                    sample_dest = os.path.join(project_dest, sample)
-                    if not os.path.exists(sample_dest):
-                        os.makedirs(sample_dest)
-                    for file in glob.glob(
-                        os.path.join(
-                            self.run_dir,
-                            f"Demultiplexing_{demux_id}",
-                            f"Undetermined*L0?{lane}*",
-                        )
-                    ):
-                        old_name = os.path.basename(file)
-                        old_name_comps = old_name.split("_")
-                        new_name_comps = [
-                            sample.replace("Sample_", ""),
-                            f"S{str(sample_counter)}",
-                        ] + old_name_comps[2:]
-                        new_name = "_".join(new_name_comps)
-                        os.symlink(file, os.path.join(sample_dest, new_name))
-                        logger.info(
-                            "For undet sample {}, renaming {} to {}".format(
-                                sample.replace("Sample_", ""), old_name, new_name
-                            )
-                        )
-                    sample_counter += 1
-            # Ordinary cases
+        return html_reports_lane, html_reports_laneBarcode, stats_json
+
+    def _plan_sub_demux_links(
+        self,
+        plan,
+        demux_id,
+        samplesheet,
+        ssparser,
+        legacy_path,
+        index_cycles,
+        simple_lanes,
+        noindex_lanes,
+    ):
+        """Plan the links of the FastQ files of a sub-demultiplexing, and of
+        the undetermined stats of its simple lanes, from a single scan of its
+        folder."""
+        fastq_index = symlink_farm.FastqIndex(
+            os.path.join(self.run_dir, f"Demultiplexing_{demux_id}")
+        )
+        lanes_samples = dict()
+        for row in ssparser.data:
+            if row["Lane"] not in lanes_samples.keys():
+                lanes_samples[row["Lane"]] = [row["Sample_Name"]]
             else:
-                projects = [
-                    project
-                    for project in os.listdir(
-                        os.path.join(self.run_dir, f"Demultiplexing_{demux_id}")
+                lanes_samples[row["Lane"]].append(row["Sample_Name"])
+
+        # Special case that when we assign fake indexes for NoIndex samples
+        if (set(list(lanes_samples.keys())) & set(noindex_lanes)) and index_cycles != [
+            0,
+            0,
+        ]:
+            self._plan_noindex_sample_links(plan, fastq_index, ssparser.data)
+            return
+        # Ordinary cases
+        for project in fastq_index.subdirs():
+            if project in "Reports" or project in "Stats":
+                continue
+            # There might be project seqeunced with multiple index lengths
+            plan.add_dir(os.path.join(plan.root, project))
+            for sample in fastq_index.subdirs(project):
+                # There should never be the same sample sequenced with different index length,
+                # however a sample might be pooled in several lanes and therefore sequenced using different samplesheets
+                sample_dest = os.path.join(plan.root, project, sample)
+                plan.add_dir(sample_dest)
+                for fastq in fastq_index.files(project, sample):
+                    plan.add(fastq.path, os.path.join(sample_dest, fastq.name))
+        # Copy fastq files for undetermined and the undetermined stats for simple lanes only
+        lanes_in_sub_samplesheet = []
+        header = [
+            "[Header]",
+            "[Data]",
+            "FCID",
+            "Lane",
+            "Sample_ID",
+            "Sample_Name",
+            "Sample_Ref",
+            "index",
+            "index2",
+            "Description",
+            "Control",
+            "Recipe",
+            "Operator",
+            "Sample_Project",
+            "[Settings]",
+            "OverrideCycles",
+            "MinimumTrimmedReadLength",
+            "MaskShortReads",
+            "CreateFastqForIndexReads",
+            "BarcodeMismatchesIndex1",
+            "BarcodeMismatchesIndex2",
+            "TrimUMI",
+        ]
+        with open(samplesheet) as sub_samplesheet_file:
+            sub_samplesheet_reader = csv.reader(sub_samplesheet_file)
+            for row in sub_samplesheet_reader:
+                if row[0] not in header:
+                    lanes_in_sub_samplesheet.append(row[1])
+        lanes_in_sub_samplesheet = list(set(lanes_in_sub_samplesheet))
+        for lane in lanes_in_sub_samplesheet:
+            if lane in simple_lanes.keys():
+                # Contains only simple lanes undetermined
+                for fastq in fastq_index.files(lane=lane):
+                    if fastq.name.startswith("Undetermined_S0_"):
+                        plan.add(fastq.path, os.path.join(plan.root, fastq.name))
+                DemuxSummaryFiles = glob.glob(
+                    os.path.join(
+                        self.run_dir,
+                        f"Demultiplexing_{demux_id}",
+                        legacy_path,
+                        "Stats",
+                        f"*L{lane}*txt",
                     )
-                    if os.path.isdir(
+                )
+                plan.add_dir(os.path.join(plan.root, "Stats"))
+                for DemuxSummaryFile in DemuxSummaryFiles:
+                    plan.add(
+                        DemuxSummaryFile,
                         os.path.join(
-                            self.run_dir, f"Demultiplexing_{demux_id}", project
-                        )
-                    )
-                ]
-                for project in projects:
-                    if project in "Reports" or project in "Stats":
-                        continue
-                    project_source = os.path.join(
-                        self.run_dir, f"Demultiplexing_{demux_id}", project
+                            plan.root, "Stats", os.path.split(DemuxSummaryFile)[1]
+                        ),
                     )
-                    project_dest = os.path.join(demux_folder, project)
-                    if not os.path.exists(project_dest):
-                        # There might be project seqeunced with multiple index lengths
-                        os.makedirs(project_dest)
-                    samples = [
-                        sample
-                        for sample in os.listdir(project_source)
-                        if os.path.isdir(os.path.join(project_source, sample))
-                    ]
-                    for sample in samples:
-                        sample_source = os.path.join(project_source, sample)
-                        sample_dest = os.path.join(project_dest, sample)
-                        if not os.path.exists(sample_dest):
-                            # There should never be the same sample sequenced with different index length,
-                            # however a sample might be pooled in several lanes and therefore sequenced using different samplesheets
-                            os.makedirs(sample_dest)
-                        fastqfiles = glob.glob(os.path.join(sample_source, "*.fastq*"))
-                        for fastqfile in fastqfiles:
-                            os.symlink(
-                                fastqfile,
-                                os.path.join(sample_dest, os.path.split(fastqfile)[1]),
-                            )
-                # Copy fastq files for undetermined and the undetermined stats for simple lanes only
-                lanes_in_sub_samplesheet = []
-                header = [
-                    "[Header]",
-                    "[Data]",
-                    "FCID",
-                    "Lane",
-                    "Sample_ID",
-                    "Sample_Name",
-                    "Sample_Ref",
-                    "index",
-                    "index2",
-                    "Description",
-                    "Control",
-                    "Recipe",
-                    "Operator",
-                    "Sample_Project",
-                    "[Settings]",
-                    "OverrideCycles",
-                    "MinimumTrimmedReadLength",
-                    "MaskShortReads",
-                    "CreateFastqForIndexReads",
-                    "BarcodeMismatchesIndex1",
-                    "BarcodeMismatchesIndex2",
-                    "TrimUMI",
-                ]
-                with open(samplesheet) as sub_samplesheet_file:
-                    sub_samplesheet_reader = csv.reader(sub_samplesheet_file)
-                    for row in sub_samplesheet_reader:
-                        if row[0] not in header:
-                            lanes_in_sub_samplesheet.append(row[1])
-                lanes_in_sub_samplesheet = list(set(lanes_in_sub_samplesheet))
-                for lane in lanes_in_sub_samplesheet:
-                    if lane in simple_lanes.keys():
-                        undetermined_fastq_files = glob.glob(
-                            os.path.join(
-                                self.run_dir,
-                                f"Demultiplexing_{demux_id}",
-                                f"Undetermined_S0_L00{lane}*.fastq*",
-                            )
-                        )  # Contains only simple lanes undetermined
-                        for fastqfile in undetermined_fastq_files:
-                            os.symlink(
-                                fastqfile,
-                                os.path.join(demux_folder, os.path.split(fastqfile)[1]),
-                            )
-                        DemuxSummaryFiles = glob.glob(
-                            os.path.join(
-                                self.run_dir,
-                                f"Demultiplexing_{demux_id}",
-                                legacy_path,
-                                "Stats",
-                                f"*L{lane}*txt",
-                            )
-                        )
-                        if not os.path.exists(os.path.join(demux_folder, "Stats")):
-                            os.makedirs(os.path.join(demux_folder, "Stats"))
-                        for DemuxSummaryFile in DemuxSummaryFiles:
-                            os.symlink(
-                                DemuxSummaryFile,
-                                os.path.join(
-                                    demux_folder,
-                                    "Stats",
-                                    os.path.split(DemuxSummaryFile)[1],
-                                ),
-                            )
-
-        return html_reports_lane, html_reports_laneBarcode, stats_json
 
-    def _aggregate_demux_results_simple_complex(self):
+    def _aggregation_setup(self):
+        """Return the sub-samplesheets, the path of the legacy reports, the
+        index cycles and the NoIndex, simple and complex lanes of the run."""
         runSetup = self.runParserObj.runinfo.get_read_configuration()
-        demux_folder = os.path.join(self.run_dir, self.demux_dir)
         samplesheets = glob.glob(os.path.join(self.run_dir, "*_[0-9].csv"))
         if self.software == "bcl2fastq":
             legacy_path = ""
@@ -1413,6 +1478,62 @@ class Run:
         (noindex_lanes, simple_lanes, complex_lanes) = self._classify_lanes(
             samplesheets
         )
+        return (
+            samplesheets,
+            legacy_path,
+            index_cycles,
+            noindex_lanes,
+            simple_lanes,
+            complex_lanes,
+        )
+
+    def plan_demux_links(self):
+        """Plan the links aggregating the sub-demultiplexings of the run in
+        its demux folder, without making them.
+
+        :returns: the symlink_farm.LinkPlan of the links
+        """
+        (
+            samplesheets,
+            legacy_path,
+            index_cycles,
+            noindex_lanes,
+            simple_lanes,
+            complex_lanes,
+        ) = self._aggregation_setup()
+        if len(complex_lanes) == 0 and len(samplesheets) == 1:
+            if noindex_lanes and index_cycles != [0, 0]:
+                return self._plan_noindex_sample_with_fake_index_with_single_demux(
+                    "0", legacy_path
+                )
+            return self._plan_simple_lane_with_single_demux(
+                "0", legacy_path, noindex_lanes
+            )
+        plan = symlink_farm.LinkPlan(os.path.join(self.run_dir, self.demux_dir))
+        for samplesheet in samplesheets:
+            demux_id = os.path.splitext(os.path.split(samplesheet)[1])[0].split("_")[1]
+            self._plan_sub_demux_links(
+                plan,
+                demux_id,
+                samplesheet,
+                SampleSheetParser(samplesheet),
+                legacy_path,
+                index_cycles,
+                simple_lanes,
+                noindex_lanes,
+            )
+        return plan
+
+    def _aggregate_demux_results_simple_complex(self):
+        demux_folder = os.path.join(self.run_dir, self.demux_dir)
+        (
+            samplesheets,
+            legacy_path,
+            index_cycles,
+            noindex_lanes,
+            simple_lanes,
+            complex_lanes,
+        ) = self._aggregation_setup()
 
         # Case with only one sub-demultiplexing
         if len(complex_lanes) == 0 and len(samplesheets) == 1:
@@ -1431,6 +1552,7 @@ class Run:
             return True
 
         # Case with multiple sub-demultiplexings
+        native_reports = self._use_native_reports(samplesheets)
         (
             html_reports_lane,
             html_reports_laneBarcode,
@@ -1443,17 +1565,28 @@ class Run:
             simple_lanes,
             complex_lanes,
             noindex_lanes,
+            html_reports=not native_reports,
         )
 
-        # Create the html reports
-        self._fix_html_reports_for_complex_lanes(
-            demux_folder,
-            index_cycles,
-            complex_lanes,
-            noindex_lanes,
-            html_reports_lane,
-            html_reports_laneBarcode,
-        )
+        # Create the reports
+        if native_reports:
+            self._aggregate_native_reports(
+                demux_folder,
+                samplesheets,
+                index_cycles,
+                simple_lanes,
+                complex_lanes,
+                noindex_lanes,
+            )
+        else:
+            self._fix_html_reports_for_complex_lanes(
+                demux_folder,
+                index_cycles,
+                complex_lanes,
+                noindex_lanes,
+                html_reports_lane,
+                html_reports_laneBarcode,
+            )
 
         # Fix contents under the DemultiplexingStats folder
         self._fix_demultiplexingstats_xml_dir(
@@ -1481,55 +1614,21 @@ def _create_folder_structure(root, dirs):
     return path
 
 
-def _generate_lane_html(html_file, html_report_lane_parser):
-    with open(html_file, "w") as html:
-        # HEADER
-        html.write(
-            '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">\n'
-        )
-        html.write("<html xmlns:bcl2fastq>\n")
-        html.write(
-            '<link rel="stylesheet" href="../../../../Report.css" type="text/css">\n'
-        )
-        html.write("<body>\n")
-        html.write('<table width="100%"><tr>\n')
-        html.write("<td><p><p>C6L1WANXX /\n")
-        html.write("        [all projects] /\n")
-        html.write("        [all samples] /\n")
-        html.write("        [all barcodes]</p></p></td>\n")
-        html.write(
-            '<td><p align="right"><a href="../../../../FAKE/all/all/all/laneBarcode.html">show barcodes</a></p></td>\n'
+def _get_indexes_per_lane(samplesheet):
+    """Return the (index, index2) of the samples of each lane of a samplesheet,
+    in samplesheet order.
+    """
+    indexes = dict()
+    for row in SampleSheetParser(samplesheet).data:
+        indexes.setdefault(row["Lane"], []).append(
+            (row.get("index") or "", row.get("index2") or "")
         )
-        html.write("</tr></table>\n")
-        # FLOWCELL SUMMARY TABLE
-        html.write("<h2>Flowcell Summary</h2>\n")
-        html.write('<table border="1" ID="ReportTable">\n')
-        html.write("<tr>\n")
-        fc_keys = sorted(list(html_report_lane_parser.flowcell_data.keys()))
-        for key in fc_keys:
-            html.write(f"<th>{key}</th>\n")
-        html.write("</tr>\n")
-        html.write("<tr>\n")
-        for key in fc_keys:
-            html.write(f"<td>{html_report_lane_parser.flowcell_data[key]}</td>\n")
-        html.write("</tr>\n")
-        html.write("</table>\n")
-        # LANE SUMMARY TABLE
-        html.write("<h2>Lane Summary</h2>\n")
-        html.write('<table border="1" ID="ReportTable">\n')
-        html.write("<tr>\n")
-        lane_keys = sorted(list(html_report_lane_parser.sample_data[0].keys()))
-        for key in lane_keys:
-            html.write(f"<th>{key}</th>\n")
-        html.write("</tr>\n")
-
-        for sample in html_report_lane_parser.sample_data:
-            html.write("<tr>\n")
-            for key in lane_keys:
-                html.write(f"<td>{sample[key]}</td>\n")
-            html.write("</tr>\n")
-        html.write("</table>\n")
-        # FOOTER
-        html.write("<p></p>\n")
-        html.write("</body>\n")
-        html.write("</html>\n")
+    return indexes
+
+
+def _generate_lane_html(html_file, html_report_lane_parser):
+    bclconvert_reports.write_lane_html(
+        html_file,
+        html_report_lane_parser.flowcell_data,
+        html_report_lane_parser.sample_data,
+    )
@@ -5,8 +5,8 @@ from datetime import datetime
 
 from flowcell_parser.classes import SampleSheetParser
 
+from taca.illumina.demux_plan import DemuxPlan
 from taca.illumina.Runs import Run
-from taca.utils import misc
 from taca.utils.filesystem import chdir
 
 logger = logging.getLogger(__name__)
@@ -76,10 +76,7 @@ class Standard_Run(Run):
         self.runParserObj.samplesheet = SampleSheetParser(
             os.path.join(self.run_dir, "SampleSheet.csv")
         )
-        if not self.runParserObj.obj.get("samplesheet_csv"):
-            self.runParserObj.obj["samplesheet_csv"] = (
-                self.runParserObj.samplesheet.data
-            )
+        # The parser falls back to it for the samplesheet_csv of its obj
 
     def _parse_10X_indexes(self, indexfile):
         """
@@ -126,77 +123,26 @@ class Standard_Run(Run):
                     read_cycles[0] = int(read["NumCycles"])
                 else:
                     read_cycles[1] = int(read["NumCycles"])
+        # Samples sharing indexes and recipe are classified alike, and a large
+        # sample sheet has many of them, e.g. the same 10X index in each lane
+        classified = dict()
         for sample in ssparser.data:
             lane = sample["Lane"]
             sample_name = sample.get("Sample_Name") or sample.get("SampleName")
-            umi_length = [0, 0]
-            read_length = read_cycles
             if not sample.get("index"):
                 sample["index"] = ""
             if not sample.get("index2"):
                 sample["index2"] = ""
-            # Read the length of read 1 and read 2 from the field Recipe
-            if sample.get("Recipe") and RECIPE_PAT.findall(sample.get("Recipe")):
-                ss_read_length = [
-                    int(sample.get("Recipe").split("-")[0]),
-                    int(sample.get("Recipe").split("-")[1]),
-                ]
-            else:
-                ss_read_length = [0, 0]
-            # By default use the read cycles from the sequncing setup. Otherwise use the shorter read length
-            if ss_read_length != [0, 0]:
-                read_length = [min(rd) for rd in zip(ss_read_length, read_length)]
-            # 10X single index
-            if TENX_SINGLE_PAT.findall(sample["index"]):
-                index_length = [len(index_dict_tenX[sample["index"]][0]), 0]
-                sample_type = "10X_SINGLE"
-            # 10X dual index
-            elif TENX_DUAL_PAT.findall(sample["index"]):
-                index_length = [
-                    len(index_dict_tenX[sample["index"]][0]),
-                    len(index_dict_tenX[sample["index"]][1]),
-                ]
-                sample_type = "10X_DUAL"
-            # IDT UMI samples
-            elif IDT_UMI_PAT.findall(sample["index"]) or IDT_UMI_PAT.findall(
-                sample["index2"]
-            ):
-                # Index length after removing "N" part
-                index_length = [
-                    len(sample["index"].replace("N", "")),
-                    len(sample["index2"].replace("N", "")),
-                ]
-                sample_type = "IDT_UMI"
-                umi_length = [
-                    sample["index"].upper().count("N"),
-                    sample["index2"].upper().count("N"),
-                ]
-            # Smart-seq
-            elif SMARTSEQ_PAT.findall(sample["index"]):
-                smartseq_index = sample["index"].split("-")[1]
-                index_length = [
-                    len(index_dict_smartseq[smartseq_index][0][0]),
-                    len(index_dict_smartseq[smartseq_index][0][1]),
-                ]
-                sample_type = "SMARTSEQ"
-            # No Index case 1. We will write indexes to separate FastQ files
-            elif sample["index"].upper() == "NOINDEX" and index_cycles != [0, 0]:
-                index_length = index_cycles
-                sample_type = "NOINDEX"
-            # No Index case 2. Both index 1 and 2 are empty, it will be the same index type but will be handled in the next case
-            elif sample["index"].upper() == "NOINDEX" and index_cycles == [0, 0]:
-                index_length = [0, 0]
-                sample_type = "ordinary"
-            # Ordinary samples
-            else:
-                index_length = [len(sample["index"]), len(sample["index2"])]
-                # Short single index (<=6nt)
-                if (index_length[0] <= 8 and index_length[1] == 0) or (
-                    index_length[0] == 0 and index_length[1] <= 8
-                ):
-                    sample_type = "short_single_index"
-                else:
-                    sample_type = "ordinary"
+            key = (sample["index"], sample["index2"], sample.get("Recipe"))
+            if key not in classified:
+                classified[key] = self._classify_sample(
+                    sample,
+                    index_dict_tenX,
+                    index_dict_smartseq,
+                    index_cycles,
+                    read_cycles,
+                )
+            sample_type, index_length, umi_length, read_length = classified[key]
 
             # Write in sample table
             # {'1': [('101', {'sample_type': 'ordinary', 'index_length': [8, 8]}), ('102', {'sample_type': 'ordinary', 'index_length': [8, 8]})]}
@@ -231,6 +177,76 @@ class Standard_Run(Run):
 
         return sample_table
 
+    def _classify_sample(
+        self, sample, index_dict_tenX, index_dict_smartseq, index_cycles, read_cycles
+    ):
+        """Return the sample type and the index, UMI and read lengths of a sample."""
+        umi_length = [0, 0]
+        read_length = read_cycles
+        # Read the length of read 1 and read 2 from the field Recipe
+        if sample.get("Recipe") and RECIPE_PAT.search(sample.get("Recipe")):
+            ss_read_length = [
+                int(sample.get("Recipe").split("-")[0]),
+                int(sample.get("Recipe").split("-")[1]),
+            ]
+        else:
+            ss_read_length = [0, 0]
+        # By default use the read cycles from the sequncing setup. Otherwise use the shorter read length
+        if ss_read_length != [0, 0]:
+            read_length = [min(rd) for rd in zip(ss_read_length, read_length)]
+        # 10X single index
+        if TENX_SINGLE_PAT.search(sample["index"]):
+            index_length = [len(index_dict_tenX[sample["index"]][0]), 0]
+            sample_type = "10X_SINGLE"
+        # 10X dual index
+        elif TENX_DUAL_PAT.search(sample["index"]):
+            index_length = [
+                len(index_dict_tenX[sample["index"]][0]),
+                len(index_dict_tenX[sample["index"]][1]),
+            ]
+            sample_type = "10X_DUAL"
+        # IDT UMI samples
+        elif IDT_UMI_PAT.search(sample["index"]) or IDT_UMI_PAT.search(
+            sample["index2"]
+        ):
+            # Index length after removing "N" part
+            index_length = [
+                len(sample["index"].replace("N", "")),
+                len(sample["index2"].replace("N", "")),
+            ]
+            sample_type = "IDT_UMI"
+            umi_length = [
+                sample["index"].upper().count("N"),
+                sample["index2"].upper().count("N"),
+            ]
+        # Smart-seq
+        elif SMARTSEQ_PAT.search(sample["index"]):
+            smartseq_index = sample["index"].split("-")[1]
+            index_length = [
+                len(index_dict_smartseq[smartseq_index][0][0]),
+                len(index_dict_smartseq[smartseq_index][0][1]),
+            ]
+            sample_type = "SMARTSEQ"
+        # No Index case 1. We will write indexes to separate FastQ files
+        elif sample["index"].upper() == "NOINDEX" and index_cycles != [0, 0]:
+            index_length = index_cycles
+            sample_type = "NOINDEX"
+        # No Index case 2. Both index 1 and 2 are empty, it will be the same index type but will be handled in the next case
+        elif sample["index"].upper() == "NOINDEX" and index_cycles == [0, 0]:
+            index_length = [0, 0]
+            sample_type = "ordinary"
+        # Ordinary samples
+        else:
+            index_length = [len(sample["index"]), len(sample["index2"])]
+            # Short single index (<=6nt)
+            if (index_length[0] <= 8 and index_length[1] == 0) or (
+                index_length[0] == 0 and index_length[1] <= 8
+            ):
+                sample_type = "short_single_index"
+            else:
+                sample_type = "ordinary"
+        return sample_type, index_length, umi_length, read_length
+
     def demultiplex_run(self):
         """
         Demultiplex a run:
@@ -239,208 +255,112 @@ class Standard_Run(Run):
          - run bcl2fastq/bclconvert conversion
         """
         runSetup = self.runParserObj.runinfo.get_read_configuration()
-        # Check sample types
-        sample_type_list = []
-        for lane, lane_contents in self.sample_table.items():
-            for sample in lane_contents:
-                sample_detail = sample[1]
-                sample_type = sample_detail["sample_type"]
-                if sample_type not in sample_type_list:
-                    sample_type_list.append(sample_type)
-
-        # Go through sample_table for demultiplexing
-        bcl_cmd_counter = 0
-        for sample_type in sorted(sample_type_list):
-            # Looking for lanes with multiple masks under the same sample type
-            lane_table = dict()
-            for lane, lane_contents in self.sample_table.items():
-                for sample in lane_contents:
-                    sample_detail = sample[1]
-                    sample_type_t = sample_detail["sample_type"]
-                    sample_index_length = sample_detail["index_length"]
-                    sample_umi_length = sample_detail["umi_length"]
-                    sample_read_length = sample_detail["read_length"]
-                    if sample_type_t == sample_type:
-                        if lane_table.get(lane):
-                            if (
-                                sample_index_length,
-                                sample_umi_length,
-                                sample_read_length,
-                            ) not in lane_table[lane]:
-                                lane_table[lane].append(
-                                    (
-                                        sample_index_length,
-                                        sample_umi_length,
-                                        sample_read_length,
-                                    )
-                                )
-                        else:
-                            lane_table.update(
-                                {
-                                    lane: [
-                                        (
-                                            sample_index_length,
-                                            sample_umi_length,
-                                            sample_read_length,
-                                        )
-                                    ]
-                                }
-                            )
-
-            # Determine the number of demux needed for the same sample type
-            if self.software == "bcl2fastq":
-                demux_number_with_the_same_sample_type = len(
-                    max([v for k, v in lane_table.items()], key=len)
-                )
-            elif self.software == "bclconvert":
-                unique_masks = []
-                for masks in lane_table.values():
-                    for mask in masks:
-                        if mask not in unique_masks:
-                            unique_masks.append(mask)
-                demux_number_with_the_same_sample_type = len(unique_masks)
-            # Prepare sub-samplesheets, masks and commands
-            for i in range(0, demux_number_with_the_same_sample_type):
-                # Prepare sub-samplesheet
-                # A dictionary with lane and sample IDs to include
-                samples_to_include = dict()
-                # A dictionary with lane and index length for generating masks
-                mask_table = dict()
-                if self.software == "bcl2fastq":
-                    for lane, lane_contents in self.sample_table.items():
-                        try:
-                            (index_length, umi_length, read_length) = lane_table[lane][
-                                i
-                            ]
-                            mask_table.update(
-                                {lane: (index_length, umi_length, read_length)}
-                            )
-                            for sample in lane_contents:
-                                sample_name = sample[0]
-                                sample_detail = sample[1]
-                                sample_type_t = sample_detail["sample_type"]
-                                sample_index_length = sample_detail["index_length"]
-                                sample_umi_length = sample_detail["umi_length"]
-                                sample_read_length = sample_detail["read_length"]
-                                if (
-                                    sample_type_t == sample_type
-                                    and sample_index_length == index_length
-                                    and sample_umi_length == umi_length
-                                    and sample_read_length == read_length
-                                ):
-                                    if samples_to_include.get(lane):
-                                        samples_to_include[lane].append(sample_name)
-                                    else:
-                                        samples_to_include.update({lane: [sample_name]})
-                        except (KeyError, IndexError):
-                            logger.info(
-                                f"No corresponding mask in lane {lane}. Skip it."
-                            )
-                            continue
-                elif self.software == "bclconvert":
-                    mask = unique_masks[i]
-                    for lane, lane_contents in self.sample_table.items():
-                        if lane_table.get(lane):
-                            if mask in lane_table[lane]:
-                                mask_table.update({lane: mask})
-                                for sample in lane_contents:
-                                    sample_name = sample[0]
-                                    sample_detail = sample[1]
-                                    sample_type_t = sample_detail["sample_type"]
-                                    sample_index_length = sample_detail["index_length"]
-                                    sample_umi_length = sample_detail["umi_length"]
-                                    sample_read_length = sample_detail["read_length"]
-                                    if (
-                                        sample_type_t == sample_type
-                                        and sample_index_length == mask[0]
-                                        and sample_umi_length == mask[1]
-                                        and sample_read_length == mask[2]
-                                    ):
-                                        if samples_to_include.get(lane):
-                                            samples_to_include[lane].append(sample_name)
-                                        else:
-                                            samples_to_include.update(
-                                                {lane: [sample_name]}
-                                            )
-
-                if self.software == "bclconvert":
-                    runSetup = self.runParserObj.runinfo.get_read_configuration()
-                    (index_length, umi_length, read_length) = mask
-                    index1_size = int(index_length[0])
-                    index2_size = int(index_length[1])
-                    umi1_size = int(umi_length[0])
-                    umi2_size = int(umi_length[1])
-                    read1_size = int(read_length[0])
-                    read2_size = int(read_length[1])
-                    is_dual_index = False
-                    if (index1_size != 0 and index2_size != 0) or (
-                        index1_size == 0 and index2_size != 0
-                    ):
-                        is_dual_index = True
-                    base_mask = self._compute_base_mask(
-                        runSetup,
-                        sample_type,
-                        index1_size,
-                        is_dual_index,
-                        index2_size,
-                        umi1_size,
-                        umi2_size,
-                        read1_size,
-                        read2_size,
-                    )
-                else:
-                    index1_size = 0
-                    index2_size = 0
-                    base_mask = []
-                # Make sub-samplesheet
-                with chdir(self.run_dir):
-                    samplesheet_dest = f"SampleSheet_{bcl_cmd_counter}.csv"
-                    with open(samplesheet_dest, "w") as fcd:
-                        fcd.write(
-                            self._generate_samplesheet_subset(
-                                self.runParserObj.samplesheet,
-                                samples_to_include,
-                                runSetup,
-                                self.software,
-                                sample_type,
-                                index1_size,
-                                index2_size,
-                                base_mask,
-                                self.CONFIG,
-                            )
+        plan = self.get_demux_plan()
+        # Go through the planned sub-demultiplexings
+        for sub_demux in plan.sub_demuxes:
+            bcl_cmd_counter = sub_demux["id"]
+            sample_type = sub_demux["sample_type"]
+            mask_table = sub_demux["mask_table"]
+            samples_to_include = sub_demux["samples"]
+            if self.software == "bclconvert":
+                (index_length, _, _) = sub_demux["mask"]
+                index1_size = int(index_length[0])
+                index2_size = int(index_length[1])
+            else:
+                index1_size = 0
+                index2_size = 0
+            # The sub-samplesheet adjusts the base mask of NOINDEX samples
+            base_mask = list(sub_demux["base_mask"])
+            # Make sub-samplesheet
+            with chdir(self.run_dir):
+                samplesheet_dest = f"SampleSheet_{bcl_cmd_counter}.csv"
+                with open(samplesheet_dest, "w") as fcd:
+                    fcd.write(
+                        self._generate_samplesheet_subset(
+                            self.runParserObj.samplesheet,
+                            samples_to_include,
+                            runSetup,
+                            self.software,
+                            sample_type,
+                            index1_size,
+                            index2_size,
+                            base_mask,
+                            self.CONFIG,
                         )
+                    )
 
-                # Prepare demultiplexing dir
-                with chdir(self.run_dir):
-                    # Create Demultiplexing dir, this changes the status to IN_PROGRESS
-                    if not os.path.exists("Demultiplexing"):
-                        os.makedirs("Demultiplexing")
-
-                # Prepare demultiplexing command
-                with chdir(self.run_dir):
+            # Prepare demultiplexing dir
+            with chdir(self.run_dir):
+                # Create Demultiplexing dir, this changes the status to IN_PROGRESS
+                if not os.path.exists("Demultiplexing"):
+                    os.makedirs("Demultiplexing")
+
+            # Prepare demultiplexing command
+            with chdir(self.run_dir):
+                if self._is_split_per_lane():
+                    # One job per lane, merged when all of them are done
+                    for lane in sorted(samples_to_include):
+                        cmd = self.generate_bcl_command(
+                            sample_type, mask_table, bcl_cmd_counter, lane=lane
+                        )
+                        self._start_demux_job(cmd, f"{bcl_cmd_counter}_L{lane}")
+                else:
                     cmd = self.generate_bcl_command(
                         sample_type, mask_table, bcl_cmd_counter
                     )
-                    misc.call_external_command_detached(
-                        cmd, with_log_files=True, prefix=f"demux_{bcl_cmd_counter}"
-                    )
-                    logger.info(
-                        "BCL to FASTQ conversion and demultiplexing "
-                        f"started for run {os.path.basename(self.id)} on {datetime.now()}"
-                    )
-
-                # Demultiplexing done for one mask type and scripts will continue
-                # Working with the next type. Command counter should increase by 1
-                bcl_cmd_counter += 1
+                    self._start_demux_job(cmd, bcl_cmd_counter)
+                logger.info(
+                    "BCL to FASTQ conversion and demultiplexing "
+                    f"started for run {os.path.basename(self.id)} on {datetime.now()}"
+                )
+        # Keep the plan with the run, for the aggregation and for inspection
+        plan.write(self.run_dir)
         return True
 
+    def get_demux_plan(self):
+        """Group the samples of the run into sub-demultiplexings.
+
+        :returns: a DemuxPlan, with the base mask of each sub-demultiplexing
+        """
+        plan = DemuxPlan.from_sample_table(
+            os.path.basename(self.id), self.software, self.sample_table
+        )
+        runSetup = self.runParserObj.runinfo.get_read_configuration()
+        for sub_demux in plan.sub_demuxes:
+            if self.software == "bclconvert":
+                (index_length, umi_length, read_length) = sub_demux["mask"]
+                index1_size = int(index_length[0])
+                index2_size = int(index_length[1])
+                is_dual_index = False
+                if (index1_size != 0 and index2_size != 0) or (
+                    index1_size == 0 and index2_size != 0
+                ):
+                    is_dual_index = True
+                sub_demux["base_mask"] = self._compute_base_mask(
+                    runSetup,
+                    sub_demux["sample_type"],
+                    index1_size,
+                    is_dual_index,
+                    index2_size,
+                    int(umi_length[0]),
+                    int(umi_length[1]),
+                    int(read_length[0]),
+                    int(read_length[1]),
+                )
+            else:
+                sub_demux["base_mask"] = []
+        return plan
+
     def _aggregate_demux_results(self):
         """Take the Stats.json files from the different
         demultiplexing folders and merges them into one
         """
         self._aggregate_demux_results_simple_complex()
 
-    def generate_bcl_command(self, sample_type, mask_table, bcl_cmd_counter):
+    def generate_bcl_command(self, sample_type, mask_table, bcl_cmd_counter, lane=None):
+        """Build the bcl2fastq or bclconvert command of a sub-demultiplexing,
+        or of one of its lanes if 'lane' is given (bclconvert only).
+        """
         with chdir(self.run_dir):
             # Software
             cl = [self.CONFIG.get(self.software)["bin"]]
@@ -468,6 +388,9 @@ class Standard_Run(Run):
                 raise RuntimeError("Unrecognized software!")
             # Output dir
             output_dir = os.path.join(self.run_dir, f"Demultiplexing_{bcl_cmd_counter}")
+            if lane is not None:
+                cl.extend(["--bcl-only-lane", str(lane)])
+                output_dir = self._get_lane_dir(bcl_cmd_counter, lane)
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             cl.extend(["--output-dir", output_dir])
@@ -911,12 +834,16 @@ class Standard_Run(Run):
             datafields.append(field)
         output += ",".join(datafields)
         output += os.linesep
+        # Sets, as every line of the sample sheet is looked up
+        samples_to_include = {
+            lane: set(samples) for lane, samples in samples_to_include.items()
+        }
         for line in ssparser.data:
             sample_name = line.get("Sample_Name") or line.get("SampleName")
             lane = line["Lane"]
             noindex_flag = False
-            if lane in samples_to_include.keys():
-                if sample_name in samples_to_include.get(lane):
+            if lane in samples_to_include:
+                if sample_name in samples_to_include[lane]:
                     line_ar = []
                     for field in datafields:
                         # Case with NoIndex
@@ -0,0 +1,542 @@
+"""Aggregation of the native reports of bcl-convert sub-demultiplexings.
+
+bcl-convert writes its statistics as CSV files under Reports: the reads of
+each sample in Demultiplex_Stats.csv, their yield and quality per read in
+Quality_Metrics.csv, and the most frequent unknown barcodes of each lane in
+Top_Unknown_Barcodes.csv. The reports of the sub-demultiplexings of a run
+are read into data frames and merged with table operations, keeping for
+each lane the rows of the sub-demultiplexing it belongs to. Lanes
+demultiplexed several times, the complex lanes, keep the samples of all
+their sub-demultiplexings, and their undetermined reads are what the top
+priority sub-demultiplexing read in the lane minus those of all samples.
+
+The merged reports are written in the same format, and the lane and
+laneBarcode HTML reports of bcl2fastq, which the statusdb upload reads, are
+rendered from them without parsing those of the sub-demultiplexings.
+"""
+
+import csv
+import os
+
+import pandas as pd
+
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+
+DEMUX_STATS = "Demultiplex_Stats.csv"
+QUALITY_METRICS = "Quality_Metrics.csv"
+UNKNOWN_BARCODES = "Top_Unknown_Barcodes.csv"
+REPORTS = [DEMUX_STATS, QUALITY_METRICS, UNKNOWN_BARCODES]
+
+UNDETERMINED = "Undetermined"
+# Text columns, kept as read, empty rather than NaN
+TEXT_COLUMNS = {
+    "SampleID": str,
+    "Sample_Project": str,
+    "Index": str,
+    "index": str,
+    "index2": str,
+}
+COUNT_COLUMNS = [
+    "# Reads",
+    "# Perfect Index Reads",
+    "# One Mismatch Index Reads",
+    "# Two Mismatch Index Reads",
+]
+QUALITY_COLUMNS = ["Yield", "YieldQ30", "QualityScoreSum"]
+
+
+def has_native_reports(demux_dir):
+    """Return True if a sub-demultiplexing folder has all native reports."""
+    return all(
+        os.path.exists(os.path.join(demux_dir, "Reports", report)) for report in REPORTS
+    )
+
+
+def _read_report(path, demux_id):
+    report = pd.read_csv(path, dtype=TEXT_COLUMNS, keep_default_na=False)
+    report["Lane"] = report["Lane"].astype(str)
+    # Single index runs have no index 2 column
+    if "index" in report.columns and "index2" not in report.columns:
+        report.insert(report.columns.get_loc("index") + 1, "index2", "")
+    report["demux_id"] = demux_id
+    return report
+
+
+def _format(column, spec):
+    """Format the values of a column, faster than Series.map on large reports."""
+    return [format(value, spec) for value in column.tolist()]
+
+
+def _records(frame):
+    """Return the rows of a data frame as dicts, as DataFrame.to_dict("records")."""
+    columns = list(frame.columns)
+    return [
+        dict(zip(columns, row))
+        for row in zip(*(frame[column].tolist() for column in columns))
+    ]
+
+
+def _ratio(numerator, denominator):
+    """Element-wise ratio, 0 where the denominator is 0."""
+    return (numerator / denominator.where(denominator != 0)).fillna(0)
+
+
+class DemuxReports:
+    """The native reports of one or more sub-demultiplexings of a run.
+
+    Each data frame has the columns of the report, with lanes as strings,
+    plus the id of the sub-demultiplexing of each row.
+    """
+
+    def __init__(self, demux_stats, quality_metrics, unknown_barcodes):
+        self.demux_stats = demux_stats
+        self.quality_metrics = quality_metrics
+        self.unknown_barcodes = unknown_barcodes
+
+    @classmethod
+    def read(cls, demux_dir, demux_id="0"):
+        """Read the native reports of a sub-demultiplexing folder."""
+        reports_dir = os.path.join(demux_dir, "Reports")
+        return cls(
+            *(
+                _read_report(os.path.join(reports_dir, report), str(demux_id))
+                for report in REPORTS
+            )
+        )
+
+    @classmethod
+    def merge(cls, reports, simple_lanes, complex_lanes):
+        """Merge the reports of the sub-demultiplexings of a run.
+
+        :param dict reports: sub-demultiplexing id -> DemuxReports, in the
+            order the sub-samplesheets are aggregated
+        :param dict simple_lanes: lane -> id of its only sub-demultiplexing
+        :param dict complex_lanes: lane -> {id of the top priority
+            sub-demultiplexing of the lane: its index lengths}
+        """
+        top_demux = {
+            lane: list(demuxes.keys())[0] for lane, demuxes in complex_lanes.items()
+        }
+        demux_stats = pd.concat(
+            [report.demux_stats for report in reports.values()], ignore_index=True
+        )
+        quality_metrics = pd.concat(
+            [report.quality_metrics for report in reports.values()], ignore_index=True
+        )
+        unknown_barcodes = pd.concat(
+            [report.unknown_barcodes for report in reports.values()],
+            ignore_index=True,
+        )
+
+        # What the top priority sub-demultiplexing of each complex lane read
+        top_stats = demux_stats[
+            demux_stats["demux_id"] == demux_stats["Lane"].map(top_demux)
+        ]
+        lane_reads = top_stats.groupby("Lane")["# Reads"].sum()
+        top_quality = quality_metrics[
+            quality_metrics["demux_id"] == quality_metrics["Lane"].map(top_demux)
+        ]
+        lane_quality = top_quality.groupby(["Lane", "ReadNumber"])[
+            QUALITY_COLUMNS
+        ].sum()
+
+        demux_stats = cls._select(demux_stats, simple_lanes, top_demux)
+        quality_metrics = cls._select(quality_metrics, simple_lanes, top_demux)
+
+        # Undetermined reads of complex lanes are those of no sample
+        samples = demux_stats[demux_stats["SampleID"] != UNDETERMINED]
+        undetermined_reads = (
+            lane_reads.sub(samples.groupby("Lane")["# Reads"].sum(), fill_value=0)
+            .clip(lower=0)
+            .astype("int64")
+        )
+        complex_undetermined = (demux_stats["SampleID"] == UNDETERMINED) & demux_stats[
+            "Lane"
+        ].isin(top_demux)
+        demux_stats.loc[complex_undetermined, COUNT_COLUMNS] = 0
+        demux_stats.loc[complex_undetermined, "# Reads"] = (
+            demux_stats.loc[complex_undetermined, "Lane"]
+            .map(undetermined_reads)
+            .to_numpy()
+        )
+        reads = demux_stats["# Reads"]
+        demux_stats["% Reads"] = _ratio(
+            reads, demux_stats.groupby("Lane")["# Reads"].transform("sum")
+        )
+        for count in COUNT_COLUMNS[1:]:
+            demux_stats[count.replace("#", "%")] = _ratio(demux_stats[count], reads)
+
+        sample_quality = quality_metrics[quality_metrics["SampleID"] != UNDETERMINED]
+        undetermined_quality = (
+            lane_quality.sub(
+                sample_quality.groupby(["Lane", "ReadNumber"])[QUALITY_COLUMNS].sum(),
+                fill_value=0,
+            )
+            .clip(lower=0)
+            .astype("int64")
+        )
+        complex_undetermined = (
+            quality_metrics["SampleID"] == UNDETERMINED
+        ) & quality_metrics["Lane"].isin(top_demux)
+        keys = pd.MultiIndex.from_frame(
+            quality_metrics.loc[complex_undetermined, ["Lane", "ReadNumber"]]
+        )
+        quality_metrics.loc[complex_undetermined, QUALITY_COLUMNS] = (
+            undetermined_quality.reindex(keys, fill_value=0).to_numpy()
+        )
+        quality_metrics["Mean Quality Score (PF)"] = _ratio(
+            quality_metrics["QualityScoreSum"], quality_metrics["Yield"]
+        )
+        quality_metrics["% Q30"] = _ratio(
+            quality_metrics["YieldQ30"], quality_metrics["Yield"]
+        )
+
+        unknown_barcodes = cls._merge_unknown_barcodes(
+            unknown_barcodes,
+            quality_metrics,
+            simple_lanes,
+            top_demux,
+            list(reports.keys()),
+        )
+        # Shares of the undetermined reads of complex lanes, which changed
+        undetermined = demux_stats[demux_stats["SampleID"] == UNDETERMINED]
+        in_complex = unknown_barcodes["Lane"].isin(top_demux)
+        unknown_barcodes.loc[in_complex, "% of Unknown Barcodes"] = _ratio(
+            unknown_barcodes.loc[in_complex, "# Reads"],
+            unknown_barcodes.loc[in_complex, "Lane"].map(
+                undetermined.groupby("Lane")["# Reads"].sum()
+            ),
+        )
+        return cls(demux_stats, quality_metrics, unknown_barcodes)
+
+    @staticmethod
+    def _select(report, simple_lanes, top_demux):
+        """Keep the rows of the sub-demultiplexing of each simple lane, and the
+        samples of all sub-demultiplexings and the undetermined reads of the top
+        priority one for complex lanes, undetermined reads last in each lane.
+        """
+        lane = report["Lane"]
+        undetermined = report["SampleID"] == UNDETERMINED
+        keep = (report["demux_id"] == lane.map(simple_lanes)) | (
+            lane.isin(top_demux)
+            & (~undetermined | (report["demux_id"] == lane.map(top_demux)))
+        )
+        report = report[keep].assign(_undetermined=undetermined[keep])
+        return (
+            report.sort_values(
+                ["Lane", "_undetermined"],
+                key=lambda column: (
+                    column.astype(int) if column.name == "Lane" else column
+                ),
+                kind="stable",
+            )
+            .drop(columns="_undetermined")
+            .reset_index(drop=True)
+        )
+
+    @staticmethod
+    def _merge_unknown_barcodes(
+        unknown_barcodes, quality_metrics, simple_lanes, top_demux, demux_ids
+    ):
+        """Keep the unknown barcodes of the sub-demultiplexing of simple lanes,
+        and those of the top priority sub-demultiplexing of complex lanes that
+        match no sample of the others.
+        """
+        lane = unknown_barcodes["Lane"]
+        merged = unknown_barcodes[
+            (unknown_barcodes["demux_id"] == lane.map(simple_lanes))
+            | (unknown_barcodes["demux_id"] == lane.map(top_demux))
+        ]
+        barcodes = merged["index"].where(
+            merged["index2"] == "", merged["index"] + "+" + merged["index2"]
+        )
+        keep = pd.Series(True, index=merged.index)
+        # Indexes of the samples, once per sample and index pair
+        sample_indexes = quality_metrics[
+            quality_metrics["SampleID"] != UNDETERMINED
+        ].drop_duplicates(["demux_id", "Lane", "SampleID", "index", "index2"])
+        compared_idx1 = None
+        for complex_lane in sorted(top_demux, key=int):
+            in_lane = merged["Lane"] == complex_lane
+            lane_barcodes = dict.fromkeys(barcodes[in_lane])
+            others = sample_indexes[
+                (sample_indexes["Lane"] == complex_lane)
+                & (sample_indexes["demux_id"] != top_demux[complex_lane])
+            ]
+            # The other sub-demultiplexings in aggregation order
+            others = others.iloc[
+                others["demux_id"]
+                .map(demux_ids.index)
+                .argsort(kind="stable")
+                .to_numpy()
+            ]
+            compared_idx1 = filter_unknown_barcodes(
+                lane_barcodes,
+                list(zip(others["index"], others["index2"])),
+                compared_idx1,
+            )
+            keep &= ~in_lane | barcodes.isin(lane_barcodes)
+        merged = merged[keep]
+        return merged.sort_values(
+            "Lane", key=lambda column: column.astype(int), kind="stable"
+        ).reset_index(drop=True)
+
+    def write(self, reports_dir):
+        """Write the reports, as bcl-convert does, into a folder."""
+        os.makedirs(reports_dir, exist_ok=True)
+        for report, frame in zip(
+            REPORTS, [self.demux_stats, self.quality_metrics, self.unknown_barcodes]
+        ):
+            path = os.path.join(reports_dir, report)
+            frame = frame.drop(columns="demux_id")
+            columns = [
+                _format(frame[column], ".4f")
+                if frame[column].dtype.kind == "f"
+                else frame[column].tolist()
+                for column in frame.columns
+            ]
+            with open(f"{path}.tmp", "w", newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                writer.writerow(frame.columns)
+                writer.writerows(zip(*columns))
+            os.replace(f"{path}.tmp", path)
+
+    def lane_summary(self):
+        """Return the reads and yields (Mbases) of each lane, in total, of
+        its samples, and undetermined, as Run.NumberReads_Summary.
+        """
+        stats = self.demux_stats
+        yields = self._sample_yields()
+        undetermined = stats["SampleID"] == UNDETERMINED
+        lanes = pd.DataFrame(
+            {
+                "total_lane_cluster": stats.groupby("Lane")["# Reads"].sum(),
+                "total_lane_yield": yields.groupby("Lane")["Yield"].sum(),
+                "total_sample_cluster": stats[~undetermined]
+                .groupby("Lane")["# Reads"]
+                .sum(),
+                "total_sample_yield": yields[yields["SampleID"] != UNDETERMINED]
+                .groupby("Lane")["Yield"]
+                .sum(),
+            }
+        ).fillna(0)
+        lanes[["total_lane_yield", "total_sample_yield"]] = (
+            lanes[["total_lane_yield", "total_sample_yield"]] / 1e6
+        ).round()
+        lanes = lanes.astype("int64")
+        lanes["undet_cluster"] = (
+            lanes["total_lane_cluster"] - lanes["total_sample_cluster"]
+        )
+        lanes["undet_yield"] = lanes["total_lane_yield"] - lanes["total_sample_yield"]
+        return {
+            lane: {key: int(value) for key, value in row.items()}
+            for lane, row in lanes.iterrows()
+        }
+
+    def _sample_yields(self):
+        """Return the yield, yield >= Q30 and quality score sum over all reads
+        of each row of Demultiplex_Stats.csv."""
+        quality = self.quality_metrics.groupby(
+            ["demux_id", "Lane", "SampleID"], as_index=False
+        )[QUALITY_COLUMNS].sum()
+        return (
+            self.demux_stats[["demux_id", "Lane", "SampleID"]]
+            .merge(quality, how="left", on=["demux_id", "Lane", "SampleID"])
+            .fillna({column: 0 for column in QUALITY_COLUMNS})
+        )
+
+    def lane_barcode_rows(self, complex_lanes=(), noindex_lanes=()):
+        """Return the rows of laneBarcode.html, as LaneBarcodeParser reads them.
+
+        Only the numbers of reads and yields of the undetermined reads of
+        complex lanes are given. Samples of NoIndex lanes, demultiplexed with
+        fake indexes, take the undetermined reads of their lane.
+        """
+        stats = self.demux_stats.reset_index(drop=True)
+        yields = self._sample_yields()
+        undetermined = stats["SampleID"] == UNDETERMINED
+        rows = pd.DataFrame(
+            {
+                "Lane": stats["Lane"],
+                "Project": stats["Sample_Project"].where(~undetermined, "default"),
+                "Sample": stats["SampleID"],
+                "Barcode sequence": stats["Index"].where(~undetermined, "unknown"),
+                "PF Clusters": _format(stats["# Reads"], ","),
+                "% of thelane": _format(stats["% Reads"] * 100, ".2f"),
+                "% Perfectbarcode": _format(
+                    stats["% Perfect Index Reads"] * 100, ".2f"
+                ),
+                "% One mismatchbarcode": _format(
+                    stats["% One Mismatch Index Reads"] * 100, ".2f"
+                ),
+                "Yield (Mbases)": _format(
+                    (yields["Yield"] / 1e6).round().astype("int64"), ","
+                ),
+                # bcl-convert only reports clusters passing filter
+                "% PFClusters": "100.00",
+                "% >= Q30bases": _format(
+                    _ratio(yields["YieldQ30"], yields["Yield"]) * 100, ".2f"
+                ),
+                "Mean QualityScore": _format(
+                    _ratio(yields["QualityScoreSum"], yields["Yield"]), ".2f"
+                ),
+            }
+        )
+        complex_undetermined = undetermined & stats["Lane"].isin(list(complex_lanes))
+        for column in [
+            "% of thelane",
+            "% Perfectbarcode",
+            "% One mismatchbarcode",
+            "% PFClusters",
+            "% >= Q30bases",
+            "Mean QualityScore",
+        ]:
+            rows.loc[complex_undetermined, column] = "0"
+        noindex = stats["Lane"].isin(list(noindex_lanes))
+        if noindex.any():
+            lane_samples = rows[noindex & ~undetermined].drop_duplicates("Lane")
+            lane_samples = lane_samples.set_index("Lane")
+            rows.loc[noindex & undetermined, "Project"] = rows.loc[
+                noindex & undetermined, "Lane"
+            ].map(lane_samples["Project"])
+            rows.loc[noindex & undetermined, "Sample"] = rows.loc[
+                noindex & undetermined, "Lane"
+            ].map(lane_samples["Sample"])
+            rows = rows[~noindex | undetermined]
+        # Remove the trailing "_SX" postfix of the Smart-seq3 samples of bcl-convert
+        postfixed = rows["Sample"].str.contains("_S", regex=False)
+        rows.loc[postfixed, "Sample"] = (
+            rows.loc[postfixed, "Sample"].str.rsplit("_", n=1).str[0]
+        )
+        rows = rows.sort_values(
+            ["Lane", "Sample"],
+            key=lambda column: column.str.lower() if column.name == "Lane" else column,
+            kind="stable",
+        )
+        return _records(rows)
+
+    def lane_rows(self, complex_lanes=()):
+        """Return the rows of lane.html, as LaneBarcodeParser reads them."""
+        stats = self.demux_stats
+        yields = self._sample_yields()
+        lanes = pd.DataFrame(
+            {
+                "reads": stats.groupby("Lane")["# Reads"].sum(),
+                "perfect": stats.groupby("Lane")["# Perfect Index Reads"].sum(),
+                "one_mismatch": stats.groupby("Lane")[
+                    "# One Mismatch Index Reads"
+                ].sum(),
+            }
+        ).join(yields.groupby("Lane")[QUALITY_COLUMNS].sum())
+        lanes = lanes.sort_index(key=lambda index: index.astype(int))
+        rows = pd.DataFrame(
+            {
+                "Lane": lanes.index,
+                "PF Clusters": _format(lanes["reads"], ","),
+                "% of thelane": "100.00",
+                "% Perfectbarcode": _format(
+                    _ratio(lanes["perfect"], lanes["reads"]) * 100, ".2f"
+                ),
+                "% One mismatchbarcode": _format(
+                    _ratio(lanes["one_mismatch"], lanes["reads"]) * 100, ".2f"
+                ),
+                "Yield (Mbases)": _format(
+                    (lanes["Yield"] / 1e6).round().astype("int64"), ","
+                ),
+                "% PFClusters": "100.00",
+                "% >= Q30bases": _format(
+                    _ratio(lanes["YieldQ30"], lanes["Yield"]) * 100, ".2f"
+                ),
+                "Mean QualityScore": _format(
+                    _ratio(lanes["QualityScoreSum"], lanes["Yield"]), ".2f"
+                ),
+            }
+        )
+        rows = _records(rows)
+        # Index metrics do not add up over sub-demultiplexings
+        for row in rows:
+            if row["Lane"] in complex_lanes:
+                row["% Perfectbarcode"] = None
+                row["% One mismatchbarcode"] = None
+        return rows
+
+    def flowcell_summary(self):
+        """Return the Flowcell Summary of the HTML reports."""
+        reads = int(self.demux_stats["# Reads"].sum())
+        yield_mbases = int(
+            (self._sample_yields().groupby("Lane")["Yield"].sum() / 1e6).round().sum()
+        )
+        return {
+            "Clusters (Raw)": f"{reads:,}",
+            "Clusters(PF)": f"{reads:,}",
+            "Yield (MBases)": f"{yield_mbases:,}",
+        }
+
+    def write_html(self, html_dir, complex_lanes=(), noindex_lanes=(), lane_html=True):
+        """Render lane.html and laneBarcode.html into a folder.
+
+        :param bool lane_html: also render lane.html, laneBarcode.html only otherwise
+        """
+        os.makedirs(html_dir, exist_ok=True)
+        flowcell_data = self.flowcell_summary()
+        if lane_html:
+            write_lane_html(
+                os.path.join(html_dir, "lane.html"),
+                flowcell_data,
+                self.lane_rows(complex_lanes),
+            )
+        write_lane_html(
+            os.path.join(html_dir, "laneBarcode.html"),
+            flowcell_data,
+            self.lane_barcode_rows(complex_lanes, noindex_lanes),
+        )
+
+
+def write_lane_html(html_file, flowcell_data, sample_data):
+    """Write a lane or laneBarcode HTML report in the format of bcl2fastq,
+    one row of the lane summary per write.
+    """
+    fc_keys = sorted(flowcell_data.keys())
+    lane_keys = sorted(sample_data[0].keys())
+    with open(html_file, "w") as f:
+        f.write(
+            "".join(
+                [
+                    '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">\n',
+                    "<html xmlns:bcl2fastq>\n",
+                    '<link rel="stylesheet" href="../../../../Report.css" type="text/css">\n',
+                    "<body>\n",
+                    '<table width="100%"><tr>\n',
+                    "<td><p><p>C6L1WANXX /\n",
+                    "        [all projects] /\n",
+                    "        [all samples] /\n",
+                    "        [all barcodes]</p></p></td>\n",
+                    '<td><p align="right"><a href="../../../../FAKE/all/all/all/laneBarcode.html">show barcodes</a></p></td>\n',
+                    "</tr></table>\n",
+                    # FLOWCELL SUMMARY TABLE
+                    "<h2>Flowcell Summary</h2>\n",
+                    '<table border="1" ID="ReportTable">\n',
+                    "<tr>\n",
+                    *(f"<th>{key}</th>\n" for key in fc_keys),
+                    "</tr>\n",
+                    "<tr>\n",
+                    *(f"<td>{flowcell_data[key]}</td>\n" for key in fc_keys),
+                    "</tr>\n",
+                    "</table>\n",
+                    # LANE SUMMARY TABLE
+                    "<h2>Lane Summary</h2>\n",
+                    '<table border="1" ID="ReportTable">\n',
+                    "<tr>\n",
+                    *(f"<th>{key}</th>\n" for key in lane_keys),
+                    "</tr>\n",
+                ]
+            )
+        )
+        for sample in sample_data:
+            f.write(
+                "<tr>\n"
+                + "".join(f"<td>{sample[key]}</td>\n" for key in lane_keys)
+                + "</tr>\n"
+            )
+        # FOOTER
+        f.write("</table>\n<p></p>\n</body>\n</html>\n")
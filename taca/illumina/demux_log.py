@@ -0,0 +1,179 @@
+"""Incremental scan of the logs of bcl2fastq and bclconvert.
+
+The logs of the sub-demultiplexings of a run are checked for errors and
+warnings on every invocation, and they get large on large runs. The scanner
+keeps, for each log, the offset it read it to, the counts and messages found
+so far and the tiles it mentions, keyed by the inode of the file, and reads
+only what was appended since. A log replaced, or truncated, is read again
+from its start. Messages are kept up to a bound, the first ones and the
+latest ones.
+"""
+
+import json
+import logging
+import os
+import re
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Messages kept at the start of a log, and at its end
+MESSAGES_KEPT = 100
+BCL2FASTQ_SUMMARY = re.compile(
+    r"Processing completed with (\d+) errors and (\d+) warnings"
+)
+# "tile 1101" or "Tile: 1101", starting with a literal for a fast search
+TILE = re.compile(rb"ile(?<=\b[Tt]ile)[ \t:]+(\d+)")
+# What makes a line an error or a warning for each software
+MARKERS = {
+    "bcl2fastq": ("ERROR", "WARN"),
+    "bclconvert": ("ERROR", "WARNING"),
+}
+BLOCK_SIZE = 1 << 22
+
+
+def _marked_lines(lines, markers):
+    """Return the (start, end) of the lines holding any of the markers, in
+    their order, with bytes.find rather than a line by line scan."""
+    found = set()
+    for marker in markers:
+        position = lines.find(marker)
+        while position != -1:
+            start = lines.rfind(b"\n", 0, position) + 1
+            end = lines.find(b"\n", position) + 1
+            found.add((start, end))
+            position = lines.find(marker, end)
+    return sorted(found)
+
+
+class _LogState:
+    """What was found in a log up to an offset."""
+
+    def __init__(self, inode=None, kept=MESSAGES_KEPT):
+        self.inode = inode
+        self.offset = 0
+        self.errors = 0
+        self.warnings = 0
+        self.first = []
+        self.latest = deque(maxlen=kept)
+        self.kept = kept
+        self.tiles = set()
+        self.last_line = None
+
+    @classmethod
+    def from_dict(cls, data, kept=MESSAGES_KEPT):
+        state = cls(data["inode"], kept)
+        state.offset = data["offset"]
+        state.errors = data["errors"]
+        state.warnings = data["warnings"]
+        state.first = list(data["first"])
+        state.latest.extend(data["latest"])
+        state.tiles = set(data["tiles"])
+        state.last_line = data["last_line"]
+        return state
+
+    def to_dict(self):
+        return {
+            "inode": self.inode,
+            "offset": self.offset,
+            "errors": self.errors,
+            "warnings": self.warnings,
+            "first": self.first,
+            "latest": list(self.latest),
+            "tiles": sorted(self.tiles),
+            "last_line": self.last_line,
+        }
+
+    def add_lines(self, lines, software):
+        """Add complete lines, as bytes."""
+        self.tiles.update(tile.decode() for tile in set(TILE.findall(lines)))
+        error, warning = MARKERS[software]
+        for start, end in _marked_lines(lines, (error.encode(), warning.encode())):
+            line = lines[start:end].decode(errors="replace")
+            if error in line:
+                self.errors += 1
+            else:
+                self.warnings += 1
+            if len(self.first) < self.kept:
+                self.first.append(line)
+            else:
+                self.latest.append(line)
+        start = lines.rfind(b"\n", 0, len(lines) - 1) + 1
+        self.last_line = lines[start:].decode(errors="replace")
+
+    @property
+    def messages(self):
+        return self.first + list(self.latest)
+
+
+class DemuxLogScanner:
+    """Scanner of demultiplexing logs, its state saved in a JSON file.
+
+    :param str state_file: the file the state is kept in, None to read the
+        logs whole every time
+    """
+
+    def __init__(self, state_file=None, kept=MESSAGES_KEPT):
+        self.state_file = state_file
+        self.kept = kept
+        self._states = dict()
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    self._states = {
+                        log: _LogState.from_dict(data, kept)
+                        for log, data in json.load(f).items()
+                    }
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring the demux log state {state_file}: {e}")
+
+    def save(self):
+        if not self.state_file:
+            return
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(f"{self.state_file}.tmp", "w") as f:
+            json.dump({log: state.to_dict() for log, state in self._states.items()}, f)
+        os.replace(f"{self.state_file}.tmp", self.state_file)
+
+    def scan(self, demux_log, software):
+        """Read what was appended to a log since it was last scanned.
+
+        :param str demux_log: the log file
+        :param str software: bcl2fastq or bclconvert
+        :returns: a dict with the number of errors and warnings, the
+            error_and_warning_messages kept, the number of tiles mentioned
+            and the last line of the log
+        """
+        stat = os.stat(demux_log)
+        state = self._states.get(demux_log)
+        if state is None or state.inode != stat.st_ino or state.offset > stat.st_size:
+            state = _LogState(stat.st_ino, self.kept)
+            self._states[demux_log] = state
+        tail = b""
+        with open(demux_log, "rb") as f:
+            f.seek(state.offset)
+            while block := f.read(BLOCK_SIZE):
+                block = tail + block
+                end = block.rfind(b"\n") + 1
+                # Lines still being written are read again next time
+                tail = block[end:]
+                if end:
+                    state.add_lines(block[:end], software)
+                    state.offset += end
+        if not tail:
+            return self._summary(state)
+        # Counted, as readlines would, but not kept
+        pending = _LogState.from_dict(state.to_dict(), self.kept)
+        pending.add_lines(tail + b"\n", software)
+        pending.last_line = tail.decode(errors="replace")
+        return self._summary(pending)
+
+    @staticmethod
+    def _summary(state):
+        return {
+            "errors": state.errors,
+            "warnings": state.warnings,
+            "error_and_warning_messages": state.messages,
+            "tiles": len(state.tiles),
+            "last_line": state.last_line,
+        }
@@ -0,0 +1,170 @@
+"""Plan of the sub-demultiplexings of an Illumina run.
+
+The samples of a run are grouped by sample type and by mask, i.e. their
+index, UMI and read lengths, and every group of lanes and samples that can
+be demultiplexed together becomes a sub-demultiplexing with its own
+sample sheet, command and output folder. The plan is built once per run in
+a single pass over the sample table, and written as JSON into the run
+folder so the decisions can be inspected, and are reused when the results
+are aggregated.
+"""
+
+import json
+import os
+
+PLAN_FILE = "demux_plan.json"
+
+
+def _mask(detail):
+    """Return the mask of a sample as a hashable tuple."""
+    return (
+        tuple(detail["index_length"]),
+        tuple(detail["umi_length"]),
+        tuple(detail["read_length"]),
+    )
+
+
+class DemuxPlan:
+    """Sub-demultiplexings of a run, in the order they are numbered.
+
+    Each sub-demultiplexing is a dict with:
+        id: its number, as in SampleSheet_<id>.csv and Demultiplexing_<id>
+        sample_type: type of its samples, e.g. 'ordinary' or '10X_DUAL'
+        mask: index, UMI and read lengths shared by all its lanes (bclconvert)
+        mask_table: the index, UMI and read lengths of each lane
+        samples: the names of the samples of each lane
+        base_mask: the OverrideCycles of its samples (bclconvert)
+    """
+
+    def __init__(self, run_id, software, sub_demuxes):
+        self.run_id = run_id
+        self.software = software
+        self.sub_demuxes = sub_demuxes
+
+    @classmethod
+    def from_sample_table(cls, run_id, software, sample_table):
+        """Group the samples of a sample table into sub-demultiplexings.
+
+        bcl2fastq takes one mask per lane, so a sample type is split into
+        as many sub-demultiplexings as the lane with the most masks has,
+        the n:th mask of each lane going to the n:th. bclconvert takes a
+        single mask, so there is one per mask of a sample type, covering
+        all lanes with samples of that mask.
+
+        :param dict sample_table: lane -> [(sample name, sample details)],
+            as made by Standard_Run._classify_samples
+        """
+        # sample type -> lane -> mask -> sample names, all in order of appearance
+        groups = dict()
+        for lane, lane_contents in sample_table.items():
+            for sample_name, detail in lane_contents:
+                groups.setdefault(detail["sample_type"], dict()).setdefault(
+                    lane, dict()
+                ).setdefault(_mask(detail), []).append(sample_name)
+
+        sub_demuxes = []
+        for sample_type in sorted(groups):
+            lane_table = groups[sample_type]
+            if software == "bcl2fastq":
+                masks_per_lane = {
+                    lane: list(lane_masks) for lane, lane_masks in lane_table.items()
+                }
+                for i in range(max(len(masks) for masks in masks_per_lane.values())):
+                    mask_table = dict()
+                    samples = dict()
+                    for lane in sample_table:
+                        masks = masks_per_lane.get(lane, [])
+                        if i < len(masks):
+                            mask_table[lane] = masks[i]
+                            samples[lane] = lane_table[lane][masks[i]]
+                    sub_demuxes.append(
+                        {
+                            "id": len(sub_demuxes),
+                            "sample_type": sample_type,
+                            "mask": None,
+                            "mask_table": mask_table,
+                            "samples": samples,
+                        }
+                    )
+            elif software == "bclconvert":
+                unique_masks = dict()
+                for lane_masks in lane_table.values():
+                    for mask in lane_masks:
+                        unique_masks[mask] = None
+                for mask in unique_masks:
+                    mask_table = dict()
+                    samples = dict()
+                    for lane in sample_table:
+                        if mask in lane_table.get(lane, {}):
+                            mask_table[lane] = mask
+                            samples[lane] = lane_table[lane][mask]
+                    sub_demuxes.append(
+                        {
+                            "id": len(sub_demuxes),
+                            "sample_type": sample_type,
+                            "mask": mask,
+                            "mask_table": mask_table,
+                            "samples": samples,
+                        }
+                    )
+            else:
+                raise RuntimeError("Unrecognized software!")
+        # Masks as lists, as in the sample table and once read back from JSON
+        for sub_demux in sub_demuxes:
+            if sub_demux["mask"] is not None:
+                sub_demux["mask"] = [list(lengths) for lengths in sub_demux["mask"]]
+            sub_demux["mask_table"] = {
+                lane: [list(lengths) for lengths in mask]
+                for lane, mask in sub_demux["mask_table"].items()
+            }
+        return cls(run_id, software, sub_demuxes)
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "run_id": self.run_id,
+                "software": self.software,
+                "sub_demultiplexings": self.sub_demuxes,
+            },
+            indent=2,
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        plan = json.loads(text)
+        return cls(plan["run_id"], plan["software"], plan["sub_demultiplexings"])
+
+    def write(self, run_dir):
+        """Write the plan into a run folder."""
+        plan_file = os.path.join(run_dir, PLAN_FILE)
+        with open(f"{plan_file}.tmp", "w") as f:
+            f.write(self.to_json())
+        os.replace(f"{plan_file}.tmp", plan_file)
+
+    @classmethod
+    def load(cls, run_dir):
+        """Read the plan of a run folder, or return None if there is none."""
+        try:
+            with open(os.path.join(run_dir, PLAN_FILE)) as f:
+                return cls.from_json(f.read())
+        except FileNotFoundError:
+            return None
+
+    def lane_index_lengths(self, demux_ids):
+        """Return the index lengths of each lane in the given sub-demultiplexings,
+        as lane -> sub-demultiplexing id -> [index 1 length, index 2 length].
+
+        :param list demux_ids: ids of the sub-demultiplexings, in the order
+            they should be listed for each lane
+        :raises KeyError: if a sub-demultiplexing is not in the plan
+        """
+        sub_demuxes = {
+            str(sub_demux["id"]): sub_demux for sub_demux in self.sub_demuxes
+        }
+        lane_index_lengths = dict()
+        for demux_id in demux_ids:
+            for lane, mask in sub_demuxes[str(demux_id)]["mask_table"].items():
+                lane_index_lengths.setdefault(lane, dict())[str(demux_id)] = list(
+                    mask[0]
+                )
+        return lane_index_lengths
@@ -0,0 +1,205 @@
+"""Merge of the outputs of sub-demultiplexings split per lane.
+
+With 'lane_split' in the bclconvert config, every lane of a
+sub-demultiplexing is converted by its own bcl-convert, writing into
+Demultiplexing_N/Reports/lanes/lane_L. Once all lanes are done, their outputs
+are merged into Demultiplexing_N as if a single bcl-convert had written
+them. Files of a single lane are moved. Files written by several lanes are
+merged by kind: reports that are the same in all lanes are kept once, the
+tables of bcl-convert are concatenated under the header of the first lane,
+Stats.json and the XML stats are combined, the HTML reports are rendered again
+from the rows of all lanes with the parser given by the caller, and anything
+else, e.g. FastQ files of the same name, is concatenated. Large files are
+streamed, never read whole.
+"""
+
+import filecmp
+import glob
+import json
+import logging
+import os
+import shutil
+from xml.etree import ElementTree
+
+from taca.illumina import bclconvert_reports
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1 << 20
+# The stats file whose presence marks a sub-demultiplexing as done
+DONE_MARKER = "DemultiplexingStats.xml"
+# The stats files a lane has once its bcl-convert is done
+LANE_DONE_FILES = (DONE_MARKER, "Stats.json")
+# Reports of bcl-convert that are tables under a header line
+TABLE_REPORTS = {
+    bclconvert_reports.DEMUX_STATS,
+    bclconvert_reports.QUALITY_METRICS,
+    bclconvert_reports.UNKNOWN_BARCODES,
+    "Adapter_Metrics.csv",
+    "Adapter_Cycle_Metrics.csv",
+    "Demultiplex_Tile_Stats.csv",
+    "Index_Hopping_Counts.csv",
+    "Quality_Tile_Stats.csv",
+    "fastq_list.csv",
+}
+
+
+def lane_dir(run_dir, demux_id, lane):
+    """Return the output folder of a lane of a sub-demultiplexing split per
+    lane, kept under Reports so it is not mistaken for a project.
+    """
+    return os.path.join(
+        run_dir,
+        f"Demultiplexing_{demux_id}",
+        "Reports",
+        "lanes",
+        f"lane_{lane}",
+    )
+
+
+def lane_done(lane_dir, legacy_path=""):
+    """Check if the bcl-convert of a lane wrote its stats, which it does last.
+
+    :param str legacy_path: folder of the stats within the lane folder
+    """
+    stats_dir = os.path.join(lane_dir, legacy_path, "Stats")
+    return all(os.path.exists(os.path.join(stats_dir, f)) for f in LANE_DONE_FILES)
+
+
+def merge_lane_outputs(run_dir, demux_id, lane_dirs, html_parser=None):
+    """Merge the outputs of the lanes of a sub-demultiplexing into its folder.
+
+    The lane logs demux_<id>_L<lane>_<program>.out and .err are concatenated
+    into the logs of the sub-demultiplexing. The stats file that marks the
+    sub-demultiplexing as done is written last.
+
+    :param html_parser: parser of the lane and laneBarcode HTML reports,
+        e.g. flowcell_parser's LaneBarcodeParser, needed if the lanes have some
+    """
+    demux_folder = os.path.join(run_dir, f"Demultiplexing_{demux_id}")
+    lane_files = dict()
+    for lane_path in lane_dirs:
+        for root, dirs, files in os.walk(lane_path):
+            for file in files:
+                path = os.path.join(root, file)
+                lane_files.setdefault(os.path.relpath(path, lane_path), []).append(path)
+    done_marker = None
+    for relative_path, sources in sorted(lane_files.items()):
+        dest = os.path.join(demux_folder, relative_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.basename(dest) == DONE_MARKER:
+            done_marker = (sources, dest)
+        elif len(sources) == 1:
+            os.rename(sources[0], dest)
+        else:
+            merge_lane_files(sources, dest, html_parser)
+    for ext in ["out", "err"]:
+        lane_logs = sorted(
+            glob.glob(os.path.join(run_dir, f"demux_{demux_id}_L*_*.{ext}"))
+        )
+        logs = dict()
+        for lane_log in lane_logs:
+            # demux_0_L1_bcl-convert.err is merged into demux_0_bcl-convert.err
+            program = os.path.basename(lane_log).split("_", 3)[3]
+            logs.setdefault(program, []).append(lane_log)
+        for program, sources in logs.items():
+            merge_lane_files(
+                sources, os.path.join(run_dir, f"demux_{demux_id}_{program}")
+            )
+    if done_marker:
+        merge_lane_files(*done_marker)
+    logger.info(f"Merged the outputs of {len(lane_dirs)} lanes into {demux_folder}")
+
+
+def merge_lane_files(sources, dest, html_parser=None):
+    """Merge a file written by every lane of a sub-demultiplexing split per lane.
+
+    :param html_parser: parser of the HTML reports, see merge_lane_outputs
+    """
+    tmp_file = f"{dest}.tmp"
+    if all(filecmp.cmp(sources[0], source, shallow=False) for source in sources[1:]):
+        # E.g. RunInfo.xml or the sample sheet
+        shutil.copyfile(sources[0], tmp_file)
+    elif dest.endswith(".json"):
+        stats = []
+        for source in sources:
+            with open(source) as f:
+                stats.append(json.load(f))
+        merged_stats = stats[0]
+        for key, lane_key in [
+            ("ConversionResults", "LaneNumber"),
+            ("ReadInfosForLanes", "LaneNumber"),
+            ("UnknownBarcodes", "Lane"),
+        ]:
+            if key in merged_stats:
+                merged_stats[key] = sorted(
+                    [entry for lane_stats in stats for entry in lane_stats[key]],
+                    key=lambda entry: int(entry[lane_key]),
+                )
+        with open(tmp_file, "w") as f:
+            json.dump(merged_stats, f)
+    elif dest.endswith(".xml"):
+        root = ElementTree.parse(sources[0]).getroot()
+        for source in sources[1:]:
+            merge_xml_element(root, ElementTree.parse(source).getroot())
+        ElementTree.ElementTree(root).write(
+            tmp_file, encoding="utf-8", xml_declaration=True
+        )
+    elif dest.endswith(".html"):
+        if html_parser is None:
+            raise RuntimeError(f"No parser given to merge the HTML reports {dest}")
+        _merge_html(sources, tmp_file, html_parser)
+    elif os.path.basename(dest) in TABLE_REPORTS:
+        # Keep the header of the first lane only
+        _concatenate(sources, tmp_file, skip_header=True)
+    else:
+        _concatenate(sources, tmp_file)
+    os.replace(tmp_file, dest)
+
+
+def _concatenate(sources, dest, skip_header=False):
+    with open(dest, "wb") as out:
+        for i, source in enumerate(sources):
+            with open(source, "rb") as f:
+                if skip_header and i:
+                    f.readline()
+                shutil.copyfileobj(f, out, BLOCK_SIZE)
+
+
+def _merge_html(sources, dest, html_parser):
+    """Render the lane or laneBarcode HTML report of all lanes."""
+    html_report_parser = html_parser(sources[0])
+    for source in sources[1:]:
+        next_html_report_parser = html_parser(source)
+        html_report_parser.sample_data.extend(next_html_report_parser.sample_data)
+        for key in ["Clusters (Raw)", "Clusters(PF)", "Yield (MBases)"]:
+            total = int(html_report_parser.flowcell_data[key].replace(",", "")) + int(
+                next_html_report_parser.flowcell_data[key].replace(",", "")
+            )
+            html_report_parser.flowcell_data[key] = f"{total:,}"
+    html_report_parser.sample_data = sorted(
+        html_report_parser.sample_data,
+        key=lambda k: (k["Lane"].lower(), k["Sample"]),
+    )
+    bclconvert_reports.write_lane_html(
+        dest, html_report_parser.flowcell_data, html_report_parser.sample_data
+    )
+
+
+def merge_xml_element(merged, element):
+    """Add the children of an XML element missing from another one, e.g.
+    the Lane elements of the samples in DemultiplexingStats.xml.
+    """
+    for child in element:
+        match = next(
+            (
+                merged_child
+                for merged_child in merged
+                if merged_child.tag == child.tag and merged_child.attrib == child.attrib
+            ),
+            None,
+        )
+        if match is None:
+            merged.append(child)
+        elif len(child):
+            merge_xml_element(match, child)
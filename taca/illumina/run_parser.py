@@ -0,0 +1,277 @@
+"""Lazy and cached parsing of the files of an Illumina run.
+
+RunParser of flowcell_parser parses everything it knows of in a run folder
+when it is built: RunInfo.xml, runParameters.xml, the sample sheet, the HTML
+reports, Stats.json and the undetermined and cycle times logs. Most of what a
+Run does needs the read configuration and the sample sheet only, which makes
+building a Run for every folder of the data directory slow on large runs.
+
+LazyRunParser parses each of these on first access, and keeps what it parsed
+in cache files of the run, keyed by the modification time and size of the
+files each was parsed from, so that the next instance of the run, say in the
+next cron job, reads them back unless the files changed. It also sniffs the
+type of the sequencer of the run from its run parameters, without parsing
+them whole.
+"""
+
+import importlib
+import logging
+import os
+import pickle
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".pickle"
+# In NextSeq runParameters is named RunParameters
+RUN_PARAMETERS_FILES = ("runParameters.xml", "RunParameters.xml")
+# The parsed files, with the flowcell_parser class parsing them, the run
+# parameters under any of the names of RUN_PARAMETERS_FILES
+PARSED_FILES = {
+    "runinfo": ("RunInfo.xml", "RunInfoParser"),
+    "runparameters": (RUN_PARAMETERS_FILES, "RunParametersParser"),
+    "samplesheet": ("SampleSheet.csv", "SampleSheetParser"),
+}
+# What the obj of RunParser is built from, files or folders walked through
+OBJ_SOURCES = (
+    "RunInfo.xml",
+    *RUN_PARAMETERS_FILES,
+    "SampleSheet.csv",
+    os.path.join("Logs", "CycleTimes.txt"),
+    os.path.join("Demultiplexing", "DemultiplexConfig.xml"),
+    os.path.join("Demultiplexing", "Stats"),
+    os.path.join("Demultiplexing", "Reports"),
+)
+
+
+def find_run_parameters(run_dir):
+    """Return the name of the run parameters file of a run, None if missing."""
+    for name in RUN_PARAMETERS_FILES:
+        if os.path.exists(os.path.join(run_dir, name)):
+            return name
+    return None
+
+
+def sniff_run_type(run_parameters_path):
+    """Return the type of the sequencer of a run from its run parameters.
+
+    It is the Flowcell, or ApplicationName, of the Setup of HiSeq and MiSeq
+    runs, and the InstrumentType, ApplicationName or Application of the
+    others, in this order. The file is parsed incrementally, to the end of
+    Setup or to InstrumentType, not to parse the large run parameters of
+    NovaSeq to the end.
+
+    :raises ElementTree.ParseError: if the file is not valid XML
+    """
+    found = dict()
+    setup = None
+    path = []
+    with open(run_parameters_path, "rb") as f:
+        events = ElementTree.iterparse(f, events=("start", "end"))
+        for event, element in events:
+            tag = element.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                path.append(tag)
+                if path == ["RunParameters", "Setup"]:
+                    setup = dict()
+                continue
+            path.pop()
+            if len(path) == 1 and path[0] == "RunParameters":
+                if tag == "Setup":
+                    break
+                if tag in ("InstrumentType", "ApplicationName", "Application"):
+                    found.setdefault(tag, (element.text or "").strip())
+                    if tag == "InstrumentType":
+                        break
+                # Top level elements are not needed any more
+                element.clear()
+            elif path == ["RunParameters", "Setup"] and tag in (
+                "Flowcell",
+                "ApplicationName",
+            ):
+                setup.setdefault(tag, (element.text or "").strip())
+    if setup is not None:
+        if setup.get("Flowcell"):
+            return setup["Flowcell"]
+        logger.warning(
+            "Parsing runParameters to fetch instrument type, "
+            "not found Flowcell information in it. Using ApplicationName"
+        )
+        return setup.get("ApplicationName", "")
+    for tag in ("InstrumentType", "ApplicationName", "Application"):
+        if tag in found:
+            return found[tag]
+    return ""
+
+
+def parser_cache_dir(config):
+    """Return the folder of the parser caches of the runs, under the status
+    dir of the analysis, None if there is none or 'parser_cache' is false in
+    the analysis config."""
+    analysis_config = config.get("analysis", {})
+    if analysis_config.get("status_dir") and analysis_config.get("parser_cache", True):
+        return os.path.join(analysis_config["status_dir"], "parser_cache")
+    return None
+
+
+def signature(run_dir, sources):
+    """Return the modification time and size of the files of a run, those
+    of the folders included, None for those missing."""
+    files = []
+    for source in sources:
+        path = os.path.join(run_dir, source)
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    stats = []
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stats.append((path, None))
+        else:
+            stats.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stats)
+
+
+class LazyRunParser:
+    """Stand-in of RunParser parsing the files of a run on first access.
+
+    :param str run_dir: the run folder
+    :param str cache_dir: folder of the cache files, None not to cache
+    :param classes: module of the parser classes, flowcell_parser.classes
+        if None
+    """
+
+    def __init__(self, run_dir, cache_dir=None, classes=None):
+        self.path = run_dir
+        self.cache_dir = cache_dir
+        self._classes = classes
+        self._values = dict()
+        self._signatures = dict()
+        self._samplesheet_set = False
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            self._classes = importlib.import_module("flowcell_parser.classes")
+        return self._classes
+
+    @property
+    def run_cache_dir(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(
+            self.cache_dir, os.path.basename(os.path.normpath(self.path))
+        )
+
+    def _load_cache(self, name):
+        """Return the (signature, value) cached for name, None if there is none."""
+        cache_file = os.path.join(self.run_cache_dir, name + CACHE_SUFFIX)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(
+                f"Ignoring the parser cache {cache_file} of {self.path}: {e}"
+            )
+            return None
+
+    def _save_cache(self, name, cached):
+        cache_file = os.path.join(self.run_cache_dir, name + CACHE_SUFFIX)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.run_cache_dir, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            logger.warning(f"Could not write the parser cache {cache_file}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _signature(self, sources):
+        """The signature of the sources, computed once per instance, not to
+        walk the reports folders of the run again."""
+        if sources not in self._signatures:
+            self._signatures[sources] = signature(self.path, sources)
+        return self._signatures[sources]
+
+    def _cached(self, name, sources, parse):
+        """Return the value of name, from its cache file if its sources did
+        not change since it was parsed."""
+        if name not in self._values:
+            if not self.run_cache_dir:
+                self._values[name] = parse()
+                return self._values[name]
+            current = self._signature(sources)
+            cached = self._load_cache(name)
+            if cached is not None and cached[0] == current:
+                self._values[name] = cached[1]
+            else:
+                self._values[name] = parse()
+                self._save_cache(name, (current, self._values[name]))
+        return self._values[name]
+
+    def _parse_file(self, name):
+        file_name, class_name = PARSED_FILES[name]
+        if file_name == RUN_PARAMETERS_FILES:
+            file_name = find_run_parameters(self.path) or RUN_PARAMETERS_FILES[0]
+        path = os.path.join(self.path, file_name)
+
+        def parse():
+            try:
+                return getattr(self.classes, class_name)(path)
+            except OSError as e:
+                # As RunParser, for files not there yet
+                logger.info(str(e))
+                return None
+
+        return self._cached(name, (file_name,), parse)
+
+    @property
+    def runinfo(self):
+        return self._parse_file("runinfo")
+
+    @property
+    def runparameters(self):
+        return self._parse_file("runparameters")
+
+    @property
+    def samplesheet(self):
+        return self._parse_file("samplesheet")
+
+    @samplesheet.setter
+    def samplesheet(self, samplesheet):
+        # Set by the Run, from a sample sheet of its own, not cached
+        self._values["samplesheet"] = samplesheet
+        self._samplesheet_set = True
+
+    @property
+    def run_type(self):
+        """The type of the sequencer of the run, None if it has no run
+        parameters."""
+        file_name = find_run_parameters(self.path)
+        if file_name is None:
+            return None
+        return self._cached(
+            "run_type",
+            (file_name,),
+            lambda: sniff_run_type(os.path.join(self.path, file_name)),
+        )
+
+    @property
+    def obj(self):
+        """The document of the run uploaded to statusdb, built by RunParser
+        with all the reports and stats of the run."""
+        obj = self._cached(
+            "obj", OBJ_SOURCES, lambda: self.classes.RunParser(self.path).obj
+        )
+        if self._samplesheet_set and not obj.get("samplesheet_csv"):
+            obj["samplesheet_csv"] = self.samplesheet.data
+        return obj
@@ -0,0 +1,369 @@
+"""Streaming merge of the Stats.json files of sub-demultiplexings.
+
+Stats.json files hold the metrics of every sample of every lane, and the
+unknown barcodes of each lane, which makes them large on high-plex runs. They
+are read here one top level entry at a time, and the ConversionResults and
+UnknownBarcodes arrays one lane at a time, with a small pull parser built on
+json.JSONDecoder.raw_decode. The lanes are spooled to a temporary file while
+the sub-demultiplexings are read, then merged and written one lane at a time,
+so memory holds one lane rather than all Stats.json files.
+
+The merged file has the layout and, but for the unknown barcodes beyond the
+top ones of each lane, the content json.dump gave to the whole merged
+structure.
+"""
+
+import heapq
+import json
+import os
+import re
+import tempfile
+
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+
+CHUNK_SIZE = 1 << 16
+# Number of unknown barcodes of each lane kept, as bcl2fastq does
+TOP_UNKNOWN_BARCODES = 1000
+# Arrays read one element, one lane, at a time
+LANE_ARRAYS = ("ConversionResults", "UnknownBarcodes")
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER = re.compile(r"[-+.eE0-9]*")
+_NUMBER_START = "-0123456789"
+
+
+class JsonStream:
+    """Pull parser over a JSON text file, decoding one value at a time."""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self, size):
+        """Append up to size characters to what is left of the buffer."""
+        chunk = self._f.read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character which is not whitespace."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read(self._chunk_size):
+                raise ValueError("Unexpected end of JSON")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON, found {found!r}")
+        self._pos += 1
+
+    def value(self):
+        """Decode the next value."""
+        if self.peek() in _NUMBER_START:
+            # A number might go on in the next chunk
+            while _NUMBER.match(self._buffer, self._pos).end() == len(
+                self._buffer
+            ) and self._read(self._chunk_size):
+                pass
+        while True:
+            try:
+                value, self._pos = _DECODER.raw_decode(self._buffer, self._pos)
+                return value
+            except json.JSONDecodeError:
+                # Read as much again as is pending, not to decode large values
+                # a quadratic number of times
+                if not self._read(max(self._chunk_size, len(self._buffer) - self._pos)):
+                    raise
+
+    def _members(self, start, end):
+        self.expect(start)
+        if self.peek() == end:
+            self._pos += 1
+            return
+        while True:
+            yield
+            separator = self.peek()
+            self._pos += 1
+            if separator == end:
+                return
+            if separator != ",":
+                raise ValueError(
+                    f"Expected ',' or {end!r} in JSON, found {separator!r}"
+                )
+
+    def keys(self):
+        """Iterate over the keys of an object, the value of each key has to be
+        read before the next one."""
+        for _ in self._members("{", "}"):
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def items(self):
+        """Iterate over the elements of an array, each has to be read before
+        the next one."""
+        yield from self._members("[", "]")
+
+
+def iter_stats(f, streamed=LANE_ARRAYS):
+    """Yield the (key, value) pairs of the top level of a Stats.json. The
+    values of the arrays in streamed are iterators over their elements, to
+    go through before the next pair.
+    """
+    stream = JsonStream(f)
+
+    def elements():
+        for _ in stream.items():
+            yield stream.value()
+
+    for key in stream.keys():
+        if key in streamed and stream.peek() == "[":
+            yield key, elements()
+        else:
+            yield key, stream.value()
+
+
+class JsonObjectWriter:
+    """Write a JSON object one member, or array element, at a time, as
+    json.dump writes it."""
+
+    def __init__(self, f):
+        self._f = f
+        self._members = 0
+        self._f.write("{")
+
+    def _key(self, key):
+        if self._members:
+            self._f.write(", ")
+        self._members += 1
+        self._f.write(f"{json.dumps(key)}: ")
+
+    def member(self, key, value):
+        self._key(key)
+        self._f.write(json.dumps(value))
+
+    def array(self, key, elements):
+        self._key(key)
+        self._f.write("[")
+        for i, element in enumerate(elements):
+            if i:
+                self._f.write(", ")
+            self._f.write(json.dumps(element))
+        self._f.write("]")
+
+    def close(self):
+        self._f.write("}")
+
+
+def top_barcodes(barcodes, top=TOP_UNKNOWN_BARCODES):
+    """Return the top most frequent barcodes, in their order, ties in favour
+    of the first ones. All of them if top is None."""
+    if top is None or len(barcodes) <= top:
+        return barcodes
+    kept = heapq.nlargest(
+        top, enumerate(barcodes.values()), key=lambda item: (item[1], -item[0])
+    )
+    kept = {position for position, _ in kept}
+    return {
+        barcode: count
+        for position, (barcode, count) in enumerate(barcodes.items())
+        if position in kept
+    }
+
+
+def _noindex_lane(entry):
+    """Samples of NoIndex lanes, demultiplexed with fake indexes, take the
+    undetermined reads of their lane."""
+    del entry["DemuxResults"][0]["IndexMetrics"]
+    entry["DemuxResults"][0].update(entry["Undetermined"])
+    del entry["Undetermined"]
+
+
+class _LaneSpool:
+    """ConversionResults entries spooled to a temporary file, one per line."""
+
+    def __init__(self, directory):
+        self._f = tempfile.TemporaryFile(dir=directory)
+
+    def add(self, entry):
+        offset = self._f.seek(0, os.SEEK_END)
+        self._f.write(json.dumps(entry).encode() + b"\n")
+        return offset
+
+    def get(self, offset):
+        self._f.seek(offset)
+        return json.loads(self._f.readline())
+
+    def close(self):
+        self._f.close()
+
+
+def merge_stats(
+    stats_json,
+    stats_file,
+    simple_lanes,
+    complex_lanes,
+    number_reads,
+    other_samples,
+    read_count=2,
+    noindex_lanes=(),
+    top=TOP_UNKNOWN_BARCODES,
+):
+    """Merge the Stats.json of the sub-demultiplexings of a run.
+
+    Complex lanes keep the first ConversionResults entry of the lane, with
+    the samples of the others and the undetermined reads of the last one,
+    set from number_reads. Unknown barcodes are those of the sub-demultiplexing
+    of simple lanes, and those of the top priority sub-demultiplexing of
+    complex lanes which match no sample of the others.
+
+    :param list stats_json: Stats.json of the sub-demultiplexings, in the
+        order they are aggregated
+    :param str stats_file: the merged Stats.json
+    :param dict simple_lanes: lane -> id of its only sub-demultiplexing
+    :param dict complex_lanes: lane -> {id of the top priority
+        sub-demultiplexing of the lane: its index lengths}
+    :param dict number_reads: lane -> reads and yields, as
+        Run.NumberReads_Summary
+    :param other_samples: callable returning the (index, index2) of the
+        samples of a lane in the sub-demultiplexings other than an id
+    :param int read_count: number of reads which are not index reads
+    :param noindex_lanes: lanes demultiplexed with fake indexes
+    :param int top: unknown barcodes kept per lane, all if None
+    :returns: lane -> the unknown barcodes kept for each complex lane
+    """
+    header = dict()
+    read_infos = []
+    unknown_barcodes = []
+    complex_unknown_barcodes = dict()
+    # Entries of the merged ConversionResults, each the offset of the first
+    # entry of a lane and those of the entries merged into it
+    slots = []
+    lane_slots = dict()
+    compared_idx1 = None
+    spool = _LaneSpool(os.path.dirname(os.path.abspath(stats_file)))
+    try:
+        for position, stat_json in enumerate(stats_json):
+            demux_id = re.findall("Demultiplexing_([0-9])", stat_json)[0]
+            lanes_present = set(lane_slots)
+            with open(stat_json) as f:
+                for key, value in iter_stats(f):
+                    if key == "ConversionResults":
+                        for entry in value:
+                            lane = entry["LaneNumber"]
+                            if lane in lanes_present and str(lane) in complex_lanes:
+                                _set_undetermined(
+                                    entry["Undetermined"],
+                                    number_reads[str(lane)],
+                                    read_count,
+                                )
+                                slots[lane_slots[lane]][1].append(spool.add(entry))
+                            else:
+                                lane_slots.setdefault(lane, len(slots))
+                                slots.append((spool.add(entry), []))
+                    elif key == "UnknownBarcodes":
+                        for entry in value:
+                            lane = str(entry["Lane"])
+                            if lane in simple_lanes:
+                                entry["Barcodes"] = top_barcodes(entry["Barcodes"], top)
+                                unknown_barcodes.append(entry)
+                            elif lane in complex_lanes and (
+                                list(complex_lanes[lane].keys())[0] == demux_id
+                            ):
+                                # Remove the samples involved in the other samplesheets
+                                compared_idx1 = filter_unknown_barcodes(
+                                    entry["Barcodes"],
+                                    other_samples(lane, demux_id),
+                                    compared_idx1,
+                                )
+                                entry["Barcodes"] = top_barcodes(entry["Barcodes"], top)
+                                unknown_barcodes.append(entry)
+                                complex_unknown_barcodes[lane] = entry
+                    elif key == "ReadInfosForLanes":
+                        read_infos.extend(
+                            entry
+                            for entry in value
+                            if not position or entry["LaneNumber"] not in lanes_present
+                        )
+                    elif not position and key in ("RunNumber", "Flowcell", "RunId"):
+                        header[key] = value
+
+        if noindex_lanes:
+            for entry in unknown_barcodes:
+                if str(entry["Lane"]) in noindex_lanes:
+                    entry["Barcodes"] = {"unknown": 1}
+
+        def conversion_results():
+            for offset, merged_offsets in slots:
+                entry = spool.get(offset)
+                for merged_offset in merged_offsets:
+                    merged = spool.get(merged_offset)
+                    entry["DemuxResults"].extend(merged["DemuxResults"])
+                    entry["Undetermined"] = merged["Undetermined"]
+                if str(entry["LaneNumber"]) in noindex_lanes:
+                    _noindex_lane(entry)
+                yield entry
+
+        with open(f"{stats_file}.tmp", "w") as f:
+            writer = JsonObjectWriter(f)
+            if stats_json:
+                for key in ("RunNumber", "Flowcell", "RunId"):
+                    writer.member(key, header.get(key))
+                writer.array("ConversionResults", conversion_results())
+                writer.member("ReadInfosForLanes", read_infos)
+                writer.array("UnknownBarcodes", unknown_barcodes)
+            writer.close()
+        os.replace(f"{stats_file}.tmp", stats_file)
+    finally:
+        spool.close()
+    return {lane: entry["Barcodes"] for lane, entry in complex_unknown_barcodes.items()}
+
+
+def _set_undetermined(undetermined, number_reads, read_count):
+    """Set the undetermined reads of a complex lane from those of no sample,
+    with no quality metrics as they do not add up over sub-demultiplexings."""
+    undetermined["NumberReads"] = number_reads["undet_cluster"]
+    undetermined["Yield"] = number_reads["undet_yield"] * 1000000
+    for read_metrics in undetermined["ReadMetrics"][: 2 if read_count == 2 else 1]:
+        read_metrics["QualityScoreSum"] = 0
+        read_metrics["TrimmedBases"] = 0
+        read_metrics["Yield"] = 0
+        read_metrics["YieldQ30"] = 0
+
+
+def rewrite_noindex_stats(source, stats_file):
+    """Rewrite the Stats.json of a run demultiplexed with fake indexes, its
+    samples taking the undetermined reads of their lane, one lane at a time."""
+
+    def noindex_lanes(entries):
+        for entry in entries:
+            _noindex_lane(entry)
+            yield entry
+
+    def unknown_barcodes(entries):
+        for entry in entries:
+            entry["Barcodes"] = {"unknown": 1}
+            yield entry
+
+    with open(source) as f, open(f"{stats_file}.tmp", "w") as out:
+        writer = JsonObjectWriter(out)
+        for key, value in iter_stats(f):
+            if key == "ConversionResults":
+                writer.array(key, noindex_lanes(value))
+            elif key == "UnknownBarcodes":
+                writer.array(key, unknown_barcodes(value))
+            else:
+                writer.member(key, value)
+        writer.close()
+    os.replace(f"{stats_file}.tmp", stats_file)
@@ -0,0 +1,124 @@
+"""Filtering of the unknown barcodes of lanes demultiplexed several times.
+
+When a lane holds samples with different index lengths it is demultiplexed
+once per mask, and the reads of the samples of the other demultiplexings
+show up among the unknown barcodes of each. Aggregating the results keeps
+the unknown barcodes of one demultiplexing and removes those matching a
+sample of the others, an unknown barcode matching a sample index if either
+one is a prefix of the other, for both indexes of dual index samples.
+
+Rather than comparing every sample with every unknown barcode, the samples
+are indexed by their indexes truncated to the lengths of the barcodes, so
+each barcode is looked up in a few hash tables. The samples are grouped by
+index lengths and barcodes have one or two lengths per lane, so there are
+only a handful of tables.
+"""
+
+
+def _split_barcode(barcode):
+    if "+" in barcode:
+        return barcode.split("+")[0], barcode.split("+")[1]
+    return barcode, ""
+
+
+class SamplePrefixIndex:
+    """Samples of a lane, looked up by the prefixes of their indexes."""
+
+    def __init__(self, samples):
+        """
+        :param list samples: (index, index2) of the samples, in sample sheet
+            order, index not empty
+        """
+        self.samples = samples
+        # (index length, index2 length) -> positions of the samples
+        self.by_length = dict()
+        for pos, (idx1, idx2) in enumerate(samples):
+            self.by_length.setdefault((len(idx1), len(idx2)), []).append(pos)
+        # (index lengths, compared lengths) -> compared prefixes -> first position
+        self.tables = dict()
+
+    def _table(self, lengths, compared):
+        key = (lengths, compared)
+        if key not in self.tables:
+            table = dict()
+            for pos in self.by_length[lengths]:
+                idx1, idx2 = self.samples[pos]
+                table.setdefault((idx1[: compared[0]], idx2[: compared[1]]), pos)
+            self.tables[key] = table
+        return self.tables[key]
+
+    def first_match(self, idx1, idx2):
+        """Return the position of the first sample matching an unknown barcode,
+        or None. The indexes are compared over the length of the shorter one,
+        index 2 only for samples with one.
+        """
+        first = None
+        for lengths in self.by_length:
+            compared = (min(lengths[0], len(idx1)), min(lengths[1], len(idx2)))
+            pos = self._table(lengths, compared).get(
+                (idx1[: compared[0]], idx2[: compared[1]])
+            )
+            if pos is not None and (first is None or pos < first):
+                first = pos
+        return first
+
+
+def filter_unknown_barcodes(barcodes, samples, compared_idx1=None):
+    """Remove the unknown barcodes matching the indexes of samples.
+
+    The previous implementation compared samples with an index 2 but no
+    index 1 against index 1 of the barcodes, and not with their own index 1
+    but with the one last compared for another sample. That is kept, so the
+    filtered barcodes stay the same, which is why the last compared index 1
+    is passed along from one call to the next.
+
+    :param dict barcodes: unknown barcode -> number of reads, as in the
+        UnknownBarcodes of Stats.json, filtered in place
+    :param list samples: (index, index2) of the samples, in sample sheet order
+    :param str compared_idx1: index 1 last compared by the previous call
+    :returns: index 1 last compared, for the next call
+    """
+    segment = []
+    for idx1, idx2 in samples:
+        if idx1:
+            segment.append((idx1, idx2))
+        elif idx2:
+            compared_idx1 = _filter_segment(barcodes, segment, compared_idx1)
+            segment = []
+            # Rare enough to compare with each barcode
+            for barcode in tuple(barcodes):
+                barcode_idx1 = _split_barcode(barcode)[0]
+                compared_idx2 = idx2[: len(barcode_idx1)]
+                if (
+                    compared_idx1 is not None
+                    and compared_idx1 == barcode_idx1[: len(compared_idx2)]
+                ):
+                    del barcodes[barcode]
+    return _filter_segment(barcodes, segment, compared_idx1)
+
+
+def _filter_segment(barcodes, samples, compared_idx1):
+    """Remove the barcodes matching samples with an index 1, and return the
+    index 1 the previous implementation would have compared last: the one of
+    the last sample to still have barcodes to compare, truncated to the
+    length of the last of those barcodes.
+    """
+    if not samples or not barcodes:
+        return compared_idx1
+    index = SamplePrefixIndex(samples)
+    # Position of the first sample matching each barcode, None if there is none
+    first_matches = {
+        barcode: index.first_match(*_split_barcode(barcode)) for barcode in barcodes
+    }
+    if None in first_matches.values():
+        last_pos = len(samples) - 1
+    else:
+        last_pos = max(first_matches.values())
+    for barcode in reversed(first_matches):
+        if first_matches[barcode] is None or first_matches[barcode] >= last_pos:
+            compared_idx1 = samples[last_pos][0][: len(_split_barcode(barcode)[0])]
+            break
+    for barcode, pos in first_matches.items():
+        if pos is not None:
+            del barcodes[barcode]
+    return compared_idx1
@@ -11,6 +11,7 @@ from typing import Union
 
 import pandas as pd
 
+from taca.utils import mirror, transfer_ledger
 from taca.utils.config import CONFIG
 from taca.utils.statusdb import NanoporeRunsConnection
 from taca.utils.transfer import RsyncAgent, RsyncError
@@ -103,6 +104,23 @@ class ONT_run:
     def is_synced(self) -> bool:
         return self.has_file("/.sync_finished")
 
+    def is_transferred(self) -> bool:
+        """Return True if the run is in the transfer log of its run type."""
+        raise NotImplementedError
+
+    def get_lifecycle_state(self) -> tuple[str, bool]:
+        """Return the state of the run as derived from its marker files, and
+        whether it is settled, i.e. can only change when the run dir does.
+        """
+        if not os.path.isdir(self.run_abspath):
+            return "archived", True
+        if self.is_transferred():
+            # Transferred user runs that were not archived are reported on every pass
+            return "transferred", self.run_type == "qc_run"
+        if not self.is_synced():
+            return "sequencing", False
+        return "synced", False
+
     def assert_contents(self):
         """Checklist function to assure run has all files necessary to proceed with processing"""
 
@@ -306,27 +324,26 @@ class ONT_run:
     def copy_metadata(self):
         """Copies run dir (excluding seq data) to metadata dir"""
 
-        exclude_patterns = [
-            # Main seq dirs
-            "**/bam*/***",
-            "**/fast5*/***",
-            "**/fastq*/***",
-            "**/pod5*/***",
-            # Any files found elsewhere
-            "*.bam*",
-            "*.bai*",
-            "*.fast5*",
-            "*.fastq*",
-            "*.pod5*",
-        ]
-
-        exclude_patterns_quoted = ["'" + pattern + "'" for pattern in exclude_patterns]
+        # Main seq dirs
+        exclude_dirs = ["bam*", "fast5*", "fastq*", "pod5*"]
+        # Any files found elsewhere
+        exclude_files = ["*.bam*", "*.bai*", "*.fast5*", "*.fastq*", "*.pod5*"]
 
         src = self.run_abspath
         dst = self.transfer_details["metadata_dir"]
-
-        os.system(
-            f"rsync -rv --exclude={{{','.join(exclude_patterns_quoted)}}} {src} {dst}"
+        # As rsync, which would make the metadata dir but not its parents
+        if not os.path.isdir(os.path.dirname(os.path.normpath(dst))):
+            logger.error(f"{self.run_name}: Could not copy metadata to {dst}")
+            return
+
+        mirror.mirror(
+            mirror.tree_files(
+                src,
+                os.path.join(dst, os.path.basename(os.path.normpath(src))),
+                exclude_dirs=exclude_dirs + exclude_files,
+                exclude_files=exclude_files,
+            ),
+            f"the metadata of run {self.run_name} to {dst}",
         )
 
     def copy_html_report(self):
@@ -489,9 +506,9 @@ class ONT_run:
     def update_transfer_log(self):
         """Update transfer log with run id and date."""
         try:
-            with open(self.transfer_details["transfer_log"], "a") as f:
-                tsv_writer = csv.writer(f, delimiter="\t")
-                tsv_writer.writerow([self.run_name, str(datetime.now())])
+            transfer_ledger.get_ledger(self.transfer_details["transfer_log"]).add(
+                self.run_name
+            )
         except OSError:
             msg = f"{self.run_name}: Could not update the transfer logfile {self.transfer_details['transfer_log']}"
             logger.error(msg)
@@ -519,8 +536,9 @@ class ONT_user_run(ONT_run):
 
     def is_transferred(self) -> bool:
         """Return True if run ID in transfer.tsv, else False."""
-        with open(self.transfer_details["transfer_log"]) as f:
-            return self.run_name in f.read()
+        return self.run_name in transfer_ledger.get_ledger(
+            self.transfer_details["transfer_log"]
+        )
 
 
 class ONT_qc_run(ONT_run):
@@ -549,8 +567,21 @@ class ONT_qc_run(ONT_run):
 
     def is_transferred(self) -> bool:
         """Return True if run ID in transfer.tsv, else False."""
-        with open(self.transfer_details["transfer_log"]) as f:
-            return self.run_name in f.read()
+        return self.run_name in transfer_ledger.get_ledger(
+            self.transfer_details["transfer_log"]
+        )
+
+    def get_lifecycle_state(self) -> tuple[str, bool]:
+        state, settled = super().get_lifecycle_state()
+        if state == "synced":
+            anglerfish_exit_code = self.get_anglerfish_exit_code()
+            if anglerfish_exit_code == 0:
+                state = "anglerfish done"
+            elif anglerfish_exit_code is not None:
+                state = "anglerfish failed"
+            elif self.get_anglerfish_pid():
+                state = "anglerfish ongoing"
+        return state, settled
 
     # QC methods
 
@@ -4,8 +4,9 @@ import logging
 import os
 import re
 import subprocess
+import tarfile
 
-from taca.utils import filesystem
+from taca.utils import filesystem, hashed_tar
 from taca.utils.config import CONFIG
 
 logger = logging.getLogger(__name__)
@@ -51,37 +52,35 @@ class NanoporeFlowcell(Flowcell):
         self.tar_file = self.fc_id + ".tar"
         self.tar_path = os.path.join(self.organised_project_dir, self.tar_file)
         self.md5_path = self.tar_path + ".md5"
+        self.tar_workers = CONFIG.get("organise").get("tar_workers")
+        self.sha256 = CONFIG.get("organise").get("sha256", False)
 
     def organise_data(self):
         """Tarball data into ONT_TAR"""
         # future todo: also organise data in DATA for easier analysis
         # future todo: make a list of samples included in the tarball
         tar_err = os.path.join(self.organised_project_dir, "tar.err")
-        with filesystem.chdir(self.incoming_path):
-            try:
-                with open(tar_err, "w") as error_file:
-                    tar_command = ["tar", "-cvf", self.tar_path, self.fc_id]
-                    result = subprocess.run(tar_command, stderr=error_file)
-                    logger.info(
-                        f"Finished making tarball for {self.fc_id}. Proceeding with md5sum."
-                    )
-            except subprocess.CalledProcessError as e:
-                logger.error(
-                    f"An error occurred during tarring of {self.fc_id}. Please check {tar_err} for more information."
+        try:
+            with open(tar_err, "w") as error_file:
+                # The md5sum is computed while the tarball is written
+                hashed_tar.write_archive(
+                    self.tar_path,
+                    self.fc_path_incoming,
+                    self.fc_id,
+                    # Read the many small files ahead in parallel
+                    workers=self.tar_workers,
+                    sha256=self.sha256,
+                    stderr=error_file,
                 )
-                raise e
-        with filesystem.chdir(self.organised_project_dir):
-            try:
-                md5_command = ["md5sum", self.tar_file]
-                result = subprocess.run(md5_command, capture_output=True, text=True)
-                with open(self.md5_path, "w") as f:
-                    f.write(result.stdout)
-                logger.info(f"Finished generating md5sum for {self.fc_id}.")
-            except subprocess.CalledProcessError as e:
-                logger.error(
-                    f"An error occurred while generating the md5sum for {self.fc_id}."
-                )
-                raise e
+            logger.info(f"Finished making tarball and md5sum for {self.fc_id}.")
+        except (OSError, tarfile.TarError) as e:
+            logger.error(f"An error occurred during tarring of {self.fc_id}: {e}")
+            raise e
+        except subprocess.CalledProcessError as e:
+            logger.error(
+                f"An error occurred during tarring of {self.fc_id}. Please check {tar_err} for more information."
+            )
+            raise e
         # TODO: Add a timestamp to statusdb indicating when the FC was organised
 
 
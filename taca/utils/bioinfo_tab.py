@@ -5,9 +5,14 @@ import os
 import re
 from collections import OrderedDict, defaultdict
 
-from flowcell_parser.classes import RunParametersParser, SampleSheetParser
+from flowcell_parser.classes import SampleSheetParser
 
 from taca.element.Aviti_Runs import Aviti_Run
+from taca.illumina.run_parser import (
+    LazyRunParser,
+    find_run_parameters,
+    parser_cache_dir,
+)
 from taca.utils import statusdb
 from taca.utils.config import CONFIG
 from taca.utils.misc import send_mail
@@ -271,33 +276,13 @@ def get_ss_projects_illumina(run_dir):
         FCID = run_name_components[3][1:]
     miseq = False
     # FIXME: this check breaks if the system is case insensitive
-    if os.path.exists(os.path.join(run_dir, "runParameters.xml")):
-        run_parameters_file = "runParameters.xml"
-    elif os.path.exists(os.path.join(run_dir, "RunParameters.xml")):
-        run_parameters_file = "RunParameters.xml"
-    else:
+    if find_run_parameters(run_dir) is None:
         logger.error(
             f"Cannot find RunParameters.xml or runParameters.xml in the run folder for run {run_dir}"
         )
         return []
-    rp = RunParametersParser(os.path.join(run_dir, run_parameters_file))
-    if "Setup" in rp.data["RunParameters"]:
-        runtype = rp.data["RunParameters"]["Setup"].get("Flowcell", "")
-        if not runtype:
-            logger.warn(
-                "Parsing runParameters to fetch instrument type, "
-                "not found Flowcell information in it. Using ApplicationName"
-            )
-            runtype = rp.data["RunParameters"]["Setup"].get("ApplicationName", "")
-    elif "InstrumentType" in rp.data["RunParameters"]:
-        runtype = rp.data["RunParameters"].get("InstrumentType")
-    else:
-        runtype = rp.data["RunParameters"].get("Application")
-        if not runtype:
-            logger.warn(
-                "Couldn't find 'Application', could be NextSeq. Trying 'ApplicationName'"
-            )
-            runtype = rp.data["RunParameters"].get("ApplicationName", "")
+    # Sniffed, without parsing the whole file, and cached per run
+    runtype = LazyRunParser(run_dir, cache_dir=parser_cache_dir(CONFIG)).run_type
 
     # Miseq case
     if "MiSeq" in runtype:
@@ -1,6 +1,7 @@
 """Filesystem utilities."""
 
 import contextlib
+import fcntl
 import os
 import shutil
 
@@ -20,6 +21,26 @@ def chdir(new_dir):
         os.chdir(cur_dir)
 
 
+@contextlib.contextmanager
+def try_lock(lock_file):
+    """Context manager taking an exclusive advisory lock on a file without
+    waiting for it.
+
+    Yields True if the lock was taken and False if another process holds it.
+    The lock is released on exit, or by the system if the holder dies.
+    """
+    with open(lock_file, "a") as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
 def create_folder(target_folder):
     """Ensure that a folder exists and create it if it doesn't, including any
     parent folders, as necessary.
@@ -50,3 +71,20 @@ def do_copy(src_path, dst_path):
     # if symlinks, will copy content, not the links
     # dst_path will be created, it must NOT exist
     shutil.copytree(src_path, dst_path)
+
+
+def dir_size(path):
+    """Return the apparent size in bytes of all files under a directory,
+    without following symlinks. A file is counted as its own size."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
@@ -0,0 +1,167 @@
+"""Tar archives checksummed while they are written.
+
+Runfolder deliveries and the organisation of ONT flowcells tar a folder to a
+file, then read the whole archive back with md5sum only to checksum it. The
+archive writer here hashes the tar stream on its way to the archive, with
+MD5 and, if asked, SHA-256, and writes the checksum files next to the
+archive in the format of md5sum and sha256sum. The tar stream is written by
+GNU tar, or by the read ahead writer of taca.utils.parallel_tar when it is
+given workers, with the same exclude patterns either way, and goes to a
+local file or to the standard input of a command, such as an ssh writing it
+straight to the destination of the delivery, so that it never touches the
+local disk.
+"""
+
+import hashlib
+import logging
+import os
+import posixpath
+import shlex
+import subprocess
+
+from taca.utils import parallel_tar
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1 << 20
+
+
+class HashingWriter:
+    """Binary stream writing to another, and hashing what goes through it."""
+
+    def __init__(self, fileobj, algorithms=("md5",)):
+        self.fileobj = fileobj
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self.size = 0
+
+    def write(self, data):
+        for hasher in self.hashes.values():
+            hasher.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+        return len(data)
+
+    def hexdigests(self):
+        return {
+            algorithm: hasher.hexdigest() for algorithm, hasher in self.hashes.items()
+        }
+
+
+def checksum_file(archive, algorithm="md5"):
+    """Path of the checksum file of an archive, e.g. run.tar.md5."""
+    return f"{archive}.{algorithm}"
+
+
+def write_checksum_files(archive, digests):
+    """Write the digests of an archive next to it, as md5sum and sha256sum
+    print them for the archive in its own folder."""
+    for algorithm, digest in digests.items():
+        with open(checksum_file(archive, algorithm), "w") as f:
+            f.write(f"{digest}  {os.path.basename(archive)}\n")
+
+
+def ssh_command(remote_host, dest_path, remote_user=None):
+    """Command writing its standard input to dest_path on a remote host,
+    through a partial file renamed once it is complete."""
+    part_path = f"{dest_path}.part"
+    return [
+        "ssh",
+        f"{remote_user}@{remote_host}" if remote_user else remote_host,
+        f"cat > {shlex.quote(part_path)} && "
+        f"mv {shlex.quote(part_path)} {shlex.quote(dest_path)}",
+    ]
+
+
+def remote_archive_path(dest_dir, archive):
+    return posixpath.join(dest_dir, os.path.basename(archive))
+
+
+def _gnu_tar(path, arcname, exclude, sink, stderr):
+    """Write the archive with GNU tar, as 'tar -cvf' with the exclude
+    patterns, run from the folder holding path."""
+    command = ["tar"]
+    for pattern in exclude:
+        command += ["--exclude", pattern]
+    if arcname != os.path.basename(path):
+        command.append(f"--transform=s,^{os.path.basename(path)},{arcname},")
+    command += ["-cvf", "-", "-C", os.path.dirname(path), os.path.basename(path)]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+    try:
+        while block := proc.stdout.read(BLOCK_SIZE):
+            sink.write(block)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode == 1:
+        # As GNU tar, the archive is written but some files changed meanwhile
+        logger.warning(f"Some files of {path} changed while they were archived")
+    elif returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def write_archive(
+    archive,
+    path,
+    arcname=None,
+    exclude=(),
+    workers=None,
+    sha256=False,
+    stream_command=None,
+    stderr=None,
+):
+    """Tar a folder and write the checksum files of the archive.
+
+    :param str archive: path of the archive, its checksum files are written
+        next to it, e.g. archive.md5
+    :param str path: the folder to archive
+    :param str arcname: name of the folder in the archive, defaults to its
+        basename
+    :param exclude: GNU tar patterns of the members to leave out
+    :param int workers: threads reading files ahead, None to run GNU tar
+    :param bool sha256: also write the SHA-256 of the archive to archive.sha256
+    :param list stream_command: command to write the archive to the standard
+        input of, instead of the file archive, see ssh_command
+    :param stderr: file the errors and verbose output of tar are written to
+    :returns: the hex digests of the archive, by algorithm
+    :raises subprocess.CalledProcessError: if tar or the command failed
+    """
+    path = os.path.abspath(path)
+    if arcname is None:
+        arcname = os.path.basename(path)
+    algorithms = ("md5", "sha256") if sha256 else ("md5",)
+    if stream_command is None:
+        with open(archive, "wb") as f:
+            sink = HashingWriter(f, algorithms)
+            _write_tar(path, arcname, exclude, workers, sink, stderr)
+    else:
+        proc = subprocess.Popen(stream_command, stdin=subprocess.PIPE, stderr=stderr)
+        sink = HashingWriter(proc.stdin, algorithms)
+        broken_pipe = False
+        try:
+            _write_tar(path, arcname, exclude, workers, sink, stderr)
+        except BrokenPipeError:
+            # The command died, its exit status is checked below
+            broken_pipe = True
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+        if returncode != 0 or broken_pipe:
+            raise subprocess.CalledProcessError(returncode, stream_command)
+    digests = sink.hexdigests()
+    write_checksum_files(archive, digests)
+    logger.info(
+        f"Archived {path} to {' '.join(stream_command or [archive])}, "
+        f"{sink.size} bytes, md5 {digests['md5']}"
+    )
+    return digests
+
+
+def _write_tar(path, arcname, exclude, workers, sink, stderr):
+    if workers:
+        with parallel_tar.ReadAheadTarWriter(fileobj=sink, workers=workers) as writer:
+            writer.add_tree(path, arcname, exclude)
+    else:
+        _gnu_tar(path, arcname, exclude, sink, stderr)
@@ -0,0 +1,540 @@
+"""Persistent queue of demultiplexing jobs run within a resource budget.
+
+Sub-demultiplexings used to be started as soon as their sample sheet or
+manifest was written, so a run with many mask groups started as many
+bcl-convert, bcl2fastq or bases2fastq processes at once, each expecting the
+whole machine. Instead, jobs are submitted to a queue kept in a SQLite
+database and launched, highest priority first and in submission order
+otherwise, as long as the configured number of jobs, CPUs and memory allow.
+Every invocation of the demultiplex commands launches the jobs that fit, so
+queued jobs start on later cron ticks.
+
+Each job runs in a small wrapper process detached from TACA, which writes
+the output of the job to the same log files as before and records its start,
+end and exit status. The job records tell whether a sub-demultiplexing is
+queued, running, finished or failed without inferring it from its output.
+
+The wrapper is this module run as a script, 'python job_queue.py DB JOB_ID',
+which only needs the standard library.
+
+With the 'slurm' executor the jobs are submitted to a cluster with sbatch
+instead, so sub-demultiplexings, e.g. the lanes of a large flow cell, can
+run on several nodes. Their records are kept in the same database.
+"""
+
+import json
+import logging
+import os
+import shlex
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    command TEXT NOT NULL,
+    cwd TEXT NOT NULL,
+    log_prefix TEXT NOT NULL,
+    cpus INTEGER,
+    memory_gb REAL NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    pid INTEGER, -- of the wrapper, or the id of the batch job
+    pid_start INTEGER, -- start time of the wrapper, in clock ticks after boot
+    queued REAL NOT NULL,
+    started REAL,
+    ended REAL,
+    exit_code INTEGER,
+    reported INTEGER NOT NULL DEFAULT 0, -- whether its failure was reported
+    UNIQUE (run_id, name)
+);
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+WRAPPER = os.path.abspath(__file__)
+
+
+def load_queue(config):
+    """Open the demultiplexing queue configured with 'demux_queue', if any.
+
+    demux_queue:
+        db: /local/path/demux_queue.db
+        executor: local            # or slurm
+        max_jobs: 2                # default: no limit
+        cpus: 64                   # default: the number of cores
+        memory_gb: 512             # default: no limit
+        priority_projects:         # jobs of these projects go first
+            - P12345
+        sbatch_options:            # slurm only
+            - --account=ngi
+    """
+    queue_config = config.get("demux_queue")
+    if not queue_config or not queue_config.get("db"):
+        return None
+    kwargs = dict(
+        max_jobs=queue_config.get("max_jobs"),
+        cpus=queue_config.get("cpus"),
+        memory_gb=queue_config.get("memory_gb"),
+        priority_projects=queue_config.get("priority_projects", []),
+    )
+    executor = queue_config.get("executor", "local")
+    if executor == "local":
+        return JobQueue(queue_config["db"], **kwargs)
+    elif executor == "slurm":
+        return SlurmJobQueue(
+            queue_config["db"],
+            sbatch=queue_config.get("sbatch", "sbatch"),
+            sacct=queue_config.get("sacct", "sacct"),
+            sbatch_options=queue_config.get("sbatch_options", []),
+            **kwargs,
+        )
+    raise RuntimeError(f"Unknown demultiplexing executor {executor}")
+
+
+def _process_start(pid):
+    """Return the start time of a process from /proc/<pid>/stat, in clock
+    ticks after boot, or None if it cannot be read, e.g. off Linux.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name in parentheses may hold spaces, starttime is the 22nd
+    # field and the 20th after it
+    return int(stat.rsplit(")", 1)[1].split()[19])
+
+
+def _is_alive(pid, start=None):
+    """Check if a process runs, and is the one started at 'start' rather
+    than a later one given the same pid.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if start is not None:
+        current_start = _process_start(pid)
+        if current_start is not None and current_start != start:
+            return False
+    return True
+
+
+class JobQueue:
+    """Demultiplexing jobs and the budget they are launched within.
+
+    A job that does not say how many CPUs it uses is taken to use them all.
+    A job larger than the whole budget is still launched when nothing else
+    is running.
+    """
+
+    def __init__(
+        self, db_path, max_jobs=None, cpus=None, memory_gb=None, priority_projects=()
+    ):
+        """
+        :param str db_path: path of the SQLite database, created if missing
+        :param int max_jobs: number of jobs running at the same time
+        :param int cpus: number of CPUs shared by the running jobs
+        :param float memory_gb: memory shared by the running jobs
+        :param priority_projects: projects whose jobs are launched first
+        """
+        self.db_path = os.path.abspath(db_path)
+        self.max_jobs = max_jobs
+        self.cpus = cpus or os.cpu_count()
+        self.memory_gb = memory_gb
+        self.priority_projects = set(priority_projects)
+        self.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        # Columns added since the first databases were created
+        for column, definition in [
+            ("pid_start", "INTEGER"),
+            ("reported", "INTEGER NOT NULL DEFAULT 0"),
+        ]:
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def priority(self, projects):
+        """Return the priority of a job demultiplexing samples of 'projects'."""
+        return 1 if self.priority_projects.intersection(projects) else 0
+
+    def submit(
+        self,
+        run_id,
+        name,
+        command,
+        cwd,
+        log_prefix=None,
+        cpus=None,
+        memory_gb=0,
+        priority=0,
+    ):
+        """Queue a job, unless the same job of the run is already queued or running.
+
+        A finished or failed job of the same name is queued again, e.g. when
+        a run is demultiplexed anew.
+
+        :param str run_id: run the job belongs to
+        :param str name: name of the job within the run, e.g. 'demux_0'
+        :param command: command as a list of arguments, or a string run by the shell
+        :param str cwd: directory to run the command in, and to write its logs to
+        :param str log_prefix: prefix of the '.out' and '.err' log files,
+            defaults to the job name
+        :param int cpus: number of CPUs used by the job, defaults to all
+        :param float memory_gb: memory used by the job
+        :param int priority: jobs of higher priority are launched first
+        :returns: the id of the job
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = self.conn.execute(
+                "SELECT id, state FROM jobs WHERE run_id = ? AND name = ?",
+                (run_id, name),
+            ).fetchone()
+            values = (
+                json.dumps(command),
+                cwd,
+                log_prefix or name,
+                cpus,
+                memory_gb,
+                priority,
+            )
+            if job is None:
+                job_id = self.conn.execute(
+                    "INSERT INTO jobs (run_id, name, command, cwd, log_prefix, cpus, "
+                    "memory_gb, priority, state, queued) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, name) + values + (QUEUED, now),
+                ).lastrowid
+                logger.info(f"Queued job {name} of run {run_id}")
+            elif job["state"] in (FINISHED, FAILED):
+                job_id = job["id"]
+                self.conn.execute(
+                    "UPDATE jobs SET command = ?, cwd = ?, log_prefix = ?, cpus = ?, "
+                    "memory_gb = ?, priority = ?, state = ?, queued = ?, pid = NULL, "
+                    "pid_start = NULL, started = NULL, reported = 0, ended = NULL, exit_code = NULL WHERE id = ?",
+                    values + (QUEUED, now, job_id),
+                )
+                logger.info(f"Queued job {name} of run {run_id} again")
+            else:
+                job_id = job["id"]
+                logger.info(f"Job {name} of run {run_id} is already {job['state']}")
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def _fits(self, job, running):
+        """Check if a job can be launched next to the running ones."""
+        if not running:
+            return True
+        if self.max_jobs and len(running) >= self.max_jobs:
+            return False
+        used_cpus = sum(r["cpus"] or self.cpus for r in running)
+        if used_cpus + (job["cpus"] or self.cpus) > self.cpus:
+            return False
+        if self.memory_gb:
+            used_memory = sum(r["memory_gb"] for r in running)
+            if used_memory + job["memory_gb"] > self.memory_gb:
+                return False
+        return True
+
+    def schedule(self):
+        """Record the jobs that ended without a trace and launch the queued
+        jobs that fit in the budget, in order.
+
+        The queue is strictly ordered: when the next job does not fit, the
+        ones after it wait too, so large jobs are not starved by small ones.
+
+        :returns: the ids of the launched jobs
+        """
+        launched = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = ?", (RUNNING,)
+            ).fetchall()
+            alive = []
+            for job in running:
+                ended = self._poll(job)
+                if ended is None:
+                    alive.append(job)
+                else:
+                    self.conn.execute(
+                        "UPDATE jobs SET state = ?, exit_code = ?, ended = ? "
+                        "WHERE id = ?",
+                        ended + (time.time(), job["id"]),
+                    )
+            queued = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id",
+                (QUEUED,),
+            ).fetchall()
+            for job in queued:
+                if not self._fits(job, alive):
+                    break
+                pid = self._launch(job)
+                self.conn.execute(
+                    "UPDATE jobs SET state = ?, pid = ?, pid_start = ?, started = ? "
+                    "WHERE id = ?",
+                    (RUNNING, pid, self._pid_start(pid), time.time(), job["id"]),
+                )
+                alive.append(job)
+                launched.append(job["id"])
+                logger.info(
+                    f"Launched job {job['name']} of run {job['run_id']} with pid {pid}"
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return launched
+
+    def _poll(self, job):
+        """Check on a running job.
+
+        The wrapper records how the job ended, so a job still marked running
+        whose wrapper is gone was killed along with it. The start time of the
+        wrapper is compared too, in case its pid was reused after a reboot or
+        a wrap around.
+
+        :returns: None while the job runs, else its state and exit code
+        """
+        if _is_alive(job["pid"], job["pid_start"]):
+            return None
+        logger.warning(
+            f"Job {job['name']} of run {job['run_id']} died without "
+            "recording its exit status"
+        )
+        return FAILED, None
+
+    def _launch(self, job):
+        """Start the wrapper of a job in a session of its own, so it outlives
+        this process.
+
+        :returns: the pid of the wrapper
+        """
+        process = subprocess.Popen(
+            [sys.executable, WRAPPER, self.db_path, str(job["id"])],
+            cwd=job["cwd"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        return process.pid
+
+    def _pid_start(self, pid):
+        """Return the start time of a launched wrapper, to tell it apart from
+        a later process given the same pid."""
+        return _process_start(pid)
+
+    def mark_reported(self, job_id):
+        """Record that the failure of a job was reported, so it is reported
+        once. Queueing the job again resets it."""
+        self.conn.execute("UPDATE jobs SET reported = 1 WHERE id = ?", (job_id,))
+
+    def jobs(self, run_id):
+        """Return the jobs of a run as dicts, in submission order."""
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                "SELECT * FROM jobs WHERE run_id = ? ORDER BY id", (run_id,)
+            )
+        ]
+
+    def job(self, run_id, name):
+        """Return a job of a run as a dict, or None."""
+        row = self.conn.execute(
+            "SELECT * FROM jobs WHERE run_id = ? AND name = ?", (run_id, name)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def run_state(self, run_id):
+        """Summarise the jobs of a run.
+
+        :returns: None if the run has no jobs, 'failed' if any job failed,
+            'ongoing' if any is queued or running, otherwise 'finished'
+        """
+        states = {job["state"] for job in self.jobs(run_id)}
+        if not states:
+            return None
+        if FAILED in states:
+            return FAILED
+        if states & {QUEUED, RUNNING}:
+            return "ongoing"
+        return FINISHED
+
+
+class SlurmJobQueue(JobQueue):
+    """Demultiplexing jobs submitted to a SLURM cluster with sbatch.
+
+    The cluster decides where and when the jobs run within their CPU and
+    memory requests, 'max_jobs' still limits how many are submitted at a
+    time. Their state and exit status are looked up with sacct.
+    """
+
+    # States of ended jobs, all but COMPLETED are failures
+    ENDED = (
+        "COMPLETED",
+        "FAILED",
+        "CANCELLED",
+        "TIMEOUT",
+        "OUT_OF_MEMORY",
+        "NODE_FAIL",
+        "PREEMPTED",
+        "BOOT_FAIL",
+        "DEADLINE",
+    )
+
+    def __init__(
+        self, db_path, sbatch="sbatch", sacct="sacct", sbatch_options=(), **kwargs
+    ):
+        """
+        :param str sbatch: sbatch command
+        :param str sacct: sacct command
+        :param sbatch_options: options added to every submission,
+            e.g. the account or partition
+        """
+        super().__init__(db_path, **kwargs)
+        self.sbatch = sbatch
+        self.sacct = sacct
+        self.sbatch_options = list(sbatch_options)
+
+    def _fits(self, job, running):
+        return not self.max_jobs or len(running) < self.max_jobs
+
+    def _launch(self, job):
+        """Submit a job to the cluster.
+
+        :returns: the id of the batch job
+        """
+        command = json.loads(job["command"])
+        if isinstance(command, list):
+            program = os.path.basename(command[0])
+            command = shlex.join(command)
+        else:
+            program = os.path.basename(command.split()[0])
+        log_name = os.path.join(job["cwd"], f"{job['log_prefix']}_{program}")
+        cl = [
+            self.sbatch,
+            "--parsable",
+            f"--job-name={job['run_id']}_{job['name']}",
+            f"--chdir={job['cwd']}",
+            f"--output={log_name}.out",
+            f"--error={log_name}.err",
+            "--open-mode=append",
+        ]
+        if job["cpus"]:
+            cl.append(f"--cpus-per-task={job['cpus']}")
+        if job["memory_gb"]:
+            cl.append(f"--mem={int(job['memory_gb'] * 1024)}M")
+        cl.extend(self.sbatch_options)
+        cl.extend(["--wrap", command])
+        output = subprocess.check_output(cl, text=True)
+        # --parsable prints the job id, followed by the cluster name if any
+        return int(output.strip().split(";")[0])
+
+    def _pid_start(self, pid):
+        # Batch job ids are not local pids
+        return None
+
+    def _poll(self, job):
+        try:
+            output = subprocess.check_output(
+                [
+                    self.sacct,
+                    "-n",
+                    "-P",
+                    "-X",
+                    "-j",
+                    str(job["pid"]),
+                    "-o",
+                    "State,ExitCode",
+                ],
+                text=True,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not check batch job {job['pid']}: {e}")
+            return None
+        lines = output.strip().splitlines()
+        if not lines:
+            # Not known to the accounting yet
+            return None
+        state, exit_code = lines[0].split("|")
+        # e.g. 'CANCELLED by 1234'
+        state = state.split()[0]
+        if state not in self.ENDED:
+            return None
+        exit_code = int(exit_code.split(":")[0])
+        if state == "COMPLETED":
+            return FINISHED, exit_code
+        logger.warning(
+            f"Batch job {job['pid']} of job {job['name']} of run {job['run_id']} "
+            f"ended as {state}"
+        )
+        return FAILED, exit_code
+
+
+def run_job(db_path, job_id):
+    """Run a job and record its exit status, in the wrapper process."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    command = json.loads(job["command"])
+    program = os.path.basename(
+        command[0] if isinstance(command, list) else command.split()[0]
+    )
+    log_name = os.path.join(job["cwd"], f"{job['log_prefix']}_{program}")
+    with open(f"{log_name}.out", "a") as stdout, open(f"{log_name}.err", "a") as stderr:
+        cl = command if isinstance(command, list) else [command]
+        started = "Started command {} on {}".format(" ".join(cl), datetime.now())
+        stdout.write(started + "\n")
+        stdout.write("".join(["="] * len(cl)) + "\n")
+        stdout.flush()
+        try:
+            exit_code = subprocess.call(
+                command,
+                shell=isinstance(command, str),
+                cwd=job["cwd"],
+                stdout=stdout,
+                stderr=stderr,
+            )
+        except OSError as e:
+            stderr.write(f"Could not start {program}: {e}\n")
+            exit_code = 127
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET state = ?, ended = ?, exit_code = ? WHERE id = ?",
+            (FINISHED if exit_code == 0 else FAILED, time.time(), exit_code, job_id),
+        )
+    conn.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(run_job(sys.argv[1], int(sys.argv[2])))
@@ -0,0 +1,178 @@
+"""Incremental mirroring of run files to shared file systems.
+
+The metadata of runs, InterOp, run parameters, reports and the like, is
+copied to shared file systems for LIMS and archiving on every pass over the
+runs, every file again whether or not it changed. A mirror copies only the
+files whose size or modification time differ from their copy, in a pool of
+threads, with the copy offload of the kernel where there is one, and writes
+each copy to a temporary file renamed over the destination, so that readers
+never see a partial file. Copies get the modification time of their source.
+
+A checksum manifest can be kept with a mirror: the SHA-256 of each file
+copied. A file rewritten with the same content, which changes its
+modification time only, is then not copied again, only its time is updated.
+"""
+
+import errno
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 4
+BLOCK_SIZE = 1 << 23
+# Errors of copy_file_range when the files do not support it
+NO_COPY_OFFLOAD = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+MirrorStats = namedtuple(
+    "MirrorStats", ["copied", "skipped", "bytes_copied", "bytes_skipped"]
+)
+
+
+def tree_files(src_dir, dest_dir, exclude_dirs=(), exclude_files=()):
+    """Return the (source, destination) of the files of a folder.
+
+    :param list exclude_dirs: patterns of the names of folders not to
+        descend into
+    :param list exclude_files: patterns of the names of files to leave out
+    """
+    pairs = []
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(src_dir, rel_dir)) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    if not any(fnmatch.fnmatch(entry.name, p) for p in exclude_dirs):
+                        pending.append(rel_path)
+                elif not any(fnmatch.fnmatch(entry.name, p) for p in exclude_files):
+                    pairs.append((entry.path, os.path.join(dest_dir, rel_path)))
+    return sorted(pairs)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def copy_file(src, dest):
+    """Copy a file atomically, with its permissions and modification time,
+    through a temporary file next to its destination."""
+    tmp_dest = f"{dest}.{os.getpid()}.tmp"
+    stat = os.stat(src)
+    try:
+        with open(src, "rb") as fsrc, open(tmp_dest, "wb") as fdst:
+            _copy_data(fsrc, fdst, stat.st_size)
+        shutil.copymode(src, tmp_dest)
+        os.utime(tmp_dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_dest, dest)
+    except BaseException:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+
+
+def _copy_data(fsrc, fdst, size):
+    if hasattr(os, "copy_file_range"):
+        copied = 0
+        try:
+            while copied < size:
+                count = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), min(size - copied, 1 << 30)
+                )
+                if count == 0:
+                    break
+                copied += count
+            return
+        except OSError as e:
+            if e.errno not in NO_COPY_OFFLOAD or copied:
+                raise
+    shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+class _Manifest:
+    """Checksums of the files of a mirror, kept in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.checksums = dict()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.checksums = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring the mirror manifest {path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.checksums, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def mirror_files(pairs, workers=WORKERS, manifest=None):
+    """Copy files to their destinations, unless their copies are current.
+
+    :param list pairs: the (source, destination) of the files
+    :param int workers: number of files copied at the same time
+    :param str manifest: the checksum manifest of the mirror, None to
+        compare the files by size and modification time only
+    :returns: a MirrorStats of the files copied and skipped
+    """
+    checksums = _Manifest(manifest) if manifest else None
+
+    def mirror_file(pair):
+        src, dest = pair
+        stat = os.stat(src)
+        try:
+            dest_stat = os.stat(dest)
+        except FileNotFoundError:
+            dest_stat = None
+        if dest_stat is not None and dest_stat.st_size == stat.st_size:
+            if dest_stat.st_mtime_ns == stat.st_mtime_ns:
+                return False, stat.st_size
+            if checksums and checksums.checksums.get(dest) == file_sha256(src):
+                # Rewritten with the same content
+                os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                return False, stat.st_size
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if checksums:
+            checksums.checksums[dest] = file_sha256(src)
+        copy_file(src, dest)
+        return True, stat.st_size
+
+    copied = skipped = bytes_copied = bytes_skipped = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for was_copied, size in executor.map(mirror_file, pairs):
+            if was_copied:
+                copied += 1
+                bytes_copied += size
+            else:
+                skipped += 1
+                bytes_skipped += size
+    if checksums:
+        checksums.save()
+    return MirrorStats(copied, skipped, bytes_copied, bytes_skipped)
+
+
+def mirror(pairs, description, workers=WORKERS, manifest=None):
+    """Mirror files as mirror_files, logging what was copied and skipped."""
+    stats = mirror_files(pairs, workers, manifest)
+    logger.info(
+        f"Mirrored {description}: copied {stats.copied} file(s), "
+        f"{stats.bytes_copied} bytes, skipped {stats.skipped} unchanged, "
+        f"{stats.bytes_skipped} bytes"
+    )
+    return stats
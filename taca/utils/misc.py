@@ -3,6 +3,7 @@
 import glob
 import hashlib
 import os
+import resource
 import smtplib
 import subprocess
 import sys
@@ -120,6 +121,15 @@ def to_seconds(days=None, hours=None):
         return 3600 * hours
 
 
+def peak_rss_mib():
+    """Return the peak resident set size of the process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in KiB elsewhere
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
 def hashfile(afile, hasher="sha1", blocksize=65536):
     """Calculate the hash digest of a file with the specified algorithm and
     return it.
@@ -0,0 +1,162 @@
+"""Transfer of a folder with several rsync processes at the same time.
+
+A single rsync moves the files of a run one at a time over one connection,
+with one process checksumming on each side, which does not fill fast links
+to the analysis cluster. The files the rsync filters select are listed once,
+with rsync itself so that the filters mean what they mean to rsync, split in
+shards of about the same number of bytes, and each shard is transferred by
+its own rsync with --files-from, all of them at the same time. Their logs are
+appended, shard after shard, to the log the single rsync would write, and the
+transfer fails if any shard does.
+"""
+
+import heapq
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def list_files(src, filters):
+    """Return the (path, size) of the regular files rsync would transfer
+    from src with the filters, paths relative to the folder holding src."""
+    output = subprocess.run(
+        ["rsync", "-rL", "--list-only", "--no-human-readable", *filters, src],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    files = []
+    for line in output.splitlines():
+        fields = line.split(None, 4)
+        # Permissions, size, date, time and path, files only
+        if len(fields) == 5 and fields[0].startswith("-"):
+            files.append((fields[4], int(fields[1].replace(",", ""))))
+    return files
+
+
+def partition(files, shards):
+    """Split (path, size) pairs into shards of about the same size, largest
+    file first to the smallest shard. Empty shards are left out."""
+    heap = [(0, i, []) for i in range(shards)]
+    for path, size in sorted(files, key=lambda file: (-file[1], file[0])):
+        total, i, shard = heapq.heappop(heap)
+        shard.append((path, size))
+        heapq.heappush(heap, (total + size, i, shard))
+    return [sorted(shard) for _, _, shard in sorted(heap, key=lambda s: s[1]) if shard]
+
+
+class ShardsFailed(subprocess.CalledProcessError):
+    """Some of the rsync of a transfer failed, the exit code and command are
+    those of the first that did."""
+
+    def __init__(self, failed, shards):
+        super().__init__(failed[0][2], failed[0][1])
+        self.failed = failed
+        self.shards = shards
+        self.message = str(self)
+
+    def __str__(self):
+        return "{} of {} rsync streams failed, {}, the first with {}".format(
+            len(self.failed),
+            self.shards,
+            ", ".join(
+                f"stream {i + 1} with exit code {returncode}"
+                for i, _, returncode in self.failed
+            ),
+            " ".join(self.cmd),
+        )
+
+
+def _throughput(size, elapsed):
+    return f"{size / max(elapsed, 1e-6) / 2**20:.1f} MiB/s"
+
+
+def transfer(src, dest, options, filters, streams, log_dir, log_name="rsync"):
+    """Transfer the folder src to dest with several rsync at the same time.
+
+    :param str src: the folder to transfer, as it is given to rsync
+    :param str dest: the destination, local or remote, of rsync
+    :param list options: rsync options of each shard, -r left out
+    :param list filters: rsync filters selecting the files of src
+    :param int streams: how many rsync run at the same time
+    :param str log_dir: where the log files are, <log_name>.out and .err
+    :returns: the number of files and bytes transferred
+    :raises subprocess.CalledProcessError: if any shard failed, once all
+        shards are done
+    """
+    src = os.path.normpath(src)
+    files = list_files(src, filters)
+    shards = partition(files, streams)
+    total_size = sum(size for _, size in files)
+    logger.info(
+        f"Transferring {len(files)} files, {total_size} bytes, of {src} "
+        f"in {len(shards)} rsync streams"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def run_shard(i):
+            files_from = os.path.join(tmp_dir, f"shard_{i}.txt")
+            with open(files_from, "w") as f:
+                f.writelines(f"{path}\n" for path, _ in shards[i])
+            command = [
+                "rsync",
+                *options,
+                f"--files-from={files_from}",
+                os.path.dirname(src),
+                dest,
+            ]
+            started = datetime.now()
+            start = time.monotonic()
+            with (
+                open(os.path.join(tmp_dir, f"shard_{i}.out"), "w") as stdout,
+                open(os.path.join(tmp_dir, f"shard_{i}.err"), "w") as stderr,
+            ):
+                returncode = subprocess.run(
+                    command, stdout=stdout, stderr=stderr
+                ).returncode
+            return command, started, returncode, time.monotonic() - start
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(shards) or 1) as executor:
+            results = list(executor.map(run_shard, range(len(shards))))
+        elapsed = time.monotonic() - start
+
+        failed = []
+        for i, (command, started, returncode, shard_elapsed) in enumerate(results):
+            shard_size = sum(size for _, size in shards[i])
+            logger.info(
+                f"rsync stream {i + 1}/{len(shards)} of {src}: "
+                f"{len(shards[i])} files, {shard_size} bytes in "
+                f"{shard_elapsed:.1f} s, {_throughput(shard_size, shard_elapsed)}, "
+                f"exit code {returncode}"
+            )
+            if returncode != 0:
+                failed.append((i, command, returncode))
+            # As call_external_command, which the single rsync is run with
+            for stream in ["out", "err"]:
+                with (
+                    open(os.path.join(tmp_dir, f"shard_{i}.{stream}")) as shard_log,
+                    open(os.path.join(log_dir, f"{log_name}.{stream}"), "a") as log,
+                ):
+                    if stream == "out":
+                        log.write(
+                            "Started command {} on {}\n".format(
+                                " ".join(command), started
+                            )
+                        )
+                        log.write("".join(["="] * len(command)) + "\n")
+                    log.write(shard_log.read())
+    if failed:
+        raise ShardsFailed(failed, len(shards))
+    logger.info(
+        f"Transferred {len(files)} files, {total_size} bytes, of {src} in "
+        f"{elapsed:.1f} s, {_throughput(total_size, elapsed)}"
+    )
+    return len(files), total_size
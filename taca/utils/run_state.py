@@ -0,0 +1,187 @@
+"""Local store of the lifecycle state of sequencing runs.
+
+Every invocation of the analysis commands used to find out the state of each
+run from its marker files ('transferring', '.rsync_exit_status',
+'.sync_finished', '.anglerfish_done', ...) and the transfer logs, which on
+NFS means many stat calls and log scans per run. The store records the state
+of each run, when it entered it and a fingerprint of the run directory in a
+SQLite database on local disk.
+
+Runs in a settled state, e.g. transferred runs left in the data directory,
+can only change state when their directory does, so they are skipped with a
+single stat as long as the fingerprint is unchanged. All other runs are
+checked as before. The marker files remain the source of truth: the recorded
+states are derived from them and 'taca analysis reconcile-state' rebuilds
+the store from disk, e.g. after a transfer log was edited by hand.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_dir TEXT PRIMARY KEY,
+    platform TEXT NOT NULL,
+    state TEXT NOT NULL,
+    settled INTEGER NOT NULL,
+    fingerprint TEXT,
+    first_seen REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    run_dir TEXT NOT NULL,
+    state TEXT NOT NULL,
+    entered REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_run_dir ON transitions (run_dir);
+"""
+
+
+def fingerprint(run_dir):
+    """Fingerprint a run directory with a single stat call.
+
+    Creating, removing or renaming entries in a directory updates its mtime,
+    and all marker files live at the top of the run directory.
+
+    :returns: a string, or None if the directory does not exist
+    """
+    try:
+        st = os.stat(run_dir)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_dev}:{st.st_ino}:{st.st_mtime_ns}"
+
+
+def load_store(config):
+    """Open the run state store configured with 'run_state_db', if any."""
+    db_path = config.get("run_state_db")
+    if not db_path:
+        return None
+    return RunStateStore(db_path)
+
+
+class RunStateStore:
+    """Run states persisted in a SQLite database.
+
+    The database is shared by concurrent invocations, each change is a
+    transaction of its own. It should live on local disk, SQLite locking is
+    not reliable over NFS.
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """
+        :param str db_path: path of the SQLite database, created if missing
+        :param int timeout: seconds to wait for a lock held by another process
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, run_dir):
+        """Return the recorded state of a run as a dict, or None."""
+        row = self.conn.execute(
+            "SELECT * FROM runs WHERE run_dir = ?", (os.path.abspath(run_dir),)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def runs(self, platform=None):
+        """Return the recorded states of all runs, or those of a platform."""
+        if platform is None:
+            rows = self.conn.execute("SELECT * FROM runs ORDER BY run_dir")
+        else:
+            rows = self.conn.execute(
+                "SELECT * FROM runs WHERE platform = ? ORDER BY run_dir", (platform,)
+            )
+        return [dict(row) for row in rows]
+
+    def history(self, run_dir):
+        """Return the states a run went through as (state, time) tuples."""
+        return [
+            (row["state"], row["entered"])
+            for row in self.conn.execute(
+                "SELECT state, entered FROM transitions WHERE run_dir = ? "
+                "ORDER BY entered, rowid",
+                (os.path.abspath(run_dir),),
+            )
+        ]
+
+    def is_settled(self, run_dir):
+        """Check if a run is in a settled state and its directory is unchanged
+        since it was recorded, in which case it need not be checked again.
+        """
+        run = self.get(run_dir)
+        return (
+            run is not None
+            and bool(run["settled"])
+            and run["fingerprint"] == fingerprint(run["run_dir"])
+        )
+
+    def record(self, run_dir, platform, state, settled=False):
+        """Record the current state of a run.
+
+        :param str run_dir: path of the run directory
+        :param str platform: 'illumina', 'element' or 'ont'
+        :param str state: state of the run as derived from its marker files
+        :param bool settled: whether the state can only change when the run
+            directory does
+        """
+        run_dir = os.path.abspath(run_dir)
+        now = time.time()
+        with self.conn:
+            previous = self.conn.execute(
+                "SELECT state FROM transitions WHERE run_dir = ? "
+                "ORDER BY entered DESC, rowid DESC LIMIT 1",
+                (run_dir,),
+            ).fetchone()
+            self.conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_dir) DO UPDATE SET platform = excluded.platform, "
+                "state = excluded.state, settled = excluded.settled, "
+                "fingerprint = excluded.fingerprint, updated = excluded.updated",
+                (run_dir, platform, state, settled, fingerprint(run_dir), now, now),
+            )
+            if previous is None or previous["state"] != state:
+                self.conn.execute(
+                    "INSERT INTO transitions VALUES (?, ?, ?)", (run_dir, state, now)
+                )
+                logger.debug(f"Run {run_dir} is now {state}")
+
+    def refresh(self, run_dir, platform, get_state, *args):
+        """Record the state of a run as returned by 'get_state(*args)'.
+
+        Errors are logged rather than raised, a run whose state could not be
+        recorded is simply checked again on the next pass.
+        """
+        try:
+            state, settled = get_state(*args)
+            self.record(run_dir, platform, state, settled)
+        except (OSError, RuntimeError, ValueError, sqlite3.Error) as e:
+            logger.warning(f"Could not record the state of run {run_dir}: {e}")
+
+    def forget(self, run_dir):
+        """Remove a run and its history from the store."""
+        run_dir = os.path.abspath(run_dir)
+        with self.conn:
+            self.conn.execute("DELETE FROM runs WHERE run_dir = ?", (run_dir,))
+            self.conn.execute("DELETE FROM transitions WHERE run_dir = ?", (run_dir,))
+
+    def clear(self, platform):
+        """Remove the states of all runs of a platform, keeping their history."""
+        with self.conn:
+            self.conn.execute("DELETE FROM runs WHERE platform = ?", (platform,))
@@ -194,6 +194,11 @@ class ElementRunsConnection(StatusdbSession):
 
 
 def update_doc(db, obj, over_write_db_entry=False):
+    """Save a document in a database, updating the one of the same name.
+
+    :returns: what was done, 'created', 'updated' or 'unchanged', None if
+        there are several documents of the name, and the id of the document
+    """
     view = db.view("info/name")
     if len(view[obj["name"]].rows) == 1:
         remote_doc = view[obj["name"]].rows[0].value
@@ -206,11 +211,15 @@ def update_doc(db, obj, over_write_db_entry=False):
             obj["_rev"] = doc_rev
             db[doc_id] = obj
             logger.info("Updating {}".format(obj["name"]))
+            return "updated", doc_id
+        return "unchanged", doc_id
     elif len(view[obj["name"]].rows) == 0:
-        db.save(obj)
+        doc_id = db.save(obj)[0]
         logger.info("Saving {}".format(obj["name"]))
+        return "created", doc_id
     else:
         logger.warning("More than one row with name {} found".format(obj["name"]))
+        return None, None
 
 
 def merge_dicts(d1, d2):
@@ -0,0 +1,257 @@
+"""Batched building of the symlink farms of demultiplexing aggregation.
+
+Aggregating the sub-demultiplexings of a run links the FASTQ files of each
+sample into the Demultiplexing folder, thousands of links on large runs. It
+used to check and create the folders of each sample and glob the tree of the
+sub-demultiplexing again for every sample before linking its files one at a
+time. Here it is done in two phases:
+
+- each sub-demultiplexing tree is scanned once, with os.scandir, into a
+  FastqIndex of its FASTQ files by project, sample, lane and read,
+- the links are planned from the index into a LinkPlan, which is then
+  compared with what the destination folder holds and applied in bulk.
+
+Applying a plan again only makes the links that are missing or point
+elsewhere, and, when pruning, removes what the plan no longer has, rather
+than clearing the folder and linking everything again. A plan can also be
+listed without applying it, as a dry run.
+"""
+
+import logging
+import os
+import re
+import shutil
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Sample_S1_L001_R1_001.fastq.gz, or I1 for the index reads
+FASTQ_NAME = re.compile(r"_L(\d{3})_(.*?)_\d{3}\.fastq")
+
+FastqFile = namedtuple(
+    "FastqFile", ["path", "name", "project", "sample", "lane", "read"]
+)
+
+
+def _fastq_file(root, parts, name):
+    match = FASTQ_NAME.search(name)
+    lane, read = (str(int(match.group(1))), match.group(2)) if match else (None, None)
+    return FastqFile(
+        os.path.join(root, *parts, name),
+        name,
+        parts[0] if parts else None,
+        parts[1] if len(parts) > 1 else None,
+        lane,
+        read,
+    )
+
+
+class FastqIndex:
+    """The FASTQ files of a demultiplexing tree, from a single scan.
+
+    Files are keyed by the folders they are in, the project and the sample,
+    None for those at the top of the tree.
+
+    :param str root: the tree to scan
+    :param int depth: how many levels of folders to descend into
+    """
+
+    def __init__(self, root, depth=2):
+        self.root = root
+        self._files = dict()
+        self._dirs = dict()
+        self._scan((), depth)
+        for files in self._files.values():
+            files.sort(key=lambda fastq: fastq.name)
+
+    def _scan(self, parts, depth):
+        subdirs = []
+        try:
+            entries = list(os.scandir(os.path.join(self.root, *parts)))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif ".fastq" in entry.name:
+                fastq = _fastq_file(self.root, parts, entry.name)
+                self._files.setdefault((fastq.project, fastq.sample), []).append(fastq)
+        self._dirs[parts] = sorted(subdirs)
+        if depth > 0:
+            for name in subdirs:
+                self._scan(parts + (name,), depth - 1)
+
+    def subdirs(self, *parts):
+        """Return the folders of a folder of the tree, in name order."""
+        return self._dirs.get(parts, [])
+
+    def files(self, project=None, sample=None, lane=None, read=None):
+        """Return the FASTQ files of a project and sample, of a lane and a
+        read or all of them, in name order."""
+        return [
+            fastq
+            for fastq in self._files.get((project, sample), [])
+            if (lane is None or fastq.lane == str(lane))
+            and (read is None or fastq.read == read)
+        ]
+
+    def __len__(self):
+        return sum(len(files) for files in self._files.values())
+
+
+class LinkPlan:
+    """Links to make in a destination folder, and the folders holding them.
+
+    :param str root: the destination folder, which the plan manages
+    """
+
+    def __init__(self, root):
+        self.root = os.path.normpath(root)
+        self.links = dict()
+        self.dirs = set()
+
+    def __len__(self):
+        return len(self.links)
+
+    def add_dir(self, path):
+        self.dirs.add(os.path.normpath(path))
+
+    def add(self, source, dest):
+        """Plan a link at dest to source.
+
+        :raises FileExistsError: if dest is planned to link elsewhere
+        """
+        dest = os.path.normpath(dest)
+        if self.links.get(dest, source) != source:
+            raise FileExistsError(
+                f"{dest} is planned to link to both {self.links[dest]} and {source}"
+            )
+        self.links[dest] = source
+        self.add_dir(os.path.dirname(dest))
+
+    def _existing(self):
+        """Return what the destination holds, a link target, "dir" or "file"
+        by path, without following links."""
+        existing = dict()
+        pending = [self.root] if os.path.isdir(self.root) else []
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        existing[entry.path] = ("link", os.readlink(entry.path))
+                    elif entry.is_dir():
+                        existing[entry.path] = ("dir",)
+                        pending.append(entry.path)
+                    else:
+                        existing[entry.path] = ("file",)
+        return existing
+
+    def diff(self, prune=False):
+        """Compare the plan with the destination.
+
+        :param bool prune: whether what the plan does not have in the
+            destination should be removed
+        :returns: the actions applying the plan takes, as (action, path,
+            source) tuples, action being one of "remove", "mkdir", "link",
+            "relink" and "keep", in the order they are taken
+        :raises FileExistsError: if a file or folder is in the way of a link
+            and prune is false
+        """
+        existing = self._existing()
+        dirs = set()
+        for path in self.dirs:
+            while path != self.root and path.startswith(self.root + os.sep):
+                dirs.add(path)
+                path = os.path.dirname(path)
+        removed, made, linked = [], [], []
+        for path in sorted(dirs):
+            if existing.get(path, ("dir",))[0] != "dir":
+                if not prune:
+                    raise FileExistsError(f"{path} is in the way of a folder")
+                removed.append(path)
+            if path not in existing or path in removed:
+                made.append(("mkdir", path, None))
+        for dest, source in sorted(self.links.items()):
+            kind = existing.get(dest)
+            if kind is None or dest in removed:
+                linked.append(("link", dest, source))
+            elif kind[0] == "link":
+                action = "keep" if kind[1] == source else "relink"
+                linked.append((action, dest, source))
+            elif not prune:
+                raise FileExistsError(f"{dest} is in the way of a link")
+            else:
+                removed.append(dest)
+                linked.append(("link", dest, source))
+        if prune:
+            for path in existing:
+                if path not in dirs and path not in self.links:
+                    removed.append(path)
+        # Removing a folder removes what it holds
+        removed_set = set(removed)
+        removed = [
+            path
+            for path in sorted(removed_set)
+            if not any(parent in removed_set for parent in _parents(path, self.root))
+        ]
+        return [("remove", path, None) for path in removed] + made + linked
+
+    def apply(self, prune=False, dry_run=False):
+        """Apply the plan, see diff for the arguments.
+
+        :param bool dry_run: only return the actions, without taking them
+        :returns: the actions taken
+        """
+        actions = self.diff(prune)
+        if dry_run:
+            return actions
+        for action, path, source in actions:
+            if action == "remove":
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            elif action == "mkdir":
+                os.makedirs(path, exist_ok=True)
+            elif action == "link":
+                os.symlink(source, path)
+            elif action == "relink":
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                os.symlink(source, tmp_path)
+                os.replace(tmp_path, path)
+        counts = count_actions(actions)
+        logger.info(
+            f"Applied the link plan of {self.root}: "
+            + ", ".join(f"{count} {action}" for action, count in counts.items())
+        )
+        return actions
+
+
+def _parents(path, root):
+    parent = os.path.dirname(path)
+    while parent != root and parent.startswith(root + os.sep):
+        yield parent
+        parent = os.path.dirname(parent)
+
+
+def count_actions(actions):
+    counts = dict.fromkeys(("remove", "mkdir", "link", "relink", "keep"), 0)
+    for action in actions:
+        counts[action[0]] += 1
+    return counts
+
+
+def format_actions(actions, root, kept=False):
+    """Return a listing of the actions of a plan, one per line, with paths
+    relative to its destination, leaving out the links kept unless kept."""
+    lines = []
+    for action, path, source in actions:
+        if action == "keep" and not kept:
+            continue
+        line = f"{action:<6} {os.path.relpath(path, root)}"
+        if source is not None:
+            line += f" -> {source}"
+        lines.append(line)
+    counts = count_actions(actions)
+    lines.append(", ".join(f"{count} {action}" for action, count in counts.items()))
+    return "\n".join(lines)
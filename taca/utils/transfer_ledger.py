@@ -0,0 +1,238 @@
+"""Indexed ledger of the runs transferred to the analysis cluster.
+
+The transfer logs are TSV files with one row per transferred run, the run
+name and the transfer date, that only ever grow. Looking a run up used to
+mean reading the whole file for every run on every pass. The ledger keeps an
+index of a transfer log in a SQLite database next to it, so lookups are
+exact matches on the run name in constant time.
+
+The TSV stays the record read by downstream tools and by people: runs are
+appended to it as before, and the index imports the rows appended since it
+was last updated, so rows added by other means are picked up too. If the
+file was truncated or replaced the index is rebuilt from scratch.
+"""
+
+import csv
+import fcntl
+import io
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    run_id TEXT PRIMARY KEY,
+    transferred TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS source (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    inode INTEGER NOT NULL,
+    imported INTEGER NOT NULL
+);
+"""
+
+# One ledger per transfer log and process
+_ledgers: dict[str, "TransferLedger"] = {}
+
+
+def get_ledger(transfer_log):
+    """Return the ledger of a transfer log, shared within the process."""
+    transfer_log = os.path.abspath(transfer_log)
+    if transfer_log not in _ledgers:
+        _ledgers[transfer_log] = TransferLedger(transfer_log)
+    return _ledgers[transfer_log]
+
+
+class TransferLedger:
+    """A transfer log and its index.
+
+    Appends are serialised with a lock file next to the log, the index is
+    shared by concurrent invocations through SQLite transactions.
+    """
+
+    def __init__(self, transfer_log):
+        """
+        :param str transfer_log: path of the TSV transfer log
+        """
+        self.transfer_log = os.path.abspath(transfer_log)
+        self.index_file = f"{self.transfer_log}.index.db"
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Connect on first use, looking a run up is often not needed at all
+        if self._conn is None:
+            conn = sqlite3.connect(self.index_file, timeout=30, isolation_level=None)
+            try:
+                conn.executescript(SCHEMA)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def sync(self):
+        """Import the rows appended to the transfer log since the last sync.
+
+        :returns: the number of rows imported
+        """
+        try:
+            st = os.stat(self.transfer_log)
+        except FileNotFoundError:
+            st = None
+        conn = self.conn
+        # Most lookups find the index up to date, without taking the write lock
+        source = conn.execute("SELECT inode, imported FROM source").fetchone()
+        if (st is None and source is None) or (
+            st is not None and source == (st.st_ino, st.st_size)
+        ):
+            return 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            source = conn.execute("SELECT inode, imported FROM source").fetchone()
+            if st is None:
+                # No runs transferred yet, or the log was removed
+                conn.execute("DELETE FROM transfers")
+                conn.execute("DELETE FROM source")
+                conn.execute("COMMIT")
+                return 0
+            if source and source[0] == st.st_ino and source[1] == st.st_size:
+                conn.execute("COMMIT")
+                return 0
+            offset = source[1] if source else 0
+            if source is None or source[0] != st.st_ino or source[1] > st.st_size:
+                if source is not None:
+                    logger.info(
+                        f"Transfer log {self.transfer_log} was replaced or truncated, "
+                        "rebuilding its index"
+                    )
+                conn.execute("DELETE FROM transfers")
+                offset = 0
+            with open(self.transfer_log, "rb") as fh:
+                fh.seek(offset)
+                tail = fh.read(st.st_size - offset)
+            # Leave a row that is still being written for the next sync
+            complete = tail[: tail.rfind(b"\n") + 1]
+            rows = [
+                row
+                for row in csv.reader(
+                    io.StringIO(complete.decode("utf-8", errors="replace")),
+                    delimiter="\t",
+                )
+                if row and row[0]
+            ]
+            conn.executemany(
+                "INSERT OR IGNORE INTO transfers VALUES (?, ?)",
+                [(row[0], row[1] if len(row) > 1 else "") for row in rows],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO source VALUES (0, ?, ?)",
+                (st.st_ino, offset + len(complete)),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def rebuild(self):
+        """Rebuild the index from the whole transfer log.
+
+        :returns: the number of runs in the ledger
+        """
+        self.conn.execute("DELETE FROM source")
+        self.sync()
+        return len(self)
+
+    def __contains__(self, run_id):
+        try:
+            self.sync()
+            return (
+                self.conn.execute(
+                    "SELECT 1 FROM transfers WHERE run_id = ?", (run_id,)
+                ).fetchone()
+                is not None
+            )
+        except sqlite3.Error as e:
+            # E.g. the index can not be created next to a read-only log
+            logger.warning(
+                f"Could not use the index of {self.transfer_log}, scanning it: {e}"
+            )
+            return self._scan(run_id)
+
+    def _scan(self, run_id):
+        """Look a run up by reading the whole transfer log, as without an index."""
+        try:
+            with open(self.transfer_log) as fh:
+                return any(
+                    row and row[0] == run_id for row in csv.reader(fh, delimiter="\t")
+                )
+        except FileNotFoundError:
+            return False
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM transfers").fetchone()[0]
+
+    def transferred(self, run_id):
+        """Return the transfer date of a run as logged, or None."""
+        self.sync()
+        row = self.conn.execute(
+            "SELECT transferred FROM transfers WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, run_id, transferred=None):
+        """Append a transferred run to the transfer log and the index.
+
+        :param str run_id: name of the run
+        :param str transferred: transfer date, defaults to now
+        """
+        transferred = transferred or str(datetime.now())
+        with open(f"{self.transfer_log}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.transfer_log, "a") as f:
+                tsv_writer = csv.writer(f, delimiter="\t")
+                tsv_writer.writerow([run_id, transferred])
+        self.sync()
+
+    def export_tsv(self, path):
+        """Write the ledger as a transfer log, in the order the runs were logged.
+
+        :returns: the number of runs written
+        """
+        self.sync()
+        rows = self.conn.execute(
+            "SELECT run_id, transferred FROM transfers ORDER BY rowid"
+        ).fetchall()
+        tmp_file = f"{path}.tmp{os.getpid()}"
+        with open(tmp_file, "w") as f:
+            tsv_writer = csv.writer(f, delimiter="\t")
+            tsv_writer.writerows(rows)
+        os.replace(tmp_file, path)
+        return len(rows)
+
+
+def configured_transfer_logs(config):
+    """Return the paths of the transfer logs of all platforms in the config."""
+    transfer_logs = []
+    if "analysis" in config and "status_dir" in config["analysis"]:
+        transfer_logs.append(
+            os.path.join(config["analysis"]["status_dir"], "transfer.tsv")
+        )
+    for sequencer in config.get("element_analysis", {}).get("Element", {}).values():
+        if "transfer_log" in sequencer:
+            transfer_logs.append(sequencer["transfer_log"])
+    for run_type in config.get("nanopore_analysis", {}).get("run_types", {}).values():
+        for instrument in run_type.get("instruments", {}).values():
+            if "transfer_log" in instrument:
+                transfer_logs.append(instrument["transfer_log"])
+    # Several run types may share a log
+    return list(dict.fromkeys(transfer_logs))
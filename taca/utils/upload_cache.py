@@ -0,0 +1,221 @@
+"""Local cache of the run documents uploaded to statusdb.
+
+Runs in progress are uploaded to statusdb on every invocation of the
+analysis commands, each upload querying a view for the remote document and
+comparing it with the run. The cache records a hash of the last document
+uploaded for each run in a SQLite database on local disk, with the document
+itself, so that:
+
+- a run whose document did not change is not sent at all,
+- a run whose document changed is sent as a patch of the paths that changed
+  since its last upload, applied to the remote document fetched by its id,
+- other runs, and those whose remote document can not be patched, are
+  uploaded as before.
+
+Every upload is counted by what it did, to report the load saved on statusdb.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import couchdb
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    name TEXT PRIMARY KEY,
+    doc_hash TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    doc_id TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+"""
+# Upload events older than this are forgotten
+EVENTS_KEPT = 30 * 24 * 3600
+ACTIONS = ("skipped", "patched", "created", "updated", "unchanged")
+
+
+def normalize(doc):
+    """Return a document as statusdb stores it, i.e. through JSON."""
+    return json.loads(json.dumps(doc, default=str))
+
+
+def doc_hash(doc):
+    """Hash a document independently of the order of its keys."""
+    text = json.dumps(doc, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def diff_docs(old, new, path=()):
+    """Return the changes from a document to another, as ("set", path,
+    value) and ("unset", path) tuples, descending into the dicts they share
+    and taking other values whole."""
+    changes = []
+    for key, value in new.items():
+        if key not in old:
+            changes.append(("set", path + (key,), value))
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changes.extend(diff_docs(old[key], value, path + (key,)))
+        elif value != old[key]:
+            changes.append(("set", path + (key,), value))
+    for key in old:
+        if key not in new:
+            changes.append(("unset", path + (key,)))
+    return changes
+
+
+def apply_patch(doc, changes):
+    """Apply the changes returned by diff_docs to a document."""
+    for change in changes:
+        *parents, key = change[1]
+        target = doc
+        for parent in parents:
+            if not isinstance(target.get(parent), dict):
+                target[parent] = dict()
+            target = target[parent]
+        if change[0] == "set":
+            target[key] = change[2]
+        else:
+            target.pop(key, None)
+    return doc
+
+
+def load_upload_cache(config):
+    """Open the upload cache configured with 'upload_cache_db', if any."""
+    db_path = config.get("upload_cache_db")
+    if not db_path:
+        return None
+    return UploadCache(db_path)
+
+
+class UploadCache:
+    """Documents uploaded to statusdb, persisted in a SQLite database.
+
+    As the run state store, it is shared by concurrent invocations and
+    should live on local disk.
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """
+        :param str db_path: path of the SQLite database, created if missing
+        :param int timeout: seconds to wait for a lock held by another process
+        """
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            self.conn.execute(
+                "DELETE FROM events WHERE time < ?", (time.time() - EVENTS_KEPT,)
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, name):
+        """Return the last upload of a document as a dict, or None."""
+        row = self.conn.execute(
+            "SELECT * FROM uploads WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        upload = dict(row)
+        upload["doc"] = json.loads(upload["doc"])
+        return upload
+
+    def record(self, doc, doc_id, action):
+        """Record the upload of a document, normalized, and what it did."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO uploads VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET doc_hash = excluded.doc_hash, "
+                "doc = excluded.doc, doc_id = excluded.doc_id, "
+                "updated = excluded.updated",
+                (doc["name"], doc_hash(doc), json.dumps(doc), doc_id, now),
+            )
+            self.conn.execute(
+                "INSERT INTO events VALUES (?, ?, ?)", (doc["name"], action, now)
+            )
+
+    def record_skipped(self, name):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO events VALUES (?, 'skipped', ?)", (name, time.time())
+            )
+
+    def forget(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM uploads WHERE name = ?", (name,))
+
+    def counts(self, since=0):
+        """Return the number of uploads since a time, by what they did."""
+        counts = dict.fromkeys(ACTIONS, 0)
+        for row in self.conn.execute(
+            "SELECT action, COUNT(*) AS count FROM events WHERE time >= ? "
+            "GROUP BY action",
+            (since,),
+        ):
+            counts[row["action"]] = row["count"]
+        return counts
+
+    def upload(self, obj, get_db, full_upload):
+        """Upload a document unless it is the one last uploaded.
+
+        :param dict obj: the document, with its 'name'
+        :param get_db: callable returning the statusdb database, only called
+            if the document is sent
+        :param full_upload: callable uploading the document to the database
+            it is given as before, returning what it did and the id of the
+            remote document, as statusdb.update_doc
+        :returns: what the upload did, one of ACTIONS, or None
+        """
+        doc = normalize(obj)
+        last = self.get(doc["name"])
+        if last is not None and last["doc_hash"] == doc_hash(doc):
+            logger.info(f"{doc['name']} unchanged since its last upload, skipping it")
+            self.record_skipped(doc["name"])
+            return "skipped"
+        db = get_db()
+        if last is not None and last["doc_id"]:
+            changes = diff_docs(last["doc"], doc)
+            if self._patch(db, last["doc_id"], changes):
+                logger.info(f"Patched {len(changes)} values of {doc['name']}")
+                self.record(doc, last["doc_id"], "patched")
+                return "patched"
+        action, doc_id = full_upload(db)
+        if action is None:
+            # Not uploaded, try again next time
+            self.forget(doc["name"])
+        else:
+            self.record(doc, doc_id, action)
+        return action
+
+    def _patch(self, db, doc_id, changes):
+        """Apply changes to a remote document, return whether it was saved."""
+        try:
+            remote_doc = db.get(doc_id)
+            if remote_doc is None:
+                return False
+            db.save(apply_patch(remote_doc, changes))
+        except couchdb.http.ResourceConflict:
+            logger.info(f"Document {doc_id} changed in statusdb, uploading it whole")
+            return False
+        return True
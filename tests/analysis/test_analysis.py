@@ -8,6 +8,7 @@ import yaml
 
 from taca.analysis import analysis
 from taca.log import init_logger_file
+from taca.utils import filesystem
 
 
 def make_illumina_test_config(tmp):
@@ -582,3 +583,48 @@ def test_run_preprocessing(create_dirs):
         analysis.run_preprocessing(None, software)
         # Demux in progress, specified run
         analysis.run_preprocessing(run_path, software)
+
+
+def test_run_preprocessing_workers(create_dirs):
+    """Runs processed in parallel should fail independently, log to files of
+    their own, and be skipped while another invocation holds their lock.
+    """
+    tmp = create_dirs
+    test_config_yaml = make_illumina_test_config(tmp)
+    patch("taca.utils.config.CONFIG", new=test_config_yaml).start()
+    importlib.reload(analysis)
+
+    # Folders without run parameters can not be processed
+    run_dirs = []
+    for i in range(1, 4):
+        run_dir = os.path.join(
+            tmp.name,
+            "ngi_data",
+            "sequencing",
+            "NovaSeqXPlus",
+            f"20240101_LH00217_000{i}_A22ABCDLT3",
+        )
+        os.mkdir(run_dir)
+        run_dirs.append(run_dir)
+    # The workers process their run only, the global steps are left to the
+    # parent
+    with patch.object(
+        analysis,
+        "run_preprocessing",
+        side_effect=AssertionError("run_preprocessing called in a worker"),
+    ):
+        failed = analysis._process_in_pool(run_dirs, "bcl2fastq", 2)
+    assert sorted(failed) == [os.path.basename(run_dir) for run_dir in run_dirs]
+    for run_dir in run_dirs:
+        with open(
+            os.path.join(tmp.name, "log", "runs", f"{os.path.basename(run_dir)}.log")
+        ) as f:
+            assert "Unrecognized instrument type" in f.read()
+
+    with filesystem.try_lock(analysis._run_lock_file(run_dirs[0])) as locked:
+        assert locked
+        with patch("taca.analysis.analysis.get_runObj") as mock_get_runObj:
+            analysis.run_preprocessing(run_dirs[0], "bcl2fastq")
+            mock_get_runObj.assert_not_called()
+
+    patch.stopall()
@@ -119,6 +119,36 @@ def test_process_on_failed_run(aviti_fixture):
     to_test.run_preprocessing(run_dir)
 
 
+def test_process_on_failed_demux_mails_once(aviti_fixture):
+    """Should report a failed demultiplexing on the first run only."""
+    to_test, tmp, caplog, mocks = aviti_fixture
+
+    run_dir = create_element_run_dir(
+        tmp=tmp,
+        lims_manifest=True,
+        metadata_files=True,
+        run_finished=True,
+        outcome_completed=True,
+        demux_dir=True,
+        demux_done=False,
+        rsync_ongoing=False,
+        rsync_exit_status=None,
+        nosync=False,
+    )
+
+    with patch(
+        "taca.element.Aviti_Runs.Aviti_Run.get_demultiplexing_status",
+        return_value="failed",
+    ):
+        to_test.run_preprocessing(run_dir)
+        to_test.run_preprocessing(run_dir)
+
+        mocks["mock_mail"].assert_called_once()
+        run = to_test.Aviti_Run(run_dir, to_test.CONFIG)
+        assert run.get_lifecycle_state() == ("demultiplexing failed", True)
+    assert "already reported" in caplog.text
+
+
 def test_process_on_finished_run_wo_lims_manifest(aviti_fixture):
     """Should fail to find LIMS run manifest and send mail."""
     to_test, tmp, caplog, mocks = aviti_fixture
@@ -155,3 +155,48 @@ def test_ont_transfer(create_dirs, run_properties, caplog):
 
     # Stop mocks
     patch.stopall()
+
+
+def test_ont_transfer_skips_settled_runs(create_dirs):
+    """A transferred QC run should be recorded as settled and skipped
+    without being read again, until its run dir changes.
+    """
+    tmp = create_dirs
+    test_config_yaml = make_ONT_test_config(tmp)
+    test_config_yaml["run_state_db"] = f"{tmp.name}/log/run_state.db"
+    patch("taca.utils.config.CONFIG", new=test_config_yaml).start()
+    patch("taca.nanopore.ONT_run_classes.CONFIG", new=test_config_yaml).start()
+    patch("taca.nanopore.ONT_run_classes.NanoporeRunsConnection").start()
+    importlib.reload(analysis_nanopore)
+
+    run_path = create_ONT_run_dir(
+        tmp, qc=True, script_files=True, run_finished=True, sync_finished=True
+    )
+    with open(f"{tmp.name}/log/transfer_minion_qc.tsv", "w") as f:
+        f.write(f"{os.path.basename(run_path)}\t2024-01-01 00:00:00\n")
+
+    mock_process = patch(
+        "taca.analysis.analysis_nanopore.process_qc_run",
+        side_effect=analysis_nanopore.WaitForRun(
+            "Run is already logged as transferred."
+        ),
+    ).start()
+    analysis_nanopore.ont_transfer(run_abspath=None)
+    assert mock_process.call_count == 1
+
+    analysis_nanopore.ont_transfer(run_abspath=None)
+    assert mock_process.call_count == 1
+
+    # Reconciling keeps the run settled
+    analysis_nanopore.reconcile_run_state()
+    analysis_nanopore.ont_transfer(run_abspath=None)
+    assert mock_process.call_count == 1
+
+    # The run is checked again once a marker file is added
+    stat = os.stat(run_path)
+    open(f"{run_path}/.anglerfish_ongoing", "w").close()
+    os.utime(run_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    analysis_nanopore.ont_transfer(run_abspath=None)
+    assert mock_process.call_count == 2
+
+    patch.stopall()
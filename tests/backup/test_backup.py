@@ -0,0 +1,776 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tarfile
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import pytest
+
+from taca.backup.compression import CompressionSettings
+from taca.backup.pdc import PdcCatalogue
+
+RUN_NAME = "20240101_LH00217_0001_A22ABCDLT3"
+
+
+def get_config(tmp: TemporaryDirectory) -> dict:
+    config = {
+        "mail": {"recipients": "mock"},
+        "backup": {
+            "data_dirs": {
+                "NovaSeqXPlus": f"{tmp.name}/ngi_data/sequencing/NovaSeqXPlus"
+            },
+            "archive_dirs": {
+                "NovaSeqXPlus": f"{tmp.name}/ngi_data/sequencing/NovaSeqXPlus/nosync"
+            },
+            "archived_dirs": {
+                "NovaSeqXPlus": f"{tmp.name}/ngi_data/sequencing/NovaSeqXPlus/archived"
+            },
+            "exclude_list": ["*.bcl.gz"],
+            "keys_path": f"{tmp.name}/run_keys",
+            "gpg_receiver": "test@taca",
+            "archive_log": f"{tmp.name}/log/archived.tsv",
+            "segment_size": 16 * 1024,
+        },
+    }
+    return config
+
+
+FAKE_DSMC = """#!{python}
+# Fake dsmc client keeping the archive as a list of paths in a text file
+# and copies of the archived files under "{pdc_file}.d"
+import os
+import shutil
+import sys
+
+pdc_file = "{pdc_file}"
+store = pdc_file + ".d"
+with open("{calls_file}", "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+archived = open(pdc_file).read().split() if os.path.exists(pdc_file) else []
+if sys.argv[1] == "archive":
+    failures = int(os.environ.get("FAKE_DSMC_ARCHIVE_FAILURES", 0))
+    attempts = [c for c in open("{calls_file}") if c.startswith("archive ")]
+    if len(attempts) <= failures:
+        print("ANS1017E Session rejected: TCP/IP connection failure")
+        sys.exit(12)
+    src = os.path.abspath(sys.argv[2])
+    os.makedirs(os.path.dirname(store + src), exist_ok=True)
+    shutil.copyfile(src, store + src)
+    with open(pdc_file, "a") as f:
+        f.write(src + "\\n")
+elif sys.argv[1] == "retrieve":
+    src, dst = [arg for arg in sys.argv[2:] if not arg.startswith("-")]
+    if src not in archived:
+        print("ANS1092W No files matching search criteria were found")
+        sys.exit(8)
+    shutil.copyfile(store + src, dst)
+elif sys.argv[1:3] == ["query", "archive"]:
+    pattern = sys.argv[3]
+    if pattern.endswith("/*"):
+        if os.environ.get("FAKE_DSMC_NO_WILDCARD"):
+            print("ANS1017E Session rejected: TCP/IP connection failure")
+            sys.exit(12)
+        hits = [a for a in archived if os.path.dirname(a) == pattern[:-2]]
+    else:
+        hits = [a for a in archived if a == pattern]
+    if not hits:
+        print("ANS1092W No files matching search criteria were found")
+        sys.exit(8)
+    print("             Size  Archive Date - Time    File - Expires on - Description")
+    print("             ----  -------------------    -------------------------------")
+    for hit in hits:
+        print(f"      1,024  B  08/20/2024 10:12:31    {{hit}} 08/20/2034 Archive Date: 08/20/2024")
+"""
+
+
+def install_fake_dsmc(tmp: TemporaryDirectory, monkeypatch) -> dict:
+    """Put a fake dsmc on PATH and return the paths of its archive and call log."""
+    bin_dir = os.path.join(tmp.name, "bin")
+    os.mkdir(bin_dir)
+    files = {
+        "pdc_file": os.path.join(tmp.name, "pdc_archive.txt"),
+        "calls_file": os.path.join(tmp.name, "dsmc_calls.txt"),
+    }
+    dsmc = os.path.join(bin_dir, "dsmc")
+    with open(dsmc, "w") as f:
+        f.write(FAKE_DSMC.format(python=sys.executable, **files))
+    os.chmod(dsmc, 0o755)
+    monkeypatch.setenv("PATH", bin_dir, prepend=os.pathsep)
+    return files
+
+
+def dsmc_calls(fake_dsmc: dict) -> list:
+    if not os.path.exists(fake_dsmc["calls_file"]):
+        return []
+    return open(fake_dsmc["calls_file"]).read().splitlines()
+
+
+def create_run_dir(tmp: TemporaryDirectory, run_name: str = RUN_NAME) -> str:
+    """Create a finished run folder in the NovaSeqXPlus archive dir.
+
+    ..
+    └── nosync
+        └── {run_name}
+            ├── RTAComplete.txt
+            ├── CopyComplete.txt
+            ├── RunInfo.xml
+            └── Data/Intensities/BaseCalls/L001
+                ├── s_1_1101.filter
+                ├── s_1_1101.bcl.gz
+                └── C1.1/L001_1.cbcl
+
+    Return it's path.
+    """
+    run_path = os.path.join(
+        tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "nosync", run_name
+    )
+    lane_dir = os.path.join(run_path, "Data", "Intensities", "BaseCalls", "L001")
+    os.makedirs(os.path.join(lane_dir, "C1.1"))
+    for indicator in ["RTAComplete.txt", "CopyComplete.txt"]:
+        open(os.path.join(run_path, indicator), "w").close()
+    with open(os.path.join(run_path, "RunInfo.xml"), "w") as f:
+        f.write("<RunInfo />\n")
+    with open(os.path.join(lane_dir, "s_1_1101.filter"), "wb") as f:
+        f.write(os.urandom(1024))
+    with open(os.path.join(lane_dir, "s_1_1101.bcl.gz"), "wb") as f:
+        f.write(os.urandom(1024))
+    with open(os.path.join(lane_dir, "C1.1", "L001_1.cbcl"), "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    return run_path
+
+
+@pytest.fixture()
+def backup_fixture(create_dirs, monkeypatch):
+    tmp: TemporaryDirectory = create_dirs
+
+    # Isolated gpg home with a key for the configured receiver
+    gnupg_home = os.path.join(tmp.name, "gnupg")
+    os.mkdir(gnupg_home, mode=0o700)
+    monkeypatch.setenv("GNUPGHOME", gnupg_home)
+    subprocess.run(
+        [
+            "gpg",
+            "--batch",
+            "--passphrase",
+            "",
+            "--quick-gen-key",
+            "test@taca",
+            "default",
+            "default",
+            "never",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.makedirs(f"{tmp.name}/run_keys")
+    os.makedirs(f"{tmp.name}/ngi_data/sequencing/NovaSeqXPlus/archived")
+    fake_dsmc = install_fake_dsmc(tmp, monkeypatch)
+
+    mocks = {
+        "mock_config": patch("taca.utils.config.CONFIG", new=get_config(tmp)).start(),
+        "mock_mail": patch("taca.utils.misc.send_mail").start(),
+        "mock_sleep": patch("taca.backup.backup.time.sleep").start(),
+        # The same passphrase for every run, so that runs encrypt alike
+        "mock_key": patch(
+            "taca.backup.backup.KEY_COMMAND", "echo taca-test-passphrase"
+        ).start(),
+    }
+
+    from taca.backup import backup as to_test
+
+    yield to_test, tmp, mocks, fake_dsmc
+
+    patch.stopall()
+    del sys.modules["taca.backup.backup"]
+
+
+def test_key_command():
+    """Passphrases should be a single line of text, as gpg reads them."""
+    from taca.backup.backup import KEY_COMMAND
+
+    # The tests import the module with their own config
+    del sys.modules["taca.backup.backup"]
+    for _ in range(20):
+        key = subprocess.run(
+            KEY_COMMAND.split(), check=True, capture_output=True
+        ).stdout
+        assert key.endswith(b"\n")
+        assert key.count(b"\n") == 1
+        assert len(key.strip()) >= 256
+        assert key.strip().decode("ascii").isprintable()
+
+
+def decrypt_and_untar(run_vars, key_file, dest):
+    """Decrypt an encrypted run tarball and return the md5 of the tar stream."""
+    decrypted = subprocess.run(
+        [
+            "gpg",
+            "--decrypt",
+            "--batch",
+            "--passphrase-file",
+            key_file,
+            run_vars.tar_encrypted,
+        ],
+        check=True,
+        capture_output=True,
+    ).stdout
+    tar_path = os.path.join(dest, "decrypted.tar")
+    with open(tar_path, "wb") as f:
+        f.write(decrypted)
+    with tarfile.open(tar_path) as tar:
+        tar.extractall(dest, filter="tar")
+    return hashlib.md5(decrypted).hexdigest()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_encrypt_runs(backup_fixture, stream):
+    """Both modes should leave only the encrypted run, a digest sidecar and the key."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+
+    to_test.backup_utils.encrypt_runs(run_path, force=False, stream=stream)
+
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    assert os.path.exists(run.tar_encrypted)
+    assert os.path.exists(run.tar_digest)
+    assert os.path.exists(os.path.join(tmp.name, "run_keys", run.key_encrypted))
+    for leftover in [run.tar, run.key, f"{run.name}.encrypting"]:
+        assert not os.path.exists(os.path.join(os.path.dirname(run_path), leftover))
+
+    # The recorded digest should match the decrypted tarball
+    key_file = os.path.join(tmp.name, "run.key")
+    subprocess.run(
+        [
+            "gpg",
+            "--decrypt",
+            "--batch",
+            "-o",
+            key_file,
+            os.path.join(tmp.name, "run_keys", run.key_encrypted),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+    digest = decrypt_and_untar(run, key_file, restore_dir)
+    with open(run.tar_digest) as f:
+        assert f.read() == f"{digest}  {run.name}.tar\n"
+
+    # Excluded files are not archived
+    restored_lane = os.path.join(
+        restore_dir, run.name, "Data", "Intensities", "BaseCalls", "L001"
+    )
+    assert os.path.exists(os.path.join(restored_lane, "C1.1", "L001_1.cbcl"))
+    assert not os.path.exists(os.path.join(restored_lane, "s_1_1101.bcl.gz"))
+    assert os.path.exists(os.path.join(restore_dir, run.name, "RunInfo.xml"))
+
+
+def test_stream_encrypt_failed_tar(backup_fixture):
+    """A failing tar should remove the partial files and not record a digest."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    bk = to_test.backup_utils(run_path)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    run.name = "missing_run_folder"
+
+    with to_test.filesystem.chdir(run.path):
+        open(run.key, "w").write("secret")
+        digest = bk._stream_encrypt(run, tmp_files=[run.tar_encrypted, run.key])
+
+    assert digest is None
+    assert not os.path.exists(run.tar_encrypted)
+    assert not os.path.exists(run.tar_digest)
+    mocks["mock_mail"].assert_called_once()
+
+
+def test_pdc_catalogue_lists_directory_once(backup_fixture):
+    """Lookups in one directory should cost a single persisted dsmc query."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    archive_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus")
+    archived = [os.path.join(archive_dir, f"run{i}.tar.gpg") for i in range(3)]
+    with open(fake_dsmc["pdc_file"], "w") as f:
+        f.write("\n".join(archived) + "\n")
+    catalogue_file = os.path.join(tmp.name, "log", "pdc_catalogue.json")
+
+    catalogue = PdcCatalogue(catalogue_file)
+    for path in archived:
+        assert catalogue.contains(path)
+    assert not catalogue.contains(os.path.join(archive_dir, "run3.tar.gpg"))
+    assert dsmc_calls(fake_dsmc) == [f"query archive {archive_dir}/*"]
+
+    # A new invocation reuses the persisted listing
+    assert PdcCatalogue(catalogue_file).contains(archived[0])
+    assert len(dsmc_calls(fake_dsmc)) == 1
+
+    # Unless it has expired
+    assert PdcCatalogue(catalogue_file, ttl=0).contains(archived[0])
+    assert len(dsmc_calls(fake_dsmc)) == 2
+
+
+def test_pdc_catalogue_refresh_drops_deleted_files(backup_fixture):
+    """Files no longer in PDC should be dropped by a refresh, while files
+    archived by other invocations are kept."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    archive_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus")
+    archived = [os.path.join(archive_dir, f"run{i}.tar.gpg") for i in range(3)]
+    with open(fake_dsmc["pdc_file"], "w") as f:
+        f.write("\n".join(archived) + "\n")
+    catalogue_file = os.path.join(tmp.name, "log", "pdc_catalogue.json")
+    catalogue = PdcCatalogue(catalogue_file)
+    assert catalogue.contains(archived[0])
+
+    # Archived by another invocation
+    other = PdcCatalogue(catalogue_file)
+    other.add(os.path.join(archive_dir, "run3.tar.gpg"))
+    assert PdcCatalogue(catalogue_file).contains(
+        os.path.join(archive_dir, "run3.tar.gpg")
+    )
+
+    # Expired from PDC
+    with open(fake_dsmc["pdc_file"], "w") as f:
+        f.write("\n".join(archived[1:]) + "\n")
+    assert catalogue.refresh(archive_dir)
+    assert not catalogue.contains(archived[0])
+    assert catalogue.contains(archived[1])
+    reread = PdcCatalogue(catalogue_file)
+    assert not reread.contains(archived[0])
+    assert not reread.contains(os.path.join(archive_dir, "run3.tar.gpg"))
+    assert len(dsmc_calls(fake_dsmc)) == 2
+
+    # A listing older than the one on disk does not replace it
+    other.dirs[archive_dir]["fetched"] = 0
+    other.save(refreshed=[archive_dir])
+    assert not PdcCatalogue(catalogue_file).contains(archived[0])
+
+
+def test_pdc_catalogue_falls_back_to_file_query(backup_fixture, monkeypatch):
+    """If the directory can not be listed, the single file should be queried."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    monkeypatch.setenv("FAKE_DSMC_NO_WILDCARD", "1")
+    archived = os.path.join(tmp.name, "run.tar.gpg")
+    with open(fake_dsmc["pdc_file"], "w") as f:
+        f.write(archived + "\n")
+
+    catalogue = PdcCatalogue(os.path.join(tmp.name, "log", "pdc.json"))
+    assert catalogue.contains(archived)
+    assert not catalogue.contains(os.path.join(tmp.name, "other.tar.gpg"))
+    assert dsmc_calls(fake_dsmc) == [
+        f"query archive {tmp.name}/*",
+        f"query archive {archived}",
+        f"query archive {tmp.name}/*",
+        f"query archive {tmp.name}/other.tar.gpg",
+    ]
+
+
+def test_pdc_put(backup_fixture):
+    """Archiving should update the catalogue and move the run to archived."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    to_test.backup_utils.encrypt_runs(run_path, force=True, stream=True)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    key_encrypted = os.path.join(tmp.name, "run_keys", run.key_encrypted)
+
+    to_test.backup_utils.pdc_put(run_path)
+
+    archived = open(fake_dsmc["pdc_file"]).read().split()
+    assert archived == [run.tar_encrypted, key_encrypted, run.tar_digest]
+    for path in archived:
+        assert not os.path.exists(path)
+    assert os.path.isdir(
+        os.path.join(
+            tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "archived", run.name
+        )
+    )
+    bk = to_test.backup_utils()
+    assert bk.file_in_pdc(run.tar_encrypted)
+    # Apart from listing the archive dirs, dsmc is only queried to confirm the archiving
+    file_queries = [
+        call.split()[-1]
+        for call in dsmc_calls(fake_dsmc)
+        if call.startswith("query archive") and not call.endswith("/*")
+    ]
+    assert file_queries == [run.tar_encrypted, key_encrypted]
+
+
+def test_pdc_put_parallel(backup_fixture, monkeypatch, caplog):
+    """Several runs should be archived concurrently, retrying failed sessions."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    monkeypatch.setenv("FAKE_DSMC_ARCHIVE_FAILURES", "2")
+    run_names = [f"20240101_LH00217_000{i}_A22ABCDLT{i}" for i in range(1, 5)]
+    for run_name in run_names:
+        run_path = create_run_dir(tmp, run_name)
+        to_test.backup_utils.encrypt_runs(run_path, force=True, stream=True)
+    # A run that is being archived by another invocation is left alone
+    archive_dir = os.path.dirname(run_path)
+    open(os.path.join(archive_dir, f"{run_names[-1]}.archiving"), "w").close()
+
+    to_test.backup_utils.pdc_put(None, workers=3)
+
+    archived = open(fake_dsmc["pdc_file"]).read().split()
+    for run_name in run_names[:-1]:
+        assert os.path.join(archive_dir, f"{run_name}.tar.gpg") in archived
+        assert not os.path.exists(os.path.join(archive_dir, f"{run_name}.archiving"))
+    assert os.path.join(archive_dir, f"{run_names[-1]}.tar.gpg") not in archived
+    assert os.path.exists(os.path.join(archive_dir, f"{run_names[-1]}.tar.gpg"))
+    # Both failed sessions were retried with backoff
+    assert mocks["mock_sleep"].call_count == 2
+    assert "Archived 3 of 4 run(s)" in caplog.text
+    assert caplog.text.count("MB/s") == 3
+
+
+def test_encrypt_runs_parallel(backup_fixture):
+    """Runs should be encrypted concurrently and their reservations released."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_names = [f"20240101_LH00217_000{i}_A22ABCDLT{i}" for i in range(1, 4)]
+    run_paths = [create_run_dir(tmp, run_name) for run_name in run_names]
+
+    to_test.backup_utils.encrypt_runs(None, force=False, stream=True, workers=3)
+
+    for run_path in run_paths:
+        assert os.path.exists(f"{run_path}.tar.gpg")
+        assert os.path.exists(f"{run_path}.tar.md5")
+    with open(os.path.join(tmp.name, "log", "encryption_reservations.json")) as f:
+        assert f.read() == "{}"
+    mocks["mock_mail"].assert_not_called()
+
+
+def test_encrypt_runs_waits_for_space(backup_fixture):
+    """With room for one run at a time, runs should be encrypted one by one."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_names = [f"20240101_LH00217_000{i}_A22ABCDLT{i}" for i in range(1, 4)]
+    run_paths = [create_run_dir(tmp, run_name) for run_name in run_names]
+    run_size = to_test.filesystem.dir_size(run_paths[0])
+    reserved = []
+
+    def reserve(self, job, path, size, files, headroom=0):
+        # Room for a single run, so a reservation only succeeds when no other
+        # run is ongoing
+        ongoing = [job for job in reserved if job not in released]
+        if ongoing:
+            return False, run_size
+        reserved.append(job)
+        return True, 2 * run_size
+
+    released = []
+    with (
+        patch.object(to_test.DiskReservationLedger, "reserve", reserve),
+        patch.object(
+            to_test.DiskReservationLedger,
+            "release",
+            lambda self, job: released.append(job),
+        ),
+        patch.object(
+            to_test.filesystem, "dir_size", wraps=to_test.filesystem.dir_size
+        ) as dir_size,
+    ):
+        to_test.backup_utils.encrypt_runs(None, force=False, stream=True, workers=3)
+
+    assert sorted(reserved) == sorted(released) == sorted(run_names)
+    # Runs are measured once however often their reservation is attempted
+    assert sorted(call.args[0] for call in dir_size.call_args_list) == run_paths
+    for run_path in run_paths:
+        assert os.path.exists(f"{run_path}.tar.gpg")
+    mocks["mock_mail"].assert_not_called()
+
+
+def test_encrypt_runs_no_space(backup_fixture):
+    """If a run does not fit on the disk, it should be reported and not encrypted."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+
+    with patch.object(to_test.DiskReservationLedger, "free_space", return_value=1024):
+        to_test.backup_utils.encrypt_runs(run_path, force=False, stream=True)
+
+    assert not os.path.exists(f"{run_path}.tar.gpg")
+    mocks["mock_mail"].assert_called_once()
+
+
+def test_reservation_ledger(create_dirs):
+    """Outstanding space should shrink as the reserved files are written."""
+    tmp = create_dirs
+    from taca.backup.reservations import DiskReservationLedger
+
+    ledger = DiskReservationLedger(os.path.join(tmp.name, "log", "ledger.json"))
+    out_file = os.path.join(tmp.name, "run.tar.gpg")
+    free = DiskReservationLedger.free_space(tmp.name)
+
+    assert ledger.reserve("run", tmp.name, free // 2, [out_file])[0]
+    # The same space can not be reserved twice
+    assert not ledger.reserve("other_run", tmp.name, free - free // 4, [])[0]
+    with open(out_file, "wb") as f:
+        f.write(os.urandom(1024))
+    with ledger._entries() as entries:
+        assert ledger.outstanding(tmp.name, entries) == free // 2 - 1024
+    ledger.release("run")
+    with ledger._entries() as entries:
+        assert entries == {}
+
+
+def test_extract_member_from_indexed_archive(backup_fixture):
+    """Single files should be restored by decrypting only their segments."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    to_test.backup_utils.encrypt_runs(run_path, force=False, indexed=True)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    assert os.path.exists(run.tar_segmented)
+    index = to_test.indexed_archive.load_index(run.tar_index)
+    # 64 KiB of cbcl in 16 KiB segments
+    assert len(index["segments"]) > 4
+    with open(run.tar_digest) as f:
+        assert f.read().split()[0] == index["md5"]
+
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+    decrypt_segment = to_test.indexed_archive.decrypt_segment
+    with patch(
+        "taca.backup.indexed_archive.decrypt_segment", wraps=decrypt_segment
+    ) as mock_decrypt:
+        for member, max_segments in [
+            ("RunInfo.xml", 1),
+            ("Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl", 6),
+        ]:
+            mock_decrypt.reset_mock()
+            to_test.backup_utils.extract_member(
+                run.tar_segmented, member, outdir=restore_dir
+            )
+            assert 0 < mock_decrypt.call_count <= max_segments
+            with (
+                open(os.path.join(run_path, member), "rb") as original,
+                open(os.path.join(restore_dir, run.name, member), "rb") as restored,
+            ):
+                assert original.read() == restored.read()
+
+    # Excluded files are not in the archive
+    with pytest.raises(SystemExit):
+        to_test.backup_utils.extract_member(
+            run.tar_segmented,
+            "Data/Intensities/BaseCalls/L001/s_1_1101.bcl.gz",
+            outdir=restore_dir,
+        )
+
+
+def test_indexed_archive_is_not_a_gpg_file(backup_fixture):
+    """Indexed archives are not single gpg messages, so they should not be
+    named as those that a plain 'gpg --decrypt' restores."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    to_test.backup_utils.encrypt_runs(run_path, force=False, indexed=True)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    assert run.tar_segmented.endswith(".tar.gpgseg")
+    assert not os.path.exists(run.tar_encrypted)
+    assert run.encrypted_file() == run.tar_segmented
+    index = to_test.indexed_archive.load_index(run.tar_index)
+    assert index["format"] == "gpg-segments"
+
+    # Decrypted as a whole, the segments are several plain texts
+    key_file = os.path.join(tmp.name, "run.key")
+    subprocess.run(
+        [
+            "gpg",
+            "--batch",
+            "--output",
+            key_file,
+            "--decrypt",
+            os.path.join(tmp.name, "run_keys", f"{run.name}.key.gpg"),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    plain = subprocess.run(
+        ["gpg", "--decrypt", "--batch", "--passphrase-file", key_file]
+        + [run.tar_segmented],
+        capture_output=True,
+    )
+    assert plain.returncode != 0
+
+    # Indexes not naming the segment format are refused
+    del index["format"]
+    with open(run.tar_index, "w") as f:
+        json.dump(index, f)
+    with pytest.raises(to_test.indexed_archive.IndexedArchiveError) as e:
+        to_test.indexed_archive.load_index(run.tar_index)
+    assert "not gpg-segments" in str(e.value)
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_restore_runs(backup_fixture, indexed):
+    """Archived runs should be restored in parallel and verified, leaving only the run folders."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_names = [RUN_NAME, RUN_NAME.replace("_0001_", "_0002_")]
+    for run_name in run_names:
+        run_path = create_run_dir(tmp, run_name)
+        to_test.backup_utils.encrypt_runs(
+            run_path, force=False, stream=True, indexed=indexed
+        )
+        to_test.backup_utils.pdc_put(run_path)
+    archived_dir = os.path.join(
+        tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "archived"
+    )
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+
+    to_test.backup_utils.restore_runs(run_names, restore_dir, workers=2)
+
+    assert sorted(os.listdir(restore_dir)) == sorted(run_names)
+    for run_name in run_names:
+        for member in [
+            "RunInfo.xml",
+            "Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl",
+        ]:
+            with (
+                open(os.path.join(archived_dir, run_name, member), "rb") as original,
+                open(os.path.join(restore_dir, run_name, member), "rb") as restored,
+            ):
+                assert original.read() == restored.read()
+    retrieved = [
+        call.split()[-2]
+        for call in dsmc_calls(fake_dsmc)
+        if call.startswith("retrieve")
+    ]
+    assert len(retrieved) == (8 if indexed else 6)
+    # The standard restore retrieves the segmented archive of indexed runs
+    assert any(
+        path.endswith(".tar.gpgseg" if indexed else ".tar.gpg") for path in retrieved
+    )
+
+
+def test_restore_run_digest_mismatch(backup_fixture):
+    """A restored run not matching the recorded digest should be removed."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    to_test.backup_utils.encrypt_runs(run_path, force=False, stream=True)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    to_test.backup_utils.pdc_put(run_path)
+    with open(fake_dsmc["pdc_file"] + ".d" + run.tar_digest, "w") as f:
+        f.write(f"{'0' * 32}  {run.name}.tar\n")
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+
+    bk = to_test.backup_utils()
+    result = bk._restore_run(run.name, restore_dir)
+
+    assert result["status"] == "failed"
+    assert os.listdir(restore_dir) == []
+
+
+def test_compress_and_restore_run(backup_fixture):
+    """Compressible runs should be compressed, logged with their ratio and restored."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    os.makedirs(os.path.join(run_path, "InterOp"))
+    with open(os.path.join(run_path, "InterOp", "TileMetricsOut.bin"), "wb") as f:
+        f.write(b"\x02\x0a" * 128 * 1024)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+
+    to_test.backup_utils.encrypt_runs(run_path, force=False, compress=True)
+
+    with open(run.tar_compression) as f:
+        compression = json.load(f)
+    assert compression["codec"] == "zstd"
+    assert compression["ratio"] > 2
+    assert compression["raw_bytes"] > os.path.getsize(run.tar_encrypted)
+    with open(run.tar_digest) as f:
+        assert f.read().split()[1] == f"{run.name}.tar.zst"
+
+    to_test.backup_utils.pdc_put(run_path)
+    with open(os.path.join(tmp.name, "log", "archived.tsv")) as f:
+        assert f.read().split("\t")[2].strip() == f"{compression['ratio']:.2f}"
+
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+    to_test.backup_utils.restore_runs([run.name], restore_dir)
+    archived_dir = os.path.join(
+        tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "archived"
+    )
+    for member in ["InterOp/TileMetricsOut.bin", "RunInfo.xml"]:
+        with (
+            open(os.path.join(archived_dir, run.name, member), "rb") as original,
+            open(os.path.join(restore_dir, run.name, member), "rb") as restored,
+        ):
+            assert original.read() == restored.read()
+
+
+def test_compress_with_missing_codec(backup_fixture):
+    """A run whose codec can not be started should be left to encrypt again."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    os.makedirs(os.path.join(run_path, "InterOp"))
+    with open(os.path.join(run_path, "InterOp", "TileMetricsOut.bin"), "wb") as f:
+        f.write(b"\x02\x0a" * 128 * 1024)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+
+    with patch.dict(
+        to_test.compression.CODECS["zstd"], {"compress": "taca-missing-zstd"}
+    ):
+        to_test.backup_utils.encrypt_runs(run_path, force=False, compress=True)
+
+    assert os.listdir(os.path.dirname(run_path)) == [run.name]
+    to_test.backup_utils.encrypt_runs(run_path, force=False, compress=True)
+    assert os.path.exists(run.tar_compression)
+
+
+def test_compress_skips_compressed_runs(backup_fixture):
+    """Runs made up of already compressed files should be encrypted as is."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    run_path = create_run_dir(tmp)
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+
+    to_test.backup_utils.encrypt_runs(run_path, force=False, compress=True)
+
+    assert os.path.exists(run.tar_encrypted)
+    assert not os.path.exists(run.tar_compression)
+    with open(run.tar_digest) as f:
+        assert f.read().split()[1] == f"{run.name}.tar"
+
+    # Logged as before, without a compression ratio
+    to_test.backup_utils.pdc_put(run_path)
+    with open(os.path.join(tmp.name, "log", "archived.tsv")) as f:
+        assert len(f.read().split("\t")) == 2
+
+
+def test_compressible_fraction():
+    settings = CompressionSettings({"min_compressible_fraction": 0.5})
+    files = [("L001_1.cbcl", 600), ("s_1_1101.filter", 300), ("RunInfo.XML", 100)]
+    assert settings.compressible_fraction(files) == 0.4
+    assert settings.compressible_fraction([]) == 0
+    with pytest.raises(ValueError):
+        CompressionSettings({"codec": "lzma"})
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_encrypt_runs_read_ahead_tar(backup_fixture, stream):
+    """Runs should be tarred with the read-ahead writer when 'tar_workers' is set."""
+    to_test, tmp, mocks, fake_dsmc = backup_fixture
+    mocks["mock_config"]["backup"]["tar_workers"] = 2
+    run_path = create_run_dir(tmp)
+
+    to_test.backup_utils.encrypt_runs(run_path, force=False, stream=stream)
+
+    run = to_test.run_vars(run_path, os.path.dirname(run_path))
+    key_file = os.path.join(tmp.name, "run.key")
+    subprocess.run(
+        [
+            "gpg",
+            "--decrypt",
+            "--batch",
+            "-o",
+            key_file,
+            os.path.join(tmp.name, "run_keys", run.key_encrypted),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    restore_dir = os.path.join(tmp.name, "restore")
+    os.mkdir(restore_dir)
+    digest = decrypt_and_untar(run, key_file, restore_dir)
+    with open(run.tar_digest) as f:
+        assert f.read().split()[0] == digest
+    restored_lane = os.path.join(
+        restore_dir, run.name, "Data", "Intensities", "BaseCalls", "L001"
+    )
+    assert os.path.exists(os.path.join(restored_lane, "C1.1", "L001_1.cbcl"))
+    assert not os.path.exists(os.path.join(restored_lane, "s_1_1101.bcl.gz"))
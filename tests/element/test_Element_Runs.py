@@ -564,6 +564,34 @@ class TestRun:
             mock_command.assert_called_once_with("mock_run_manifest", "mock_demux_dir")
             mock_Popen.assert_called_once()
 
+    def test_start_demux_queued(self, mock_db, create_dirs):
+        tmp: tempfile.TemporaryDirectory = create_dirs
+        run = to_test.Run(create_element_run_dir(create_dirs), get_config(tmp))
+        run_manifest = os.path.join(run.run_dir, "AVITI_run_manifest_0.csv")
+        with open(run_manifest, "w") as f:
+            f.write(
+                "[RUNVALUES]\nKeyName, Value\n\n[SAMPLES]\n"
+                "SampleName,Index1,Index2,Lane,Project\nS1,ACGT,,1,P12345\n"
+            )
+        run.demux_queue = mock.Mock()
+        run.demux_queue.priority.return_value = 1
+        demux_dir = os.path.join(run.run_dir, "Demultiplexing_0")
+        with mock.patch("subprocess.Popen") as mock_Popen:
+            run.start_demux(run_manifest, demux_dir)
+            mock_Popen.assert_not_called()
+        run.demux_queue.priority.assert_called_once_with({"P12345"})
+        args, kwargs = run.demux_queue.submit.call_args
+        assert args[:2] == (os.path.basename(run.run_dir), "Demultiplexing_0")
+        assert " -p 8 " in args[2]
+        assert kwargs["cpus"] == 8
+        assert kwargs["priority"] == 1
+        run.demux_queue.schedule.assert_called_once()
+
+        # The state of the queued jobs is the demultiplexing status
+        os.mkdir(run.demux_dir)
+        run.demux_queue.run_state.return_value = "failed"
+        assert run.get_demultiplexing_status() == "failed"
+
     @pytest.mark.parametrize(
         "p",
         [
@@ -668,3 +696,86 @@ class TestRun:
 
         run.parse_run_parameters()
         assert run.in_transfer_log() is p["expected"]
+
+    def test_aggregate_demux_links(self, mock_db, create_dirs):
+        tmp: tempfile.TemporaryDirectory = create_dirs
+        run = to_test.Run(create_element_run_dir(tmp, demux_dir=True), get_config(tmp))
+        # Lane 1 is demultiplexed twice, lane 2 once
+        for sub_demux, lane, sample in [
+            ("0", "1", "S1"),
+            ("1", "1", "S2"),
+            ("0", "2", "S3"),
+        ]:
+            for project, name in [("P12345", sample), ("Undetermined", None)]:
+                sample_dir = os.path.join(
+                    run.run_dir, f"Demultiplexing_{sub_demux}", "Samples", project
+                )
+                if name:
+                    sample_dir = os.path.join(sample_dir, name)
+                os.makedirs(sample_dir, exist_ok=True)
+                for read in ["R1", "R2"]:
+                    open(
+                        os.path.join(
+                            sample_dir,
+                            f"{name or 'Undetermined'}_L00{lane}_{read}_001.fastq.gz",
+                        ),
+                        "w",
+                    ).close()
+        demux_runmanifest = [
+            {
+                "Lane": lane,
+                "SampleName": sample,
+                "Project": "P12345",
+                "sub_demux_count": sub_demux,
+            }
+            for sub_demux, lane, sample in [
+                ("0", "1", "S1"),
+                ("1", "1", "S2"),
+                ("0", "2", "S3"),
+            ]
+        ]
+        stale_link = os.path.join(run.demux_dir, "P12345", "Sample_S9", "S9.fastq.gz")
+        os.makedirs(os.path.dirname(stale_link))
+        os.symlink("nowhere", stale_link)
+
+        plan = run.plan_demux_links(demux_runmanifest)
+        assert sorted(os.path.relpath(dest, run.demux_dir) for dest in plan.links) == [
+            "P12345/Sample_S1/S1_S1_L001_R1_001.fastq.gz",
+            "P12345/Sample_S1/S1_S1_L001_R2_001.fastq.gz",
+            "P12345/Sample_S2/S2_S2_L001_R1_001.fastq.gz",
+            "P12345/Sample_S2/S2_S2_L001_R2_001.fastq.gz",
+            "P12345/Sample_S3/S3_S1_L002_R1_001.fastq.gz",
+            "P12345/Sample_S3/S3_S1_L002_R2_001.fastq.gz",
+            # Only lane 2 has a single demux
+            "Undetermined/Undetermined_L002_R1_001.fastq.gz",
+            "Undetermined/Undetermined_L002_R2_001.fastq.gz",
+        ]
+        # A dry run changes nothing
+        actions = plan.apply(prune=True, dry_run=True)
+        assert ("remove", os.path.dirname(stale_link), None) in actions
+        assert os.path.islink(stale_link)
+
+        with (
+            mock.patch.object(
+                run, "collect_demux_runmanifest", return_value=demux_runmanifest
+            ),
+            mock.patch.object(run, "aggregate_stats_assigned"),
+            mock.patch.object(run, "aggregate_stats_unassigned"),
+        ):
+            run.aggregate_demux_results([])
+        assert not os.path.exists(os.path.dirname(stale_link))
+        assert os.readlink(
+            os.path.join(
+                run.demux_dir, "P12345", "Sample_S2", "S2_S2_L001_R1_001.fastq.gz"
+            )
+        ) == os.path.join(
+            run.run_dir,
+            "Demultiplexing_1",
+            "Samples",
+            "P12345",
+            "S2",
+            "S2_L001_R1_001.fastq.gz",
+        )
+        # Applied again, the links in place are kept
+        actions = run.plan_demux_links(demux_runmanifest).apply(prune=True)
+        assert {action for action, _, _ in actions} == {"keep"}
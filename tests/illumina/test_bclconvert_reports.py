@@ -0,0 +1,219 @@
+import csv
+import os
+
+from taca.illumina import bclconvert_reports
+from taca.illumina.bclconvert_reports import DemuxReports
+
+DEMUX_STATS_HEADER = (
+    "Lane,SampleID,Sample_Project,Index,# Reads,# Perfect Index Reads,"
+    "# One Mismatch Index Reads,# Two Mismatch Index Reads,% Reads,"
+    "% Perfect Index Reads,% One Mismatch Index Reads,% Two Mismatch Index Reads"
+)
+QUALITY_METRICS_HEADER = (
+    "Lane,SampleID,index,index2,ReadNumber,Yield,YieldQ30,QualityScoreSum,"
+    "Mean Quality Score (PF),% Q30"
+)
+UNKNOWN_BARCODES_HEADER = (
+    "Lane,index,index2,# Reads,% of Unknown Barcodes,% of All Reads"
+)
+
+
+def write_reports(demux_dir, samples, unknown_barcodes):
+    """Write native reports for (lane, sample, project, index, index2, reads)
+    samples, 151 cycles per read, with one mismatch reads for lane 1 samples.
+    """
+    reports_dir = os.path.join(demux_dir, "Reports")
+    os.makedirs(reports_dir)
+    lane_reads = dict()
+    for lane, _, _, _, _, reads in samples:
+        lane_reads[lane] = lane_reads.get(lane, 0) + reads
+    with open(os.path.join(reports_dir, "Demultiplex_Stats.csv"), "w") as f:
+        f.write(DEMUX_STATS_HEADER + "\n")
+        for lane, sample, project, idx1, idx2, reads in samples:
+            index = f"{idx1}-{idx2}" if sample != "Undetermined" else ""
+            perfect = reads if sample != "Undetermined" and lane != 1 else 0
+            mismatch = reads // 10 if sample != "Undetermined" and lane == 1 else 0
+            perfect = perfect or (reads - mismatch if sample != "Undetermined" else 0)
+            f.write(
+                f"{lane},{sample},{project},{index},{reads},{perfect},{mismatch},0,"
+                f"{reads / lane_reads[lane]:.4f},{perfect / reads:.4f},"
+                f"{mismatch / reads:.4f},0.0000\n"
+            )
+    with open(os.path.join(reports_dir, "Quality_Metrics.csv"), "w") as f:
+        f.write(QUALITY_METRICS_HEADER + "\n")
+        for lane, sample, _, idx1, idx2, reads in samples:
+            for read in (1, 2):
+                f.write(
+                    f"{lane},{sample},{idx1},{idx2},{read},{reads * 151},"
+                    f"{reads * 120},{reads * 151 * 35},35.00,0.7947\n"
+                )
+    with open(os.path.join(reports_dir, "Top_Unknown_Barcodes.csv"), "w") as f:
+        f.write(UNKNOWN_BARCODES_HEADER + "\n")
+        for lane, idx1, idx2, reads in unknown_barcodes:
+            f.write(f"{lane},{idx1},{idx2},{reads},0.5,0.1\n")
+
+
+def make_run(run_dir):
+    """Two sub-demultiplexings, lane 1 in both and lane 2 in the first."""
+    write_reports(
+        os.path.join(run_dir, "Demultiplexing_0"),
+        [
+            (1, "P1_101", "P1", "AAAAAAAA", "CCCCCCCC", 400_000),
+            (1, "Undetermined", "", "", "", 600_000),
+            (2, "P2_101_S1", "P2", "GGGGGGGG", "TTTTTTTT", 700_000),
+            (2, "Undetermined", "", "", "", 300_000),
+        ],
+        [
+            (1, "ACGTACGT", "TTTTGGGG", 200_000),
+            (1, "TTTTTTTT", "AAAAAAAA", 50_000),
+            (2, "CCCCCCCC", "GGGGGGGG", 100_000),
+        ],
+    )
+    write_reports(
+        os.path.join(run_dir, "Demultiplexing_1"),
+        [
+            (1, "P1_102", "P1", "ACGTACGTAC", "TTTTGGGGCC", 350_000),
+            (1, "Undetermined", "", "", "", 650_000),
+        ],
+        [(1, "AAAAAAAACC", "CCCCCCCCAA", 300_000)],
+    )
+
+
+def merge(run_dir):
+    assert bclconvert_reports.has_native_reports(
+        os.path.join(run_dir, "Demultiplexing_0")
+    )
+    return DemuxReports.merge(
+        {
+            demux_id: DemuxReports.read(
+                os.path.join(run_dir, f"Demultiplexing_{demux_id}"), demux_id
+            )
+            for demux_id in ["0", "1"]
+        },
+        simple_lanes={"2": "0"},
+        complex_lanes={"1": {"0": [8, 8]}},
+    )
+
+
+def test_merge_sub_demultiplexings(create_dirs):
+    """Complex lanes should keep all samples and what no sample took as undetermined."""
+    tmp = create_dirs
+    make_run(tmp.name)
+    merged = merge(tmp.name)
+
+    stats = merged.demux_stats
+    assert list(zip(stats["Lane"], stats["SampleID"], stats["# Reads"])) == [
+        ("1", "P1_101", 400_000),
+        ("1", "P1_102", 350_000),
+        ("1", "Undetermined", 250_000),
+        ("2", "P2_101_S1", 700_000),
+        ("2", "Undetermined", 300_000),
+    ]
+    assert list(stats["% Reads"]) == [0.4, 0.35, 0.25, 0.7, 0.3]
+    quality = merged.quality_metrics
+    undetermined = quality[
+        (quality["Lane"] == "1") & (quality["SampleID"] == "Undetermined")
+    ]
+    assert list(undetermined["Yield"]) == [250_000 * 151] * 2
+    assert list(undetermined["YieldQ30"]) == [250_000 * 120] * 2
+
+    # Unknown barcodes matching a sample of the other sub-demultiplexing go
+    unknown = merged.unknown_barcodes
+    assert list(zip(unknown["Lane"], unknown["index"], unknown["# Reads"])) == [
+        ("1", "TTTTTTTT", 50_000),
+        ("2", "CCCCCCCC", 100_000),
+    ]
+    assert list(unknown["% of Unknown Barcodes"]) == [0.2, 0.5]
+
+    assert merged.lane_summary() == {
+        "1": {
+            "total_lane_cluster": 1_000_000,
+            "total_lane_yield": 302,
+            "total_sample_cluster": 750_000,
+            "total_sample_yield": 226,
+            "undet_cluster": 250_000,
+            "undet_yield": 76,
+        },
+        "2": {
+            "total_lane_cluster": 1_000_000,
+            "total_lane_yield": 302,
+            "total_sample_cluster": 700_000,
+            "total_sample_yield": 211,
+            "undet_cluster": 300_000,
+            "undet_yield": 91,
+        },
+    }
+
+    reports_dir = os.path.join(tmp.name, "Demultiplexing", "Reports")
+    merged.write(reports_dir)
+    with open(os.path.join(reports_dir, "Demultiplex_Stats.csv")) as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0].keys()) == DEMUX_STATS_HEADER.split(",")
+    assert [row["# Reads"] for row in rows] == [
+        "400000",
+        "350000",
+        "250000",
+        "700000",
+        "300000",
+    ]
+
+
+def test_legacy_html(create_dirs):
+    """laneBarcode.html should have one row per sample, undetermined of
+    complex lanes without index metrics."""
+    tmp = create_dirs
+    make_run(tmp.name)
+    merged = merge(tmp.name)
+
+    rows = merged.lane_barcode_rows(complex_lanes=["1"])
+    assert [(row["Lane"], row["Project"], row["Sample"]) for row in rows] == [
+        ("1", "P1", "P1_101"),
+        ("1", "P1", "P1_102"),
+        ("1", "default", "Undetermined"),
+        ("2", "P2", "P2_101"),
+        ("2", "default", "Undetermined"),
+    ]
+    assert rows[0]["PF Clusters"] == "400,000"
+    assert rows[0]["% One mismatchbarcode"] == "10.00"
+    assert rows[0]["% >= Q30bases"] == "79.47"
+    assert rows[0]["Mean QualityScore"] == "35.00"
+    assert rows[2]["PF Clusters"] == "250,000"
+    assert rows[2]["Yield (Mbases)"] == "76"
+    assert rows[2]["% Perfectbarcode"] == "0"
+
+    lanes = merged.lane_rows(complex_lanes=["1"])
+    assert [(row["Lane"], row["PF Clusters"]) for row in lanes] == [
+        ("1", "1,000,000"),
+        ("2", "1,000,000"),
+    ]
+    assert lanes[0]["% Perfectbarcode"] is None
+    assert lanes[1]["% Perfectbarcode"] == "70.00"
+
+    html_dir = os.path.join(tmp.name, "Demultiplexing", "Reports", "html")
+    merged.write_html(html_dir, complex_lanes=["1"])
+    with open(os.path.join(html_dir, "laneBarcode.html")) as f:
+        html = f.read()
+    assert "<th>Clusters (Raw)</th>" in html
+    assert "<td>2,000,000</td>" in html
+    # Title, flowcell summary header and values, lane summary header and rows
+    assert html.count("<tr>") == 4 + len(rows)
+    assert os.path.exists(os.path.join(html_dir, "lane.html"))
+
+
+def test_noindex_lanes(create_dirs):
+    """Samples of NoIndex lanes should take the undetermined reads."""
+    tmp = create_dirs
+    run_dir = tmp.name
+    write_reports(
+        os.path.join(run_dir, "Demultiplexing_0"),
+        [
+            (1, "P3_101", "P3", "TTTTTTTT", "", 10),
+            (1, "Undetermined", "", "", "", 999_990),
+        ],
+        [(1, "ACGTACGT", "", 1000)],
+    )
+    reports = DemuxReports.read(os.path.join(run_dir, "Demultiplexing_0"))
+    rows = reports.lane_barcode_rows(noindex_lanes=["1"])
+    assert [(row["Project"], row["Sample"], row["PF Clusters"]) for row in rows] == [
+        ("P3", "P3_101", "999,990")
+    ]
@@ -0,0 +1,95 @@
+import os
+
+from taca.illumina.demux_log import DemuxLogScanner
+
+
+def legacy_scan(demux_log):
+    """The scan of Run._check_demux_log for bclconvert before it was
+    incremental."""
+    errors = 0
+    warnings = 0
+    error_and_warning_messages = []
+    with open(demux_log) as f:
+        for line in f.readlines():
+            if "ERROR" in line:
+                errors += 1
+                error_and_warning_messages.append(line)
+            elif "WARNING" in line:
+                warnings += 1
+                error_and_warning_messages.append(line)
+    return errors, warnings, error_and_warning_messages
+
+
+def scan(scanner, demux_log):
+    summary = scanner.scan(demux_log, "bclconvert")
+    return (
+        summary["errors"],
+        summary["warnings"],
+        summary["error_and_warning_messages"],
+    )
+
+
+def test_scan_appended(create_dirs):
+    """Only what was appended should be read, with the same result as a full
+    scan, lines being written included."""
+    demux_log = os.path.join(create_dirs.name, "demux_0_bcl-convert.err")
+    state_file = os.path.join(create_dirs.name, "state", "demux_logs.json")
+    with open(demux_log, "w") as f:
+        f.write("INFO: Processing tile 1101 of lane 1\nWARNING: low yield\nERR")
+    scanner = DemuxLogScanner(state_file)
+    assert scan(scanner, demux_log) == legacy_scan(demux_log)
+    assert scanner.scan(demux_log, "bclconvert")["tiles"] == 1
+    scanner.save()
+
+    with open(demux_log, "a") as f:
+        f.write("OR: disk full\nINFO: Processing tile 1102 of lane 1\n")
+    # Read from the offset saved, in the next invocation
+    scanner = DemuxLogScanner(state_file)
+    summary = scanner.scan(demux_log, "bclconvert")
+    assert summary["errors"] == 1
+    assert summary["tiles"] == 2
+    assert scan(scanner, demux_log) == legacy_scan(demux_log)
+    assert scanner._states[demux_log].offset == os.path.getsize(demux_log)
+
+    # A new log of the same name is read from its start
+    os.remove(demux_log)
+    with open(demux_log, "w") as f:
+        f.write("WARNING: again\n")
+    assert scan(scanner, demux_log) == (0, 1, ["WARNING: again\n"])
+
+
+def test_messages_kept(create_dirs):
+    demux_log = os.path.join(create_dirs.name, "demux_0_bcl-convert.err")
+    with open(demux_log, "w") as f:
+        f.writelines(f"WARNING: {i}\n" for i in range(50))
+    scanner = DemuxLogScanner(kept=5)
+    summary = scanner.scan(demux_log, "bclconvert")
+    assert summary["warnings"] == 50
+    assert summary["error_and_warning_messages"] == [
+        f"WARNING: {i}\n" for i in [0, 1, 2, 3, 4, 45, 46, 47, 48, 49]
+    ]
+
+
+def test_bcl2fastq_last_line(create_dirs):
+    demux_log = os.path.join(create_dirs.name, "demux_0_bcl2fastq.err")
+    with open(demux_log, "w") as f:
+        f.write("WARN: slow\nProcessing completed with 0 errors and 1 warnings.")
+    summary = DemuxLogScanner().scan(demux_log, "bcl2fastq")
+    assert summary["last_line"] == "Processing completed with 0 errors and 1 warnings."
+    assert summary["error_and_warning_messages"] == ["WARN: slow\n"]
+
+
+def test_line_being_written(create_dirs):
+    """A line being written should be counted every time, once."""
+    demux_log = os.path.join(create_dirs.name, "demux_0_bcl-convert.err")
+    with open(demux_log, "w") as f:
+        f.write("ERROR: first\nERROR: second")
+    scanner = DemuxLogScanner()
+    for _ in range(2):
+        summary = scanner.scan(demux_log, "bclconvert")
+        assert summary["errors"] == 2
+        assert summary["error_and_warning_messages"] == [
+            "ERROR: first\n",
+            "ERROR: second\n",
+        ]
+        assert summary["last_line"] == "ERROR: second"
@@ -0,0 +1,75 @@
+import os
+
+from taca.illumina.demux_plan import DemuxPlan
+
+
+def sample(sample_type, index_length, umi_length=(0, 0), read_length=(151, 151)):
+    return {
+        "sample_type": sample_type,
+        "index_length": list(index_length),
+        "umi_length": list(umi_length),
+        "read_length": list(read_length),
+    }
+
+
+SAMPLE_TABLE = {
+    "1": [
+        ("P1_101", sample("ordinary", (8, 8))),
+        ("P1_102", sample("ordinary", (10, 10))),
+        ("P1_103", sample("ordinary", (8, 8))),
+        ("P2_101", sample("IDT_UMI", (8, 8), umi_length=(9, 0))),
+    ],
+    "2": [
+        ("P1_104", sample("ordinary", (10, 10))),
+        ("P3_101", sample("10X_DUAL", (10, 10), read_length=(28, 90))),
+    ],
+}
+
+
+def test_bcl2fastq_plan():
+    """bcl2fastq takes one mask per lane, the n:th of each lane go together."""
+    plan = DemuxPlan.from_sample_table("run", "bcl2fastq", SAMPLE_TABLE)
+    assert [
+        (sub_demux["id"], sub_demux["sample_type"], sub_demux["samples"])
+        for sub_demux in plan.sub_demuxes
+    ] == [
+        (0, "10X_DUAL", {"2": ["P3_101"]}),
+        (1, "IDT_UMI", {"1": ["P2_101"]}),
+        (2, "ordinary", {"1": ["P1_101", "P1_103"], "2": ["P1_104"]}),
+        (3, "ordinary", {"1": ["P1_102"]}),
+    ]
+    assert plan.sub_demuxes[2]["mask_table"] == {
+        "1": [[8, 8], [0, 0], [151, 151]],
+        "2": [[10, 10], [0, 0], [151, 151]],
+    }
+
+
+def test_bclconvert_plan():
+    """bclconvert takes a single mask, shared by all lanes of a sub-demultiplexing."""
+    plan = DemuxPlan.from_sample_table("run", "bclconvert", SAMPLE_TABLE)
+    assert [sub_demux["samples"] for sub_demux in plan.sub_demuxes] == [
+        {"2": ["P3_101"]},
+        {"1": ["P2_101"]},
+        {"1": ["P1_101", "P1_103"]},
+        {"1": ["P1_102"], "2": ["P1_104"]},
+    ]
+    assert plan.sub_demuxes[3]["mask"] == [[10, 10], [0, 0], [151, 151]]
+    assert plan.lane_index_lengths(["2", "3"]) == {
+        "1": {"2": [8, 8], "3": [10, 10]},
+        "2": {"3": [10, 10]},
+    }
+
+
+def test_write_and_load(create_dirs):
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "run")
+    os.mkdir(run_dir)
+    assert DemuxPlan.load(run_dir) is None
+
+    plan = DemuxPlan.from_sample_table("run", "bclconvert", SAMPLE_TABLE)
+    for sub_demux in plan.sub_demuxes:
+        sub_demux["base_mask"] = ["Y151", "I8", "I8", "Y151"]
+    plan.write(run_dir)
+    loaded = DemuxPlan.load(run_dir)
+    assert (loaded.run_id, loaded.software) == ("run", "bclconvert")
+    assert loaded.sub_demuxes == plan.sub_demuxes
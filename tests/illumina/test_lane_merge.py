@@ -0,0 +1,215 @@
+import json
+import os
+from xml.etree import ElementTree
+
+from taca.illumina import lane_merge
+
+DEMUX_STATS_HEADER = "Lane,SampleID,Index,# Reads\n"
+TOP_UNKNOWN_HEADER = "Lane,index,index2,# Reads\n"
+
+
+def write(path, content, mode="w"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode) as f:
+        f.write(content)
+
+
+def demultiplexing_stats(lane, samples):
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n<Stats><Flowcell flowcell-id='HFC'>"
+        "<Project name='P1'>"
+        + "".join(
+            f"<Sample name='{sample}'><Barcode name='all'>"
+            f"<Lane number='{lane}'><BarcodeCount>{reads}</BarcodeCount></Lane>"
+            "</Barcode></Sample>"
+            for sample, reads in samples
+        )
+        + "</Project></Flowcell></Stats>"
+    )
+
+
+class HtmlReport:
+    """Parser of the HTML reports of the tests, which hold their rows as JSON."""
+
+    def __init__(self, path):
+        with open(path) as f:
+            report = json.load(f)
+        self.flowcell_data = report["flowcell"]
+        self.sample_data = report["samples"]
+
+
+def make_lane_outputs(run_dir):
+    """Write the outputs of a sub-demultiplexing split in lanes 1 and 2.
+
+    Demultiplexing_0/Reports/lanes/lane_[12]
+    ├── P1/P1_10[12]/P1_10[12]_S[12]_L00[12]_R1_001.fastq.gz
+    ├── Undetermined_S0_R1_001.fastq.gz
+    ├── Reports/Demultiplex_Stats.csv
+    ├── Reports/Top_Unknown_Barcodes.csv
+    ├── Reports/RunInfo.xml
+    ├── Reports/html/HFC/all/all/all/laneBarcode.html
+    ├── Logs/Warnings.txt
+    └── Stats/DemultiplexingStats.xml, Stats/Stats.json
+    """
+    lane_dirs = []
+    for lane, sample in [(1, "P1_101"), (2, "P1_102")]:
+        lane_dir = lane_merge.lane_dir(run_dir, 0, lane)
+        lane_dirs.append(lane_dir)
+        write(
+            os.path.join(
+                lane_dir, "P1", sample, f"{sample}_S{lane}_L00{lane}_R1_001.fastq.gz"
+            ),
+            f"@{sample}\n",
+        )
+        write(
+            os.path.join(lane_dir, "Undetermined_S0_R1_001.fastq.gz"),
+            bytes([lane]) * (3 * lane_merge.BLOCK_SIZE // 2),
+            mode="wb",
+        )
+        write(
+            os.path.join(lane_dir, "Reports", "Demultiplex_Stats.csv"),
+            f"{DEMUX_STATS_HEADER}{lane},{sample},ACGT,{lane * 100}\n"
+            f"{lane},Undetermined,,{lane * 10}\n",
+        )
+        write(
+            os.path.join(lane_dir, "Reports", "Top_Unknown_Barcodes.csv"),
+            f"{TOP_UNKNOWN_HEADER}{lane},GGGG,TTTT,{lane * 5}\n",
+        )
+        write(os.path.join(lane_dir, "Reports", "RunInfo.xml"), "<RunInfo/>\n")
+        write(
+            os.path.join(
+                lane_dir,
+                "Reports",
+                "html",
+                "HFC",
+                "all",
+                "all",
+                "all",
+                "laneBarcode.html",
+            ),
+            json.dumps(
+                {
+                    "flowcell": {
+                        "Clusters (Raw)": f"{lane},000",
+                        "Clusters(PF)": f"{lane},000",
+                        "Yield (MBases)": f"{lane},000",
+                    },
+                    "samples": [{"Lane": str(lane), "Sample": sample}],
+                }
+            ),
+        )
+        write(
+            os.path.join(lane_dir, "Logs", "Warnings.txt"),
+            f"lane {lane} warning\n",
+        )
+        write(
+            os.path.join(lane_dir, "Stats", "DemultiplexingStats.xml"),
+            demultiplexing_stats(lane, [(sample, lane * 100), ("P1_103", lane)]),
+        )
+        write(
+            os.path.join(lane_dir, "Stats", "Stats.json"),
+            json.dumps(
+                {
+                    "Flowcell": "HFC",
+                    "ConversionResults": [{"LaneNumber": lane, "TotalClustersPF": 1}],
+                    "UnknownBarcodes": [{"Lane": lane, "Barcodes": {"GGGG": 5}}],
+                }
+            ),
+        )
+        write(
+            os.path.join(run_dir, f"demux_0_L{lane}_bcl-convert.err"),
+            f"lane {lane} done\n",
+        )
+    return lane_dirs
+
+
+def test_merge_lane_outputs(create_dirs):
+    run_dir = os.path.join(create_dirs.name, "20261018_LH00001_0042_AHFC")
+    lane_dirs = make_lane_outputs(run_dir)
+
+    assert all(lane_merge.lane_done(lane_dir) for lane_dir in lane_dirs)
+    lane_merge.merge_lane_outputs(run_dir, 0, lane_dirs, html_parser=HtmlReport)
+
+    demux_dir = os.path.join(run_dir, "Demultiplexing_0")
+    # Files of a single lane are moved
+    for lane, sample in [(1, "P1_101"), (2, "P1_102")]:
+        fastq = os.path.join(
+            "P1", sample, f"{sample}_S{lane}_L00{lane}_R1_001.fastq.gz"
+        )
+        assert os.path.exists(os.path.join(demux_dir, fastq))
+        assert not os.path.exists(os.path.join(lane_dirs[lane - 1], fastq))
+    # Those of every lane are concatenated in lane order
+    with open(os.path.join(demux_dir, "Undetermined_S0_R1_001.fastq.gz"), "rb") as f:
+        undetermined = f.read()
+    assert undetermined == (
+        b"\x01" * (3 * lane_merge.BLOCK_SIZE // 2)
+        + b"\x02" * (3 * lane_merge.BLOCK_SIZE // 2)
+    )
+    # Tables under the header of the first lane
+    with open(os.path.join(demux_dir, "Reports", "Demultiplex_Stats.csv")) as f:
+        assert f.read() == (
+            DEMUX_STATS_HEADER
+            + "1,P1_101,ACGT,100\n1,Undetermined,,10\n"
+            + "2,P1_102,ACGT,200\n2,Undetermined,,20\n"
+        )
+    with open(os.path.join(demux_dir, "Reports", "Top_Unknown_Barcodes.csv")) as f:
+        assert f.read() == TOP_UNKNOWN_HEADER + "1,GGGG,TTTT,5\n2,GGGG,TTTT,10\n"
+    # Reports the same in every lane are kept once
+    with open(os.path.join(demux_dir, "Reports", "RunInfo.xml")) as f:
+        assert f.read() == "<RunInfo/>\n"
+    # Other text files are concatenated whole
+    with open(os.path.join(demux_dir, "Logs", "Warnings.txt")) as f:
+        assert f.read() == "lane 1 warning\nlane 2 warning\n"
+    # HTML reports are rendered from the rows of all lanes
+    with open(
+        os.path.join(
+            demux_dir, "Reports", "html", "HFC", "all", "all", "all", "laneBarcode.html"
+        )
+    ) as f:
+        html = f.read()
+    assert "<td>3,000</td>" in html
+    assert "P1_101" in html and "P1_102" in html
+    with open(os.path.join(demux_dir, "Stats", "Stats.json")) as f:
+        stats = json.load(f)
+    assert [r["LaneNumber"] for r in stats["ConversionResults"]] == [1, 2]
+    assert [r["Lane"] for r in stats["UnknownBarcodes"]] == [1, 2]
+    with open(os.path.join(run_dir, "demux_0_bcl-convert.err")) as f:
+        assert f.read() == "lane 1 done\nlane 2 done\n"
+
+    # The samples of every lane, and the lanes of samples in several lanes
+    stats_xml = ElementTree.parse(
+        os.path.join(demux_dir, "Stats", "DemultiplexingStats.xml")
+    ).getroot()
+    samples = [
+        (sample.get("name"), [lane.get("number") for lane in sample.iter("Lane")])
+        for sample in stats_xml.iter("Sample")
+    ]
+    assert samples == [("P1_101", ["1"]), ("P1_103", ["1", "2"]), ("P1_102", ["2"])]
+
+
+def test_lane_done(create_dirs):
+    """A lane should be done once both its stats files are written."""
+    lane_dir = os.path.join(create_dirs.name, "lane_1")
+    legacy_stats = os.path.join(lane_dir, "Reports", "legacy", "Stats")
+    write(os.path.join(legacy_stats, "DemultiplexingStats.xml"), "<Stats/>\n")
+    assert not lane_merge.lane_done(lane_dir, "Reports/legacy")
+    write(os.path.join(legacy_stats, "Stats.json"), "{}")
+    assert lane_merge.lane_done(lane_dir, "Reports/legacy")
+    assert not lane_merge.lane_done(os.path.join(create_dirs.name, "lane_2"))
+
+
+def test_merge_xml_element():
+    merged = ElementTree.fromstring(
+        "<Stats><Sample name='A'><Lane number='1'/></Sample></Stats>"
+    )
+    lane_merge.merge_xml_element(
+        merged,
+        ElementTree.fromstring(
+            "<Stats><Sample name='A'><Lane number='2'/></Sample>"
+            "<Sample name='B'><Lane number='2'/></Sample></Stats>"
+        ),
+    )
+    assert ElementTree.tostring(merged) == (
+        b'<Stats><Sample name="A"><Lane number="1" /><Lane number="2" /></Sample>'
+        b'<Sample name="B"><Lane number="2" /></Sample></Stats>'
+    )
@@ -0,0 +1,231 @@
+import os
+import types
+from unittest import mock
+from xml.etree import ElementTree
+
+import pytest
+
+from taca.illumina import run_parser
+from taca.illumina.run_parser import LazyRunParser, sniff_run_type
+
+
+class FileParser:
+    """Parser of a whole file, counting the files it parsed."""
+
+    parsed: list[str] = []
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise OSError(f"{path} not found")
+        with open(path) as f:
+            self.data = f.read()
+        FileParser.parsed.append(os.path.basename(path))
+
+
+class RunParser:
+    def __init__(self, path):
+        FileParser.parsed.append("RunParser")
+        self.obj = {"name": os.path.basename(path)}
+
+
+CLASSES = types.SimpleNamespace(
+    RunInfoParser=FileParser,
+    RunParametersParser=FileParser,
+    SampleSheetParser=FileParser,
+    RunParser=RunParser,
+)
+
+
+def make_run(tmp):
+    run_dir = os.path.join(tmp, "20261018_LH00001_0042_AHFLOWCELL")
+    os.makedirs(run_dir)
+    for name, content in [
+        ("RunInfo.xml", "<RunInfo/>"),
+        ("runParameters.xml", "<RunParameters/>"),
+    ]:
+        with open(os.path.join(run_dir, name), "w") as f:
+            f.write(content)
+    FileParser.parsed = []
+    return run_dir
+
+
+def test_parse_on_first_access(create_dirs):
+    run_dir = make_run(create_dirs.name)
+    parser = LazyRunParser(run_dir, classes=CLASSES)
+    assert FileParser.parsed == []
+    assert parser.runinfo.data == "<RunInfo/>"
+    assert parser.runinfo.data == "<RunInfo/>"
+    assert FileParser.parsed == ["RunInfo.xml"]
+    # Missing files give None, as with RunParser
+    assert parser.samplesheet is None
+    assert parser.obj == {"name": "20261018_LH00001_0042_AHFLOWCELL"}
+    assert FileParser.parsed == ["RunInfo.xml", "RunParser"]
+
+
+def test_cache(create_dirs):
+    run_dir = make_run(create_dirs.name)
+    cache_dir = os.path.join(create_dirs.name, "parser_cache")
+    LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES).runinfo
+    assert os.listdir(os.path.join(cache_dir, "20261018_LH00001_0042_AHFLOWCELL")) == [
+        "runinfo.pickle"
+    ]
+
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runinfo.data == "<RunInfo/>"
+    assert FileParser.parsed == ["RunInfo.xml"]
+
+    # Parsed again once the file changed
+    with open(os.path.join(run_dir, "RunInfo.xml"), "w") as f:
+        f.write("<RunInfo>changed</RunInfo>")
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runinfo.data == "<RunInfo>changed</RunInfo>"
+    assert FileParser.parsed == ["RunInfo.xml", "RunInfo.xml"]
+
+    # As is a file showing up in the reports
+    LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES).obj
+    LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES).obj
+    assert FileParser.parsed.count("RunParser") == 1
+    os.makedirs(os.path.join(run_dir, "Demultiplexing", "Stats"))
+    with open(os.path.join(run_dir, "Demultiplexing", "Stats", "Stats.json"), "w"):
+        pass
+    LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES).obj
+    assert FileParser.parsed.count("RunParser") == 2
+
+
+def test_broken_cache(create_dirs):
+    run_dir = make_run(create_dirs.name)
+    cache_dir = os.path.join(create_dirs.name, "parser_cache")
+    os.makedirs(os.path.join(cache_dir, "20261018_LH00001_0042_AHFLOWCELL"))
+    with open(
+        os.path.join(
+            cache_dir, "20261018_LH00001_0042_AHFLOWCELL", "runparameters.pickle"
+        ),
+        "w",
+    ) as f:
+        f.write("not a pickle")
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runparameters.data == "<RunParameters/>"
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runparameters.data == "<RunParameters/>"
+    assert FileParser.parsed == ["runParameters.xml"]
+
+
+def test_capitalized_run_parameters(create_dirs):
+    """NextSeq and NovaSeqXPlus runs have a RunParameters.xml."""
+    run_dir = make_run(create_dirs.name)
+    os.rename(
+        os.path.join(run_dir, "runParameters.xml"),
+        os.path.join(run_dir, "RunParameters.xml"),
+    )
+    cache_dir = os.path.join(create_dirs.name, "parser_cache")
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runparameters.data == "<RunParameters/>"
+    parser.obj
+    assert FileParser.parsed == ["RunParameters.xml", "RunParser"]
+
+    with open(os.path.join(run_dir, "RunParameters.xml"), "w") as f:
+        f.write("<RunParameters>changed</RunParameters>")
+    parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+    assert parser.runparameters.data == "<RunParameters>changed</RunParameters>"
+    parser.obj
+    assert FileParser.parsed.count("RunParser") == 2
+
+
+def test_signature_once(create_dirs):
+    """The reports of the run are walked once per instance."""
+    run_dir = make_run(create_dirs.name)
+    cache_dir = os.path.join(create_dirs.name, "parser_cache")
+    LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES).obj
+    with mock.patch.object(
+        run_parser, "signature", wraps=run_parser.signature
+    ) as mock_signature:
+        parser = LazyRunParser(run_dir, cache_dir=cache_dir, classes=CLASSES)
+        for _ in range(3):
+            parser.obj
+        parser._cached("obj_again", run_parser.OBJ_SOURCES, lambda: None)
+    assert mock_signature.call_count == 1
+
+
+def test_samplesheet_set(create_dirs):
+    """A sample sheet set by the Run fills in the samplesheet_csv of obj."""
+    run_dir = make_run(create_dirs.name)
+    samplesheet = os.path.join(run_dir, "SampleSheet_copy.csv")
+    with open(samplesheet, "w") as f:
+        f.write("Lane,Sample_ID\n")
+    parser = LazyRunParser(run_dir, classes=CLASSES)
+    parser.samplesheet = FileParser(samplesheet)
+    assert parser.samplesheet.data == "Lane,Sample_ID\n"
+    assert parser.obj["samplesheet_csv"] == "Lane,Sample_ID\n"
+
+
+@pytest.mark.parametrize(
+    "run_parameters, run_type",
+    [
+        (
+            "<Setup><ApplicationName>MiSeq Control Software</ApplicationName>"
+            "<Flowcell>MiSeq</Flowcell></Setup>",
+            "MiSeq",
+        ),
+        (
+            "<Setup><ApplicationName>HiSeq Control Software</ApplicationName></Setup>",
+            "HiSeq Control Software",
+        ),
+        (
+            "<Application>NovaSeq Control Software</Application>"
+            "<ApplicationName>NovaSeqXPlus Control Software</ApplicationName>"
+            "<InstrumentType>NovaSeqXPlus</InstrumentType>",
+            "NovaSeqXPlus",
+        ),
+        (
+            "<Application>NovaSeq Control Software</Application>"
+            "<RfidsInfo><FlowCellMode>S4</FlowCellMode></RfidsInfo>",
+            "NovaSeq Control Software",
+        ),
+        (
+            "<ApplicationName>NextSeq Control Software</ApplicationName>",
+            "NextSeq Control Software",
+        ),
+        ("<RunId>X</RunId>", ""),
+    ],
+)
+def test_sniff_run_type(create_dirs, run_parameters, run_type):
+    path = os.path.join(create_dirs.name, "RunParameters.xml")
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0"?>\n<RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema">'
+            f"<RunNumber>42</RunNumber>{run_parameters}</RunParameters>\n"
+        )
+    assert sniff_run_type(path) == run_type
+
+
+def test_sniff_run_type_stops_early(create_dirs):
+    """What follows the InstrumentType, or the Setup, should not be parsed."""
+    path = os.path.join(create_dirs.name, "RunParameters.xml")
+    with open(path, "w") as f:
+        f.write(
+            "<RunParameters><InstrumentType>NovaSeqXPlus</InstrumentType>"
+            "<Consumables><unclosed></Consumables>"
+        )
+    assert sniff_run_type(path) == "NovaSeqXPlus"
+    with open(path, "w") as f:
+        f.write("<RunParameters><Setup><Flowcell>MiSeq</Flowcell></Setup><")
+    assert sniff_run_type(path) == "MiSeq"
+    with open(path, "w") as f:
+        f.write("<RunParameters><Application>NovaSeq</Application><")
+    with pytest.raises(ElementTree.ParseError):
+        sniff_run_type(path)
+
+
+def test_run_type_cached(create_dirs):
+    run_dir = make_run(create_dirs.name)
+    os.remove(os.path.join(run_dir, "runParameters.xml"))
+    cache_dir = os.path.join(create_dirs.name, "parser_cache")
+    assert LazyRunParser(run_dir, cache_dir=cache_dir).run_type is None
+    with open(os.path.join(run_dir, "RunParameters.xml"), "w") as f:
+        f.write(
+            "<RunParameters><InstrumentType>NextSeq</InstrumentType></RunParameters>"
+        )
+    assert LazyRunParser(run_dir, cache_dir=cache_dir).run_type == "NextSeq"
+    assert os.path.exists(
+        os.path.join(cache_dir, "20261018_LH00001_0042_AHFLOWCELL", "run_type.pickle")
+    )
@@ -0,0 +1,311 @@
+import io
+import json
+import os
+import random
+
+import pytest
+
+from taca.illumina.stats_json import (
+    JsonStream,
+    iter_stats,
+    merge_stats,
+    rewrite_noindex_stats,
+    top_barcodes,
+)
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+
+
+def legacy_merge(
+    stats_json,
+    simple_lanes,
+    complex_lanes,
+    number_reads,
+    other_samples,
+    read_count,
+    noindex_lanes,
+):
+    """The merge of Runs._fix_demultiplexingstats_xml_dir before it streamed,
+    loading every Stats.json, returning the merged one and the unknown
+    barcodes of the complex lanes."""
+    stats_list = {}
+    lanes_to_update = dict()
+    demux_summaries = dict()
+    compared_idx1 = None
+    for stat_json in stats_json:
+        demux_id = stat_json.split("Demultiplexing_")[1][0]
+        with open(stat_json) as f:
+            data = json.load(f)
+        if len(stats_list) == 0:
+            stats_list["RunNumber"] = data["RunNumber"]
+            stats_list["Flowcell"] = data["Flowcell"]
+            stats_list["RunId"] = data["RunId"]
+            stats_list["ConversionResults"] = data["ConversionResults"]
+            stats_list["ReadInfosForLanes"] = data["ReadInfosForLanes"]
+            stats_list["UnknownBarcodes"] = []
+            for entry in stats_list["ConversionResults"]:
+                lanes_to_update.setdefault(entry["LaneNumber"], entry)
+        else:
+            lanes_present = [
+                entry["LaneNumber"] for entry in stats_list["ConversionResults"]
+            ]
+            for read_infos in data["ReadInfosForLanes"]:
+                if read_infos["LaneNumber"] not in lanes_present:
+                    stats_list["ReadInfosForLanes"].append(read_infos)
+            for entry in data["ConversionResults"]:
+                lane = entry["LaneNumber"]
+                if lane in lanes_present and str(lane) in complex_lanes:
+                    undetermined = entry["Undetermined"]
+                    undetermined["NumberReads"] = number_reads[str(lane)][
+                        "undet_cluster"
+                    ]
+                    undetermined["Yield"] = (
+                        number_reads[str(lane)]["undet_yield"] * 1000000
+                    )
+                    for read in [0, 1] if read_count == 2 else [0]:
+                        for key in [
+                            "QualityScoreSum",
+                            "TrimmedBases",
+                            "Yield",
+                            "YieldQ30",
+                        ]:
+                            undetermined["ReadMetrics"][read][key] = 0
+                    lanes_to_update[lane]["DemuxResults"].extend(entry["DemuxResults"])
+                    lanes_to_update[lane]["Undetermined"] = undetermined
+                else:
+                    stats_list["ConversionResults"].append(entry)
+                    lanes_to_update.setdefault(lane, entry)
+        for entry in data["UnknownBarcodes"]:
+            lane = str(entry["Lane"])
+            if lane in simple_lanes:
+                stats_list["UnknownBarcodes"].append(entry)
+            elif lane in complex_lanes and list(complex_lanes[lane])[0] == demux_id:
+                compared_idx1 = filter_unknown_barcodes(
+                    entry["Barcodes"], other_samples(lane, demux_id), compared_idx1
+                )
+                stats_list["UnknownBarcodes"].append(entry)
+                demux_summaries[lane] = entry
+    for entry in stats_list["ConversionResults"]:
+        if str(entry["LaneNumber"]) in noindex_lanes:
+            del entry["DemuxResults"][0]["IndexMetrics"]
+            entry["DemuxResults"][0].update(entry["Undetermined"])
+            del entry["Undetermined"]
+    for entry in stats_list["UnknownBarcodes"]:
+        if str(entry["Lane"]) in noindex_lanes:
+            entry["Barcodes"] = {"unknown": 1}
+    return (
+        json.dumps(stats_list),
+        {lane: entry["Barcodes"] for lane, entry in demux_summaries.items()},
+    )
+
+
+def read_metrics(rng, reads):
+    return [
+        {
+            "ReadNumber": read,
+            "Yield": rng.randint(0, 10**9),
+            "YieldQ30": rng.randint(0, 10**9),
+            "QualityScoreSum": rng.randint(0, 10**10),
+            "TrimmedBases": 0,
+        }
+        for read in range(1, reads + 1)
+    ]
+
+
+def make_stats(rng, lanes, samples, reads=2):
+    """A Stats.json with samples of random indexes in the given lanes."""
+    index = lambda: "".join(rng.choice("ACGT") for _ in range(8))  # noqa: E731
+    return {
+        "Flowcell": "HFLOWCELL",
+        "RunNumber": 42,
+        "RunId": "20261018_LH00001_0042_AHFLOWCELL",
+        "ReadInfosForLanes": [
+            {"LaneNumber": lane, "ReadInfos": [{"Number": 1, "NumCycles": 151}]}
+            for lane in lanes
+        ],
+        "ConversionResults": [
+            {
+                "LaneNumber": lane,
+                "TotalClustersRaw": rng.randint(0, 10**9),
+                "TotalClustersPF": rng.randint(0, 10**9),
+                "Yield": rng.randint(0, 10**11),
+                "DemuxResults": [
+                    {
+                        "SampleId": f"P1_{lane}{i:02}",
+                        "SampleName": f"P1_{lane}{i:02}",
+                        "IndexMetrics": [
+                            {"IndexSequence": index(), "MismatchCounts": {"0": 1}}
+                        ],
+                        "NumberReads": rng.randint(0, 10**7),
+                        "Yield": rng.randint(0, 10**9),
+                        "ReadMetrics": read_metrics(rng, reads),
+                    }
+                    for i in range(samples)
+                ],
+                "Undetermined": {
+                    "NumberReads": rng.randint(0, 10**7),
+                    "Yield": rng.randint(0, 10**9),
+                    "ReadMetrics": read_metrics(rng, reads),
+                },
+            }
+            for lane in lanes
+        ],
+        "UnknownBarcodes": [
+            {
+                "Lane": lane,
+                "Barcodes": {
+                    f"{index()}+{index()}": rng.randint(1, 10**6) for _ in range(50)
+                },
+            }
+            for lane in lanes
+        ],
+    }
+
+
+def write_run(run_dir, rng, demux_lanes, samples=5):
+    """Write the Stats.json of sub-demultiplexings with the given lanes."""
+    stats_json = []
+    for demux_id, lanes in enumerate(demux_lanes):
+        stats_dir = os.path.join(run_dir, f"Demultiplexing_{demux_id}", "Stats")
+        os.makedirs(stats_dir)
+        stat_json = os.path.join(stats_dir, "Stats.json")
+        with open(stat_json, "w") as f:
+            json.dump(make_stats(rng, lanes, samples), f)
+        stats_json.append(stat_json)
+    return stats_json
+
+
+MERGE_ARGS = dict(
+    # Lane 1 in both sub-demultiplexings, lane 2 in the first, lane 3 in the second
+    simple_lanes={"2": "0", "3": "1"},
+    complex_lanes={"1": {"1": [8, 8]}},
+    number_reads={"1": {"undet_cluster": 1234, "undet_yield": 56}},
+    read_count=2,
+)
+
+
+def other_samples(lane, demux_id):
+    return [("ACGT", "TTTT"), ("GG", "")]
+
+
+@pytest.mark.parametrize("noindex_lanes", [(), ("2",)])
+def test_merge_same_as_legacy(create_dirs, noindex_lanes):
+    """Merging one lane at a time should give the file json.dump gave."""
+    tmp = create_dirs
+    stats_json = write_run(tmp.name, random.Random(3), [[1, 2], [1, 3]])
+    expected, expected_summaries = legacy_merge(
+        stats_json,
+        other_samples=other_samples,
+        noindex_lanes=noindex_lanes,
+        **MERGE_ARGS,
+    )
+    stats_file = os.path.join(tmp.name, "Stats.json")
+    files = set(os.listdir(tmp.name))
+    summaries = merge_stats(
+        stats_json,
+        stats_file,
+        other_samples=other_samples,
+        noindex_lanes=noindex_lanes,
+        top=None,
+        **MERGE_ARGS,
+    )
+    with open(stats_file) as f:
+        assert f.read() == expected
+    assert summaries == expected_summaries
+    assert list(summaries) == ["1"]
+    merged = json.loads(expected)
+    assert [entry["LaneNumber"] for entry in merged["ConversionResults"]] == [1, 2, 3]
+    assert len(merged["ConversionResults"][0]["DemuxResults"]) == 10
+    assert merged["ConversionResults"][0]["Undetermined"]["NumberReads"] == 1234
+    # No spool or temporary file left behind
+    assert set(os.listdir(tmp.name)) - files == {"Stats.json"}
+
+
+def test_merge_keeps_top_unknown_barcodes(create_dirs):
+    tmp = create_dirs
+    stats_json = write_run(tmp.name, random.Random(5), [[1, 2], [1, 3]])
+    stats_file = os.path.join(tmp.name, "Stats.json")
+    merge_stats(
+        stats_json, stats_file, other_samples=other_samples, top=10, **MERGE_ARGS
+    )
+    with open(stats_file) as f:
+        merged = json.load(f)
+    with open(stats_json[0]) as f:
+        lane_2 = json.load(f)["UnknownBarcodes"][1]["Barcodes"]
+    unknown_barcodes = {
+        str(entry["Lane"]): entry for entry in merged["UnknownBarcodes"]
+    }
+    # The most frequent barcodes, in their order
+    top = set(sorted(lane_2, key=lane_2.get, reverse=True)[:10])
+    assert unknown_barcodes["2"]["Barcodes"] == {
+        barcode: count for barcode, count in lane_2.items() if barcode in top
+    }
+    assert list(unknown_barcodes["2"]["Barcodes"]) == [
+        barcode for barcode in lane_2 if barcode in top
+    ]
+    assert all(len(entry["Barcodes"]) == 10 for entry in merged["UnknownBarcodes"])
+
+
+def test_top_barcodes():
+    barcodes = {"A": 5, "C": 9, "G": 5, "T": 1, "N": 5}
+    # Kept in their order, ties in favour of the first ones
+    assert top_barcodes(barcodes, 3) == {"A": 5, "C": 9, "G": 5}
+    assert top_barcodes(barcodes, None) is barcodes
+    assert top_barcodes(barcodes, 10) is barcodes
+
+
+def test_rewrite_noindex_stats(create_dirs):
+    tmp = create_dirs
+    (source,) = write_run(tmp.name, random.Random(7), [[1, 2]], samples=1)
+    with open(source) as f:
+        data = json.load(f)
+    for entry in data["ConversionResults"]:
+        del entry["DemuxResults"][0]["IndexMetrics"]
+        entry["DemuxResults"][0].update(entry["Undetermined"])
+        del entry["Undetermined"]
+    for entry in data["UnknownBarcodes"]:
+        entry["Barcodes"] = {"unknown": 1}
+    stats_file = os.path.join(tmp.name, "Stats.json")
+    rewrite_noindex_stats(source, stats_file)
+    with open(stats_file) as f:
+        assert f.read() == json.dumps(data)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1 << 16])
+def test_json_stream_chunks(chunk_size):
+    """Values split over chunks, numbers included, should be read whole."""
+    document = {
+        "RunNumber": 123456789,
+        "Ratio": -1.5e-3,
+        "Flags": [True, False, None],
+        "ConversionResults": [{"LaneNumber": 1, "Name": 'é"\\'}, {}, 987654321],
+        "Empty": [],
+        "Nested": {"a": [1, [2, 3]]},
+    }
+    text = json.dumps(document, indent=1)
+    stream = JsonStream(io.StringIO(text), chunk_size=chunk_size)
+    read = dict()
+    for key in stream.keys():
+        if key == "ConversionResults":
+            read[key] = []
+            for _ in stream.items():
+                read[key].append(stream.value())
+        else:
+            read[key] = stream.value()
+    assert read == document
+
+
+def test_iter_stats_empty_arrays():
+    pairs = [
+        (key, list(value) if key == "ConversionResults" else value)
+        for key, value in iter_stats(
+            io.StringIO('{"ConversionResults": [], "RunId": "X"}')
+        )
+    ]
+    assert pairs == [("ConversionResults", []), ("RunId", "X")]
+
+
+def test_json_stream_truncated():
+    stream = JsonStream(io.StringIO('{"RunId": "X", "ConversionResults": [{"La'))
+    with pytest.raises(ValueError):
+        for key in stream.keys():
+            stream.value()
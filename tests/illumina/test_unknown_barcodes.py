@@ -0,0 +1,118 @@
+import random
+
+from taca.illumina.unknown_barcodes import filter_unknown_barcodes
+
+
+def legacy_filter(barcodes, samples, compared_idx1=None):
+    """The comparison of Runs._fix_demultiplexingstats_xml_dir before the
+    samples were indexed, with the last compared index 1 passed explicitly.
+    """
+    comparepart_idx1 = compared_idx1
+    for sample_idx1, sample_idx2 in samples:
+        for idx in tuple(barcodes.keys()):
+            unknownbarcode_idx1 = idx.split("+")[0] if "+" in idx else idx
+            unknownbarcode_idx2 = idx.split("+")[1] if "+" in idx else ""
+            if sample_idx1 and sample_idx2:
+                comparepart_idx1 = (
+                    sample_idx1
+                    if len(sample_idx1) <= len(unknownbarcode_idx1)
+                    else sample_idx1[: len(unknownbarcode_idx1)]
+                )
+                comparepart_idx2 = (
+                    sample_idx2
+                    if len(sample_idx2) <= len(unknownbarcode_idx2)
+                    else sample_idx2[: len(unknownbarcode_idx2)]
+                )
+                if (
+                    comparepart_idx1 == unknownbarcode_idx1[: len(comparepart_idx1)]
+                    and comparepart_idx2 == unknownbarcode_idx2[: len(comparepart_idx2)]
+                ):
+                    del barcodes[idx]
+            elif sample_idx1 and not sample_idx2:
+                comparepart_idx1 = (
+                    sample_idx1
+                    if len(sample_idx1) <= len(unknownbarcode_idx1)
+                    else sample_idx1[: len(unknownbarcode_idx1)]
+                )
+                if comparepart_idx1 == unknownbarcode_idx1[: len(comparepart_idx1)]:
+                    del barcodes[idx]
+            elif not sample_idx1 and sample_idx2:
+                comparepart_idx2 = (
+                    sample_idx2
+                    if len(sample_idx2) <= len(unknownbarcode_idx1)
+                    else sample_idx2[: len(unknownbarcode_idx1)]
+                )
+                if comparepart_idx1 == unknownbarcode_idx1[: len(comparepart_idx2)]:
+                    del barcodes[idx]
+    return comparepart_idx1
+
+
+def test_prefix_matches():
+    """Barcodes matching a sample over the length of the shorter index go."""
+    barcodes = {
+        "ACGTACGT+TTTTGGGG": 900,
+        "ACGTTCGA+TTTTGGGG": 800,
+        "ACGTAC+TTTTGG": 700,
+        "GGGGGGGGGG+AAAAAAAAAA": 600,
+        "CCCCCCCC": 500,
+        "CCCCCCAA+ACGTACGT": 400,
+    }
+    samples = [
+        # Shorter and longer than the barcodes
+        ("ACGTAC", "TTTTGG"),
+        ("GGGGGGGGGGAA", "AAAAAAAAAATT"),
+        # Single index samples match any index 2
+        ("CCCCCC", ""),
+    ]
+    assert filter_unknown_barcodes(barcodes, samples) == "CCCCCC"
+    assert barcodes == {"ACGTTCGA+TTTTGGGG": 800}
+    assert list(barcodes) == ["ACGTTCGA+TTTTGGGG"]
+
+
+def test_index2_only_samples_keep_previous_behaviour():
+    """Samples without index 1 are compared with the index 1 compared last."""
+    barcodes = {"AAAAAAAA+CCCCCCCC": 10, "TTTTTTTT+GGGGGGGG": 5}
+    # Nothing compared before, nothing is removed
+    assert filter_unknown_barcodes(barcodes, [("", "GGGGGGGG")]) is None
+    assert len(barcodes) == 2
+    # The last index 1 compared is the one of the first sample, with the last barcode
+    compared_idx1 = filter_unknown_barcodes(
+        barcodes, [("TTTTTTTT", "AAAAAAAA"), ("", "CCCCCCCC")]
+    )
+    assert compared_idx1 == "TTTTTTTT"
+    assert barcodes == {"AAAAAAAA+CCCCCCCC": 10}
+
+
+def test_same_as_legacy():
+    """The filtered barcodes and the state passed on should match the previous
+    implementation on random lanes.
+    """
+    rng = random.Random(7)
+
+    def index(length):
+        return "".join(rng.choice("ACGT") for _ in range(length))
+
+    for _ in range(300):
+        prefixes = [index(4) for _ in range(3)]
+        barcodes = dict()
+        for _ in range(rng.randint(0, 40)):
+            idx1 = rng.choice(prefixes) + index(rng.choice([0, 2, 4, 6]))
+            if rng.random() < 0.7:
+                barcodes[f"{idx1}+{rng.choice(prefixes) + index(4)}"] = rng.randint(
+                    1, 1000
+                )
+            else:
+                barcodes[idx1] = rng.randint(1, 1000)
+        samples = []
+        for _ in range(rng.randint(0, 30)):
+            idx1 = rng.choice(["", rng.choice(prefixes) + index(rng.choice([0, 2, 6]))])
+            idx2 = rng.choice(["", rng.choice(prefixes) + index(rng.choice([0, 4]))])
+            samples.append((idx1, idx2))
+        compared_idx1 = rng.choice([None, rng.choice(prefixes)])
+
+        expected = dict(barcodes)
+        expected_idx1 = legacy_filter(expected, samples, compared_idx1)
+        assert filter_unknown_barcodes(barcodes, samples, compared_idx1) == (
+            expected_idx1
+        )
+        assert list(barcodes.items()) == list(expected.items())
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+from taca.utils import hashed_tar
+
+
+def create_run(tmp_dir):
+    run_path = os.path.join(tmp_dir, "run")
+    os.makedirs(os.path.join(run_path, "Data", "Intensities", "L001"))
+    os.makedirs(os.path.join(run_path, "Demultiplexing"))
+    with open(
+        os.path.join(run_path, "Data", "Intensities", "L001", "a.cbcl"), "wb"
+    ) as f:
+        f.write(os.urandom(3 * hashed_tar.BLOCK_SIZE // 2))
+    with open(os.path.join(run_path, "Demultiplexing", "a.fastq.gz"), "wb") as f:
+        f.write(os.urandom(1024))
+    with open(os.path.join(run_path, "RunInfo.xml"), "w") as f:
+        f.write("<RunInfo />\n")
+    return run_path
+
+
+def file_digest(path, algorithm):
+    with open(path, "rb") as f:
+        return hashlib.new(algorithm, f.read()).hexdigest()
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_write_archive(create_dirs, workers):
+    run_path = create_run(create_dirs.name)
+    archive = os.path.join(create_dirs.name, "run_P1.tar")
+    digests = hashed_tar.write_archive(
+        archive,
+        run_path,
+        exclude=["Demultiplexing*", "*.csv"],
+        workers=workers,
+        sha256=True,
+    )
+
+    assert digests == {
+        "md5": file_digest(archive, "md5"),
+        "sha256": file_digest(archive, "sha256"),
+    }
+    # As md5sum run in the folder of the archive
+    md5sum = subprocess.run(
+        ["md5sum", "run_P1.tar"],
+        cwd=create_dirs.name,
+        capture_output=True,
+        text=True,
+    ).stdout
+    with open(f"{archive}.md5") as f:
+        assert f.read() == md5sum
+    with open(f"{archive}.sha256") as f:
+        assert f.read() == f"{digests['sha256']}  run_P1.tar\n"
+    with tarfile.open(archive) as tar:
+        assert sorted(tar.getnames()) == [
+            "run",
+            "run/Data",
+            "run/Data/Intensities",
+            "run/Data/Intensities/L001",
+            "run/Data/Intensities/L001/a.cbcl",
+            "run/RunInfo.xml",
+        ]
+
+
+def test_write_archive_to_command(create_dirs):
+    run_path = create_run(create_dirs.name)
+    archive = os.path.join(create_dirs.name, "run.tar")
+    dest = os.path.join(create_dirs.name, "dest.tar")
+    digests = hashed_tar.write_archive(
+        archive,
+        run_path,
+        workers=2,
+        stream_command=["sh", "-c", f"cat > {dest}"],
+    )
+
+    # Only the checksum file is written locally
+    assert not os.path.exists(archive)
+    assert digests == {"md5": file_digest(dest, "md5")}
+    with open(f"{archive}.md5") as f:
+        assert f.read() == f"{digests['md5']}  run.tar\n"
+
+
+def test_write_archive_command_failed(create_dirs):
+    run_path = create_run(create_dirs.name)
+    archive = os.path.join(create_dirs.name, "run.tar")
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        hashed_tar.write_archive(
+            archive,
+            run_path,
+            workers=2,
+            stream_command=[sys.executable, "-c", "import sys; sys.exit(3)"],
+        )
+    assert e.value.returncode == 3
+    assert not os.path.exists(f"{archive}.md5")
+
+
+def test_ssh_command():
+    assert hashed_tar.ssh_command(
+        "analysis", hashed_tar.remote_archive_path("/deliver", "/data/run 1.tar"), "fc"
+    ) == [
+        "ssh",
+        "fc@analysis",
+        "cat > '/deliver/run 1.tar.part' && "
+        "mv '/deliver/run 1.tar.part' '/deliver/run 1.tar'",
+    ]
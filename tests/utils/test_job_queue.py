@@ -0,0 +1,170 @@
+import os
+import subprocess
+import time
+
+from taca.utils import job_queue
+
+# Runs until a 'go' file shows up in its directory
+WAIT_FOR_GO = ["sh", "-c", "while [ ! -e go ]; do sleep 0.05; done"]
+
+
+def wait_for(queue, run_id, get_state=None, timeout=10):
+    """Wait for the jobs of a run, or the one 'get_state' looks at, to end."""
+    get_state = get_state or (lambda: queue.run_state(run_id))
+    deadline = time.time() + timeout
+    while get_state() in ("ongoing", "running"):
+        assert time.time() < deadline, "jobs did not finish in time"
+        time.sleep(0.05)
+
+
+def test_launch_within_budget_by_priority(create_dirs):
+    """Queued jobs should start in priority order as the budget frees up."""
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeq", "run")
+    os.mkdir(run_dir)
+
+    with job_queue.JobQueue(
+        os.path.join(tmp.name, "demux_queue.db"), max_jobs=2, cpus=4
+    ) as queue:
+        large = queue.submit("run", "demux_0", WAIT_FOR_GO, run_dir, cpus=3)
+        small = queue.submit("run", "demux_1", WAIT_FOR_GO, run_dir, cpus=2)
+        rush = queue.submit("run", "demux_2", WAIT_FOR_GO, run_dir, cpus=2, priority=1)
+        # Submitting a job again does not queue it twice
+        assert queue.submit("run", "demux_0", WAIT_FOR_GO, run_dir, cpus=3) == large
+
+        try:
+            # demux_0 does not fit next to demux_2, and demux_1 waits behind it
+            assert queue.schedule() == [rush]
+            assert queue.schedule() == []
+            assert queue.job("run", "demux_1")["state"] == "queued"
+        finally:
+            open(os.path.join(run_dir, "go"), "w").close()
+        wait_for(queue, "run", lambda: queue.job("run", "demux_2")["state"])
+        assert queue.schedule() == [large]
+        wait_for(queue, "run", lambda: queue.job("run", "demux_0")["state"])
+        assert queue.schedule() == [small]
+        wait_for(queue, "run")
+
+        jobs = queue.jobs("run")
+        assert [job["state"] for job in jobs] == ["finished"] * 3
+        assert all(job["exit_code"] == 0 for job in jobs)
+        assert all(job["pid_start"] for job in jobs)
+        assert jobs[2]["started"] < jobs[0]["started"] < jobs[1]["started"]
+        assert queue.run_state("run") == "finished"
+        with open(os.path.join(run_dir, "demux_0_sh.out")) as f:
+            assert f.readline().startswith("Started command sh -c")
+
+
+def test_failed_and_lost_jobs(create_dirs):
+    """Exit statuses should be recorded, and jobs that vanished marked failed."""
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "AV242106", "run")
+    os.mkdir(run_dir)
+
+    queue = job_queue.load_queue(
+        {"demux_queue": {"db": os.path.join(tmp.name, "demux_queue.db")}}
+    )
+    queue.submit("run", "Demultiplexing_0", "echo oops >&2; exit 3", run_dir, cpus=1)
+    queue.schedule()
+    wait_for(queue, "run")
+    job = queue.job("run", "Demultiplexing_0")
+    assert (job["state"], job["exit_code"]) == ("failed", 3)
+    assert not job["reported"]
+    queue.mark_reported(job["id"])
+    assert queue.job("run", "Demultiplexing_0")["reported"]
+    assert queue.run_state("run") == "failed"
+    with open(os.path.join(run_dir, "Demultiplexing_0_echo.err")) as f:
+        assert f.read() == "oops\n"
+
+    # Demultiplexing the run anew queues the failed job again
+    queue.submit("run", "Demultiplexing_0", "exit 0", run_dir, cpus=1)
+    assert queue.run_state("run") == "ongoing"
+    assert not queue.job("run", "Demultiplexing_0")["reported"]
+
+    # A job whose wrapper died without a trace
+    process = subprocess.Popen(["true"])
+    process.wait()
+    queue.conn.execute(
+        "UPDATE jobs SET state = 'running', pid = ? WHERE name = 'Demultiplexing_0'",
+        (process.pid,),
+    )
+    queue.schedule()
+    assert queue.job("run", "Demultiplexing_0")["state"] == "failed"
+
+    # A job whose pid was given to another process since
+    queue.submit("run", "Demultiplexing_0", "exit 0", run_dir, cpus=1)
+    queue.conn.execute(
+        "UPDATE jobs SET state = 'running', pid = ?, pid_start = ? "
+        "WHERE name = 'Demultiplexing_0'",
+        (os.getpid(), job_queue._process_start(os.getpid()) - 1),
+    )
+    queue.schedule()
+    assert queue.job("run", "Demultiplexing_0")["state"] == "failed"
+    queue.close()
+    assert job_queue.load_queue({}) is None
+
+
+def test_priority_projects(create_dirs):
+    tmp = create_dirs
+    with job_queue.JobQueue(
+        os.path.join(tmp.name, "demux_queue.db"), priority_projects=["P12345"]
+    ) as queue:
+        assert queue.priority({"P12345", "P54321"}) == 1
+        assert queue.priority({"P54321"}) == 0
+
+
+def test_slurm_executor(create_dirs):
+    """Jobs should be submitted with sbatch and their end looked up with sacct."""
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeqXPlus", "run")
+    os.mkdir(run_dir)
+    sbatch = os.path.join(tmp.name, "sbatch")
+    with open(sbatch, "w") as f:
+        f.write(f'#!/bin/sh\necho "$@" >> {tmp.name}/sbatch.log\necho "4242;cluster"\n')
+    sacct = os.path.join(tmp.name, "sacct")
+    with open(sacct, "w") as f:
+        f.write(f"#!/bin/sh\ncat {tmp.name}/sacct.out\n")
+    for stub in [sbatch, sacct]:
+        os.chmod(stub, 0o755)
+
+    queue = job_queue.load_queue(
+        {
+            "demux_queue": {
+                "db": os.path.join(tmp.name, "demux_queue.db"),
+                "executor": "slurm",
+                "max_jobs": 1,
+                "sbatch": sbatch,
+                "sacct": sacct,
+                "sbatch_options": ["--account=ngi"],
+            }
+        }
+    )
+    assert isinstance(queue, job_queue.SlurmJobQueue)
+    cmd = ["/opt/bcl-convert", "--bcl-only-lane", "1", "--output-dir", "out dir"]
+    queue.submit("run", "demux_0_L1", cmd, run_dir, cpus=16, memory_gb=64)
+    queue.submit("run", "demux_0_L2", cmd, run_dir, cpus=16, memory_gb=64)
+    assert len(queue.schedule()) == 1
+    with open(os.path.join(tmp.name, "sbatch.log")) as f:
+        args = f.read()
+    assert "--cpus-per-task=16 --mem=65536M" in args
+    assert f"--output={run_dir}/demux_0_L1_bcl-convert.out" in args
+    assert "--account=ngi --wrap /opt/bcl-convert --bcl-only-lane 1" in args
+    assert queue.job("run", "demux_0_L1")["pid"] == 4242
+
+    # Not in the accounting yet, then running
+    with open(os.path.join(tmp.name, "sacct.out"), "w") as f:
+        f.write("")
+    assert queue.schedule() == []
+    with open(os.path.join(tmp.name, "sacct.out"), "w") as f:
+        f.write("RUNNING|0:0\n")
+    assert queue.schedule() == []
+    with open(os.path.join(tmp.name, "sacct.out"), "w") as f:
+        f.write("OUT_OF_MEMORY|0:125\n")
+    assert len(queue.schedule()) == 1
+    job = queue.job("run", "demux_0_L1")
+    assert (job["state"], job["exit_code"]) == ("failed", 0)
+    with open(os.path.join(tmp.name, "sacct.out"), "w") as f:
+        f.write("COMPLETED|0:0\n")
+    queue.schedule()
+    assert queue.job("run", "demux_0_L2")["state"] == "finished"
+    queue.close()
@@ -0,0 +1,74 @@
+import os
+
+from taca.utils import mirror
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_tree_files(create_dirs):
+    src = os.path.join(create_dirs.name, "run")
+    write(os.path.join(src, "report.html"), "report")
+    write(os.path.join(src, "reads.fastq.gz"), "reads")
+    write(os.path.join(src, "fastq_pass", "barcode01", "reads.txt"), "reads")
+    write(os.path.join(src, "other_reports", "pore_activity.csv"), "pores")
+    assert mirror.tree_files(
+        src,
+        "/mirror/run",
+        exclude_dirs=["fastq*"],
+        exclude_files=["*.fastq*"],
+    ) == [
+        (
+            os.path.join(src, "other_reports", "pore_activity.csv"),
+            "/mirror/run/other_reports/pore_activity.csv",
+        ),
+        (os.path.join(src, "report.html"), "/mirror/run/report.html"),
+    ]
+
+
+def test_mirror_files(create_dirs):
+    src = os.path.join(create_dirs.name, "run", "InterOp")
+    dest = os.path.join(create_dirs.name, "mfs", "run", "InterOp")
+    write(os.path.join(src, "TileMetricsOut.bin"), "tiles")
+    write(os.path.join(src, "C1.1", "ErrorMetricsOut.bin"), "errors")
+    pairs = mirror.tree_files(src, dest)
+
+    assert mirror.mirror_files(pairs) == mirror.MirrorStats(2, 0, 11, 0)
+    with open(os.path.join(dest, "C1.1", "ErrorMetricsOut.bin")) as f:
+        assert f.read() == "errors"
+    assert os.stat(os.path.join(dest, "TileMetricsOut.bin")).st_mtime_ns == (
+        os.stat(os.path.join(src, "TileMetricsOut.bin")).st_mtime_ns
+    )
+    assert mirror.mirror_files(pairs) == mirror.MirrorStats(0, 2, 0, 11)
+
+    write(os.path.join(src, "TileMetricsOut.bin"), "more tiles")
+    assert mirror.mirror_files(pairs) == mirror.MirrorStats(1, 1, 10, 6)
+    with open(os.path.join(dest, "TileMetricsOut.bin")) as f:
+        assert f.read() == "more tiles"
+    assert sorted(os.listdir(dest)) == ["C1.1", "TileMetricsOut.bin"]
+
+
+def test_mirror_manifest(create_dirs):
+    src = os.path.join(create_dirs.name, "run", "RunInfo.xml")
+    dest = os.path.join(create_dirs.name, "mfs", "RunInfo.xml")
+    manifest = os.path.join(create_dirs.name, "cache", "manifest.json")
+    write(src, "<RunInfo/>")
+    assert mirror.mirror_files([(src, dest)], manifest=manifest).copied == 1
+
+    # Rewritten with the same content
+    os.utime(src, ns=(0, 10**18))
+    assert mirror.mirror_files([(src, dest)], manifest=manifest).skipped == 1
+    assert os.stat(dest).st_mtime_ns == 10**18
+    # Without the manifest, only the size and time are compared
+    os.utime(src, ns=(0, 2 * 10**18))
+    assert mirror.mirror_files([(src, dest)]).copied == 1
+
+    write(src, "<RunInfo>")
+    os.utime(src, ns=(0, 3 * 10**18))
+    write(dest, "<RunInfo/")
+    assert mirror.mirror_files([(src, dest)], manifest=manifest).copied == 1
+    with open(dest) as f:
+        assert f.read() == "<RunInfo>"
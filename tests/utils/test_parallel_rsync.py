@@ -0,0 +1,84 @@
+import os
+import subprocess
+from unittest import mock
+
+import pytest
+
+from taca.utils import parallel_rsync
+
+LISTING = """\
+drwxr-xr-x           4096 2026/10/18 04:00:00 run
+-rw-r--r--           2000 2026/10/18 04:00:00 run/RunInfo.xml
+drwxr-xr-x           4096 2026/10/18 04:00:00 run/Demultiplexing
+-rw-r--r--      1,000,000 2026/10/18 04:00:00 run/Demultiplexing/A_R1.fastq.gz
+-rw-r--r--         600000 2026/10/18 04:00:00 run/Demultiplexing/B R1.fastq.gz
+-rw-r--r--         500000 2026/10/18 04:00:00 run/Demultiplexing/C_R1.fastq.gz
+"""
+
+
+def fake_rsync(returncodes):
+    """Stand-in of subprocess.run listing the files of LISTING, and running
+    the rsync of each shard with the given exit codes, in order."""
+    shards = []
+
+    def run(command, **kwargs):
+        if "--list-only" in command:
+            return subprocess.CompletedProcess(command, 0, stdout=LISTING)
+        files_from = [arg for arg in command if arg.startswith("--files-from=")][0]
+        with open(files_from.split("=", 1)[1]) as f:
+            shards.append(f.read().splitlines())
+        kwargs["stdout"].write(f"shard {len(shards)}\n")
+        return subprocess.CompletedProcess(command, returncodes[len(shards) - 1])
+
+    return run, shards
+
+
+def test_list_files():
+    run, _ = fake_rsync([])
+    with mock.patch("taca.utils.parallel_rsync.subprocess.run", side_effect=run):
+        assert parallel_rsync.list_files("/data/run", ["--include=*"]) == [
+            ("run/RunInfo.xml", 2000),
+            ("run/Demultiplexing/A_R1.fastq.gz", 1000000),
+            ("run/Demultiplexing/B R1.fastq.gz", 600000),
+            ("run/Demultiplexing/C_R1.fastq.gz", 500000),
+        ]
+
+
+def test_partition():
+    files = [("a", 100), ("b", 60), ("c", 50), ("d", 30), ("e", 10), ("f", 10)]
+    shards = parallel_rsync.partition(files, 2)
+    assert [sum(size for _, size in shard) for shard in shards] == [130, 130]
+    assert sorted(sum(shards, [])) == files
+    assert parallel_rsync.partition(files[:1], 3) == [[("a", 100)]]
+
+
+def test_transfer(create_dirs):
+    run, shards = fake_rsync([0, 0])
+    with mock.patch("taca.utils.parallel_rsync.subprocess.run", side_effect=run):
+        assert parallel_rsync.transfer(
+            "/data/run/", "host:/archive", ["-Lt"], [], 2, create_dirs.name
+        ) == (4, 2102000)
+    assert sorted(sum(shards, [])) == [
+        "run/Demultiplexing/A_R1.fastq.gz",
+        "run/Demultiplexing/B R1.fastq.gz",
+        "run/Demultiplexing/C_R1.fastq.gz",
+        "run/RunInfo.xml",
+    ]
+    with open(os.path.join(create_dirs.name, "rsync.out")) as f:
+        log = f.read()
+    assert log.count("Started command rsync -Lt --files-from=") == 2
+    assert "/data host:/archive on " in log
+    assert "shard 1\n" in log and "shard 2\n" in log
+
+
+def test_transfer_failed(create_dirs):
+    run, shards = fake_rsync([0, 23, 12])
+    with mock.patch("taca.utils.parallel_rsync.subprocess.run", side_effect=run):
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            parallel_rsync.transfer(
+                "/data/run", "host:/archive", [], [], 3, create_dirs.name
+            )
+    # Raised once all shards are done
+    assert len(shards) == 3
+    assert e.value.returncode in (23, 12)
+    assert "2 of 3 rsync streams failed" in str(e.value)
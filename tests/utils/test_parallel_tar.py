@@ -0,0 +1,142 @@
+import io
+import os
+import subprocess
+import tarfile
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from taca.utils import parallel_tar
+
+
+def create_tree(tmp: TemporaryDirectory) -> str:
+    """Create a run folder with small and large files and links.
+
+    run
+    ├── Data/Intensities/BaseCalls/L00[1-2]/s_[1-2]_11[01-20].filter
+    ├── Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl
+    ├── Data/Intensities/BaseCalls/L001/C1.1/L001_1.hardlink.cbcl
+    ├── Thumbnail_Images/L001/s_1_1101.jpg
+    ├── RunInfo.xml -> RunInfo.xml.orig
+    ├── RunInfo.xml.orig
+    └── SampleSheet.csv
+
+    Return its path.
+    """
+    run_path = os.path.join(tmp.name, "run")
+    for lane in [1, 2]:
+        lane_dir = os.path.join(
+            run_path, "Data", "Intensities", "BaseCalls", f"L00{lane}"
+        )
+        os.makedirs(lane_dir)
+        for tile in range(1101, 1121):
+            with open(os.path.join(lane_dir, f"s_{lane}_{tile}.filter"), "wb") as f:
+                f.write(os.urandom(tile % 7 * 100))
+    cycle_dir = os.path.join(
+        run_path, "Data", "Intensities", "BaseCalls", "L001", "C1.1"
+    )
+    os.makedirs(cycle_dir)
+    with open(os.path.join(cycle_dir, "L001_1.cbcl"), "wb") as f:
+        f.write(os.urandom(300 * 1024))
+    os.link(
+        os.path.join(cycle_dir, "L001_1.cbcl"),
+        os.path.join(cycle_dir, "L001_1.hardlink.cbcl"),
+    )
+    os.makedirs(os.path.join(run_path, "Thumbnail_Images", "L001"))
+    with open(
+        os.path.join(run_path, "Thumbnail_Images", "L001", "s_1_1101.jpg"), "wb"
+    ) as f:
+        f.write(os.urandom(1024))
+    with open(os.path.join(run_path, "RunInfo.xml.orig"), "w") as f:
+        f.write("<RunInfo />\n")
+    os.symlink("RunInfo.xml.orig", os.path.join(run_path, "RunInfo.xml"))
+    with open(os.path.join(run_path, "SampleSheet.csv"), "w") as f:
+        f.write("[Data]\n")
+    return run_path
+
+
+def test_same_archive_as_tarfile(create_dirs):
+    """The archive should be identical to adding the tree with tarfile."""
+    tmp = create_dirs
+    run_path = create_tree(tmp)
+    expected = io.BytesIO()
+    with tarfile.open(fileobj=expected, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        tar.add(run_path, arcname="run")
+
+    archive = os.path.join(tmp.name, "run.tar")
+    # The cbcl file is too large to be read ahead and is streamed instead
+    with parallel_tar.ReadAheadTarWriter(
+        name=archive, workers=4, read_ahead=3, read_ahead_size=64 * 1024
+    ) as writer:
+        writer.add_tree(run_path)
+
+    with open(archive, "rb") as f:
+        assert f.read() == expected.getvalue()
+    with tarfile.open(archive) as tar:
+        hardlink = tar.getmember(
+            "run/Data/Intensities/BaseCalls/L001/C1.1/L001_1.hardlink.cbcl"
+        )
+        assert hardlink.islnk()
+        assert tar.getmember("run/RunInfo.xml").issym()
+
+
+def test_exclude_like_gnu_tar(create_dirs):
+    """Excluded members should be the same as with GNU tar."""
+    tmp = create_dirs
+    run_path = create_tree(tmp)
+    exclude = ["*.csv", "Thumbnail_Images/L001", "s_2_*"]
+    gnu_tar = subprocess.run(
+        ["tar"]
+        + [option for pattern in exclude for option in ["--exclude", pattern]]
+        + ["-C", tmp.name, "-cf", "-", "run"],
+        check=True,
+        capture_output=True,
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(gnu_tar)) as tar:
+        expected = sorted(tar.getnames())
+
+    archive = os.path.join(tmp.name, "run.tar")
+    parallel_tar.write_tar(archive, run_path, exclude=exclude, workers=2)
+
+    with tarfile.open(archive) as tar:
+        assert sorted(tar.getnames()) == expected
+    assert "run/Thumbnail_Images" in expected
+    assert "run/Thumbnail_Images/L001" not in expected
+
+
+def test_tar_pipe(create_dirs):
+    """The pipe should yield the archive and report failures like tar."""
+    tmp = create_dirs
+    run_path = create_tree(tmp)
+    archive = os.path.join(tmp.name, "run.tar")
+    parallel_tar.write_tar(archive, run_path)
+
+    pipe = parallel_tar.TarPipe(run_path, "run", workers=2)
+    content = pipe.stdout.read()
+    assert pipe.wait() == 0
+    with open(archive, "rb") as f:
+        assert content == f.read()
+
+    with open(os.path.join(tmp.name, "tar.err"), "w+b") as stderr:
+        pipe = parallel_tar.TarPipe(os.path.join(tmp.name, "missing"), stderr=stderr)
+        pipe.stdout.read()
+        assert pipe.wait() == 2
+        stderr.seek(0)
+        assert b"missing" in stderr.read()
+
+
+@pytest.mark.parametrize(
+    "arcname, excluded",
+    [
+        ("run/SampleSheet.csv", True),
+        ("run/Data/SampleSheet.csv", True),
+        ("run/Thumbnail_Images/L001", True),
+        ("run/Thumbnail_Images/L0011", False),
+        ("run/Data/Intensities/BaseCalls/L001/s_1_1101.filter", False),
+    ],
+)
+def test_is_excluded(arcname, excluded):
+    assert (
+        parallel_tar.is_excluded(arcname, ["*.csv", "Thumbnail_Images/L001"])
+        == excluded
+    )
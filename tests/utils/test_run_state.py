@@ -0,0 +1,79 @@
+import os
+
+from taca.utils import run_state
+
+
+def test_record_and_history(create_dirs):
+    """States should be recorded with their transitions."""
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeq", "run")
+    os.mkdir(run_dir)
+
+    with run_state.RunStateStore(os.path.join(tmp.name, "run_state.db")) as store:
+        assert store.get(run_dir) is None
+        store.record(run_dir, "illumina", "sequencing")
+        store.record(run_dir, "illumina", "sequencing")
+        store.record(run_dir, "illumina", "in_progress")
+        run = store.get(run_dir)
+        assert run["state"] == "in_progress"
+        assert run["platform"] == "illumina"
+        assert not run["settled"]
+        assert [state for state, _ in store.history(run_dir)] == [
+            "sequencing",
+            "in_progress",
+        ]
+        assert [run["run_dir"] for run in store.runs("illumina")] == [run_dir]
+        assert store.runs("ont") == []
+
+
+def test_is_settled(create_dirs):
+    """Settled runs should only be skipped while their directory is unchanged."""
+    tmp = create_dirs
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "NovaSeq", "run")
+    os.mkdir(run_dir)
+
+    with run_state.RunStateStore(os.path.join(tmp.name, "run_state.db")) as store:
+        store.record(run_dir, "illumina", "completed")
+        assert not store.is_settled(run_dir)
+        store.record(run_dir, "illumina", "transferred", settled=True)
+        assert store.is_settled(run_dir)
+
+        # Touching a marker file changes the fingerprint of the run
+        stat = os.stat(run_dir)
+        open(os.path.join(run_dir, "transferring"), "w").close()
+        os.utime(run_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        assert not store.is_settled(run_dir)
+
+
+def test_persisted_and_cleared(create_dirs):
+    """States should survive reopening the store until they are cleared."""
+    tmp = create_dirs
+    db_path = os.path.join(tmp.name, "run_state.db")
+    run_dir = os.path.join(tmp.name, "ngi_data", "sequencing", "minion", "run")
+    os.mkdir(run_dir)
+
+    with run_state.RunStateStore(db_path) as store:
+        store.record(run_dir, "ont", "transferred", settled=True)
+    with run_state.load_store({"run_state_db": db_path}) as store:
+        assert store.is_settled(run_dir)
+        store.clear("ont")
+        assert store.get(run_dir) is None
+        # The history is kept, recording the same state again is not a transition
+        store.record(run_dir, "ont", "transferred", settled=True)
+        assert len(store.history(run_dir)) == 1
+        store.forget(run_dir)
+        assert store.history(run_dir) == []
+    assert run_state.load_store({}) is None
+
+
+def test_refresh_logs_errors(create_dirs, caplog):
+    """A state that can not be derived should be logged, not raised."""
+    tmp = create_dirs
+
+    def get_state():
+        raise OSError("transfer log missing")
+
+    with run_state.RunStateStore(os.path.join(tmp.name, "run_state.db")) as store:
+        store.refresh(tmp.name, "element", get_state)
+        assert store.get(tmp.name) is None
+    assert "transfer log missing" in caplog.text
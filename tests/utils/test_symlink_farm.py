@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from taca.utils import symlink_farm
+
+
+def touch(*parts):
+    os.makedirs(os.path.dirname(os.path.join(*parts)), exist_ok=True)
+    open(os.path.join(*parts), "w").close()
+
+
+def test_fastq_index(create_dirs):
+    root = os.path.join(create_dirs.name, "Demultiplexing_0")
+    touch(root, "Undetermined_S0_L001_R1_001.fastq.gz")
+    touch(root, "Undetermined_S0_L002_R1_001.fastq.gz")
+    touch(root, "P1", "Sample_A", "A_S1_L001_R2_001.fastq.gz")
+    touch(root, "P1", "Sample_A", "A_S1_L001_R1_001.fastq.gz")
+    touch(root, "P1", "Sample_A", "A_S1_L001_R1_001.fastq.gz.md5")
+    touch(root, "P1", "Sample_A", "SampleSheet.csv")
+    touch(root, "Reports", "html", "index.html")
+    index = symlink_farm.FastqIndex(root)
+
+    assert index.subdirs() == ["P1", "Reports"]
+    assert index.subdirs("P1") == ["Sample_A"]
+    assert [fastq.name for fastq in index.files(lane=2)] == [
+        "Undetermined_S0_L002_R1_001.fastq.gz"
+    ]
+    fastq = index.files("P1", "Sample_A", lane="1", read="R1")[0]
+    assert fastq == symlink_farm.FastqFile(
+        os.path.join(root, "P1", "Sample_A", "A_S1_L001_R1_001.fastq.gz"),
+        "A_S1_L001_R1_001.fastq.gz",
+        "P1",
+        "Sample_A",
+        "1",
+        "R1",
+    )
+    assert len(index) == 5
+    assert len(symlink_farm.FastqIndex(root, depth=0)) == 2
+
+
+def test_link_plan(create_dirs):
+    dest = os.path.join(create_dirs.name, "Demultiplexing")
+    plan = symlink_farm.LinkPlan(dest)
+    plan.add("/data/A_R1.fastq.gz", os.path.join(dest, "P1", "A", "A_R1.fastq.gz"))
+    plan.add("/data/A_R1.fastq.gz", os.path.join(dest, "P1", "A", "A_R1.fastq.gz"))
+    plan.add_dir(os.path.join(dest, "P1", "B"))
+    with pytest.raises(FileExistsError):
+        plan.add("/data/B_R1.fastq.gz", os.path.join(dest, "P1", "A", "A_R1.fastq.gz"))
+
+    listing = symlink_farm.format_actions(plan.apply(dry_run=True), dest)
+    assert listing.splitlines() == [
+        "mkdir  P1",
+        "mkdir  P1/A",
+        "mkdir  P1/B",
+        "link   P1/A/A_R1.fastq.gz -> /data/A_R1.fastq.gz",
+        "0 remove, 3 mkdir, 1 link, 0 relink, 0 keep",
+    ]
+    assert not os.path.exists(dest)
+    plan.apply()
+    assert os.readlink(os.path.join(dest, "P1", "A", "A_R1.fastq.gz")) == (
+        "/data/A_R1.fastq.gz"
+    )
+    assert os.path.isdir(os.path.join(dest, "P1", "B"))
+    assert symlink_farm.count_actions(plan.apply())["keep"] == 1
+
+
+def test_link_plan_changes(create_dirs):
+    dest = os.path.join(create_dirs.name, "Demultiplexing")
+    touch(dest, "P1", "A", "A_R2.fastq.gz")
+    touch(dest, "IndexAssignment.csv")
+    os.symlink("/data/old.fastq.gz", os.path.join(dest, "P1", "A", "A_R1.fastq.gz"))
+    plan = symlink_farm.LinkPlan(dest)
+    plan.add("/data/A_R1.fastq.gz", os.path.join(dest, "P1", "A", "A_R1.fastq.gz"))
+    plan.add("/data/A_R2.fastq.gz", os.path.join(dest, "P1", "A", "A_R2.fastq.gz"))
+
+    # Files in the way are only removed when pruning
+    with pytest.raises(FileExistsError):
+        plan.apply()
+    assert plan.apply(prune=True) == [
+        ("remove", os.path.join(dest, "IndexAssignment.csv"), None),
+        ("remove", os.path.join(dest, "P1", "A", "A_R2.fastq.gz"), None),
+        (
+            "relink",
+            os.path.join(dest, "P1", "A", "A_R1.fastq.gz"),
+            "/data/A_R1.fastq.gz",
+        ),
+        ("link", os.path.join(dest, "P1", "A", "A_R2.fastq.gz"), "/data/A_R2.fastq.gz"),
+    ]
+    assert sorted(os.listdir(dest)) == ["P1"]
+    assert os.readlink(os.path.join(dest, "P1", "A", "A_R1.fastq.gz")) == (
+        "/data/A_R1.fastq.gz"
+    )
+    assert os.path.islink(os.path.join(dest, "P1", "A", "A_R2.fastq.gz"))
@@ -0,0 +1,125 @@
+import os
+
+from taca.utils import transfer_ledger
+
+
+def test_lookup_is_exact(create_dirs):
+    """Runs should only match their own name, not names they are a prefix of."""
+    tmp = create_dirs
+    transfer_log = os.path.join(tmp.name, "log", "transfer.tsv")
+    with open(transfer_log, "w") as f:
+        f.write("20240101_LH00217_0001_A22ABCDLT3_2\t2024-01-02 10:00:00\n")
+
+    ledger = transfer_ledger.TransferLedger(transfer_log)
+    assert "20240101_LH00217_0001_A22ABCDLT3_2" in ledger
+    assert "20240101_LH00217_0001_A22ABCDLT3" not in ledger
+    assert "LH00217" not in ledger
+
+
+def test_lookup_without_index(create_dirs):
+    """Runs should be looked up in the log itself if its index can not be opened."""
+    tmp = create_dirs
+    transfer_log = os.path.join(tmp.name, "log", "transfer.tsv")
+    with open(transfer_log, "w") as f:
+        f.write("20240101_LH00217_0001_A22ABCDLT3\t2024-01-02 10:00:00\n")
+    # As sqlite fails to open an index in a read-only folder
+    os.mkdir(f"{transfer_log}.index.db")
+
+    ledger = transfer_ledger.TransferLedger(transfer_log)
+    assert "20240101_LH00217_0001_A22ABCDLT3" in ledger
+    assert "20240101_LH00217_0002_A22ABCDLT3" not in ledger
+
+
+def test_add_and_pick_up_appended_rows(create_dirs):
+    """Added runs and rows appended by other means should both be found."""
+    tmp = create_dirs
+    transfer_log = os.path.join(tmp.name, "log", "transfer_new.tsv")
+
+    ledger = transfer_ledger.TransferLedger(transfer_log)
+    assert "run_1" not in ledger
+    ledger.add("run_1", "2024-01-01 00:00:00")
+    assert "run_1" in ledger
+    with open(transfer_log) as f:
+        assert f.read().splitlines() == ["run_1\t2024-01-01 00:00:00"]
+
+    # Another process appends a row, the last one is still being written
+    with open(transfer_log, "a") as f:
+        f.write("run_2\t2024-01-02 00:00:00\nrun_3\t2024-01")
+    assert "run_2" in ledger
+    assert "run_3" not in ledger
+    with open(transfer_log, "a") as f:
+        f.write("-03 00:00:00\n")
+    assert ledger.transferred("run_3") == "2024-01-03 00:00:00"
+
+    # A second ledger shares the index
+    other = transfer_ledger.TransferLedger(transfer_log)
+    assert len(other) == 3
+    other.close()
+
+
+def test_replaced_log_is_reindexed(create_dirs):
+    """Rewriting the log, e.g. removing a run by hand, should rebuild the index."""
+    tmp = create_dirs
+    transfer_log = os.path.join(tmp.name, "log", "transfer.tsv")
+    ledger = transfer_ledger.TransferLedger(transfer_log)
+    ledger.add("run_1")
+    ledger.add("run_2")
+
+    with open(f"{transfer_log}.new", "w") as f:
+        f.write("run_2\t2024-01-02 00:00:00\n")
+    os.replace(f"{transfer_log}.new", transfer_log)
+    assert "run_1" not in ledger
+    assert "run_2" in ledger
+
+    os.remove(transfer_log)
+    assert "run_2" not in ledger
+
+
+def test_import_and_export(create_dirs):
+    """Exporting should give back the imported log."""
+    tmp = create_dirs
+    transfer_log = os.path.join(tmp.name, "log", "transfer_minion.tsv")
+    rows = [f"run_{i}\t2024-01-{i:02} 00:00:00" for i in range(1, 21)]
+    with open(transfer_log, "w") as f:
+        f.write("\n".join(rows + [rows[0]]) + "\n")
+
+    ledger = transfer_ledger.get_ledger(transfer_log)
+    assert ledger is transfer_ledger.get_ledger(transfer_log)
+    assert ledger.rebuild() == 20
+    exported = os.path.join(tmp.name, "exported.tsv")
+    assert ledger.export_tsv(exported) == 20
+    with open(exported) as f:
+        assert f.read().splitlines() == rows
+
+
+def test_configured_transfer_logs(create_dirs):
+    tmp = create_dirs
+    config = {
+        "analysis": {"status_dir": f"{tmp.name}/log"},
+        "element_analysis": {
+            "Element": {"Aviti": {"transfer_log": f"{tmp.name}/log/transfer_aviti.tsv"}}
+        },
+        "nanopore_analysis": {
+            "run_types": {
+                "user_run": {
+                    "instruments": {
+                        "minion": {
+                            "transfer_log": f"{tmp.name}/log/transfer_minion.tsv"
+                        }
+                    }
+                },
+                "qc_run": {
+                    "instruments": {
+                        "minion": {
+                            "transfer_log": f"{tmp.name}/log/transfer_minion.tsv"
+                        }
+                    }
+                },
+            }
+        },
+    }
+    assert transfer_ledger.configured_transfer_logs(config) == [
+        f"{tmp.name}/log/transfer.tsv",
+        f"{tmp.name}/log/transfer_aviti.tsv",
+        f"{tmp.name}/log/transfer_minion.tsv",
+    ]
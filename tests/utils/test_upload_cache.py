@@ -0,0 +1,147 @@
+import os
+
+import couchdb
+
+from taca.utils import statusdb, upload_cache
+
+
+class FakeDb:
+    """Database of documents by id, counting the requests it served."""
+
+    def __init__(self):
+        self.docs = dict()
+        self.requests = []
+
+    def get(self, doc_id):
+        self.requests.append("get")
+        doc = self.docs.get(doc_id)
+        return dict(doc) if doc is not None else None
+
+    def save(self, doc):
+        self.requests.append("save")
+        doc_id = doc.setdefault("_id", f"id{len(self.docs)}")
+        if doc_id in self.docs and self.docs[doc_id]["_rev"] != doc.get("_rev"):
+            raise couchdb.http.ResourceConflict(
+                ("conflict", "Document update conflict.")
+            )
+        doc["_rev"] = str(int(self.docs.get(doc_id, {}).get("_rev", "0")) + 1)
+        self.docs[doc_id] = dict(doc)
+        return doc_id, doc["_rev"]
+
+
+def full_upload(obj):
+    """Upload a whole document, as update_doc, to a fake database."""
+
+    def upload(db):
+        for doc_id, doc in db.docs.items():
+            if doc["name"] == obj["name"]:
+                db.save(dict(obj, _id=doc_id, _rev=doc["_rev"]))
+                return "updated", doc_id
+        return "created", db.save(dict(obj))[0]
+
+    return upload
+
+
+def run_doc(reads):
+    return {
+        "name": "20261018_LH00001_0042_AHFLOWCELL",
+        "RunInfo": {"Id": "20261018_LH00001_0042_AHFLOWCELL", "Reads": [151, 151]},
+        "illumina": {"Demultiplex_Stats": {"Lanes_stats": [{"PF Clusters": reads}]}},
+    }
+
+
+def test_doc_hash():
+    assert upload_cache.doc_hash({"a": 1, "b": {"c": [1, 2]}}) == (
+        upload_cache.doc_hash({"b": {"c": [1, 2]}, "a": 1})
+    )
+    assert upload_cache.doc_hash({"a": 1}) != upload_cache.doc_hash({"a": 2})
+
+
+def test_diff_and_patch():
+    old = {"a": 1, "b": {"c": 2, "d": 3}, "e": [1], "f": "gone"}
+    new = {"a": 1, "b": {"c": 4, "d": 3, "g": {"h": 5}}, "e": [1, 2]}
+    changes = upload_cache.diff_docs(old, new)
+    assert sorted(changes) == [
+        ("set", ("b", "c"), 4),
+        ("set", ("b", "g"), {"h": 5}),
+        ("set", ("e",), [1, 2]),
+        ("unset", ("f",)),
+    ]
+    # Values set by others are kept
+    remote = dict(old, pdc_archived="2026-10-18")
+    assert upload_cache.apply_patch(remote, changes) == dict(
+        new, pdc_archived="2026-10-18"
+    )
+
+
+def test_upload(create_dirs):
+    """Unchanged documents should not be sent, changed ones as patches."""
+    db = FakeDb()
+    db_path = os.path.join(create_dirs.name, "uploads.db")
+    with upload_cache.load_upload_cache({"upload_cache_db": db_path}) as cache:
+        obj = run_doc("1,000")
+        assert cache.upload(obj, lambda: db, full_upload(obj)) == "created"
+        assert cache.upload(obj, lambda: db, full_upload(obj)) == "skipped"
+        assert db.requests == ["save"]
+
+        db.docs["id0"]["pdc_archived"] = "2026-10-18"
+        obj = run_doc("2,000")
+        assert cache.upload(obj, lambda: db, full_upload(obj)) == "patched"
+        assert db.requests == ["save", "get", "save"]
+        assert db.docs["id0"]["illumina"] == obj["illumina"]
+        assert db.docs["id0"]["pdc_archived"] == "2026-10-18"
+        assert db.docs["id0"]["_rev"] == "2"
+
+        # Documents which can not be patched are uploaded whole
+        del db.docs["id0"]
+        obj = run_doc("3,000")
+        assert cache.upload(obj, lambda: db, full_upload(obj)) == "created"
+        assert cache.get(obj["name"])["doc_id"] == "id0"
+        assert cache.counts() == {
+            "skipped": 1,
+            "patched": 1,
+            "created": 2,
+            "updated": 0,
+            "unchanged": 0,
+        }
+    # The cache outlives the process
+    with upload_cache.UploadCache(db_path) as cache:
+        assert cache.upload(obj, lambda: None, None) == "skipped"
+    assert upload_cache.load_upload_cache({}) is None
+
+
+def test_upload_conflict(create_dirs):
+    db = FakeDb()
+    with upload_cache.UploadCache(
+        os.path.join(create_dirs.name, "uploads.db")
+    ) as cache:
+        obj = run_doc("1,000")
+        cache.upload(obj, lambda: db, full_upload(obj))
+
+        # Updated in between, the patch conflicts
+        real_get = db.get
+        db.get = lambda doc_id: dict(real_get(doc_id), _rev="0")
+        obj = run_doc("2,000")
+        assert cache.upload(obj, lambda: db, full_upload(obj)) == "updated"
+        assert db.docs["id0"]["illumina"] == obj["illumina"]
+
+
+class FakeView:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getitem__(self, name):
+        return self
+
+
+class Row:
+    def __init__(self, value):
+        self.value = value
+
+
+def test_update_doc_returns_action():
+    db = FakeDb()
+    db.view = lambda name: FakeView([])
+    assert statusdb.update_doc(db, {"name": "run"}) == ("created", "id0")
+    db.view = lambda name: FakeView([Row({"_id": "id0", "_rev": "1", "name": "run"})])
+    assert statusdb.update_doc(db, {"name": "run"}) == ("unchanged", "id0")